@@ -5,6 +5,7 @@
 # -----------------------------------------------------------------------------
 
 import logging
+import multiprocessing
 import signal
 import sys
 
@@ -19,6 +20,9 @@ def excepthook(exctype, value, tb):
 
 
 def main():
+    # Let frozen builds run worker processes (see graph.packscan)
+    multiprocessing.freeze_support()
+
     logging.basicConfig(
         stream=sys.stdout,
         level=logging.DEBUG,
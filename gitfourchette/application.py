@@ -99,6 +99,7 @@ class GFApplication(QApplication):
 
         from gitfourchette.globalshortcuts import GlobalShortcuts
         from gitfourchette.tasks import TaskBook, TaskInvoker, RepoTaskRunner
+        from gitfourchette.repowatcher import RepoWatcher
         from gitfourchette import settings
 
         # Set up global flags from command line
@@ -109,6 +110,7 @@ class GFApplication(QApplication):
         if parser.isSet("test-mode"):
             settings.TEST_MODE = True
             RepoTaskRunner.ForceSerial = True
+            RepoWatcher.Disabled = True
             self.setApplicationName(APP_SYSTEM_NAME + "_TESTMODE")
 
         # Prepare session-wide temporary directory
@@ -0,0 +1,41 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+from gitfourchette.porcelain import *
+from gitfourchette.toolbox import SizeBoundedLRU
+
+
+class CommitDiffCache(SizeBoundedLRU[tuple[Oid, int], tuple[list[Diff], bool]]):
+    """
+    Remembers the diffs of recently viewed commits (as returned by
+    Repo.commit_diffs), so that going back to a commit doesn't diff its trees
+    and look for renames all over again. Commits never change, so entries
+    remain valid until they're evicted.
+
+    An entry may have been made without rename detection, to load a large
+    commit quickly. Such an entry is replaced once rename detection is done.
+    """
+
+    MaxSize = 100_000
+    "Approximate memory budget, in number of files across all cached diffs."
+
+    def sizeOf(self, value: tuple[list[Diff], bool]) -> int:
+        diffs, _skippedRenameDetection = value
+        return sum(len(diff) for diff in diffs)
+
+    def get(self, oid: Oid, contextLines: int, needRenames: bool = False) -> tuple[list[Diff], bool] | None:
+        """
+        Return the diffs of a commit and whether rename detection was skipped,
+        or None if they aren't cached. If needRenames is True, only return
+        diffs in which renames have been detected.
+        """
+        accept = (lambda value: not value[1]) if needRenames else None
+        return super().get((oid, contextLines), accept)
+
+    def put(self, oid: Oid, contextLines: int, diffs: list[Diff], skippedRenameDetection: bool):
+        # Don't downgrade an entry in which renames have been detected
+        replace = (lambda previous: previous[1]) if skippedRenameDetection else None
+        super().put((oid, contextLines), (diffs, skippedRenameDetection), replace)
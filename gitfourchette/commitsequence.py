@@ -0,0 +1,337 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+Compact, columnar storage for the commit log.
+
+Keeping one live pygit2 Commit per row costs several kilobytes per commit,
+which adds up to gigabytes in very large repositories. CommitSequence keeps
+only what the graph needs (oids and parent oids, packed into flat buffers),
+plus a few interned columns for the commit log. Actual Commit objects are
+read from the object database on demand and kept in a small LRU cache.
+"""
+
+from __future__ import annotations
+
+import itertools
+import threading
+from array import array
+from collections.abc import Iterable
+
+from gitfourchette.graph import MockCommit
+from gitfourchette.porcelain import *
+
+
+class LazyCommit:
+    """
+    Stand-in for a row of a CommitSequence.
+
+    The commit's id and parent ids are known upfront, which is all the graph
+    needs. Accessing any other attribute looks up the actual Commit on demand.
+    """
+
+    __slots__ = ("id", "parent_ids", "_sequence", "_row", "_commit")
+
+    def __init__(self, sequence: CommitSequence, row: int, oid: Oid, parentIds: list[Oid]):
+        self.id = oid
+        self.parent_ids = parentIds
+        self._sequence = sequence
+        self._row = row
+        self._commit = None
+
+    def __getattr__(self, name):
+        commit = self._commit
+        if commit is None:
+            commit = self._sequence.commitAt(self._row)
+            self._commit = commit
+        return getattr(commit, name)
+
+    def __eq__(self, other):
+        # Compare equal to the actual Commit, like pygit2 Objects do
+        try:
+            return self.id == other.id
+        except AttributeError:
+            return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"LazyCommit({self.id})"
+
+
+class CommitSequence:
+    """
+    Ordered list of commits in graph row order, stored as flat arrays.
+
+    - `oids`: raw ids, back to back (one per row), `oidLength` bytes each
+      (20 for SHA-1, 32 for SHA-256);
+    - `parentStart`/`parentOids`: each row's raw parent ids live in
+      `parentOids[oidLength*parentStart[row] : oidLength*parentStart[row+1]]`;
+    - `authorTimes`/`authorNames`: author timestamp and interned author name
+      of each row, or -1 if the commit hasn't been read yet.
+
+    Rows that aren't real commits (i.e. the Uncommitted Changes row) are kept
+    as MockCommits in `mocks`.
+
+    Indexing a row returns a LazyCommit; slicing or concatenating returns a new
+    CommitSequence that shares the name table and Commit cache of the original.
+    A CommitSequence is append-only: rows never move once added.
+
+    A background thread may append rows while the UI thread reads the log
+    columns (which fills them in lazily). `lock` guards the name table and
+    the lazily filled columns.
+    """
+
+    CommitCacheSize = 500
+    "Number of materialized Commit objects to keep around (enough to cover the visible rows)."
+
+    repo: Repo | None
+    oidLength: int
+    oids: bytearray
+    parentStart: array
+    parentOids: bytearray
+    authorTimes: array
+    authorNames: array
+    mocks: dict[int, MockCommit]
+
+    names: list[str]
+    "Interned author names, shared by all sequences derived from this one."
+
+    lock: threading.Lock
+    "Guards the name table and the log columns. Shared by all sequences derived from this one."
+
+    def __init__(self, repo: Repo | None = None, oidLength: int = 0):
+        self.repo = repo
+        if not oidLength:
+            oidLength = repo.oid_length if repo is not None else 20
+        self.oidLength = oidLength
+        self.oids = bytearray()
+        self.parentStart = array("i", [0])
+        self.parentOids = bytearray()
+        self.authorTimes = array("q")
+        self.authorNames = array("i")
+        self.mocks = {}
+        self.names = []
+        self._nameIds: dict[str, int] = {}
+        self._commitCache: dict[Oid, Commit] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromCommits(cls, repo: Repo | None, commits: Iterable) -> CommitSequence:
+        sequence = cls(repo)
+        sequence.extend(commits)
+        return sequence
+
+    def _spawn(self, commits: Iterable = ()) -> CommitSequence:
+        """ Create a sequence that shares our name table and Commit cache. """
+        sequence = CommitSequence(self.repo, self.oidLength)
+        sequence.names = self.names
+        sequence._nameIds = self._nameIds
+        sequence._commitCache = self._commitCache
+        sequence.lock = self.lock
+        sequence.extend(commits)
+        return sequence
+
+    # -------------------------------------------------------------------------
+    # Building
+
+    def internName(self, name: str) -> int:
+        """ Return the id of an author name in the name table. Call with `lock` held. """
+        try:
+            return self._nameIds[name]
+        except KeyError:
+            i = len(self.names)
+            self.names.append(name)
+            self._nameIds[name] = i
+            return i
+
+    def append(self, commit):
+        oid = commit.id
+        parentIds = commit.parent_ids
+        row = len(self.authorTimes)
+
+        h = self.oidLength
+        if type(oid) is not Oid:
+            self.mocks[row] = commit
+            self.oids += bytes(h)
+        else:
+            raw = oid.raw
+            assert len(raw) == h, f"expected {h}-byte oids, got {len(raw)}"
+            self.oids += raw
+            for parent in parentIds:
+                self.parentOids += parent.raw
+
+        self.parentStart.append(len(self.parentOids) // h)
+
+        # Full Commits (from a Walker) give us the log columns for free
+        if type(commit) is Commit:
+            author = commit.author
+            with self.lock:
+                self.authorTimes.append(author.time)
+                self.authorNames.append(self.internName(author.name))
+        else:
+            with self.lock:
+                self.authorTimes.append(-1)
+                self.authorNames.append(-1)
+
+    def extend(self, commits: Iterable):
+        for commit in commits:
+            self.append(commit)
+
+    # -------------------------------------------------------------------------
+    # Row access
+
+    def __len__(self):
+        return len(self.authorTimes)
+
+    def _checkRow(self, row: int) -> int:
+        n = len(self.authorTimes)
+        if row < 0:
+            row += n
+        if not (0 <= row < n):
+            raise IndexError("CommitSequence index out of range")
+        return row
+
+    def oidAt(self, row: int) -> Oid | str:
+        row = self._checkRow(row)
+        try:
+            return self.mocks[row].id
+        except KeyError:
+            pass
+        h = self.oidLength
+        start = row * h
+        return Oid(bytes(self.oids[start: start + h]))
+
+    def parentIdsAt(self, row: int) -> list[Oid]:
+        row = self._checkRow(row)
+        try:
+            return list(self.mocks[row].parent_ids)
+        except KeyError:
+            pass
+        parentOids = self.parentOids
+        h = self.oidLength
+        return [Oid(bytes(parentOids[p * h: (p + 1) * h]))
+                for p in range(self.parentStart[row], self.parentStart[row + 1])]
+
+    def isMock(self, row: int) -> bool:
+        return self._checkRow(row) in self.mocks
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("CommitSequence doesn't support extended slices")
+            return self._slice(start, max(start, stop))
+
+        row = self._checkRow(key)
+        try:
+            return self.mocks[row]
+        except KeyError:
+            return LazyCommit(self, row, self.oidAt(row), self.parentIdsAt(row))
+
+    def __iter__(self):
+        # Hot path (graph splicing, graph cache): avoid per-row bounds checks
+        oids = bytes(self.oids)
+        parentOids = bytes(self.parentOids)
+        parentStart = self.parentStart
+        mocks = self.mocks
+        h = self.oidLength
+
+        p1 = 0
+        for row, p2 in enumerate(itertools.islice(parentStart, 1, None)):
+            if row in mocks:
+                yield mocks[row]
+            else:
+                o = row * h
+                parentIds = [Oid(parentOids[p * h: (p + 1) * h]) for p in range(p1, p2)]
+                yield LazyCommit(self, row, Oid(oids[o: o + h]), parentIds)
+            p1 = p2
+
+    def commitAt(self, row: int) -> Commit:
+        """
+        Return the actual Commit at the given row, reading it from the object
+        database if needed. Also fills in the log columns for this row.
+        """
+        row = self._checkRow(row)
+        if row in self.mocks:
+            raise TypeError(f"row {row} isn't a real commit")
+
+        oid = self.oidAt(row)
+        cache = self._commitCache
+
+        try:
+            commit = cache.pop(oid)
+        except KeyError:
+            commit = self.repo[oid]
+            if len(cache) >= self.CommitCacheSize:
+                del cache[next(iter(cache))]
+        cache[oid] = commit  # (re)insert at most-recently-used end
+
+        if self.authorTimes[row] == -1:
+            author = commit.author
+            with self.lock:
+                self.authorTimes[row] = author.time
+                self.authorNames[row] = self.internName(author.name)
+
+        return commit
+
+    def authorTimeAt(self, row: int) -> int:
+        row = self._checkRow(row)
+        if self.authorTimes[row] == -1:
+            self.commitAt(row)
+        return self.authorTimes[row]
+
+    def authorNameAt(self, row: int) -> str:
+        row = self._checkRow(row)
+        if self.authorNames[row] == -1:
+            self.commitAt(row)
+        with self.lock:
+            return self.names[self.authorNames[row]]
+
+    # -------------------------------------------------------------------------
+    # Slicing & concatenation
+
+    def _slice(self, start: int, stop: int) -> CommitSequence:
+        sequence = self._spawn()
+        p1 = self.parentStart[start]
+        p2 = self.parentStart[stop]
+        h = self.oidLength
+        sequence.oids = self.oids[start * h: stop * h]
+        sequence.parentOids = self.parentOids[p1 * h: p2 * h]
+        sequence.parentStart = array("i", map((-p1).__add__, self.parentStart[start: stop + 1]))
+        with self.lock:
+            sequence.authorTimes = self.authorTimes[start:stop]
+            sequence.authorNames = self.authorNames[start:stop]
+        sequence.mocks = {row - start: mock for row, mock in self.mocks.items() if start <= row < stop}
+        return sequence
+
+    def __add__(self, other):
+        if not isinstance(other, CommitSequence):
+            other = self._spawn(other)
+        assert other.oidLength == self.oidLength, "can't mix oid lengths"
+
+        sequence = self._spawn()
+        sequence.oids = self.oids + other.oids
+        sequence.parentOids = self.parentOids + other.parentOids
+        sequence.parentStart = self.parentStart + array("i", map(self.parentStart[-1].__add__, other.parentStart[1:]))
+        with self.lock:
+            sequence.authorTimes = self.authorTimes + other.authorTimes
+            if other.names is self.names:
+                sequence.authorNames = self.authorNames + other.authorNames
+            else:
+                sequence.authorNames = self.authorNames + array(
+                    "i", (-1 if i < 0 else self.internName(other.names[i]) for i in other.authorNames))
+
+        offset = len(self)
+        sequence.mocks = dict(self.mocks)
+        sequence.mocks.update((row + offset, mock) for row, mock in other.mocks.items())
+        return sequence
+
+    def __radd__(self, other):
+        # e.g. list of fresh commits + CommitSequence (see GraphSpliceLoop)
+        return self._spawn(other) + self
+
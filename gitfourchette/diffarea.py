@@ -10,6 +10,7 @@ from typing import Literal
 
 from gitfourchette.diffview.diffview import DiffView
 from gitfourchette.diffview.specialdiffview import SpecialDiffView
+from gitfourchette.diffview.virtualdiffview import VirtualDiffView
 from gitfourchette.filelists.committedfiles import CommittedFiles
 from gitfourchette.filelists.dirtyfiles import DirtyFiles
 from gitfourchette.filelists.filelist import FileList
@@ -25,7 +26,7 @@ from gitfourchette.tasks import TaskBook, AmendCommit, NewCommit, NewStash
 from gitfourchette.toolbox import *
 
 FileStackPage = Literal["workdir", "commit"]
-DiffStackPage = Literal["text", "special", "conflict"]
+DiffStackPage = Literal["text", "special", "conflict", "virtual"]
 
 FILEHEADER_HEIGHT = 24
 
@@ -280,11 +281,22 @@ class DiffArea(QWidget):
         conflictScroll.setWidget(conflict)
         conflictScroll.setWidgetResizable(True)
 
+        virtualDiff = VirtualDiffView()
+
+        virtualDiffContainer = QWidget()
+        virtualDiffContainerLayout = QVBoxLayout(virtualDiffContainer)
+        virtualDiffContainerLayout.setSpacing(0)
+        virtualDiffContainerLayout.setContentsMargins(0, 0, 0, 0)
+        virtualDiffContainerLayout.addWidget(virtualDiff.searchBar)
+        virtualDiffContainerLayout.addWidget(virtualDiff)
+        virtualDiffContainerLayout.addWidget(virtualDiff.progressBar)
+
         stack = QStackedWidget()
         # Add widgets in same order as DiffStackPage
         stack.addWidget(diffViewContainer)
         stack.addWidget(specialDiff)
         stack.addWidget(conflictScroll)
+        stack.addWidget(virtualDiffContainer)
         stack.setCurrentIndex(0)
 
         stackContainer = QWidget()
@@ -299,6 +311,7 @@ class DiffArea(QWidget):
         self.conflictView = conflict
         self.specialDiffView = specialDiff
         self.diffView = diff
+        self.virtualDiffView = virtualDiff
 
         return stackContainer
 
@@ -464,6 +477,7 @@ class DiffArea(QWidget):
 
         # Might as well free up any memory taken by DiffView document
         self.diffView.clear()
+        self.virtualDiffView.clear()
 
         self.diffHeader.setText(" ")
 
@@ -4,13 +4,18 @@
 # For full terms, see the included LICENSE file.
 # -----------------------------------------------------------------------------
 
-import difflib
+import dataclasses
+import logging
+import os
+import sys
+from collections import deque
 from collections.abc import Generator
 from dataclasses import dataclass
 
 from gitfourchette import colors
 from gitfourchette import settings
-from gitfourchette.diffview.specialdiff import SpecialDiffError
+from gitfourchette.diffview.intraline import MatchingBlocks, matchingBlocks
+from gitfourchette.diffview.specialdiff import ShouldDisplayPatchAsVirtualDiff, SpecialDiffError
 from gitfourchette.localization import *
 from gitfourchette.nav import NavLocator, NavFlags
 from gitfourchette.porcelain import *
@@ -18,10 +23,18 @@ from gitfourchette.qt import *
 from gitfourchette.subpatch import DiffLinePos
 from gitfourchette.toolbox import *
 
+logger = logging.getLogger(__name__)
+
 MAX_LINE_LENGTH = 10_000
 
+INTRALINE_WORK_BUDGET = 3_000_000
+"""
+Work (see intraline.matchingBlocks) that fromPatch may spend looking for intra-line
+differences before giving up on the rest of the lines. Roughly 0.3 s on a typical machine.
+"""
 
-@dataclass
+
+@dataclass(slots=True)
 class LineData:
     text: str
     "Line text for visual representation."
@@ -29,8 +42,14 @@ class LineData:
     hunkPos: DiffLinePos
     "Which hunk this line pertains to, and its position in the hunk."
 
-    diffLine: DiffLine | None = None
-    "pygit2 diff line data."
+    origin: str = "@"
+    "Origin of the line as in pygit2's DiffLine ('+', '-' or ' '), or '@' for hunk headers."
+
+    oldLineNo: int = -1
+    "Line number in the old file, or -1 (like DiffLine.old_lineno)."
+
+    newLineNo: int = -1
+    "Line number in the new file, or -1 (like DiffLine.new_lineno)."
 
     cursorStart: int = -1
     "Cursor position at start of line in QDocument."
@@ -96,14 +115,32 @@ class DiffStyle:
 
 @dataclass
 class DiffDocument:
-    document: QTextDocument
     lineData: list[LineData]
-    style: DiffStyle
     pluses: int
     minuses: int
 
+    text: str
+    "Plain text of the entire document."
+
+    warningSpans: list[tuple[int, int]]
+    "Start/end positions of line ending warnings."
+
+    emphasisSpans: list[tuple[int, int, str]]
+    "Start/end positions of intra-line differences, and origin of the line ('+' or '-')."
+
+    document: QTextDocument | None = None
+    "Rich text document, created on the UI thread by assemble()."
+
+    style: DiffStyle | None = None
+
     @staticmethod
     def fromPatch(patch: Patch, locator: NavLocator):
+        """
+        Lay out the contents of a patch. This doesn't create any Qt objects,
+        so it can run on a worker thread. Call assemble() on the UI thread to
+        create the actual QTextDocument.
+        """
+
         if patch.delta.similarity == 100:
             raise SpecialDiffError.noChange(patch.delta)
 
@@ -121,14 +158,14 @@ class DiffDocument:
         if patch.delta.status == DeltaStatus.TYPECHANGE:
             raise SpecialDiffError.typeChange(patch.delta)
 
-        # Don't load large diffs.
-        threshold = settings.prefs.largeFileThresholdKB * 1024
-        if threshold != 0 and len(patch.data) > threshold and not locator.hasFlags(NavFlags.AllowLargeFiles):
-            raise SpecialDiffError.diffTooLarge(len(patch.data), threshold, locator)
-
         if len(patch.hunks) == 0:
             raise SpecialDiffError.noChange(patch.delta)
 
+        # Large diffs go to VirtualDiffView.
+        threshold = settings.prefs.largeFileThresholdKB * 1024
+        if threshold != 0 and len(patch.data) > threshold and not locator.hasFlags(NavFlags.AllowLargeFiles):
+            raise ShouldDisplayPatchAsVirtualDiff()
+
         lineData = []
 
         clumpID = 0
@@ -170,15 +207,12 @@ class DiffDocument:
                 if origin in "=><":
                     continue
 
+                # QTextDocument chokes on very long lines, so leave them to VirtualDiffView.
                 if len(content) > MAX_LINE_LENGTH and not locator.hasFlags(NavFlags.AllowLongLines):
-                    loadAnywayLoc = locator.withExtraFlags(NavFlags.AllowLongLines)
-                    loadAnywayText = _("[Load diff anyway] (this may take a moment)")
-                    raise SpecialDiffError(
-                        _("This file contains very long lines."),
-                        linkify(loadAnywayText, loadAnywayLoc.url()),
-                        "SP_MessageBoxWarning")
+                    raise ShouldDisplayPatchAsVirtualDiff()
 
-                ld = LineData(text=content, hunkPos=DiffLinePos(hunkID, hunkLineNum), diffLine=diffLine)
+                ld = LineData(text=content, hunkPos=DiffLinePos(hunkID, hunkLineNum), origin=origin,
+                              oldLineNo=diffLine.old_lineno, newLineNo=diffLine.new_lineno)
 
                 assert origin in " -+", F"diffline origin: '{origin}'"
                 if origin == '+':
@@ -205,111 +239,239 @@ class DiffDocument:
 
                 lineData.append(ld)
 
-        style = DiffStyle()
-
-        document = QTextDocument()  # recreating a document is faster than clearing the existing one
-        document.setObjectName("DiffPatchDocument")
-        document.setDocumentLayout(QPlainTextDocumentLayout(document))
-
-        cursor: QTextCursor = QTextCursor(document)
-
-        # Begin batching text insertions for performance.
-        # This prevents Qt from recomputing the document's layout after every line insertion.
-        cursor.beginEditBlock()
-
-        defaultBF = cursor.blockFormat()
-        defaultCF = cursor.charFormat()
         showStrayCRs = settings.prefs.showStrayCRs
+        noNewlineTrailer = _("<no newline at end of file>")
+        chunks = []
+        warningSpans = []
+        position = 0
 
-        assert document.isEmpty()
-
-        # Build up document from the lineData array.
+        # Lay out the text of the document from the lineData array.
+        # Positions are counted in UTF-16 code units, like QTextDocument does.
         for ld in lineData:
-            # Decide block format & character format
-            if ld.diffLine is None:
-                bf = style.hunkBF
-                cf = style.hunkCF
-            elif ld.diffLine.origin == '+':
-                bf = style.addBF1
-                cf = defaultCF
-            elif ld.diffLine.origin == '-':
-                bf = style.delBF1
-                cf = defaultCF
-            else:
-                bf = defaultBF
-                cf = defaultCF
-
             # Process line ending
+            text = ld.text
             trailer = ""
-            if ld.text.endswith('\r\n'):
-                trimBack = -2
+            if text.endswith('\r\n'):
+                text = text[:-2]
                 if showStrayCRs:
                     trailer = "<CRLF>"
-            elif ld.text.endswith('\n'):
-                trimBack = -1
-            elif ld.text.endswith('\r'):
-                trimBack = -1
+            elif text.endswith('\n'):
+                text = text[:-1]
+            elif text.endswith('\r'):
+                text = text[:-1]
                 if showStrayCRs:
                     trailer = "<CR>"
             else:
-                trailer = _("<no newline at end of file>")
-                trimBack = None  # yes, None. This will cancel slicing.
+                trailer = noNewlineTrailer
 
-            if not document.isEmpty():
-                cursor.insertBlock()
-                ld.cursorStart = cursor.position()
-            else:
-                ld.cursorStart = 0
-
-            cursor.setBlockFormat(bf)
-            cursor.setBlockCharFormat(cf)
-            cursor.insertText(ld.text[:trimBack])
+            if chunks:
+                position += 1  # block separator
+            ld.cursorStart = position
+            position += _qtLength(text)
+            chunks.append(text)
 
             if trailer:
-                cursor.setCharFormat(style.warningCF)
-                cursor.insertText(trailer)
+                warningSpans.append((position, position + len(trailer)))
+                position += len(trailer)
+                chunks.append(trailer)
 
-            ld.cursorEnd = cursor.position()
+            ld.cursorEnd = position
+            chunks.append("\n")
+
+        chunks.pop()  # no block separator after the last line
 
         # Emphasize doppelganger differences
-        doppelgangerBlocksQueue = []
+        emphasisSpans = []
+        doppelgangerBlocksQueue = deque()
+        workLeft = INTRALINE_WORK_BUDGET
+        outOfTime = False
         for i, ld in enumerate(lineData):
             if ld.doppelganger < 0:  # Skip lines without doppelgangers
                 continue
 
             assert i != ld.doppelganger, "line cannot be its own doppelganger"
-            assert ld.diffLine is not None, "line with doppelganger must have a DiffLine"
+            assert ld.origin in "+-", "line with doppelganger must be a +/- line"
             aheadOfDoppelganger = i < ld.doppelganger
 
             if aheadOfDoppelganger:
-                sm = difflib.SequenceMatcher(a=ld.text, b=lineData[ld.doppelganger].text)
-                blocks = sm.get_matching_blocks()
+                if not outOfTime and workLeft <= 0:
+                    logger.info("Out of time for intra-line differences, skipping the rest of the lines")
+                    outOfTime = True
+                if outOfTime:
+                    blocks = None
+                else:
+                    blocks, work = matchingBlocks(ld.text, lineData[ld.doppelganger].text)
+                    workLeft -= work
                 doppelgangerBlocksQueue.append(blocks)  # Set blocks aside for my doppelganger
             else:
-                blocks = doppelgangerBlocksQueue.pop(0)  # Consume blocks set aside by my doppelganger
+                blocks = doppelgangerBlocksQueue.popleft()  # Consume blocks set aside by my doppelganger
 
-            cf = style.delCF2 if ld.diffLine.origin == '-' else style.addCF2
+            if blocks is None:  # Line too long, or out of time
+                continue
+
+            origin = ld.origin
             offset = ld.cursorStart
+            text = ld.text
+            isAscii = text.isascii()
 
             for x1, x2 in _invertMatchingBlocks(blocks, useA=aheadOfDoppelganger):
-                cursor.setPosition(offset + x1, QTextCursor.MoveMode.MoveAnchor)
-                cursor.setPosition(offset + x2, QTextCursor.MoveMode.KeepAnchor)
-                cursor.setCharFormat(cf)
+                if not isAscii:
+                    x1, x2 = _qtLength(text[:x1]), _qtLength(text[:x2])
+                emphasisSpans.append((offset + x1, offset + x2, origin))
 
         assert not doppelgangerBlocksQueue, "should've consumed all doppelganger matching blocks!"
 
-        # Done batching text insertions.
+        return DiffDocument(lineData=lineData, pluses=pluses, minuses=minuses, text="".join(chunks),
+                            warningSpans=warningSpans, emphasisSpans=emphasisSpans)
+
+    def assemble(self):
+        """
+        Create the QTextDocument from the layout prepared by fromPatch().
+        Must be called on the UI thread.
+        """
+        if self.document is not None:
+            return
+
+        style = DiffStyle()
+
+        document = QTextDocument()  # recreating a document is faster than clearing the existing one
+        document.setObjectName("DiffPatchDocument")
+        document.setDocumentLayout(QPlainTextDocumentLayout(document))
+
+        # Insert all the text in one go, then format it.
+        document.setPlainText(self.text)
+
+        cursor: QTextCursor = QTextCursor(document)
+        cursor.beginEditBlock()
+
+        def select(start: int, end: int):
+            cursor.setPosition(start, QTextCursor.MoveMode.MoveAnchor)
+            cursor.setPosition(end, QTextCursor.MoveMode.KeepAnchor)
+
+        blockFormats = {'+': style.addBF1, '-': style.delBF1}
+
+        # Color +/- lines. Runs of adjacent lines with the same origin are formatted in one go.
+        runFormat = None
+        runStart = 0
+        runEnd = 0
+        for ld in self.lineData:
+            if ld.origin == "@":  # Hunk header
+                select(ld.cursorStart, ld.cursorEnd)
+                cursor.setBlockCharFormat(style.hunkCF)
+                cursor.setCharFormat(style.hunkCF)
+                blockFormat = None
+            else:
+                blockFormat = blockFormats.get(ld.origin, None)
+
+            if blockFormat is not runFormat:
+                if runFormat is not None:
+                    select(runStart, runEnd)
+                    cursor.setBlockFormat(runFormat)
+                runFormat = blockFormat
+                runStart = ld.cursorStart
+            runEnd = ld.cursorEnd
+
+        if runFormat is not None:
+            select(runStart, runEnd)
+            cursor.setBlockFormat(runFormat)
+
+        for start, end in self.warningSpans:
+            select(start, end)
+            cursor.setCharFormat(style.warningCF)
+
+        for start, end, origin in self.emphasisSpans:
+            select(start, end)
+            cursor.setCharFormat(style.delCF2 if origin == '-' else style.addCF2)
+
         cursor.endEditBlock()
 
-        return DiffDocument(document=document, lineData=lineData, style=style, pluses=pluses, minuses=minuses)
+        self.document = document
+        self.style = style
 
 
-def _invertMatchingBlocks(blockList: list[difflib.Match], useA: bool) -> Generator[tuple[int, int], None, None]:
+class DiffDocumentCache(SizeBoundedLRU[tuple, DiffDocument]):
+    """
+    Remembers the layouts of recently viewed diffs, so that going back
+    and forth between the same few files doesn't lay them out from scratch.
+
+    Only the output of DiffDocument.fromPatch is kept. The QTextDocument
+    belongs to DiffView, so every hit is handed out as a fresh copy that
+    still needs to be assembled.
+    """
+
+    MaxSize = 64 * 1024 * 1024
+    "Approximate memory budget for the cached layouts, in bytes."
+
+    LineDataSize = 260
+    "Approximate size of a LineData along with its DiffLinePos, not counting its text."
+
+    @staticmethod
+    def fileStat(locator: NavLocator, workdir: str) -> tuple | None:
+        """
+        The new side of an unstaged file is on disk, and its id isn't always known.
+        Versions of the file are told apart by their stat data, like the index does.
+
+        Take the stat data BEFORE computing the patch: if the file changes in
+        between, the stale layout must not be cached under the new stat data.
+
+        Return an empty tuple if the locator isn't dirty, or None if the file
+        can't be stat'ed (then the patch can't be identified).
+        """
+        if not locator.context.isDirty():
+            return ()
+        try:
+            st = os.stat(os.path.join(workdir, locator.path))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino
+
+    @staticmethod
+    def key(patch: Patch, locator: NavLocator, fileStat: tuple | None) -> tuple | None:
+        """
+        Identify a patch by the contents it compares (see fileStat) and by the
+        prefs that affect its layout. Return None if the patch can't be identified.
+        """
+        if fileStat is None:
+            return None
+
+        delta = patch.delta
+        oldFile = delta.old_file
+        newFile = delta.new_file
+        prefs = settings.prefs
+
+        return (oldFile.path, oldFile.id, newFile.path, newFile.id, fileStat,
+                locator.flags & (NavFlags.AllowLongLines | NavFlags.AllowLargeFiles),
+                prefs.contextLines, prefs.largeFileThresholdKB, prefs.showStrayCRs, prefs.colorblind, prefs.renderSvg)
+
+    def sizeOf(self, document: DiffDocument) -> int:
+        return (sys.getsizeof(document.text)
+                + sum(self.LineDataSize + sys.getsizeof(ld.text) for ld in document.lineData)
+                + 100 * (len(document.warningSpans) + len(document.emphasisSpans)))
+
+    def get(self, key: tuple) -> DiffDocument | None:
+        document = super().get(key)
+        if document is None:
+            return None
+        return dataclasses.replace(document, document=None, style=None)
+
+    def put(self, key: tuple, document: DiffDocument):
+        # Don't hang on to the caller's QTextDocument
+        super().put(key, dataclasses.replace(document, document=None, style=None))
+
+
+def _qtLength(text: str) -> int:
+    """ Length of a string in UTF-16 code units, as counted by Qt. """
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _invertMatchingBlocks(blockList: MatchingBlocks, useA: bool) -> Generator[tuple[int, int], None, None]:
     px = 0
 
-    for block in blockList:
-        x1 = block.a if useA else block.b
-        x2 = x1 + block.size
+    for a, b, size in blockList:
+        x1 = a if useA else b
+        x2 = x1 + size
 
         if px != x1:
             yield px, x1
@@ -8,8 +8,7 @@ from __future__ import annotations
 
 import logging
 import os
-import re
-from bisect import bisect_left, bisect_right
+from bisect import bisect_right
 
 from gitfourchette import colors
 from gitfourchette import settings
@@ -17,6 +16,7 @@ from gitfourchette.application import GFApplication
 from gitfourchette.diffview.diffdocument import DiffDocument, LineData
 from gitfourchette.diffview.diffgutter import DiffGutter
 from gitfourchette.diffview.diffrubberband import DiffRubberBand
+from gitfourchette.diffview.patchactionsmixin import PatchActionsMixin
 from gitfourchette.exttools import openPrefsDialog
 from gitfourchette.forms.searchbar import SearchBar
 from gitfourchette.globalshortcuts import GlobalShortcuts
@@ -24,8 +24,7 @@ from gitfourchette.localization import *
 from gitfourchette.nav import NavContext, NavFlags, NavLocator
 from gitfourchette.porcelain import *
 from gitfourchette.qt import *
-from gitfourchette.subpatch import extractSubpatch
-from gitfourchette.tasks import ApplyPatch, RevertPatch
+from gitfourchette.subpatch import DiffLinePos
 from gitfourchette.toolbox import *
 
 logger = logging.getLogger(__name__)
@@ -61,7 +60,7 @@ class DiffSearchHighlighter(QSyntaxHighlighter):
             index += termLength
 
 
-class DiffView(QPlainTextEdit):
+class DiffView(QPlainTextEdit, PatchActionsMixin):
     DetachedWindowObjectName = "DiffViewDetachedWindow"
 
     contextualHelp = Signal(str)
@@ -253,8 +252,6 @@ class DiffView(QPlainTextEdit):
         super().clear()
 
     def replaceDocument(self, repo: Repo, patch: Patch, locator: NavLocator, newDoc: DiffDocument):
-        assert newDoc.document is not None
-
         oldDocument = self.document()
 
         # Detect if we're trying to load exactly the same patch - common occurrence when moving the app back to the
@@ -264,18 +261,21 @@ class DiffView(QPlainTextEdit):
                 assert self.currentPatch is not None
                 assert patch.data == self.currentPatch.data
 
-            # Delete new document
-            assert newDoc.document is not oldDocument  # make sure it's not in use before deleting
-            newDoc.document.deleteLater()
-            newDoc.document = None  # prevent any callers from using a stale object
+            # Delete new document if it was already assembled
+            if newDoc.document is not None:
+                assert newDoc.document is not oldDocument  # make sure it's not in use before deleting
+                newDoc.document.deleteLater()
+                newDoc.document = None  # prevent any callers from using a stale object
 
-            # Bail now - don't change the document
+            # Bail now - don't change the document (and don't bother assembling the new one)
             logger.debug("Don't need to regenerate diff document.")
             return
 
         if oldDocument:
             oldDocument.deleteLater()  # avoid leaking memory/objects, even though we do set QTextDocument's parent to this QTextEdit
 
+        newDoc.assemble()
+
         self.repo = repo
         self.currentPatch = patch
         self.currentLocator = locator
@@ -474,99 +474,8 @@ class DiffView(QPlainTextEdit):
 
         # Find hunk at click position
         clickedHunkID = self.findHunkIDAt(clickedPosition)
-        shortHunkHeader = ""
-        if clickedHunkID >= 0:
-            hunk: DiffHunk = self.currentPatch.hunks[clickedHunkID]
-            headerMatch = re.match(r"@@ ([^@]+) @@.*", hunk.header)
-            shortHunkHeader = headerMatch.group(1) if headerMatch else f"#{clickedHunkID}"
 
-        actions = []
-
-        navContext = self.currentLocator.context
-
-        if navContext == NavContext.COMMITTED:
-            if hasSelection:
-                actions = [
-                    ActionDef(_("Export Lines as Patch…"), self.exportSelection),
-                    ActionDef(_("Revert Lines…"), self.revertSelection),
-                ]
-            else:
-                actions = [
-                    ActionDef(_("Export Hunk {0} as Patch…").format(shortHunkHeader), lambda: self.exportHunk(clickedHunkID)),
-                    ActionDef(_("Revert Hunk…"), lambda: self.revertHunk(clickedHunkID)),
-                ]
-
-        elif navContext == NavContext.UNTRACKED:
-            if hasSelection:
-                actions = [
-                    ActionDef(_("Export Lines as Patch…"), self.exportSelection),
-                ]
-            else:
-                actions = [
-                    ActionDef(_("Export Hunk as Patch…"), lambda: self.exportHunk(clickedHunkID)),
-                ]
-
-        elif navContext == NavContext.UNSTAGED:
-            if hasSelection:
-                actions = [
-                    ActionDef(
-                        _("Stage Lines"),
-                        self.stageSelection,
-                        "git-stage-lines",
-                        shortcuts=GlobalShortcuts.stageHotkeys[0],
-                    ),
-                    ActionDef(
-                        _("Discard Lines"),
-                        self.discardSelection,
-                        "git-discard-lines",
-                        shortcuts=GlobalShortcuts.discardHotkeys[0],
-                    ),
-                    ActionDef(
-                        _("Export Lines as Patch…"),
-                        self.exportSelection
-                    ),
-                ]
-            else:
-                actions = [
-                    ActionDef(
-                        _("Stage Hunk {0}").format(shortHunkHeader),
-                        lambda: self.stageHunk(clickedHunkID),
-                        "git-stage-lines",
-                    ),
-                    ActionDef(
-                        _("Discard Hunk"),
-                        lambda: self.discardHunk(clickedHunkID),
-                        "git-discard-lines",
-                    ),
-                    ActionDef(_("Export Hunk as Patch…"), lambda: self.exportHunk(clickedHunkID)),
-                ]
-
-        elif navContext == NavContext.STAGED:
-            if hasSelection:
-                actions = [
-                    ActionDef(
-                        _("Unstage Lines"),
-                        self.unstageSelection,
-                        "git-unstage-lines",
-                        shortcuts=GlobalShortcuts.discardHotkeys[0],
-                    ),
-                    ActionDef(
-                        _("Export Lines as Patch…"),
-                        self.exportSelection,
-                    ),
-                ]
-            else:
-                actions = [
-                    ActionDef(
-                        _("Unstage Hunk {0}").format(shortHunkHeader),
-                        lambda: self.unstageHunk(clickedHunkID),
-                        "git-unstage-lines",
-                    ),
-                    ActionDef(
-                        _("Export Hunk as Patch…"),
-                        lambda: self.exportHunk(clickedHunkID),
-                    ),
-                ]
+        actions = self.patchActions(hasSelection, clickedHunkID)
 
         actions += [
             ActionDef.SEPARATOR,
@@ -627,96 +536,12 @@ class DiffView(QPlainTextEdit):
             return False
         for i in range(start, end+1):
             ld = self.lineData[i]
-            if ld.diffLine and ld.diffLine.origin in "+-":
+            if ld.origin in "+-":
                 return True
         return False
 
-    def extractSelection(self, reverse=False) -> bytes:
-        assert self.currentPatch is not None
-
-        start, end = self.getSelectedLineExtents()
-
-        return extractSubpatch(
-            self.currentPatch,
-            self.lineData[start].hunkPos,
-            self.lineData[end].hunkPos,
-            reverse)
-
-    def extractHunk(self, hunkID: int, reverse=False) -> bytes:
-        assert self.currentPatch is not None
-
-        # Find indices of first and last LineData objects given the current hunk
-        hunkFirstLineIndex = bisect_left(self.lineHunkIDCache, hunkID, 0)
-        hunkLastLineIndex = bisect_left(self.lineHunkIDCache, hunkID+1, hunkFirstLineIndex) - 1
-
-        return extractSubpatch(
-            self.currentPatch,
-            self.lineData[hunkFirstLineIndex].hunkPos,
-            self.lineData[hunkLastLineIndex].hunkPos,
-            reverse)
-
-    def exportPatch(self, patchData: bytes):
-        if not patchData:
-            QApplication.beep()
-            return
-
-        def dump(path: str):
-            with open(path, "wb") as file:
-                file.write(patchData)
-
-        name = os.path.basename(self.currentLocator.path) + "[partial].patch"
-        qfd = PersistentFileDialog.saveFile(self, "SaveFile", _("Export selected lines"), name)
-        qfd.fileSelected.connect(dump)
-        qfd.show()
-
-    def fireRevert(self, patchData: bytes):
-        RevertPatch.invoke(self, self.currentPatch, patchData)
-
-    def fireApplyLines(self, purpose: PatchPurpose):
-        purpose |= PatchPurpose.LINES
-        reverse = not (purpose & PatchPurpose.STAGE)
-        patchData = self.extractSelection(reverse)
-        ApplyPatch.invoke(self, self.currentPatch, patchData, purpose)
-
-    def fireApplyHunk(self, hunkID: int, purpose: PatchPurpose):
-        purpose |= PatchPurpose.HUNK
-        reverse = not (purpose & PatchPurpose.STAGE)
-        patchData = self.extractHunk(hunkID, reverse)
-        ApplyPatch.invoke(self, self.currentPatch, patchData, purpose)
-
-    def stageSelection(self):
-        self.fireApplyLines(PatchPurpose.STAGE)
-
-    def unstageSelection(self):
-        self.fireApplyLines(PatchPurpose.UNSTAGE)
-
-    def discardSelection(self):
-        self.fireApplyLines(PatchPurpose.DISCARD)
-
-    def exportSelection(self):
-        patchData = self.extractSelection()
-        self.exportPatch(patchData)
-
-    def revertSelection(self):
-        patchData = self.extractSelection(reverse=True)
-        self.fireRevert(patchData)
-
-    def stageHunk(self, hunkID: int):
-        self.fireApplyHunk(hunkID, PatchPurpose.STAGE)
-
-    def unstageHunk(self, hunkID: int):
-        self.fireApplyHunk(hunkID, PatchPurpose.UNSTAGE)
-
-    def discardHunk(self, hunkID: int):
-        self.fireApplyHunk(hunkID, PatchPurpose.DISCARD)
-
-    def exportHunk(self, hunkID: int):
-        patchData = self.extractHunk(hunkID)
-        self.exportPatch(patchData)
-
-    def revertHunk(self, hunkID: int):
-        patchData = self.extractHunk(hunkID, reverse=True)
-        self.fireRevert(patchData)
+    def lineHunkPos(self, line: int) -> DiffLinePos:
+        return self.lineData[line].hunkPos
 
     # ---------------------------------------------
     # Gutter
@@ -899,42 +724,6 @@ class DiffView(QPlainTextEdit):
         cursor.setPosition(endPosition, QTextCursor.MoveMode.KeepAnchor)
         self.replaceCursor(cursor)
 
-    # ---------------------------------------------
-    # Selection help
-
-    def emitSelectionHelp(self):
-        if self.currentLocator.context in [NavContext.COMMITTED, NavContext.EMPTY]:
-            return
-
-        if not self.isSelectionActionable():
-            self.contextualHelp.emit("")
-            self.selectionActionable.emit(False)
-            return
-
-        start, end = self.getSelectedLineExtents()
-        numLines = end - start + 1
-
-        if self.currentLocator.context == NavContext.UNSTAGED:
-            if numLines <= 1:
-                help = _("Hit {stagekey} to stage the current line, or {discardkey} to discard it.")
-            else:
-                help = _("Hit {stagekey} to stage the selected lines, or {discardkey} to discard them.")
-        elif self.currentLocator.context == NavContext.STAGED:
-            if numLines <= 1:
-                help = _("Hit {unstagekey} to unstage the current line.")
-            else:
-                help = _("Hit {unstagekey} to unstage the selected lines.")
-        else:
-            return
-
-        help = help.format(
-            stagekey=QKeySequence(GlobalShortcuts.stageHotkeys[0]).toString(QKeySequence.SequenceFormat.NativeText),
-            unstagekey=QKeySequence(GlobalShortcuts.discardHotkeys[0]).toString(QKeySequence.SequenceFormat.NativeText),
-            discardkey=QKeySequence(GlobalShortcuts.discardHotkeys[0]).toString(QKeySequence.SequenceFormat.NativeText))
-
-        self.contextualHelp.emit(help)
-        self.selectionActionable.emit(True)
-
     # ---------------------------------------------
     # Search
 
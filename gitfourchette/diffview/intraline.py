@@ -0,0 +1,119 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+Intra-line differences between the old and new versions of a line.
+
+Lines are compared word by word rather than character by character, which
+keeps SequenceMatcher's inputs short. Results are cached by a digest of the
+pair of lines, because the same pairs of lines come up again whenever a diff
+is reloaded.
+"""
+
+import difflib
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from itertools import accumulate
+
+MAX_TOKENS = 500
+"Don't look for intra-line differences in lines made up of more tokens than this."
+
+CACHE_SIZE = 8192
+"Number of pairs of lines whose matching blocks are cached."
+
+TOKENIZE_WORK = 10
+"Units of work charged for each token, on top of one unit per pair of tokens compared."
+
+# Words, runs of whitespace, and single punctuation characters
+_tokenPattern = re.compile(r"\w+|\s+|[^\w\s]")
+
+MatchingBlocks = tuple[tuple[int, int, int], ...]
+
+_cache: OrderedDict[bytes, tuple[MatchingBlocks | None, int]] = OrderedDict()
+_cacheLock = threading.Lock()
+
+
+def _tokenize(text: str) -> tuple[list[str], list[int]]:
+    """ Split text into tokens, along with their positions (plus the length of the text). """
+    tokens = _tokenPattern.findall(text)
+    positions = list(accumulate(map(len, tokens), initial=0))
+    return tokens, positions
+
+
+def clearCache():
+    with _cacheLock:
+        _cache.clear()
+
+
+def matchingBlocks(a: str, b: str) -> tuple[MatchingBlocks | None, int]:
+    """
+    Find the runs of characters that a and b have in common, word by word.
+
+    Return (start in a, start in b, size) triplets, ending with a
+    (len(a), len(b), 0) sentinel like SequenceMatcher.get_matching_blocks(),
+    or None if the lines are too long to be compared.
+
+    Also return the amount of work that the comparison takes, so that callers
+    can stick to a budget. This doesn't depend on whether the result was cached.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(a.encode("utf-8", errors="surrogatepass"))
+    hasher.update(b"\0")
+    hasher.update(b.encode("utf-8", errors="surrogatepass"))
+    key = hasher.digest()
+
+    with _cacheLock:
+        try:
+            _cache.move_to_end(key)
+            return _cache[key]
+        except KeyError:
+            pass
+
+    result = _matchingBlocks(a, b)
+
+    with _cacheLock:
+        _cache[key] = result
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return result
+
+
+def _matchingBlocks(a: str, b: str) -> tuple[MatchingBlocks | None, int]:
+    tokensA, positionsA = _tokenize(a)
+    tokensB, positionsB = _tokenize(b)
+    lenA = len(tokensA)
+    lenB = len(tokensB)
+    work = TOKENIZE_WORK * (lenA + lenB)
+
+    if lenA > MAX_TOKENS or lenB > MAX_TOKENS:
+        return None, work
+
+    # Only run SequenceMatcher on the tokens between the common prefix and suffix
+    prefix = 0
+    while prefix < lenA and prefix < lenB and tokensA[prefix] == tokensB[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < lenA - prefix and suffix < lenB - prefix
+           and tokensA[lenA - 1 - suffix] == tokensB[lenB - 1 - suffix]):
+        suffix += 1
+
+    tokenBlocks = []
+    if prefix:
+        tokenBlocks.append((0, 0, prefix))
+    if prefix < lenA - suffix and prefix < lenB - suffix:
+        sm = difflib.SequenceMatcher(a=tokensA[prefix: lenA - suffix], b=tokensB[prefix: lenB - suffix],
+                                     autojunk=False)
+        tokenBlocks.extend((prefix + i, prefix + j, n) for i, j, n in sm.get_matching_blocks() if n)
+        work += (lenA - suffix - prefix) * (lenB - suffix - prefix)
+    if suffix:
+        tokenBlocks.append((lenA - suffix, lenB - suffix, suffix))
+    tokenBlocks.append((lenA, lenB, 0))
+
+    blocks = tuple((positionsA[i], positionsB[j], positionsA[i + n] - positionsA[i]) for i, j, n in tokenBlocks)
+    return blocks, work
@@ -0,0 +1,271 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+from __future__ import annotations
+
+import os
+import re
+
+from gitfourchette.globalshortcuts import GlobalShortcuts
+from gitfourchette.localization import *
+from gitfourchette.nav import NavContext, NavLocator
+from gitfourchette.porcelain import *
+from gitfourchette.qt import *
+from gitfourchette.subpatch import DiffLinePos, extractSubpatch
+from gitfourchette.tasks import ApplyPatch, RevertPatch
+from gitfourchette.toolbox import *
+
+
+class PatchActionsMixin:
+    """
+    Stage, unstage, discard, export and revert lines or hunks of the patch
+    shown in a diff view (DiffView or VirtualDiffView).
+
+    The view locates rows with getSelectedLineExtents, isSelectionActionable
+    and lineHunkPos; everything else is shared.
+    """
+
+    contextualHelp: Signal
+    selectionActionable: Signal
+    currentLocator: NavLocator
+    currentPatch: Patch | None
+
+    def getSelectedLineExtents(self) -> tuple[int, int]:
+        raise NotImplementedError
+
+    def isSelectionActionable(self) -> bool:
+        raise NotImplementedError
+
+    def lineHunkPos(self, line: int) -> DiffLinePos:
+        raise NotImplementedError
+
+    # ---------------------------------------------
+    # Context menu
+
+    def patchActions(self, hasSelection: bool, clickedHunkID: int) -> list[ActionDef]:
+        """ Context menu actions for the selection, or for the clicked hunk if there's no selection. """
+        assert self.currentPatch is not None
+
+        shortHunkHeader = ""
+        if clickedHunkID >= 0:
+            hunk: DiffHunk = self.currentPatch.hunks[clickedHunkID]
+            headerMatch = re.match(r"@@ ([^@]+) @@.*", hunk.header)
+            shortHunkHeader = headerMatch.group(1) if headerMatch else f"#{clickedHunkID}"
+
+        navContext = self.currentLocator.context
+
+        if navContext == NavContext.COMMITTED:
+            if hasSelection:
+                return [
+                    ActionDef(_("Export Lines as Patch…"), self.exportSelection),
+                    ActionDef(_("Revert Lines…"), self.revertSelection),
+                ]
+            else:
+                return [
+                    ActionDef(_("Export Hunk {0} as Patch…").format(shortHunkHeader), lambda: self.exportHunk(clickedHunkID)),
+                    ActionDef(_("Revert Hunk…"), lambda: self.revertHunk(clickedHunkID)),
+                ]
+
+        elif navContext == NavContext.UNTRACKED:
+            if hasSelection:
+                return [
+                    ActionDef(_("Export Lines as Patch…"), self.exportSelection),
+                ]
+            else:
+                return [
+                    ActionDef(_("Export Hunk as Patch…"), lambda: self.exportHunk(clickedHunkID)),
+                ]
+
+        elif navContext == NavContext.UNSTAGED:
+            if hasSelection:
+                return [
+                    ActionDef(
+                        _("Stage Lines"),
+                        self.stageSelection,
+                        "git-stage-lines",
+                        shortcuts=GlobalShortcuts.stageHotkeys[0],
+                    ),
+                    ActionDef(
+                        _("Discard Lines"),
+                        self.discardSelection,
+                        "git-discard-lines",
+                        shortcuts=GlobalShortcuts.discardHotkeys[0],
+                    ),
+                    ActionDef(
+                        _("Export Lines as Patch…"),
+                        self.exportSelection
+                    ),
+                ]
+            else:
+                return [
+                    ActionDef(
+                        _("Stage Hunk {0}").format(shortHunkHeader),
+                        lambda: self.stageHunk(clickedHunkID),
+                        "git-stage-lines",
+                    ),
+                    ActionDef(
+                        _("Discard Hunk"),
+                        lambda: self.discardHunk(clickedHunkID),
+                        "git-discard-lines",
+                    ),
+                    ActionDef(_("Export Hunk as Patch…"), lambda: self.exportHunk(clickedHunkID)),
+                ]
+
+        elif navContext == NavContext.STAGED:
+            if hasSelection:
+                return [
+                    ActionDef(
+                        _("Unstage Lines"),
+                        self.unstageSelection,
+                        "git-unstage-lines",
+                        shortcuts=GlobalShortcuts.discardHotkeys[0],
+                    ),
+                    ActionDef(
+                        _("Export Lines as Patch…"),
+                        self.exportSelection,
+                    ),
+                ]
+            else:
+                return [
+                    ActionDef(
+                        _("Unstage Hunk {0}").format(shortHunkHeader),
+                        lambda: self.unstageHunk(clickedHunkID),
+                        "git-unstage-lines",
+                    ),
+                    ActionDef(
+                        _("Export Hunk as Patch…"),
+                        lambda: self.exportHunk(clickedHunkID),
+                    ),
+                ]
+
+        return []
+
+    # ---------------------------------------------
+    # Selection help
+
+    def emitSelectionHelp(self):
+        if self.currentLocator.context in [NavContext.COMMITTED, NavContext.EMPTY]:
+            return
+
+        if not self.isSelectionActionable():
+            self.contextualHelp.emit("")
+            self.selectionActionable.emit(False)
+            return
+
+        start, end = self.getSelectedLineExtents()
+        numLines = end - start + 1
+
+        if self.currentLocator.context == NavContext.UNSTAGED:
+            if numLines <= 1:
+                help = _("Hit {stagekey} to stage the current line, or {discardkey} to discard it.")
+            else:
+                help = _("Hit {stagekey} to stage the selected lines, or {discardkey} to discard them.")
+        elif self.currentLocator.context == NavContext.STAGED:
+            if numLines <= 1:
+                help = _("Hit {unstagekey} to unstage the current line.")
+            else:
+                help = _("Hit {unstagekey} to unstage the selected lines.")
+        else:
+            return
+
+        help = help.format(
+            stagekey=QKeySequence(GlobalShortcuts.stageHotkeys[0]).toString(QKeySequence.SequenceFormat.NativeText),
+            unstagekey=QKeySequence(GlobalShortcuts.discardHotkeys[0]).toString(QKeySequence.SequenceFormat.NativeText),
+            discardkey=QKeySequence(GlobalShortcuts.discardHotkeys[0]).toString(QKeySequence.SequenceFormat.NativeText))
+
+        self.contextualHelp.emit(help)
+        self.selectionActionable.emit(True)
+
+    # ---------------------------------------------
+    # Patch
+
+    def extractSelection(self, reverse=False) -> bytes:
+        assert self.currentPatch is not None
+
+        start, end = self.getSelectedLineExtents()
+        if start < 0:
+            return b""
+
+        return extractSubpatch(
+            self.currentPatch,
+            self.lineHunkPos(start),
+            self.lineHunkPos(end),
+            reverse)
+
+    def extractHunk(self, hunkID: int, reverse=False) -> bytes:
+        assert self.currentPatch is not None
+
+        # Go by the patch rather than by the lines in the view, which may not all be laid out yet
+        numHunkLines = len(self.currentPatch.hunks[hunkID].lines)
+
+        return extractSubpatch(
+            self.currentPatch,
+            DiffLinePos(hunkID, -1),
+            DiffLinePos(hunkID, numHunkLines - 1),
+            reverse)
+
+    def exportPatch(self, patchData: bytes):
+        if not patchData:
+            QApplication.beep()
+            return
+
+        def dump(path: str):
+            with open(path, "wb") as file:
+                file.write(patchData)
+
+        name = os.path.basename(self.currentLocator.path) + "[partial].patch"
+        qfd = PersistentFileDialog.saveFile(self, "SaveFile", _("Export selected lines"), name)
+        qfd.fileSelected.connect(dump)
+        qfd.show()
+
+    def fireRevert(self, patchData: bytes):
+        RevertPatch.invoke(self, self.currentPatch, patchData)
+
+    def fireApplyLines(self, purpose: PatchPurpose):
+        purpose |= PatchPurpose.LINES
+        reverse = not (purpose & PatchPurpose.STAGE)
+        patchData = self.extractSelection(reverse)
+        ApplyPatch.invoke(self, self.currentPatch, patchData, purpose)
+
+    def fireApplyHunk(self, hunkID: int, purpose: PatchPurpose):
+        purpose |= PatchPurpose.HUNK
+        reverse = not (purpose & PatchPurpose.STAGE)
+        patchData = self.extractHunk(hunkID, reverse)
+        ApplyPatch.invoke(self, self.currentPatch, patchData, purpose)
+
+    def stageSelection(self):
+        self.fireApplyLines(PatchPurpose.STAGE)
+
+    def unstageSelection(self):
+        self.fireApplyLines(PatchPurpose.UNSTAGE)
+
+    def discardSelection(self):
+        self.fireApplyLines(PatchPurpose.DISCARD)
+
+    def exportSelection(self):
+        patchData = self.extractSelection()
+        self.exportPatch(patchData)
+
+    def revertSelection(self):
+        patchData = self.extractSelection(reverse=True)
+        self.fireRevert(patchData)
+
+    def stageHunk(self, hunkID: int):
+        self.fireApplyHunk(hunkID, PatchPurpose.STAGE)
+
+    def unstageHunk(self, hunkID: int):
+        self.fireApplyHunk(hunkID, PatchPurpose.UNSTAGE)
+
+    def discardHunk(self, hunkID: int):
+        self.fireApplyHunk(hunkID, PatchPurpose.DISCARD)
+
+    def exportHunk(self, hunkID: int):
+        patchData = self.extractHunk(hunkID)
+        self.exportPatch(patchData)
+
+    def revertHunk(self, hunkID: int):
+        patchData = self.extractHunk(hunkID, reverse=True)
+        self.fireRevert(patchData)
@@ -20,28 +20,107 @@ from gitfourchette.toolbox import *
 from gitfourchette.trtables import TrTables
 
 
+class DiffImageCache(SizeBoundedLRU[tuple[Oid, int, int], tuple[QImage, QSize]]):
+    """
+    Recently decoded images, keyed by blob id and size. Blobs never change,
+    so entries remain valid until they're evicted.
+    """
+
+    MaxSize = 64 * 1024 * 1024
+    "Approximate memory budget for all cached images, in bytes."
+
+    @staticmethod
+    def key(oid: Oid, maxSize: QSize) -> tuple[Oid, int, int]:
+        return oid, maxSize.width(), maxSize.height()
+
+    def sizeOf(self, value: tuple[QImage, QSize]) -> int:
+        image, _fullSize = value
+        return image.sizeInBytes()
+
+
 class DiffImagePair:
+    """
+    Old and new versions of an image, decoded no larger than maxSize unless
+    the locator has NavFlags.FullResolution. Decoding doesn't touch any
+    widgets, so it can run on a worker thread.
+    """
+
     oldImage: QImage
     newImage: QImage
 
-    def __init__(self, repo: Repo, delta: DiffDelta, locator: NavLocator):
-        if delta.old_file.id != NULL_OID:
-            imageDataA = repo.peel_blob(delta.old_file.id).data
-        else:
-            imageDataA = b''
+    oldSize: QSize
+    "Actual size of the old image, which may be larger than oldImage."
 
-        if delta.new_file.id == NULL_OID:
-            imageDataB = b''
-        elif locator.context.isDirty():
+    newSize: QSize
+    "Actual size of the new image, which may be larger than newImage."
+
+    def __init__(self, repo: Repo, delta: DiffDelta, locator: NavLocator,
+                 maxSize: QSize | None = None, cache: DiffImageCache | None = None):
+        if maxSize is None or locator.hasFlags(NavFlags.FullResolution):
+            maxSize = QSize()
+
+        self.oldImage, self.oldSize = DiffImagePair.decodeBlob(repo, delta.old_file.id, maxSize, cache)
+
+        if delta.new_file.id != NULL_OID and locator.context.isDirty():
             fullPath = repo.in_workdir(delta.new_file.path)
             assert os.lstat(fullPath).st_size == delta.new_file.size, "Size mismatch in unstaged image file"
-            with open(fullPath, 'rb') as file:
-                imageDataB = file.read()
+            # Let QImageReader stream the file from disk instead of reading it all into memory.
+            # The file may change at any time, so it isn't cached.
+            self.newImage, self.newSize = DiffImagePair.decode(QImageReader(fullPath), maxSize)
         else:
-            imageDataB = repo.peel_blob(delta.new_file.id).data
+            self.newImage, self.newSize = DiffImagePair.decodeBlob(repo, delta.new_file.id, maxSize, cache)
+
+    def isScaledDown(self) -> bool:
+        return self.oldImage.size() != self.oldSize or self.newImage.size() != self.newSize
+
+    @staticmethod
+    def decodeBlob(repo: Repo, oid: Oid, maxSize: QSize, cache: DiffImageCache | None) -> tuple[QImage, QSize]:
+        if oid == NULL_OID:
+            return QImage(), QSize(0, 0)
+
+        key = DiffImageCache.key(oid, maxSize)
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                return entry
+
+        buffer = QBuffer()
+        buffer.setData(repo.peel_blob(oid).data)
+        image, fullSize = DiffImagePair.decode(QImageReader(buffer), maxSize)
 
-        self.oldImage = QImage.fromData(imageDataA)
-        self.newImage = QImage.fromData(imageDataB)
+        # Full-resolution images are only cached if they fit in maxSize anyway
+        if cache is not None and maxSize.isValid():
+            cache.put(key, (image, fullSize))
+        return image, fullSize
+
+    @staticmethod
+    def decode(reader: QImageReader, maxSize: QSize) -> tuple[QImage, QSize]:
+        """
+        Decode an image no larger than maxSize (if valid), preserving its aspect ratio.
+        Return the decoded image and the actual size of the image.
+        """
+        fullSize = reader.size()  # From the image header, if the format supports it
+        fits = not maxSize.isValid() or (fullSize.isValid()
+                                         and fullSize.width() <= maxSize.width()
+                                         and fullSize.height() <= maxSize.height())
+
+        # Let the decoder scale the image down as it goes, if the format supports it
+        if not fits and fullSize.isValid():
+            reader.setScaledSize(fullSize.scaled(maxSize, Qt.AspectRatioMode.KeepAspectRatio))
+
+        image = reader.read()
+        if image.isNull():
+            return image, QSize(0, 0)
+
+        if not fullSize.isValid():
+            fullSize = image.size()
+            fits = not maxSize.isValid() or (fullSize.width() <= maxSize.width()
+                                             and fullSize.height() <= maxSize.height())
+        if not fits and image.size() == fullSize:
+            image = image.scaled(maxSize, Qt.AspectRatioMode.KeepAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+
+        return image, fullSize
 
 
 class ShouldDisplayPatchAsImageDiff(Exception):
@@ -49,6 +128,11 @@ class ShouldDisplayPatchAsImageDiff(Exception):
         super().__init__("This patch should be viewed as an image diff!")
 
 
+class ShouldDisplayPatchAsVirtualDiff(Exception):
+    def __init__(self):
+        super().__init__("This patch is too large to be laid out in full!")
+
+
 class SpecialDiffError(Exception):
     def __init__(
             self,
@@ -99,23 +183,6 @@ class SpecialDiffError(Exception):
 
         return SpecialDiffError(message, "\n".join(details), longform="\n".join(longform))
 
-    @staticmethod
-    def diffTooLarge(size, threshold, locator):
-        locale = QLocale()
-        humanSize = locale.formattedDataSize(size, 1)
-        humanThreshold = locale.formattedDataSize(threshold, 0)
-        loadAnyway = locator.withExtraFlags(NavFlags.AllowLargeFiles)
-        configure = makeInternalLink("prefs", "largeFileThresholdKB")
-        longform = toRoomyUL([
-            linkify(_("[Load diff anyway] (this may take a moment)"), loadAnyway.url()),
-            linkify(_("[Configure diff preview limit] (currently: {0})"), configure).format(humanThreshold),
-        ])
-        return SpecialDiffError(
-            _("This diff is too large to be previewed."),
-            _("Diff size: {0}").format(humanSize),
-            "SP_MessageBoxWarning",
-            longform=longform)
-
     @staticmethod
     def imageTooLarge(size, threshold, locator):
         locale = QLocale()
@@ -6,10 +6,12 @@
 
 from gitfourchette import colors
 from gitfourchette.diffview.diffdocument import SpecialDiffError
+from gitfourchette.diffview.specialdiff import DiffImagePair
 from gitfourchette.localization import *
+from gitfourchette.nav import NavLocator, NavFlags
 from gitfourchette.porcelain import *
 from gitfourchette.qt import *
-from gitfourchette.toolbox import stockIcon, escape, DocumentLinks
+from gitfourchette.toolbox import stockIcon, escape, linkify, DocumentLinks
 
 IMAGE_RESOURCE_TYPE = QTextDocument.ResourceType.ImageResource
 
@@ -79,15 +81,18 @@ class SpecialDiffView(QTextBrowser):
         assert self.documentLinks is None
         self.documentLinks = err.links
 
-    def displayImageDiff(self, delta: DiffDelta, imageA: QImage, imageB: QImage):
+    def displayImageDiff(self, delta: DiffDelta, pair: DiffImagePair, locator: NavLocator):
         document = QTextDocument(self)
         document.setObjectName("ImageDiffDocument")
 
+        imageA = pair.oldImage
+        imageB = pair.newImage
         humanSizeA = self.locale().formattedDataSize(delta.old_file.size)
         humanSizeB = self.locale().formattedDataSize(delta.new_file.size)
 
-        textA = _("Old:") + " " + _("{0}&times;{1} pixels, {2}").format(imageA.width(), imageA.height(), humanSizeA)
-        textB = _("New:") + " " + _("{0}&times;{1} pixels, {2}").format(imageB.width(), imageB.height(), humanSizeB)
+        # Show the actual dimensions of the images, even if they've been scaled down
+        textA = _("Old:") + " " + _("{0}&times;{1} pixels, {2}").format(pair.oldSize.width(), pair.oldSize.height(), humanSizeA)
+        textB = _("New:") + " " + _("{0}&times;{1} pixels, {2}").format(pair.newSize.width(), pair.newSize.height(), humanSizeB)
 
         if delta.old_file.id == NULL_OID:
             header = f"<add>{textB}</add>"
@@ -102,6 +107,10 @@ class SpecialDiffView(QTextBrowser):
         image.setDevicePixelRatio(self.devicePixelRatio())
         document.addResource(IMAGE_RESOURCE_TYPE, QUrl("image"), image)
 
+        if pair.isScaledDown():
+            fullResolution = locator.withExtraFlags(NavFlags.FullResolution)
+            header += "<br>" + linkify(_("Scaled down to fit. [Show at full resolution]"), fullResolution.url())
+
         document.setHtml(
             f"{HTML_HEADER}"
             f"<p>{header}</p>"
@@ -0,0 +1,305 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+import io
+import re
+from array import array
+from bisect import bisect_right
+from collections.abc import Generator
+from itertools import accumulate
+
+from gitfourchette.nav import NavLocator
+from gitfourchette.porcelain import *
+from gitfourchette.subpatch import DiffLinePos
+
+_hunkHeaderPattern = re.compile(rb"@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+
+def _caseInsensitivePattern(term: str) -> re.Pattern:
+    """
+    Compile a pattern that finds a term in UTF-8 text regardless of case.
+    re.IGNORECASE only folds ASCII letters in bytes, so every other letter
+    matches its single-character upper and lower case forms explicitly.
+    """
+    parts = []
+    for char in term:
+        variants = {v for v in (char, char.lower(), char.upper()) if len(v) == 1}
+        if char.isascii() or len(variants) == 1:
+            parts.append(re.escape(char.encode("utf-8")))
+        else:
+            parts.append(b"(?:" + b"|".join(re.escape(v.encode("utf-8")) for v in sorted(variants)) + b")")
+    return re.compile(b"".join(parts), re.IGNORECASE)
+
+
+class VirtualDiffDocument:
+    """
+    Compact layout of a diff that is too large (or whose lines are too long)
+    to be laid out in a QTextDocument. VirtualDiffView paints its visible
+    rows straight from the patch text.
+
+    The rows are the lines of the patch text, starting at the first hunk
+    header. "\\ No newline at end of file" markers get rows of their own,
+    just like in pygit2's DiffHunk.lines, so that row numbers translate
+    directly to DiffLinePos for extractSubpatch.
+
+    Rows are indexed a chunk at a time (see indexMore), so that the top of a
+    huge diff can be shown before the rest of it has been indexed. Until the
+    document is complete, len() only counts the rows indexed so far.
+    """
+
+    BlockSize = 1024
+    "Number of rows between two line number checkpoints."
+
+    ChunkSize = 1024 * 1024
+    "Approximate number of bytes of patch text to index in one go."
+
+    data: bytes
+    "Patch text."
+
+    offsets: array
+    "Position of the start of each indexed row in the patch text, plus the end of the last indexed row."
+
+    hunkRows: list[int]
+    "Row of each hunk header indexed so far."
+
+    hunkStarts: list[tuple[int, int]]
+    "Old and new line numbers at the start of each hunk."
+
+    pluses: int
+    minuses: int
+
+    def __init__(self, data: bytes, start: int, pluses: int, minuses: int):
+        self.data = data
+        self.pluses = pluses
+        self.minuses = minuses
+        self.offsets = array("q", [start])
+        self.hunkRows = []
+        self.hunkStarts = []
+        self._lineNumberBlocks = []
+
+    @staticmethod
+    def fromPatch(patch: Patch, locator: NavLocator):
+        """
+        Index the first chunk of a patch. This doesn't create any Qt objects,
+        so it can run on a worker thread.
+        """
+        data = patch.data
+        start = 0 if data.startswith(b"@@ -") else data.find(b"\n@@ -") + 1
+        assert start > 0 or data.startswith(b"@@ -"), "patch has no hunks"
+        _context, pluses, minuses = patch.line_stats
+        document = VirtualDiffDocument(data, start, pluses, minuses)
+        document.indexMore()
+        return document
+
+    def isComplete(self) -> bool:
+        return self.offsets[-1] >= len(self.data)
+
+    def progress(self) -> float:
+        """ Fraction of the patch text that has been indexed. """
+        start = self.offsets[0]
+        return (self.offsets[-1] - start) / max(1, len(self.data) - start)
+
+    def indexMore(self, maxBytes: int = 0) -> bool:
+        """
+        Index the rows in the next maxBytes of patch text (ChunkSize by default),
+        rounded up to a whole row. Return True if the document is complete.
+        """
+        data = self.data
+        offsets = self.offsets
+        position = offsets[-1]
+        if position >= len(data):
+            return True
+
+        maxBytes = maxBytes or self.ChunkSize
+        end = data.find(b"\n", min(position + maxBytes, len(data)) - 1)
+        end = len(data) if end < 0 else end + 1
+
+        # Iterating over a BytesIO splits lines without copying the whole patch
+        lines = io.BytesIO(data[position:end])
+        offsets.pop()
+        offsets.extend(accumulate(map(len, lines), initial=position))
+
+        # Hunk headers are the only rows that start with "@@ -"
+        header = position
+        while header >= 0:
+            if header != position or data.startswith(b"@@ -", position):
+                match = _hunkHeaderPattern.match(data, header)
+                assert match, "malformed hunk header"
+                self.hunkRows.append(bisect_right(offsets, header) - 1)
+                self.hunkStarts.append((int(match.group(1)), int(match.group(2))))
+                self._lineNumberBlocks.append([])
+            header = data.find(b"\n@@ -", header, end)
+            if header >= 0:
+                header += 1
+
+        return end >= len(data)
+
+    def indexUpTo(self, position: int):
+        """ Index all rows up to the one containing the given position in the patch text. """
+        while self.offsets[-1] <= position and not self.indexMore():
+            pass
+
+    def indexAll(self):
+        self.indexUpTo(len(self.data))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def origin(self, row: int) -> str:
+        """ Origin character of a row ('@' for hunk headers). """
+        return chr(self.data[self.offsets[row]])
+
+    def rowText(self, row: int) -> str:
+        """ Text of a row, without its origin character (except for hunk headers) or line ending. """
+        start = self.offsets[row]
+        end = self.offsets[row + 1]
+        if self.data[start] in b" +-":
+            start += 1
+        raw = self.data[start:end].rstrip(b"\r\n")
+        return raw.decode("utf-8", errors="replace")
+
+    def rowColumns(self, row: int, firstColumn: int, numColumns: int, tabSpaces: int) -> tuple[str, int]:
+        """
+        Text of a row between two columns, with tabs expanded, and the width of
+        the entire row in columns (approximate if the row isn't plain ASCII).
+
+        A column takes up at most 4 bytes of UTF-8, so there's no need to decode
+        more of the row than that, however long it is.
+        """
+        start = self.offsets[row]
+        end = self.offsets[row + 1]
+        if self.data[start] in b" +-":
+            start += 1
+        rowEnd = end
+        end = min(end, start + 4 * (firstColumn + numColumns))
+        raw = self.data[start:end]
+        if end == rowEnd:
+            raw = raw.rstrip(b"\r\n")
+            rowEnd = start + len(raw)
+        text = raw.decode("utf-8", errors="replace").expandtabs(tabSpaces)
+        width = max(len(text), rowEnd - start)
+        return text[firstColumn: firstColumn + numColumns], width
+
+    def hunkID(self, row: int) -> int:
+        return bisect_right(self.hunkRows, row) - 1
+
+    def hunkPos(self, row: int) -> DiffLinePos:
+        hunkID = self.hunkID(row)
+        return DiffLinePos(hunkID, row - self.hunkRows[hunkID] - 1)
+
+    def hunkRange(self, hunkID: int) -> tuple[int, int]:
+        """
+        First and last rows of a hunk, including its header. Until the document
+        is complete, the last indexed hunk only spans the rows indexed so far.
+        """
+        first = self.hunkRows[hunkID]
+        try:
+            last = self.hunkRows[hunkID + 1] - 1
+        except IndexError:
+            last = len(self) - 1
+        return first, last
+
+    def countOrigins(self, origin: str, startRow: int, endRow: int) -> int:
+        """ Count the rows in [startRow, endRow) that have the given origin. """
+        if startRow >= endRow:
+            return 0
+        # The newline that ends the previous row tells origins apart from line contents.
+        # (The first row is always a hunk header, so it doesn't matter if it isn't preceded by a newline.)
+        needle = b"\n" + origin.encode()
+        offsets = self.offsets
+        return self.data.count(needle, max(0, offsets[startRow] - 1), offsets[endRow])
+
+    def _blockLineNumbers(self, hunkID: int, block: int) -> tuple[int, int]:
+        """ Old and new line numbers at the first row of a block of rows in a hunk. """
+        blocks = self._lineNumberBlocks[hunkID]
+        if not blocks:
+            blocks.append(self.hunkStarts[hunkID])
+
+        size = self.BlockSize
+        firstRow = self.hunkRows[hunkID] + 1
+        while len(blocks) <= block:
+            oldLine, newLine = blocks[-1]
+            blockStart = firstRow + (len(blocks) - 1) * size
+            blockEnd = blockStart + size
+            backslashes = self.countOrigins("\\", blockStart, blockEnd)
+            oldLine += size - self.countOrigins("+", blockStart, blockEnd) - backslashes
+            newLine += size - self.countOrigins("-", blockStart, blockEnd) - backslashes
+            blocks.append((oldLine, newLine))
+
+        return blocks[block]
+
+    def lineNumbers(self, startRow: int, endRow: int) -> Generator[tuple[int, int], None, None]:
+        """
+        Generate the old and new line numbers of the rows in [startRow, endRow),
+        with -1 where a row has no old or new line number (like DiffLine).
+        """
+        if startRow >= endRow:
+            return
+
+        hunkID = self.hunkID(startRow)
+        headerRow = self.hunkRows[hunkID]
+        if startRow == headerRow:
+            oldLine, newLine = self.hunkStarts[hunkID]
+        else:
+            block = (startRow - headerRow - 1) // self.BlockSize
+            oldLine, newLine = self._blockLineNumbers(hunkID, block)
+            for row in range(headerRow + 1 + block * self.BlockSize, startRow):
+                origin = self.origin(row)
+                if origin != "+" and origin != "\\":
+                    oldLine += 1
+                if origin != "-" and origin != "\\":
+                    newLine += 1
+
+        for row in range(startRow, endRow):
+            origin = self.origin(row)
+            if origin == "@":
+                oldLine, newLine = self.hunkStarts[self.hunkID(row)]
+                yield -1, -1
+            elif origin == " ":
+                yield oldLine, newLine
+                oldLine += 1
+                newLine += 1
+            elif origin == "-":
+                yield oldLine, -1
+                oldLine += 1
+            elif origin == "+":
+                yield -1, newLine
+                newLine += 1
+            else:
+                yield -1, -1
+
+    def clumpRange(self, row: int) -> tuple[int, int]:
+        """ First and last rows of the run of adjacent +/- rows around a row. """
+        start = row
+        end = row
+        while start > 0 and self.origin(start - 1) in "+-":
+            start -= 1
+        while end < len(self) - 1 and self.origin(end + 1) in "+-":
+            end += 1
+        return start, end
+
+    def find(self, term: str, startRow: int, backward: bool = False) -> int:
+        """
+        Return the row of the first occurrence of a (case-insensitive) term
+        after startRow (or the last one before startRow if backward), or -1.
+        """
+        pattern = _caseInsensitivePattern(term)
+        offsets = self.offsets
+
+        if not backward:
+            startRow = min(startRow + 1, len(self))
+            match = pattern.search(self.data, offsets[startRow])
+        else:
+            # Keep the last match before startRow (None if there's none)
+            match = None
+            endPosition = offsets[max(0, startRow)] if startRow < len(self) else len(self.data)
+            for m in pattern.finditer(self.data, offsets[0], endPosition):
+                match = m
+
+        if match is None:
+            return -1
+        self.indexUpTo(match.start())
+        return bisect_right(offsets, match.start()) - 1
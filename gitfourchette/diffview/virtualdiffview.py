@@ -0,0 +1,604 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+from __future__ import annotations
+
+import logging
+
+from gitfourchette import settings
+from gitfourchette.application import GFApplication
+from gitfourchette.diffview.diffdocument import DiffStyle
+from gitfourchette.diffview.patchactionsmixin import PatchActionsMixin
+from gitfourchette.diffview.virtualdiffdocument import VirtualDiffDocument
+from gitfourchette.forms.searchbar import SearchBar
+from gitfourchette.globalshortcuts import GlobalShortcuts
+from gitfourchette.localization import *
+from gitfourchette.nav import NavContext, NavFlags, NavLocator
+from gitfourchette.porcelain import *
+from gitfourchette.qt import *
+from gitfourchette.subpatch import DiffLinePos
+from gitfourchette.tasks import Jump
+from gitfourchette.toolbox import *
+
+logger = logging.getLogger(__name__)
+
+
+class VirtualDiffView(QAbstractScrollArea, PatchActionsMixin):
+    """
+    Read-only view of a VirtualDiffDocument, for diffs that are too large for
+    DiffView. Instead of laying out the entire diff in a QTextDocument, it only
+    paints the rows that are visible in the viewport.
+
+    Selections span whole rows, which is all it takes to stage, discard or
+    export lines.
+
+    The document may only be partly indexed when it's handed to the view.
+    The view indexes the rest of it a chunk at a time while the event loop is
+    idle, so that the top of the diff can be browsed right away.
+    """
+
+    contextualHelp = Signal(str)
+    selectionActionable = Signal(bool)
+
+    TextMargin = 4
+
+    document: VirtualDiffDocument | None
+    currentLocator: NavLocator
+    currentPatch: Patch | None
+    repo: Repo | None
+    anchorRow: int
+    cursorRow: int
+    growingHunk: int
+    "Hunk whose selection extends to the rows that are still being indexed, or -1."
+    textWidth: int
+    "Width of the widest row painted so far (rows aren't measured until they're visible)."
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setObjectName("VirtualDiffView")
+        self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
+
+        self.document = None
+        self.currentLocator = NavLocator()
+        self.currentPatch = None
+        self.repo = None
+        self.anchorRow = -1
+        self.cursorRow = -1
+        self.growingHunk = -1
+        self.textWidth = 0
+        self.gutterPadding = ""
+
+        self.searchBar = SearchBar(self, toLengthVariants(_("Find text in diff|Find in diff")))
+        self.searchBar.textChanged.connect(lambda: self.viewport().update())
+        self.searchBar.searchNext.connect(lambda: self.search(SearchBar.Op.NEXT))
+        self.searchBar.searchPrevious.connect(lambda: self.search(SearchBar.Op.PREVIOUS))
+        self.searchBar.visibilityChanged.connect(lambda: self.viewport().update())
+        self.searchBar.hide()
+
+        self.progressBar = QProgressBar()
+        self.progressBar.setFormat(_("Loading diff… %p%"))
+        self.progressBar.hide()
+
+        self.indexTimer = QTimer(self)
+        self.indexTimer.setInterval(0)
+        self.indexTimer.timeout.connect(self.indexMoreRows)
+
+        self.refreshPrefs()
+        GFApplication.instance().restyle.connect(self.refreshPrefs)
+
+    # ---------------------------------------------
+    # Document replacement
+
+    def clear(self):
+        self.document = None
+        self.currentLocator = NavLocator()
+        self.currentPatch = None
+        self.anchorRow = -1
+        self.cursorRow = -1
+        self.growingHunk = -1
+        self.textWidth = 0
+        self.updateIndexingProgress()
+        self.updateScrollBars()
+        self.viewport().update()
+
+    def replaceDocument(self, repo: Repo, patch: Patch, locator: NavLocator, newDoc: VirtualDiffDocument):
+        if self.canReuseCurrentDocument(locator, patch, newDoc):
+            logger.debug("Don't need to replace virtual diff document.")
+            return
+
+        self.repo = repo
+        self.currentPatch = patch
+        self.currentLocator = locator
+        self.document = newDoc
+        self.textWidth = 0
+
+        lastHunk = patch.hunks[-1]
+        maxLine = max(lastHunk.new_start + lastHunk.new_lines, lastHunk.old_start + lastHunk.old_lines)
+        self.gutterPadding = "0" * (2 * len(str(maxLine)) + 2)
+
+        # Index enough rows to restore the position right away
+        neededRows = max(locator.diffLineNo, locator.diffScroll + self.visibleRowCount())
+        while len(newDoc) <= neededRows and not newDoc.indexMore():
+            pass
+
+        self.updateIndexingProgress()
+        self.updateScrollBars()
+        self.restorePosition(locator)
+        self.viewport().update()
+
+    def canReuseCurrentDocument(self, newLocator: NavLocator, newPatch: Patch, newDocument: VirtualDiffDocument
+                                ) -> bool:
+        """Detect if we're trying to reload the same patch that's already being displayed"""
+
+        if newLocator.hasFlags(NavFlags.ForceRecreateDocument):
+            return False
+
+        if self.document is None or not self.currentLocator.isSimilarEnoughTo(newLocator):
+            return False
+
+        assert self.currentPatch is not None
+        oldDelta = self.currentPatch.delta
+        newDelta = newPatch.delta
+        return (DiffFile_compare(oldDelta.old_file, newDelta.old_file)
+                and DiffFile_compare(oldDelta.new_file, newDelta.new_file)
+                and len(newDocument.data) == len(self.document.data))
+
+    # ---------------------------------------------
+    # Incremental indexing
+
+    def indexMoreRows(self):
+        document = self.document
+        if document is not None:
+            showingEnd = len(document) <= self.verticalScrollBar().value() + self.visibleRowCount()
+            document.indexMore()
+            self.updateScrollBars()
+            if self.growingHunk >= 0:
+                self.growHunkSelection()
+            elif showingEnd:
+                self.viewport().update()
+        self.updateIndexingProgress()
+
+    def growHunkSelection(self):
+        """ Extend a whole-hunk selection to the rows that were just indexed, without scrolling. """
+        _first, last = self.document.hunkRange(self.growingHunk)
+        if self.document.isComplete() or self.growingHunk < len(self.document.hunkRows) - 1:
+            self.growingHunk = -1
+        if last != self.cursorRow:
+            self.cursorRow = last
+            self.viewport().update()
+            self.emitSelectionHelp()
+
+    def finishIndexing(self):
+        """ Index the rest of the document now, e.g. before selecting all rows. """
+        if self.document is not None and not self.document.isComplete():
+            self.document.indexAll()
+            self.updateScrollBars()
+            self.viewport().update()
+        self.updateIndexingProgress()
+
+    def updateIndexingProgress(self):
+        document = self.document
+        if document is None or document.isComplete():
+            self.indexTimer.stop()
+            self.progressBar.hide()
+            return
+
+        self.progressBar.setValue(int(document.progress() * 100))
+        self.progressBar.show()
+        if not self.indexTimer.isActive():
+            self.indexTimer.start()
+
+    # ---------------------------------------------
+    # Position
+
+    def restorePosition(self, locator: NavLocator):
+        numRows = len(self.document)
+        row = min(max(locator.diffLineNo, 0), numRows - 1)
+        self.anchorRow = row
+        self.cursorRow = row
+        self.growingHunk = -1
+        self.verticalScrollBar().setValue(locator.diffScroll)
+
+    def getPreciseLocator(self):
+        return self.currentLocator.coarse().replace(
+            diffLineNo=self.cursorRow,
+            diffScroll=self.verticalScrollBar().value())
+
+    # ---------------------------------------------
+    # Prefs
+
+    def refreshPrefs(self):
+        monoFont = QFontDatabase.systemFont(QFontDatabase.SystemFont.FixedFont)
+        if settings.prefs.font:
+            monoFont.fromString(settings.prefs.font)
+        self.setFont(monoFont)
+
+        self.diffStyle = DiffStyle()
+        self.textWidth = 0
+        self.updateScrollBars()
+        self.viewport().update()
+
+    # ---------------------------------------------
+    # Geometry
+
+    def rowHeight(self) -> int:
+        return self.fontMetrics().height()
+
+    def gutterWidth(self) -> int:
+        return self.fontMetrics().horizontalAdvance(self.gutterPadding)
+
+    def visibleRowCount(self) -> int:
+        return max(1, self.viewport().height() // self.rowHeight())
+
+    def rowAt(self, y: int) -> int:
+        row = self.verticalScrollBar().value() + y // self.rowHeight()
+        return min(max(row, 0), len(self.document) - 1)
+
+    def updateScrollBars(self):
+        numRows = len(self.document) if self.document is not None else 0
+        visibleRows = self.visibleRowCount()
+        vsb = self.verticalScrollBar()
+        vsb.setRange(0, max(0, numRows - visibleRows))
+        vsb.setPageStep(visibleRows)
+        vsb.setSingleStep(1)
+
+        textAreaWidth = max(1, self.viewport().width() - self.gutterWidth() - self.TextMargin)
+        hsb = self.horizontalScrollBar()
+        hsb.setRange(0, max(0, self.textWidth - textAreaWidth))
+        hsb.setPageStep(textAreaWidth)
+        hsb.setSingleStep(self.fontMetrics().horizontalAdvance(" "))
+
+    def ensureRowVisible(self, row: int):
+        vsb = self.verticalScrollBar()
+        if row < vsb.value():
+            vsb.setValue(row)
+        elif row >= vsb.value() + self.visibleRowCount():
+            vsb.setValue(row - self.visibleRowCount() + 1)
+
+    # ---------------------------------------------
+    # Qt events
+
+    def resizeEvent(self, event: QResizeEvent):
+        super().resizeEvent(event)
+        self.updateScrollBars()
+
+    def scrollContentsBy(self, dx: int, dy: int):
+        self.viewport().update()
+
+    def focusInEvent(self, event: QFocusEvent):
+        super().focusInEvent(event)
+        self.viewport().update()
+
+    def focusOutEvent(self, event: QFocusEvent):
+        super().focusOutEvent(event)
+        self.viewport().update()
+
+    def paintEvent(self, event: QPaintEvent):
+        document = self.document
+        palette = self.palette()
+        painter = QPainter(self.viewport())
+        rect = self.viewport().rect()
+        painter.fillRect(rect, palette.color(QPalette.ColorRole.Base))
+
+        if document is None:
+            painter.end()
+            return
+
+        style = self.diffStyle
+        font = self.font()
+        fontMetrics = self.fontMetrics()
+        rowHeight = fontMetrics.height()
+        ascent = fontMetrics.ascent()
+        charWidth = max(1, fontMetrics.horizontalAdvance(" "))
+        gutterWidth = self.gutterWidth()
+        tabSpaces = settings.prefs.tabSpaces
+
+        firstRow = self.verticalScrollBar().value()
+        endRow = min(len(document), firstRow + rect.height() // rowHeight + 2)
+        lineNumbers = list(document.lineNumbers(firstRow, endRow))
+
+        # Only draw the columns that are visible, so that very long lines don't slow us down
+        scrollX = self.horizontalScrollBar().value()
+        firstColumn = scrollX // charWidth
+        numColumns = rect.width() // charWidth + 2
+        textX = gutterWidth + self.TextMargin + firstColumn * charWidth - scrollX
+
+        selectionStart, selectionEnd = self.getSelectedLineExtents()
+        selectionColor = QColor(palette.color(QPalette.ColorRole.Highlight))
+        selectionColor.setAlphaF(.5 if self.hasFocus() else .25)
+
+        searchTerm = self.searchBar.searchTerm if self.searchBar.isVisible() else ""
+
+        textPen = QPen(palette.color(QPalette.ColorRole.Text))
+        hunkPen = QPen(style.hunkCF.foreground().color())
+        warningPen = QPen(style.warningCF.foreground().color())
+        hunkFont = QFont(font)
+        hunkFont.setItalic(True)
+        warningFont = QFont(font)
+        warningFont.setWeight(QFont.Weight.Bold)
+        backgrounds = {"+": style.addBF1.background(), "-": style.delBF1.background()}
+
+        # Draw rows
+        painter.setClipRect(gutterWidth, 0, rect.width() - gutterWidth, rect.height())
+        textWidth = self.textWidth
+        for i, row in enumerate(range(firstRow, endRow)):
+            top = i * rowHeight
+            rowRect = QRect(gutterWidth, top, rect.width() - gutterWidth, rowHeight)
+            origin = document.origin(row)
+
+            if origin in backgrounds:
+                painter.fillRect(rowRect, backgrounds[origin])
+            if selectionStart <= row <= selectionEnd:
+                painter.fillRect(rowRect, selectionColor)
+
+            if origin == "@":
+                painter.setPen(hunkPen)
+                painter.setFont(hunkFont)
+            elif origin == "\\":
+                painter.setPen(warningPen)
+                painter.setFont(warningFont)
+            else:
+                painter.setPen(textPen)
+                painter.setFont(font)
+
+            text, rowColumns = document.rowColumns(row, firstColumn, numColumns, tabSpaces)
+            textWidth = max(textWidth, rowColumns * charWidth + self.TextMargin * 2)
+            painter.drawText(textX, top + ascent, text)
+
+            if searchTerm:
+                needleRect = QRect(textX, top, rect.width(), rowHeight)
+                lowerText = text.lower()
+                needlePos = lowerText.find(searchTerm)
+                while needlePos >= 0:
+                    SearchBar.highlightNeedle(painter, needleRect, text, needlePos, len(searchTerm))
+                    needlePos = lowerText.find(searchTerm, needlePos + len(searchTerm))
+
+        # Draw gutter
+        painter.setClipping(False)
+        painter.setFont(font)
+        themeFG = palette.color(QPalette.ColorRole.Text)
+        themeBG = palette.color(QPalette.ColorRole.Base)
+        gutterColor = themeBG.darker(105) if isDarkTheme(palette) else themeBG.lighter(140)
+        lineColor = QColor(themeFG.red(), themeFG.green(), themeFG.blue(), 80)
+        rightEdge = gutterWidth - 1
+        columnWidth = (rightEdge - 3) // 2
+        noOldPlaceholder = "+" if settings.prefs.colorblind else "·"
+        noNewPlaceholder = "-" if settings.prefs.colorblind else "·"
+
+        painter.fillRect(0, 0, gutterWidth, rect.height(), gutterColor)
+        painter.fillRect(rightEdge, 0, 1, rect.height(), lineColor)
+        textPen = QPen(lineColor)
+        linePen = QPen(lineColor, 1, Qt.PenStyle.DashLine)
+
+        for i, (oldLine, newLine) in enumerate(lineNumbers):
+            top = i * rowHeight
+            origin = document.origin(firstRow + i)
+            if origin == "@":
+                y = top + rowHeight // 2
+                painter.setPen(linePen)
+                painter.drawLine(QLine(0, y, rightEdge, y))
+            elif origin != "\\":
+                old = str(oldLine) if oldLine > 0 else noOldPlaceholder
+                new = str(newLine) if newLine > 0 else noNewPlaceholder
+                painter.setPen(textPen)
+                painter.drawText(0, top, columnWidth, rowHeight, Qt.AlignmentFlag.AlignRight, old)
+                painter.drawText(columnWidth, top, columnWidth, rowHeight, Qt.AlignmentFlag.AlignRight, new)
+
+        painter.end()
+
+        if textWidth > self.textWidth:
+            self.textWidth = textWidth
+            self.updateScrollBars()
+
+    def mousePressEvent(self, event: QMouseEvent):
+        if self.document is None or event.button() != Qt.MouseButton.LeftButton:
+            super().mousePressEvent(event)
+            return
+
+        row = self.rowAt(event.position().toPoint().y())
+        if event.modifiers() & Qt.KeyboardModifier.ShiftModifier and self.anchorRow >= 0:
+            self.selectRows(self.anchorRow, row)
+        else:
+            self.selectRows(row, row)
+
+    def mouseMoveEvent(self, event: QMouseEvent):
+        if self.document is None or event.buttons() != Qt.MouseButton.LeftButton:
+            super().mouseMoveEvent(event)
+            return
+
+        row = self.rowAt(event.position().toPoint().y())
+        self.selectRows(self.anchorRow, row)
+
+    def mouseDoubleClickEvent(self, event: QMouseEvent):
+        if self.document is None or event.button() != Qt.MouseButton.LeftButton:
+            super().mouseDoubleClickEvent(event)
+            return
+
+        self.selectClumpOfLinesAt(self.rowAt(event.position().toPoint().y()))
+
+    def contextMenuEvent(self, event: QContextMenuEvent):
+        try:
+            menu = self.contextMenu(event.globalPos())
+            if not menu:
+                return
+            menu.exec(event.globalPos())
+            menu.deleteLater()
+        except Exception as exc:  # pragma: no cover
+            # Avoid exceptions in contextMenuEvent at all costs to prevent a crash
+            excMessageBox(exc, message="Failed to create VirtualDiffView context menu")
+
+    def keyPressEvent(self, event: QKeyEvent):
+        if self.document is None:
+            super().keyPressEvent(event)
+            return
+
+        k = event.key()
+        navContext = self.currentLocator.context
+        shift = bool(event.modifiers() & Qt.KeyboardModifier.ShiftModifier)
+        pageStep = self.visibleRowCount()
+        if k == Qt.Key.Key_End:
+            self.finishIndexing()
+        moves = {
+            Qt.Key.Key_Up: self.cursorRow - 1,
+            Qt.Key.Key_Down: self.cursorRow + 1,
+            Qt.Key.Key_PageUp: self.cursorRow - pageStep,
+            Qt.Key.Key_PageDown: self.cursorRow + pageStep,
+            Qt.Key.Key_Home: 0,
+            Qt.Key.Key_End: len(self.document) - 1,
+        }
+
+        if k in GlobalShortcuts.stageHotkeys:
+            if navContext == NavContext.UNSTAGED:
+                self.stageSelection()
+            else:
+                QApplication.beep()
+        elif k in GlobalShortcuts.discardHotkeys:
+            if navContext == NavContext.STAGED:
+                self.unstageSelection()
+            elif navContext == NavContext.UNSTAGED:
+                self.discardSelection()
+            else:
+                QApplication.beep()
+        elif k == Qt.Key.Key_Escape:
+            if self.searchBar.isVisible():
+                self.searchBar.hide()
+            else:
+                QApplication.beep()
+        elif event.matches(QKeySequence.StandardKey.Copy):
+            self.copySelection()
+        elif event.matches(QKeySequence.StandardKey.SelectAll):
+            self.selectAll()
+        elif k in moves:
+            row = min(max(moves[k], 0), len(self.document) - 1)
+            self.selectRows(self.anchorRow if shift else row, row)
+        else:
+            super().keyPressEvent(event)
+
+    # ---------------------------------------------
+    # Selection
+
+    def selectRows(self, anchorRow: int, cursorRow: int):
+        self.anchorRow = anchorRow
+        self.cursorRow = cursorRow
+        self.growingHunk = -1
+        self.ensureRowVisible(cursorRow)
+        self.viewport().update()
+        self.emitSelectionHelp()
+
+    def selectAll(self):
+        self.finishIndexing()
+        self.selectRows(0, len(self.document) - 1)
+
+    def selectClumpOfLinesAt(self, row: int):
+        document = self.document
+        origin = document.origin(row)
+        if origin == "@":
+            # Hunk header line, select whole hunk
+            hunkID = document.hunkID(row)
+            start, end = document.hunkRange(hunkID)
+            self.selectRows(start, end)
+            # The rest of the hunk may not be indexed yet; keep selecting it as it comes in
+            if not document.isComplete() and hunkID == len(document.hunkRows) - 1:
+                self.growingHunk = hunkID
+            return
+        elif origin in "+-":
+            start, end = document.clumpRange(row)
+        else:
+            QApplication.beep()
+            return
+        self.selectRows(start, end)
+
+    def getSelectedLineExtents(self) -> tuple[int, int]:
+        if self.document is None or self.cursorRow < 0:
+            return -1, -1
+        return min(self.anchorRow, self.cursorRow), max(self.anchorRow, self.cursorRow)
+
+    def isSelectionActionable(self):
+        start, end = self.getSelectedLineExtents()
+        if start < 0:
+            return False
+        return any(self.document.countOrigins(origin, start, end + 1) for origin in "+-")
+
+    def copySelection(self):
+        start, end = self.getSelectedLineExtents()
+        if start < 0:
+            QApplication.beep()
+            return
+        text = "\n".join(self.document.rowText(row) for row in range(start, end + 1))
+        QApplication.clipboard().setText(text)
+
+    # ---------------------------------------------
+    # Context menu
+
+    def contextMenu(self, globalPos: QPoint):
+        if self.document is None:
+            return None
+
+        assert self.currentPatch is not None
+
+        clickedRow = self.rowAt(self.viewport().mapFromGlobal(globalPos).y())
+        clickedHunkID = self.document.hunkID(clickedRow)
+
+        start, end = self.getSelectedLineExtents()
+        hasSelection = start <= clickedRow <= end and self.isSelectionActionable()
+
+        actions = self.patchActions(hasSelection, clickedHunkID)
+
+        actions += [
+            ActionDef.SEPARATOR,
+            ActionDef(_("Copy"), self.copySelection, shortcuts=QKeySequence.StandardKey.Copy, enabled=start >= 0),
+            ActionDef(_("Select All"), self.selectAll, shortcuts=QKeySequence.StandardKey.SelectAll),
+            ActionDef.SEPARATOR,
+            ActionDef(_("Load Formatted Diff (this may take a moment)"), self.loadFormattedDiff),
+        ]
+
+        menu = ActionDef.makeQMenu(self, actions)
+        menu.setObjectName("VirtualDiffViewContextMenu")
+        return menu
+
+    def loadFormattedDiff(self):
+        locator = self.currentLocator.withExtraFlags(NavFlags.AllowLargeFiles | NavFlags.AllowLongLines)
+        Jump.invoke(self, locator)
+
+    # ---------------------------------------------
+    # Patch
+
+    def lineHunkPos(self, line: int) -> DiffLinePos:
+        return self.document.hunkPos(line)
+
+    # ---------------------------------------------
+    # Search
+
+    def search(self, op: SearchBar.Op):
+        assert isinstance(op, SearchBar.Op)
+        self.searchBar.popUp(forceSelectAll=op == SearchBar.Op.START)
+
+        if op == SearchBar.Op.START:
+            return
+
+        message = self.searchBar.searchTerm
+        if not message or self.document is None:
+            QApplication.beep()
+            return
+
+        backward = op == SearchBar.Op.PREVIOUS
+        row = self.document.find(message, self.cursorRow, backward)
+        if row >= 0:
+            self.selectRows(row, row)
+            return
+
+        def wrapAround():
+            self.cursorRow = len(self.document) if backward else -1
+            self.growingHunk = -1
+            self.search(op)
+
+        prompt = [
+            _("End of diff reached.") if op == SearchBar.Op.NEXT
+            else _("Top of diff reached."),
+            _("No more occurrences of {0} found.").format(bquo(message))
+        ]
+        askConfirmation(self, _("Find in Diff"), paragraphs(prompt), okButtonText=_("Wrap Around"),
+                        messageBoxIcon="information", callback=wrapAround)
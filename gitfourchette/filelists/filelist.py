@@ -170,6 +170,11 @@ class FileList(QListView):
         self.skippedRenameDetection = skippedRenameDetection
         self.updateFocusPolicy()
 
+    def updateContents(self, diffs: list[Diff], paths: set[str]):
+        """ Refresh the files under the given paths from diffs limited to these paths. """
+        self.flModel.updateDiffs(diffs, paths)
+        self.updateFocusPolicy()
+
     def clear(self):
         self.flModel.clear()
         self.commitId = NULL_OID
@@ -231,6 +236,11 @@ class FileList(QListView):
         return [
             ActionDef.SEPARATOR,
 
+            ActionDef(
+                _n("Show &History of This File", "Show &History of These Files", n),
+                self.showPathHistory,
+            ),
+
             ActionDef(
                 _n("Open &Folder", "Open {n} &Folders", n),
                 self.showInFolder,
@@ -548,6 +558,14 @@ class FileList(QListView):
         assert len(patches) == 1
         ApplyPatchData.invoke(self, patches[0].text, reverse=True)
 
+    def adjacentEntries(self) -> list[FileListModel.Entry]:
+        """ Entries in the rows just below and above the current row. """
+        row = self.currentIndex().row()
+        if row < 0:
+            return []
+        entries = self.flModel.entries
+        return [entries[adjacentRow] for adjacentRow in (row + 1, row - 1) if 0 <= adjacentRow < len(entries)]
+
     def firstPath(self) -> str:
         index: QModelIndex = self.flModel.index(0)
         if index.isValid():
@@ -601,6 +619,14 @@ class FileList(QListView):
             paths.add(patch.delta.new_file.path)
         NewStash.invoke(self, list(paths))
 
+    def showPathHistory(self):
+        paths = set()
+        for patch in self.selectedPatches():
+            # Include the old path of a rename so that the history doesn't stop here
+            paths.add(patch.delta.old_file.path)
+            paths.add(patch.delta.new_file.path)
+        ShowPathHistory.invoke(self, sorted(paths))
+
     def openSubmoduleTabs(self):
         patches = [p for p in self.selectedPatches() if p.delta.new_file.mode in [FileMode.COMMIT]]
         for patch in patches:
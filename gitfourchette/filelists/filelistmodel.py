@@ -4,8 +4,10 @@
 # For full terms, see the included LICENSE file.
 # -----------------------------------------------------------------------------
 
+import bisect
 import logging
 import os
+from collections.abc import Generator
 from contextlib import suppress
 from dataclasses import dataclass
 from typing import Any
@@ -176,23 +178,61 @@ class FileListModel(QAbstractListModel):
         self.highlightedCounterpartRow = -1
         self.modelReset.emit()
 
-    def setDiffs(self, diffs: list[Diff]):
-        self.beginResetModel()
-
-        self.entries.clear()
-        self.fileRows.clear()
-
+    def makeEntries(self, diffs: list[Diff]) -> Generator[Entry, None, None]:
         for diff in diffs:
             for patchNo, delta in enumerate(diff.deltas):
                 if self.skipConflicts and delta.status == DeltaStatus.CONFLICTED:
                     continue
                 path = delta.new_file.path
                 path = path.removesuffix("/")  # trees (submodules) have a trailing slash - remove for NavLocator consistency
-                self.fileRows[path] = len(self.entries)
-                self.entries.append(FileListModel.Entry(delta, diff, patchNo, path))
+                yield FileListModel.Entry(delta, diff, patchNo, path)
 
+    def setDiffs(self, diffs: list[Diff]):
+        self.beginResetModel()
+        self.entries = list(self.makeEntries(diffs))
+        self.updateFileRows()
         self.endResetModel()
 
+    def updateDiffs(self, diffs: list[Diff], paths: set[str]):
+        """
+        Replace the entries under the given paths (files or directories) with
+        the ones from diffs limited to these paths. Other entries are left as
+        they are, so the selection in the view is preserved.
+        """
+        newEntries = {entry.canonicalPath: entry for entry in self.makeEntries(diffs)}
+
+        # Update or remove the entries under the paths (bottom-up so the row numbers stay valid)
+        for row in range(len(self.entries) - 1, -1, -1):
+            entry = self.entries[row]
+            if not (isUnderPaths(entry.canonicalPath, paths) or isUnderPaths(entry.delta.old_file.path, paths)):
+                continue
+            try:
+                self.entries[row] = newEntries.pop(entry.canonicalPath)
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+            except KeyError:
+                self.beginRemoveRows(QModelIndex_default, row, row)
+                del self.entries[row]
+                self.endRemoveRows()
+
+        # Insert new entries in path order, like libgit2 does
+        for path, entry in newEntries.items():
+            row = bisect.bisect_left(self.entries, path, key=lambda e: e.canonicalPath)
+            self.beginInsertRows(QModelIndex_default, row, row)
+            self.entries.insert(row, entry)
+            self.endInsertRows()
+
+        self.updateFileRows()
+
+    def updateFileRows(self):
+        self.fileRows = {entry.canonicalPath: row for row, entry in enumerate(self.entries)}
+
+    def hasRenamesUnder(self, paths: set[str]) -> bool:
+        """ Return True if any renamed or copied entry involves the given paths (files or directories). """
+        return any(entry.delta.status in (DeltaStatus.RENAMED, DeltaStatus.COPIED)
+                   and (isUnderPaths(entry.canonicalPath, paths) or isUnderPaths(entry.delta.old_file.path, paths))
+                   for entry in self.entries)
+
     def rowCount(self, parent: QModelIndex = QModelIndex_default) -> int:
         return len(self.entries)
 
@@ -110,6 +110,8 @@ class SearchBar(QWidget):
         self.searchPulseTimer.timeout.connect(self.searchPulse)
 
         tweakWidgetFont(self.lineEdit, 85)
+        tweakWidgetFont(self.ui.matchCountLabel, 85)
+        self.ui.matchCountLabel.hide()
 
     def keyPressEvent(self, event: QKeyEvent):
         if not self.lineEdit.hasFocus():
@@ -157,6 +159,7 @@ class SearchBar(QWidget):
 
     def onSearchTextChanged(self, text: str):
         self.turnRed(False)
+        self.setMatchCount(-1)
         self.searchTerm = text.strip().lower()
 
         if self.detectHashes and 0 < len(self.searchTerm) <= 40:
@@ -176,6 +179,19 @@ class SearchBar(QWidget):
         if wasRed ^ red:  # trigger stylesheet refresh
             self.setStyleSheet("* {}")
 
+    def setMatchCount(self, count: int, final: bool = True):
+        """ Show how many items match the search term. Pass -1 to hide the count. """
+        label = self.ui.matchCountLabel
+        if count < 0:
+            label.hide()
+            return
+        if final:
+            text = _np("SearchBar", "{n} match", "{n} matches", count)
+        else:
+            text = _p("SearchBar", "{0} matches so far…").format(count)
+        label.setText(text)
+        label.show()
+
     def searchRange(self, r: range) -> QModelIndex | None:
         """ Proxy for buddy.searchRange """
         assert hasattr(self.buddy, "searchRange"), "missing searchRange callback"
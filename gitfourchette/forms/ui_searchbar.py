@@ -27,6 +27,10 @@ class Ui_SearchBar(object):
         self.lineEdit.setClearButtonEnabled(True)
         self.lineEdit.setObjectName("lineEdit")
         self.horizontalLayout.addWidget(self.lineEdit)
+        self.matchCountLabel = QLabel(parent=SearchBar)
+        self.matchCountLabel.setText("0")
+        self.matchCountLabel.setObjectName("matchCountLabel")
+        self.horizontalLayout.addWidget(self.matchCountLabel)
         self.forwardButton = QToolButton(parent=SearchBar)
         self.forwardButton.setText("↓")
         self.forwardButton.setObjectName("forwardButton")
@@ -21,3 +21,12 @@ from gitfourchette.graph.graphbuilder import (
     GraphSpliceLoop,
     MockCommit,
 )
+from gitfourchette.graph.graphcache import (
+    GraphCache,
+    GraphCacheError,
+)
+from gitfourchette.graph.commitgraphfile import (
+    CommitGraphError,
+    CommitGraphFile,
+    commitGraphEnabled,
+)
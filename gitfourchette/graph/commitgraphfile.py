@@ -0,0 +1,675 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+Reader for git's commit-graph file (objects/info/commit-graph) and split
+commit-graph chains (objects/info/commit-graphs/).
+
+The commit-graph file stores the parents and commit time of every commit in
+flat tables, so we can sort the history topologically without inflating a
+single commit object from the ODB.
+
+It may also store a changed-path Bloom filter for every commit, which tells us
+that a commit definitely doesn't touch a path without diffing any trees.
+
+File format reference: https://git-scm.com/docs/commit-graph
+"""
+
+from __future__ import annotations
+
+import bisect
+import heapq
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import deque
+from collections.abc import Callable, Iterator, Sequence
+from typing import Any
+
+from gitfourchette.graph.graph import Oid
+from gitfourchette.graph.graphbuilder import MockCommit
+from gitfourchette.porcelain import Oid as _RealOidType, Repo
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct(">4sBBBB")
+_TOC_ENTRY = struct.Struct(">4sQ")
+_BLOOM_HEADER = struct.Struct(">III")
+
+_NO_PARENT = 0x70000000
+_EXTRA_EDGES = 0x80000000
+_LAST_EDGE = 0x80000000
+
+_HASH_LENGTHS = {1: 20, 2: 32}
+
+_BLOOM_SEEDS = (0x293ae76f, 0x7e646e2c)
+_BLOOM_VERSIONS = (1, 2)
+
+
+class CommitGraphError(Exception):
+    pass
+
+
+class CommitGraphStale(CommitGraphError):
+    """ Too many commits are missing from the commit-graph file to make it worthwhile. """
+    pass
+
+
+class _Layer:
+    """ One file in a commit-graph chain (or the sole commit-graph file). """
+
+    def __init__(self, path: str, offset: int, hashLength: int | None):
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            try:
+                self._parse(mm, offset, hashLength)
+            except (struct.error, ValueError, IndexError) as exc:
+                raise CommitGraphError(f"{os.path.basename(path)}: {exc}") from exc
+
+    def _parse(self, mm: mmap.mmap, offset: int, hashLength: int | None):
+        signature, version, hashVersion, numChunks, _numBases = _HEADER.unpack_from(mm, 0)
+        if signature != b"CGPH" or version != 1:
+            raise CommitGraphError("bad commit-graph header")
+        try:
+            self.hashLength = _HASH_LENGTHS[hashVersion]
+        except KeyError as exc:
+            raise CommitGraphError(f"unsupported hash version {hashVersion}") from exc
+        if hashLength is not None and hashLength != self.hashLength:
+            raise CommitGraphError("hash version mismatch in commit-graph chain")
+
+        toc = [_TOC_ENTRY.unpack_from(mm, _HEADER.size + i * _TOC_ENTRY.size) for i in range(numChunks + 1)]
+        chunks = {}
+        for (chunkID, start), (_, end) in zip(toc, toc[1:], strict=False):
+            if not 0 <= start <= end <= len(mm):
+                raise CommitGraphError("bad chunk offsets")
+            chunks[chunkID] = (start, end)
+
+        try:
+            fanout = _bigEndianArray(mm, *chunks[b"OIDF"])
+            oidStart, oidEnd = chunks[b"OIDL"]
+            cdat = _bigEndianArray(mm, *chunks[b"CDAT"])
+        except KeyError as exc:
+            raise CommitGraphError(f"missing chunk {exc}") from exc
+
+        count = fanout[255] if len(fanout) == 256 else -1
+        stride = (self.hashLength + 16) // 4
+        if count < 0 or oidEnd - oidStart != count * self.hashLength or len(cdat) != count * stride:
+            raise CommitGraphError("inconsistent chunk sizes")
+
+        self.offset = offset
+        self.count = count
+        self.fanout = fanout
+        self.oids = mm[oidStart: oidEnd]
+
+        fieldOffset = self.hashLength // 4  # skip root tree oid
+        self.parent1 = cdat[fieldOffset + 0:: stride]
+        self.parent2 = cdat[fieldOffset + 1:: stride]
+        self.timeHigh = cdat[fieldOffset + 2:: stride]
+        self.timeLow = cdat[fieldOffset + 3:: stride]
+
+        try:
+            self.edges = _bigEndianArray(mm, *chunks[b"EDGE"])
+        except KeyError:
+            self.edges = array("I")
+
+        # Changed-path Bloom filters are optional (git commit-graph write --changed-paths)
+        self.bloomVersion = 0
+        self.bloomNumHashes = 0
+        self.bloomIndex = array("I")
+        self.bloomData = b""
+        if b"BIDX" in chunks and b"BDAT" in chunks:
+            bdatStart, bdatEnd = chunks[b"BDAT"]
+            version, numHashes, _bitsPerEntry = _BLOOM_HEADER.unpack_from(mm, bdatStart)
+            bloomIndex = _bigEndianArray(mm, *chunks[b"BIDX"])
+            if version in _BLOOM_VERSIONS and numHashes > 0 and len(bloomIndex) == count:
+                self.bloomVersion = version
+                self.bloomNumHashes = numHashes
+                self.bloomIndex = bloomIndex
+                self.bloomData = mm[bdatStart + _BLOOM_HEADER.size: bdatEnd]
+
+    def find(self, raw: bytes) -> int:
+        """ Return the global position of a commit in this layer, or -1. """
+        h = self.hashLength
+        firstByte = raw[0]
+        lo = self.fanout[firstByte - 1] if firstByte > 0 else 0
+        hi = self.fanout[firstByte]
+        oids = self.oids
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = oids[mid * h: mid * h + h]
+            if candidate < raw:
+                lo = mid + 1
+            elif candidate > raw:
+                hi = mid
+            else:
+                return self.offset + mid
+        return -1
+
+    def bloomFilter(self, local: int) -> bytes:
+        """ Return the changed-path Bloom filter of a commit in this layer (empty if none). """
+        if not self.bloomVersion:
+            return b""
+        start = self.bloomIndex[local - 1] if local > 0 else 0
+        end = self.bloomIndex[local]
+        if not start <= end <= len(self.bloomData):
+            return b""
+        return self.bloomData[start: end]
+
+
+class CommitGraphFile:
+    """
+    Read-only view of a repository's commit-graph.
+
+    Commits are identified by their global position in the commit-graph
+    (base layers first). Commits that are absent from the commit-graph may
+    be supplied by a fallback lookup function; they receive positions past
+    the end of the file.
+    """
+
+    maxMissingCommits = 10_000
+    "Give up on the commit-graph if more commits than this must be read from the ODB."
+
+    def __init__(self, layers: list[_Layer]):
+        self.layers = layers
+        self.layerOffsets = [layer.offset for layer in layers]
+        self.numCommits = sum(layer.count for layer in layers)
+
+        self.parent1 = array("I")
+        self.parent2 = array("I")
+        self.timeHigh = array("I")
+        self.timeLow = array("I")
+        for layer in layers:
+            self.parent1.extend(layer.parent1)
+            self.parent2.extend(layer.parent2)
+            self.timeHigh.extend(layer.timeHigh)
+            self.timeLow.extend(layer.timeLow)
+
+        # Commits missing from the commit-graph
+        self.missingIndex: dict[Oid, int] = {}
+        self.missingOids: list[Oid] = []
+        self.missingParents: list[list[Oid] | list[int]] = []
+        self.missingTimes: list[int] = []
+        self.numLookups = 0
+
+        self._bloomKeys: dict[tuple[str, int, int], list[list[int]] | None] = {}
+
+    @staticmethod
+    def open(gitDir: str) -> CommitGraphFile | None:
+        """
+        Load the commit-graph of the repository at `gitDir` (the .git directory).
+        Return None if the repository doesn't have a commit-graph.
+        Raise CommitGraphError if the commit-graph is corrupt.
+        """
+        infoDir = os.path.join(_commonDir(gitDir), "objects", "info")
+
+        singlePath = os.path.join(infoDir, "commit-graph")
+        if os.path.isfile(singlePath):
+            return CommitGraphFile([_Layer(singlePath, 0, None)])
+
+        chainDir = os.path.join(infoDir, "commit-graphs")
+        chainPath = os.path.join(chainDir, "commit-graph-chain")
+        if not os.path.isfile(chainPath):
+            return None
+
+        with open(chainPath, encoding="ascii") as chainFile:
+            hashes = [line.strip() for line in chainFile if line.strip()]
+
+        layers = []
+        offset = 0
+        hashLength = None
+        for layerHash in hashes:
+            layer = _Layer(os.path.join(chainDir, f"graph-{layerHash}.graph"), offset, hashLength)
+            hashLength = layer.hashLength
+            offset += layer.count
+            layers.append(layer)
+
+        if not layers:
+            return None
+        return CommitGraphFile(layers)
+
+    def _layerOf(self, pos: int) -> _Layer:
+        return self.layers[bisect.bisect_right(self.layerOffsets, pos) - 1]
+
+    def find(self, oid: Oid) -> int:
+        """ Return the position of a commit in the commit-graph, or -1. """
+        raw = oid.raw
+        for layer in self.layers:
+            pos = layer.find(raw)
+            if pos >= 0:
+                return pos
+        return -1
+
+    def oidAt(self, pos: int) -> Oid:
+        if pos >= self.numCommits:
+            return self.missingOids[pos - self.numCommits]
+        layer = self._layerOf(pos)
+        h = layer.hashLength
+        local = pos - layer.offset
+        return _RealOidType(raw=layer.oids[local * h: local * h + h])
+
+    @property
+    def hasChangedPaths(self) -> bool:
+        """ True if any layer of the commit-graph has changed-path Bloom filters. """
+        return any(layer.bloomVersion for layer in self.layers)
+
+    def mayChangePaths(self, pos: int, paths: Sequence[str]) -> bool | None:
+        """
+        Consult the changed-path Bloom filter of a commit. Return False if the
+        commit definitely doesn't touch any of the given paths (compared to its
+        first parent), True if it may touch any of them, or None if the commit
+        doesn't have a usable filter.
+
+        Paths are relative to the root of the repository, without a trailing
+        slash. A path may be a directory.
+        """
+        if pos >= self.numCommits:
+            return None
+
+        layer = self._layerOf(pos)
+        bloomFilter = layer.bloomFilter(pos - layer.offset)
+        if not bloomFilter:  # Filter wasn't computed
+            return None
+
+        numBits = len(bloomFilter) * 8
+        for path in paths:
+            keys = self._getBloomKeys(path, layer.bloomVersion, layer.bloomNumHashes)
+            if keys is None:
+                return None
+            # The path's leading directories must all be in the filter as well
+            if all(all(bloomFilter[(h % numBits) >> 3] & (1 << (h % numBits & 7)) for h in key) for key in keys):
+                return True
+        return False
+
+    def _getBloomKeys(self, path: str, version: int, numHashes: int) -> list[list[int]] | None:
+        cacheKey = (path, version, numHashes)
+        try:
+            return self._bloomKeys[cacheKey]
+        except KeyError:
+            pass
+
+        data = path.encode("utf-8")
+        if version == 1 and not data.isascii():
+            # Version 1 filters were hashed with signed chars, which we can't trust
+            keys = None
+        else:
+            keys = []
+            while data:
+                h0, h1 = (_murmur3(seed, data) for seed in _BLOOM_SEEDS)
+                keys.append([(h0 + i * h1) & 0xFFFFFFFF for i in range(numHashes)])
+                data = data.rpartition(b"/")[0]
+
+        self._bloomKeys[cacheKey] = keys
+        return keys
+
+    def commitTime(self, pos: int) -> int:
+        if pos >= self.numCommits:
+            return self.missingTimes[pos - self.numCommits]
+        return ((self.timeHigh[pos] & 0x3) << 32) | self.timeLow[pos]
+
+    def parentPositions(self, pos: int, lookUpMissing: Callable[[Oid], tuple[int, list[Oid]]] | None) -> list[int]:
+        if pos >= self.numCommits:
+            i = pos - self.numCommits
+            parents = self.missingParents[i]
+            if parents and not isinstance(parents[0], int):
+                parents = [self.resolve(p, lookUpMissing) for p in parents]
+                self.missingParents[i] = parents
+            return parents
+
+        p1 = self.parent1[pos]
+        if p1 == _NO_PARENT:
+            return []
+        p2 = self.parent2[pos]
+        if p2 == _NO_PARENT:
+            return [p1]
+        if not p2 & _EXTRA_EDGES:
+            return [p1, p2]
+
+        # Octopus merge: parents beyond the first are listed in the EDGE chunk
+        parents = [p1]
+        edges = self._layerOf(pos).edges
+        e = p2 & ~_EXTRA_EDGES
+        while True:
+            edge = edges[e]
+            parents.append(edge & ~_LAST_EDGE)
+            if edge & _LAST_EDGE:
+                break
+            e += 1
+        return parents
+
+    def resolve(self, oid: Oid, lookUpMissing: Callable[[Oid], tuple[int, list[Oid]]] | None) -> int:
+        """
+        Return the position of a commit. If the commit is absent from the
+        commit-graph, `lookUpMissing(oid)` must return its commit time and
+        parent ids.
+        """
+        pos = self.find(oid)
+        if pos >= 0:
+            return pos
+
+        try:
+            return self.missingIndex[oid]
+        except KeyError:
+            pass
+
+        if lookUpMissing is None or self.numLookups >= self.maxMissingCommits:
+            raise CommitGraphStale(f"commit {oid} isn't in the commit-graph")
+
+        self.numLookups += 1
+        commitTime, parentIds = lookUpMissing(oid)
+        return self._addMissing(oid, commitTime, list(parentIds))
+
+    def _addMissing(self, oid: Oid, commitTime: int, parentIds: list[Oid]) -> int:
+        pos = self.numCommits + len(self.missingOids)
+        self.missingIndex[oid] = pos
+        self.missingOids.append(oid)
+        self.missingTimes.append(commitTime)
+        self.missingParents.append(parentIds)
+        return pos
+
+    def addCommits(self, oids: bytes, parentCounts: array, parentOids: bytes, times: array, oidLength: int = 20):
+        """
+        Register commits that were read from another source (see packscan)
+        as flat buffers: raw ids back to back, number of parents of each
+        commit, raw parent ids back to back, and commit times.
+
+        Commits that are already known are skipped. These commits don't count
+        towards maxMissingCommits.
+        """
+        h = oidLength
+        p = 0
+        missingIndex = self.missingIndex
+        for i, (numParents, commitTime) in enumerate(zip(parentCounts, times, strict=True)):
+            oid = _RealOidType(raw=oids[i * h: i * h + h])
+            parentIds = [_RealOidType(raw=parentOids[q * h: q * h + h]) for q in range(p, p + numParents)]
+            p += numParents
+            if oid not in missingIndex and self.find(oid) < 0:
+                self._addMissing(oid, commitTime, parentIds)
+
+    def topologicalSequence(
+            self,
+            tips: Sequence[Oid],
+            timeSort: bool,
+            lookUpMissing: Callable[[Oid], tuple[int, list[Oid]]] | None = None,
+            makeCommit: Callable[[Oid, list[Oid]], Any] = MockCommit,
+    ) -> Iterator:
+        """
+        Sort all commits reachable from `tips` in the same order as libgit2's
+        revwalk with GIT_SORT_TOPOLOGICAL (optionally combined with
+        GIT_SORT_TIME), given that the tips are pushed in the order listed.
+
+        The commits are sorted right away, but the returned iterator only
+        creates each commit, with `makeCommit(id, parentIds)`, once it's
+        reached. This way, the top of the history can be used before commit
+        objects have been created for the entire history.
+
+        Raise CommitGraphStale if too many commits are missing from the
+        commit-graph.
+        """
+
+        positions, parentsOf, timeOf = self._limitList(tips, lookUpMissing)
+        positions = self._sortInTopologicalOrder(positions, parentsOf, timeOf, timeSort)
+
+        # Every parent was reached by the walk, so oidAt can look it up
+        oidAt = self.oidAt
+        return (makeCommit(oidAt(pos), [oidAt(parent) for parent in parentsOf[pos]]) for pos in positions)
+
+    def _limitList(self, tips, lookUpMissing) -> tuple[list[int], dict[int, list[int]], dict[int, int]]:
+        """ Mirrors `prepare_walk` + `limit_list` in libgit2's revwalk.c """
+
+        commitTime = self.commitTime
+        parentPositions = self.parentPositions
+        timeOf: dict[int, int] = {}  # also serves as the 'seen' set
+        parentsOf: dict[int, list[int]] = {}
+
+        # libgit2 inserts each parent in front of the first commit in the queue
+        # that is older than the parent ("by date"). To avoid linear-time
+        # insertions, the queue is kept as a series of runs sorted by
+        # descending date, front first. There's only one run unless the tips
+        # were pushed out of chronological order, and insertions never start
+        # new runs. Each run is a heap ordered by date, then by insertion
+        # order, which is the same as inserting in front of the first older
+        # commit within the run. A run's oldest date only changes when a
+        # commit is appended to the last run, so we keep track of it.
+        # Heap keys pack the date and the insertion order into a single int
+        # (cheaper to compare than tuples); `items` maps insertion order to commits.
+        runs: deque[list[int]] = deque()
+        oldest: deque[int] = deque()
+        items: list[int] = []
+
+        def appendToQueue(pos: int, t: int):
+            key = (-t << 32) | len(items)
+            items.append(pos)
+            if runs and oldest[-1] >= t:
+                heapq.heappush(runs[-1], key)
+                oldest[-1] = t
+            else:
+                runs.append([key])
+                oldest.append(t)
+
+        # Pushed tips come out last-in, first-out.
+        for tip in reversed(tips):
+            pos = self.resolve(tip, lookUpMissing)
+            if pos not in timeOf:
+                timeOf[pos] = commitTime(pos)
+                appendToQueue(pos, timeOf[pos])
+
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        result = []
+        while runs:
+            run = runs[0]
+            pos = items[heappop(run) & 0xFFFFFFFF]
+            if not run:
+                runs.popleft()
+                oldest.popleft()
+
+            parents = parentPositions(pos, lookUpMissing)
+            parentsOf[pos] = parents
+
+            for parent in parents:
+                if parent in timeOf:
+                    continue
+                t = commitTime(parent)
+                timeOf[parent] = t
+
+                key = (-t << 32) | len(items)
+                items.append(parent)
+                if not runs:
+                    runs.append([key])
+                    oldest.append(t)
+                    continue
+                for run, runOldest in zip(runs, oldest, strict=True):
+                    if runOldest < t:
+                        heappush(run, key)
+                        break
+                else:
+                    # No older commits: append to the end of the queue (the last run stays sorted)
+                    heappush(runs[-1], key)
+                    oldest[-1] = t
+
+            result.append(pos)
+
+        return result, parentsOf, timeOf
+
+    @staticmethod
+    def _sortInTopologicalOrder(positions: list[int], parentsOf: dict[int, list[int]], timeOf: dict[int, int],
+                                timeSort: bool) -> list[int]:
+        """ Mirrors `sort_in_topological_order` in libgit2's revwalk.c """
+
+        inDegree = dict.fromkeys(positions, 1)
+
+        for pos in positions:
+            for parent in parentsOf[pos]:
+                if inDegree.get(parent, 0):
+                    inDegree[parent] += 1
+
+        if timeSort:
+            queue = _PriorityQueue(timeOf.__getitem__)
+        else:
+            queue = _Stack()
+
+        for pos in positions:
+            if inDegree[pos] == 1:
+                queue.insert(pos)
+
+        if not timeSort:
+            queue.items.reverse()
+
+        result = []
+        while queue.items:
+            pos = queue.pop()
+            for parent in parentsOf[pos]:
+                degree = inDegree.get(parent, 0)
+                if degree == 0:
+                    continue
+                degree -= 1
+                inDegree[parent] = degree
+                if degree == 1:
+                    queue.insert(parent)
+            inDegree[pos] = 0
+            result.append(pos)
+
+        return result
+
+
+class _Stack:
+    """ libgit2's git_pqueue without a comparison function """
+
+    def __init__(self):
+        self.items = []
+
+    def insert(self, item):
+        self.items.append(item)
+
+    def pop(self):
+        return self.items.pop()
+
+
+class _PriorityQueue:
+    """
+    libgit2's git_pqueue with git_commit_list_time_cmp (newest first).
+    Ties must be broken exactly like libgit2 does, so heapq won't do.
+    """
+
+    def __init__(self, timeOf: Callable[[int], int]):
+        self.items = []
+        self.timeOf = timeOf
+
+    def insert(self, item):
+        items = self.items
+        timeOf = self.timeOf
+        items.append(item)
+
+        # pqueue_up
+        el = len(items) - 1
+        kidTime = timeOf(item)
+        while el > 0:
+            parentEl = (el - 1) // 2
+            parent = items[parentEl]
+            if timeOf(parent) >= kidTime:  # cmp(parent, kid) <= 0
+                break
+            items[el] = parent
+            el = parentEl
+        items[el] = item
+
+    def pop(self):
+        items = self.items
+        top = items[0]
+        last = items.pop()
+        if not items:
+            return top
+
+        # pqueue_down
+        timeOf = self.timeOf
+        items[0] = last
+        lastTime = timeOf(last)
+        el = 0
+        size = len(items)
+        while True:
+            kidEl = el * 2 + 1
+            if kidEl >= size:
+                break
+            kid = items[kidEl]
+            kidTime = timeOf(kid)
+            if kidEl + 1 < size:
+                rkid = items[kidEl + 1]
+                rkidTime = timeOf(rkid)
+                if kidTime < rkidTime:  # cmp(kid, rkid) > 0
+                    kid, kidEl, kidTime = rkid, kidEl + 1, rkidTime
+            if lastTime >= kidTime:  # cmp(parent, kid) <= 0
+                break
+            items[el] = kid
+            el = kidEl
+        items[el] = last
+        return top
+
+
+def _murmur3(seed: int, data: bytes) -> int:
+    """ 32-bit MurmurHash3, as used by git's changed-path Bloom filters. """
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    mask = 0xFFFFFFFF
+    h = seed
+    length = len(data)
+    tailStart = length - (length & 3)
+
+    for i in range(0, tailStart, 4):
+        k = int.from_bytes(data[i: i + 4], "little")
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        k = (k * c2) & mask
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & mask
+        h = (h * 5 + 0xe6546b64) & mask
+
+    if tailStart < length:
+        k = int.from_bytes(data[tailStart:], "little")
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        k = (k * c2) & mask
+        h ^= k
+
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & mask
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & mask
+    h ^= h >> 16
+    return h
+
+
+def _bigEndianArray(mm: mmap.mmap, start: int, end: int) -> array:
+    arr = array("I")
+    if arr.itemsize != 4:
+        raise CommitGraphError("unsupported platform")
+    arr.frombytes(mm[start: end])
+    if sys.byteorder == "little":
+        arr.byteswap()
+    return arr
+
+
+def commitGraphEnabled(repo: Repo) -> bool:
+    """ Return False if git wouldn't use the repository's commit-graph either. """
+    # libgit2 rewrites parents in these cases, so the commit-graph can't be trusted
+    if repo.is_shallow or os.path.exists(os.path.join(repo.path, "info", "grafts")):
+        return False
+
+    try:
+        return repo.config.get_bool("core.commitGraph")
+    except KeyError:
+        return True  # Enabled by default
+
+
+def _commonDir(gitDir: str) -> str:
+    """ Linked worktrees keep their objects in the main repository's .git directory. """
+    try:
+        with open(os.path.join(gitDir, "commondir"), encoding="utf-8") as file:
+            commonDir = file.read().strip()
+    except OSError:
+        return gitDir
+    return os.path.normpath(os.path.join(gitDir, commonDir))
@@ -9,7 +9,7 @@ from __future__ import annotations
 import bisect
 import logging
 from dataclasses import dataclass
-from collections.abc import Iterable, Iterator, Set
+from collections.abc import Callable, Iterable, Iterator, Set
 from typing import ClassVar
 
 from gitfourchette.porcelain import Oid as _RealOidType
@@ -27,12 +27,32 @@ The bigger the interval...:
 - but slower random access to any point of the graph.
 """
 
+VOLATILE_KF_MIN_REPLAY = 32
+"""
+Playback saves a volatile keyframe at the goal row if it had to replay at
+least this many rows to get there. This makes keyframes denser in regions
+of the graph that actually get visited (e.g. by the GraphView's viewport).
+"""
+
+VOLATILE_KF_SPACING = 256
+"Interval (in rows) at which long replays save volatile keyframes along the way."
+
+MAX_VOLATILE_KEYFRAMES = 2000
+"""
+Memory budget for volatile keyframes. Past this number, the least recently
+used volatile keyframes are evicted. Keyframes saved while building the
+graph (every KF_INTERVAL rows) are never evicted.
+"""
+
 DEAD_VALUE = "!DEAD"
 
 Oid = _RealOidType | str
 
+_batchOffsets: list[int] = []
+"Global row offset of each batch. Use via BatchRow.BatchManager.globalOffsets; never reassign."
+
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class BatchRow:
     """
     For a row in the Graph, BatchRow keeps track of the row's batch number
@@ -62,7 +82,7 @@ class BatchRow:
         the lifespan of the app.
         """
 
-        globalOffsets: ClassVar[list[int]] = []
+        globalOffsets: ClassVar[list[int]] = _batchOffsets
         freeBatchNos: ClassVar[list[int]] = []
 
         @classmethod
@@ -115,9 +135,10 @@ class BatchRow:
         """Any BatchRow is convertible to int, giving a global row index.
         Note that the int value of any given BatchRow may change over time
         as the graph gets spliced."""
-        if self.b < 0:
+        b = self.b
+        if b < 0:
             return -1
-        return BatchRow.BatchManager.globalOffsets[self.b] + self.y
+        return _batchOffsets[b] + self.y
 
     # -------------------------------------------------------------------------
     # Arithmetics
@@ -158,7 +179,7 @@ BATCHROW_UNDEF = BatchRow(-1, -1)
 "Use this special BatchRow as a placeholder for a row position that is yet to be determined."
 
 
-@dataclass
+@dataclass(slots=True)
 class ChainHandle:
     """ Object shared by arcs on the same chain. """
     _t: BatchRow = BATCHROW_UNDEF
@@ -220,7 +241,7 @@ class ChainHandle:
         self._b = BATCHROW_UNDEF
 
 
-@dataclass
+@dataclass(slots=True)
 class ArcJunction:
     """ Represents the merging of an Arc into another Arc. """
 
@@ -237,7 +258,7 @@ class ArcJunction:
         return self.joinedAt < other.joinedAt
 
 
-@dataclass
+@dataclass(slots=True)
 class Arc:
     """ An arc connects two commits in the graph.
 
@@ -341,7 +362,7 @@ class Arc:
         return False
 
 
-@dataclass
+@dataclass(slots=True)
 class Frame:
     """ A frame is a slice of the graph at a given row. """
 
@@ -429,10 +450,11 @@ class Frame:
         """
         solvedArcsCopy = self.solvedArcs.copy()
         openArcsCopy = self.openArcs.copy()
+        row = int(self.row)
 
         # Move arcs that just got closed to solved list
         for lane, arc in enumerate(openArcsCopy):
-            if arc and 0 <= arc.closedAt <= self.row:
+            if arc and 0 <= int(arc.closedAt) <= row:
                 openArcsCopy[lane] = None
 
                 # For parentless commits, prevent bogus auto-closing arcs
@@ -463,8 +485,9 @@ class Frame:
     @staticmethod
     def cleanUpArcList(theList: list[Arc | None], olderThanRow: BatchRow, alsoTrimBack: bool = True):
         # Remove references to arcs that were closed earlier than `olderThanRow`
+        olderThanRow = int(olderThanRow)
         for j, arc in enumerate(theList):
-            if arc and 0 <= arc.closedAt < olderThanRow:
+            if arc and 0 <= int(arc.closedAt) < olderThanRow:
                 theList[j] = None
 
         # Cull None items at the end of the list
@@ -527,6 +550,8 @@ class Frame:
 
 
 class PlaybackState(Frame):
+    __slots__ = ("callingNextWillAdvanceFrame", "seenCommits")
+
     def __init__(self, keyframe: Frame):
         super().__init__(
             row=keyframe.row,
@@ -553,27 +578,40 @@ class PlaybackState(Frame):
         goalRow = BATCHROW_UNDEF
         goalCommit = None
 
-        while self.lastArc.nextArc:
-            arc: Arc = self.lastArc.nextArc
+        # Compare plain ints in this hot loop (BatchRow comparisons are costly)
+        currentRow = int(self.row)
+        goalRowInt = -1
+        solvedArcs = self.solvedArcs
+        openArcs = self.openArcs
+        lastArc = self.lastArc
 
-            if not goalFound and arc.openedAt > self.row:
+        while lastArc.nextArc:
+            arc: Arc = lastArc.nextArc
+            openedAt = int(arc.openedAt)
+
+            if not goalFound and openedAt > currentRow:
                 # The goal row is determined by the first arc opened at a row greater than the player's current row.
                 goalFound = True
                 goalRow = arc.openedAt
+                goalRowInt = openedAt
                 goalCommit = arc.openedBy
-            elif goalFound and arc.openedAt > goalRow:
+            elif goalFound and openedAt > goalRowInt:
                 # If we went past the goal row, we have seen all arcs opened at the goal row. Stop.
                 break
             else:
                 # Keep iterating on arcs in the goal row. Gather them in a frame.
                 pass
 
-            self.reserveArcListCapacity(self.solvedArcs, arc.lane + 1)
-            self.reserveArcListCapacity(self.openArcs, arc.lane + 1)
+            lane = arc.lane
+            if len(openArcs) <= lane or len(solvedArcs) <= lane:
+                self.reserveArcListCapacity(solvedArcs, lane + 1)
+                self.reserveArcListCapacity(openArcs, lane + 1)
+
+            solvedArcs[lane] = openArcs[lane]  # move any open arc to "just closed"
+            openArcs[lane] = arc
+            lastArc = arc
 
-            self.solvedArcs[arc.lane] = self.openArcs[arc.lane]  # move any open arc to "just closed"
-            self.openArcs[arc.lane] = arc
-            self.lastArc = arc
+        self.lastArc = lastArc
 
         if not goalFound:
             raise StopIteration()
@@ -624,9 +662,24 @@ class Graph:
 
     volatilePlayer: PlaybackState | None
 
+    volatileKeyframeUse: dict[tuple[int, int], int]
+    """
+    Last use of each volatile keyframe (keyed by its row's batch and position
+    in the batch). Keyframes that aren't in here are permanent.
+    """
+
+    maxVolatileKeyframes: int
+
+    onReplay: Callable[[int, int], None] | None
+    "Stats hook, called with (goal row, number of rows replayed) whenever playback starts."
+
     def __init__(self):
         self.keyframes = []
         self.keyframeRows = []
+        self.volatileKeyframeUse = {}
+        self.maxVolatileKeyframes = MAX_VOLATILE_KEYFRAMES
+        self.onReplay = None
+        self._useClock = 0
         self.commitRows = {}
         self.startArc = Arc(
             openedAt=BATCHROW_UNDEF,
@@ -654,8 +707,10 @@ class Graph:
         # Free up owned batches
         self.freeOwnBatches()
 
-        self.keyframes = source.keyframes
-        self.keyframeRows = source.keyframeRows
+        # Take our own copies: saveKeyframe and evictColdKeyframes mutate these
+        self.keyframes = list(source.keyframes)
+        self.keyframeRows = list(source.keyframeRows)
+        self.volatileKeyframeUse = dict(source.volatileKeyframeUse)
         self.startArc = source.startArc
         self.commitRows = source.commitRows
         self.ownBatches = source.ownBatches
@@ -671,7 +726,7 @@ class Graph:
     def getCommitRow(self, oid: Oid):
         return int(self.commitRows[oid])
 
-    def saveKeyframe(self, frame: Frame) -> int:
+    def saveKeyframe(self, frame: Frame, volatile: bool = False) -> int:
         assert len(self.keyframes) == len(self.keyframeRows)
 
         kfID = bisect.bisect_left(self.keyframeRows, frame.row)
@@ -682,8 +737,38 @@ class Graph:
             kf = frame.sealCopy()
             self.keyframes.insert(kfID, kf)
             self.keyframeRows.insert(kfID, frame.row)
+
+            if volatile:
+                self._useClock += 1
+                self.volatileKeyframeUse[(frame.row.b, frame.row.y)] = self._useClock
+                if len(self.volatileKeyframeUse) > self.maxVolatileKeyframes:
+                    self.evictColdKeyframes()
+                    kfID = self.getBestKeyframeID(int(frame.row))
         return kfID
 
+    def touchKeyframe(self, row: BatchRow):
+        """ Mark a volatile keyframe as recently used. No-op for permanent keyframes. """
+        key = (row.b, row.y)
+        if key in self.volatileKeyframeUse:
+            self._useClock += 1
+            self.volatileKeyframeUse[key] = self._useClock
+
+    def evictColdKeyframes(self):
+        """ Evict least recently used volatile keyframes until we're back under budget. """
+        use = self.volatileKeyframeUse
+        numEvict = len(use) - self.maxVolatileKeyframes // 2
+        if numEvict <= 0:
+            return
+
+        coldKeys = sorted(use, key=use.__getitem__)[:numEvict]
+        coldRows = set(coldKeys)
+        for key in coldKeys:
+            del use[key]
+
+        keep = [i for i, row in enumerate(self.keyframeRows) if (row.b, row.y) not in coldRows]
+        self.keyframes = [self.keyframes[i] for i in keep]
+        self.keyframeRows = [self.keyframeRows[i] for i in keep]
+
     def getBestKeyframeID(self, row: int) -> int:
         """
         Attempts to find a keyframe closest to `row` in the frame sequence.
@@ -712,6 +797,7 @@ class Graph:
         kfID = self.getBestKeyframeID(goalRow)
         if kfID >= 0:
             kf = self.keyframes[kfID]
+            self.touchKeyframe(kf.row)
         else:
             kf = self.initialKeyframe()
 
@@ -720,30 +806,57 @@ class Graph:
         else:
             player = PlaybackState(kf)
 
+        startRow = int(player.row)
+
         # Position playback context on target row
         try:
-            volatileKeyframeCounter = 1
+            nextVolatileKeyframe = startRow + VOLATILE_KF_SPACING
             assert player.row <= goalRow, f"{player.row} {goalRow}"
             while player.row < goalRow:
                 player.advanceToNextRow()  # raises StopIteration if depleted
 
-                # Save keyframes every now and then
-                if player.row - kf.row >= volatileKeyframeCounter:
-                    volatileKeyframeCounter *= 2
-                    self.saveKeyframe(player)
+                # Leave keyframes behind during long replays
+                if nextVolatileKeyframe <= player.row < goalRow:
+                    nextVolatileKeyframe += VOLATILE_KF_SPACING
+                    self.saveKeyframe(player, volatile=True)
 
             assert player.row == goalRow
             player.callingNextWillAdvanceFrame = False  # let us re-obtain current frame by calling next()
+
+            # Make the goal row's neighborhood cheaper to revisit
+            if goalRow - startRow >= VOLATILE_KF_MIN_REPLAY:
+                self.saveKeyframe(player, volatile=True)
         except StopIteration:
             # Depleted - make sure we get StopIteration next time we call `next`.
             assert player.callingNextWillAdvanceFrame
             assert player.lastArc.nextArc is None
 
+        if self.onReplay is not None:
+            self.onReplay(goalRow, int(player.row) - startRow)
+
         if oneOff:
             self.volatilePlayer = player
 
         return player
 
+    def placeKeyframes(self, rows: Iterable[int], margin: int = VOLATILE_KF_MIN_REPLAY):
+        """
+        Save volatile keyframes a little above each of the given rows (e.g.
+        HEAD and branch tips), so that jumping to them doesn't replay a long
+        stretch of the graph.
+        """
+        for row in sorted(set(rows)):
+            row = max(0, row - margin)
+            kfID = self.getBestKeyframeID(row)
+            if kfID >= 0 and row - int(self.keyframeRows[kfID]) < margin:
+                continue  # already have a keyframe close enough
+            player = self.startPlayback(row)
+            if player.row != row:
+                break  # ran past the end of the graph
+            kfID = self.getBestKeyframeID(row)
+            if self.keyframeRows[kfID] != row:
+                self.saveKeyframe(player, volatile=True)
+
     def getCommitFrame(self, commit: Oid, unsafe=False) -> Frame:
         row = self.getCommitRow(commit)
         return self.getFrame(row, unsafe)
@@ -756,6 +869,7 @@ class Graph:
         if kfID >= 0 and self.keyframes[kfID].row == row:
             # Cache hit
             frame = self.keyframes[kfID]
+            self.touchKeyframe(frame.row)
         else:
             # Cache miss
             frame = self.startPlayback(row)
@@ -806,6 +920,11 @@ class Graph:
         self.keyframeRows = self.keyframeRows[kfID:]
         assert len(self.keyframes) == len(self.keyframeRows)
 
+        # Forget usage of deleted volatile keyframes
+        if self.volatileKeyframeUse:
+            liveKeys = {(r.b, r.y) for r in self.keyframeRows}
+            self.volatileKeyframeUse = {k: t for k, t in self.volatileKeyframeUse.items() if k in liveKeys}
+
     def deleteArcsDependingOnRowsAbove(self, row: int):
         """
         Deletes all arcs opened before the given row.
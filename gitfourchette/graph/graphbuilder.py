@@ -8,7 +8,7 @@ import dataclasses
 import logging
 from collections.abc import Sequence, Iterable, Callable, Set
 
-from gitfourchette.graph.graph import Graph, BatchRow, KF_INTERVAL, Oid
+from gitfourchette.graph.graph import Graph, BatchRow, Frame, KF_INTERVAL, Oid
 from gitfourchette.graph.graphsplicer import GraphSplicer
 from gitfourchette.graph.graphtrickle import GraphTrickle
 from gitfourchette.graph.graphweaver import GraphWeaver
@@ -37,6 +37,13 @@ class MockCommit:
 class GraphBuildLoop:
     onKeyframe: Callable[[int], None]
 
+    deferredKeyframes: list[Frame] | None
+    """
+    If not None, keyframes are collected here instead of being saved into the
+    graph right away. Use this if another thread may be reading the graph
+    while it's being built; that thread can merge the keyframes in later.
+    """
+
     def __init__(
             self,
             heads=None,
@@ -56,6 +63,7 @@ class GraphBuildLoop:
         self.keyframeInterval = keyframeInterval
 
         self.onKeyframe = GraphBuildLoop.defaultOnKeyframe
+        self.deferredKeyframes = None
 
     def sendAll(self, sequence):
         gen = self.coBuild()
@@ -97,7 +105,10 @@ class GraphBuildLoop:
 
             # Save keyframes at regular intervals for faster random access.
             if rowInt % keyframeInterval == 0:
-                graph.saveKeyframe(weaver)
+                if self.deferredKeyframes is None:
+                    graph.saveKeyframe(weaver)
+                else:
+                    self.deferredKeyframes.append(weaver.sealCopy())
                 self.onKeyframe(rowInt)
 
         logger.debug(f"Peak arc count: {weaver.peakArcCount}")
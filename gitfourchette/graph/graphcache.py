@@ -0,0 +1,361 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+Persistent snapshot of a Graph and its commit sequence.
+
+The snapshot is written in a flat binary format made of typed arrays (no
+pickle, so a tampered cache file can't execute code). Arcs, chains and
+keyframes refer to each other by index; oids are interned in a single table.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Iterable, Sequence
+from typing import BinaryIO
+
+from gitfourchette.graph.graph import (
+    Arc,
+    ArcJunction,
+    BATCHROW_UNDEF,
+    BatchRow,
+    ChainHandle,
+    Frame,
+    Graph,
+    Oid,
+)
+from gitfourchette.graph.graphbuilder import MockCommit
+from gitfourchette.porcelain import Oid as _RealOidType
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("<8sII")
+_ARRAY_HEADER = struct.Struct("<cQ")
+
+_OID_RAW = 0
+_OID_STR = 1
+
+_FLAG_TRUNCATED = 1 << 0
+_FLAG_CHRONOLOGICAL = 1 << 1
+
+
+class GraphCacheError(Exception):
+    pass
+
+
+class GraphCache:
+    """
+    Serializable snapshot of a commit graph.
+
+    `sequence` lists the commits in graph row order (oids and parent ids only).
+    `tips` records the ref targets that the graph was generated from, so the
+    caller can tell whether the snapshot is still current. `keyframes`
+    defaults to the graph's own keyframes.
+    """
+
+    MAGIC = b"GF4GRAPH"
+    VERSION = 1
+
+    tips: list[Oid]
+    sequence: list[MockCommit]
+    graph: Graph
+    truncated: bool
+    chronological: bool
+    keyframes: Sequence[Frame]
+
+    def __init__(self, graph: Graph, sequence: Sequence, tips: Iterable[Oid],
+                 truncated: bool = False, chronological: bool = False,
+                 keyframes: Sequence[Frame] | None = None):
+        self.graph = graph
+        self.keyframes = graph.keyframes if keyframes is None else keyframes
+        self.sequence = sequence
+        self.tips = list(tips)
+        self.truncated = truncated
+        self.chronological = chronological
+
+    # -------------------------------------------------------------------------
+    # Writing
+
+    def write(self, path: str):
+        """ Write the snapshot to `path` atomically. """
+        tempPath = path + ".tmp"
+        with open(tempPath, "wb") as file:
+            self.dump(file)
+        os.replace(tempPath, path)
+
+    def dump(self, file: BinaryIO):
+        graph = self.graph
+
+        oidTable: dict[Oid, int] = {}
+
+        def internOid(oid: Oid) -> int:
+            try:
+                return oidTable[oid]
+            except KeyError:
+                i = len(oidTable)
+                oidTable[oid] = i
+                return i
+
+        # Commit sequence
+        seqCommits = array("i")
+        seqParentStart = array("i", [0])
+        seqParents = array("i")
+        for commit in self.sequence:
+            seqCommits.append(internOid(commit.id))
+            seqParents.extend(internOid(p) for p in commit.parent_ids)
+            seqParentStart.append(len(seqParents))
+
+        # Arcs (walk the linked list)
+        arcIndices: dict[int, int] = {}
+        chainIndices: dict[int, int] = {}
+        chainTop = array("i")
+        chainBottom = array("i")
+        arcOpenedAt = array("i")
+        arcClosedAt = array("i")
+        arcChain = array("i")
+        arcLane = array("i")
+        arcOpenedBy = array("i")
+        arcClosedBy = array("i")
+        arcJunctionStart = array("i", [0])
+        junctionRow = array("i")
+        junctionBy = array("i")
+
+        arc = graph.startArc.nextArc
+        while arc is not None:
+            arcIndices[id(arc)] = len(arcOpenedAt)
+
+            chain = arc.chain.resolve()
+            try:
+                chainIndex = chainIndices[id(chain)]
+            except KeyError:
+                chainIndex = len(chainTop)
+                chainIndices[id(chain)] = chainIndex
+                chainTop.append(int(chain.topRow))
+                chainBottom.append(int(chain.bottomRow))
+
+            arcOpenedAt.append(int(arc.openedAt))
+            arcClosedAt.append(int(arc.closedAt))
+            arcChain.append(chainIndex)
+            arcLane.append(arc.lane)
+            arcOpenedBy.append(internOid(arc.openedBy))
+            arcClosedBy.append(internOid(arc.closedBy))
+            for junction in arc.junctions:
+                junctionRow.append(int(junction.joinedAt))
+                junctionBy.append(internOid(junction.joinedBy))
+            arcJunctionStart.append(len(junctionRow))
+
+            arc = arc.nextArc
+
+        def arcIndex(a: Arc | None) -> int:
+            if a is None:
+                return -1
+            return arcIndices[id(a)]
+
+        # Keyframes
+        kfRow = array("i")
+        kfCommit = array("i")
+        kfLastArc = array("i")
+        kfSolvedStart = array("i", [0])
+        kfSolved = array("i")
+        kfOpenStart = array("i", [0])
+        kfOpen = array("i")
+        for kf in self.keyframes:
+            kfRow.append(int(kf.row))
+            kfCommit.append(internOid(kf.commit))
+            kfLastArc.append(-1 if kf.lastArc is graph.startArc else arcIndex(kf.lastArc))
+            kfSolved.extend(arcIndex(a) for a in kf.solvedArcs)
+            kfSolvedStart.append(len(kfSolved))
+            kfOpen.extend(arcIndex(a) for a in kf.openArcs)
+            kfOpenStart.append(len(kfOpen))
+
+        tips = array("i", (internOid(t) for t in self.tips))
+
+        # Oid table
+        oidKinds = array("b")
+        oidLengths = array("i")
+        oidBlob = bytearray()
+        for oid in oidTable:  # dicts preserve insertion order, i.e. index order
+            if isinstance(oid, str):
+                raw = oid.encode("utf-8")
+                oidKinds.append(_OID_STR)
+            else:
+                raw = oid.raw
+                oidKinds.append(_OID_RAW)
+            oidLengths.append(len(raw))
+            oidBlob += raw
+
+        flags = 0
+        if self.truncated:
+            flags |= _FLAG_TRUNCATED
+        if self.chronological:
+            flags |= _FLAG_CHRONOLOGICAL
+
+        file.write(_HEADER.pack(self.MAGIC, self.VERSION, flags))
+        _writeBytes(file, oidBlob)
+        for arr in (oidKinds, oidLengths, tips,
+                    seqCommits, seqParentStart, seqParents,
+                    chainTop, chainBottom,
+                    arcOpenedAt, arcClosedAt, arcChain, arcLane, arcOpenedBy, arcClosedBy,
+                    arcJunctionStart, junctionRow, junctionBy,
+                    kfRow, kfCommit, kfLastArc, kfSolvedStart, kfSolved, kfOpenStart, kfOpen):
+            _writeArray(file, arr)
+
+    # -------------------------------------------------------------------------
+    # Reading
+
+    @classmethod
+    def read(cls, path: str) -> GraphCache:
+        """ Load a snapshot from `path`. Raise GraphCacheError if the file is unusable. """
+        with open(path, "rb") as file:
+            try:
+                return cls.load(file)
+            except (struct.error, IndexError, ValueError, EOFError, OverflowError) as exc:
+                raise GraphCacheError(f"corrupt graph cache: {exc}") from exc
+
+    @classmethod
+    def load(cls, file: BinaryIO) -> GraphCache:
+        magic, version, flags = _HEADER.unpack(_readExactly(file, _HEADER.size))
+        if magic != cls.MAGIC:
+            raise GraphCacheError("not a graph cache file")
+        if version != cls.VERSION:
+            raise GraphCacheError(f"unsupported graph cache version {version}")
+
+        oidBlob = _readBytes(file)
+        (oidKinds, oidLengths, tips,
+         seqCommits, seqParentStart, seqParents,
+         chainTop, chainBottom,
+         arcOpenedAt, arcClosedAt, arcChain, arcLane, arcOpenedBy, arcClosedBy,
+         arcJunctionStart, junctionRow, junctionBy,
+         kfRow, kfCommit, kfLastArc, kfSolvedStart, kfSolved, kfOpenStart, kfOpen,
+         ) = (_readArray(file, t) for t in "bii" + "i" * 21)
+
+        # Indices into the oid and chain tables must not wrap around
+        for arr in (tips, seqCommits, seqParents, arcChain, arcOpenedBy, arcClosedBy, junctionBy, kfCommit):
+            if min(arr, default=0) < 0:
+                raise GraphCacheError("negative index")
+
+        # Rebuild oid table
+        oids: list[Oid] = []
+        pos = 0
+        for kind, length in zip(oidKinds, oidLengths, strict=True):
+            end = pos + length
+            if end > len(oidBlob):
+                raise GraphCacheError("truncated oid table")
+            if kind == _OID_RAW:
+                oids.append(_RealOidType(raw=oidBlob[pos:end]))
+            elif kind == _OID_STR:
+                oids.append(oidBlob[pos:end].decode("utf-8"))
+            else:
+                raise GraphCacheError(f"unknown oid kind {kind}")
+            pos = end
+
+        # Rebuild commit sequence
+        sequence = []
+        seqParents = [oids[p] for p in seqParents]
+        for commitIndex, p1, p2 in zip(seqCommits, seqParentStart[:-1], seqParentStart[1:], strict=True):
+            sequence.append(MockCommit(oids[commitIndex], seqParents[p1:p2]))
+
+        # All rows go into a single fresh batch
+        graph = Graph()
+        batchNo = BatchRow.BatchManager.reserveNewBatch()
+        graph.ownBatches.append(batchNo)
+        rows = [BatchRow(batchNo, y) for y in range(len(sequence))]
+        rows.append(BATCHROW_UNDEF)  # rows[-1] is BATCHROW_UNDEF
+
+        def toRow(y: int) -> BatchRow:
+            if y < -1:
+                raise GraphCacheError(f"invalid row {y}")
+            return rows[y]
+
+        graph.commitRows = {commit.id: rows[y] for y, commit in enumerate(sequence)}
+
+        chains = [ChainHandle(toRow(t), toRow(b)) for t, b in zip(chainTop, chainBottom, strict=True)]
+
+        junctions = [ArcJunction(joinedAt=toRow(y), joinedBy=oids[by])
+                     for y, by in zip(junctionRow, junctionBy, strict=True)]
+
+        arcs: list[Arc] = []
+        lastArc = graph.startArc
+        for openedAt, closedAt, chain, lane, openedBy, closedBy, j1, j2 in zip(
+                arcOpenedAt, arcClosedAt, arcChain, arcLane, arcOpenedBy, arcClosedBy,
+                arcJunctionStart[:-1], arcJunctionStart[1:], strict=True):
+            arc = Arc(openedAt=toRow(openedAt),
+                      closedAt=toRow(closedAt),
+                      chain=chains[chain],
+                      lane=lane,
+                      openedBy=oids[openedBy],
+                      closedBy=oids[closedBy],
+                      junctions=junctions[j1:j2])
+            lastArc.nextArc = arc
+            lastArc = arc
+            arcs.append(arc)
+
+        def toArc(i: int) -> Arc | None:
+            if i < 0:
+                return None
+            return arcs[i]
+
+        for i in range(len(kfRow)):
+            row = toRow(kfRow[i])
+            frame = Frame(
+                row=row,
+                commit=oids[kfCommit[i]],
+                solvedArcs=[toArc(a) for a in kfSolved[kfSolvedStart[i]: kfSolvedStart[i + 1]]],
+                openArcs=[toArc(a) for a in kfOpen[kfOpenStart[i]: kfOpenStart[i + 1]]],
+                lastArc=graph.startArc if kfLastArc[i] < 0 else arcs[kfLastArc[i]])
+            graph.keyframes.append(frame)
+            graph.keyframeRows.append(row)
+
+        return GraphCache(
+            graph=graph,
+            sequence=sequence,
+            tips=(oids[t] for t in tips),
+            truncated=bool(flags & _FLAG_TRUNCATED),
+            chronological=bool(flags & _FLAG_CHRONOLOGICAL))
+
+
+def _readExactly(file: BinaryIO, size: int) -> bytes:
+    data = file.read(size)
+    if len(data) != size:
+        raise EOFError("unexpected end of graph cache")
+    return data
+
+
+def _writeBytes(file: BinaryIO, data: bytes | bytearray):
+    file.write(_ARRAY_HEADER.pack(b"B", len(data)))
+    file.write(data)
+
+
+def _readBytes(file: BinaryIO) -> bytes:
+    typecode, count = _ARRAY_HEADER.unpack(_readExactly(file, _ARRAY_HEADER.size))
+    if typecode != b"B":
+        raise GraphCacheError("unexpected section type")
+    return _readExactly(file, count)
+
+
+def _writeArray(file: BinaryIO, arr: array):
+    # Arrays are stored little-endian regardless of the host
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    file.write(_ARRAY_HEADER.pack(arr.typecode.encode("ascii"), len(arr)))
+    file.write(arr.tobytes())
+
+
+def _readArray(file: BinaryIO, typecode: str) -> array:
+    storedTypecode, count = _ARRAY_HEADER.unpack(_readExactly(file, _ARRAY_HEADER.size))
+    if storedTypecode.decode("ascii") != typecode:
+        raise GraphCacheError("unexpected section type")
+    arr = array(typecode)
+    arr.frombytes(_readExactly(file, count * arr.itemsize))
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
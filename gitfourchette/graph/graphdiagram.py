@@ -30,6 +30,7 @@ class GraphDiagram:
         sequence = []
         seen: set[Oid] = set()
         heads: set[Oid] = set()
+        ids: set[Oid] = set()
 
         lines = re.split(r"\s+", text)
 
@@ -55,7 +56,8 @@ class GraphDiagram:
             parents = [[c] for c in chain[1:]] + [rootParents]
 
             for oid, commitParents in zip(chain, parents, strict=True):
-                assert oid not in sequence, f"Commit hash appears twice in sequence! {oid}"
+                assert oid not in ids, f"Commit hash appears twice in sequence! {oid}"
+                ids.add(oid)
                 mockCommit = MockCommit(oid, commitParents)
                 sequence.append(mockCommit)
                 if mockCommit.id not in seen:
@@ -13,6 +13,8 @@ from gitfourchette.graph.graph import Graph, Frame, Oid, Arc, ChainHandle, Batch
 
 
 class GraphWeaver(Frame):
+    __slots__ = ("freeLanes", "parentLookup", "peakArcCount", "batchNo")
+
     freeLanes: list[int]
     parentLookup: collections.defaultdict[Oid, list[Arc]]  # list: all lanes
     peakArcCount: int
@@ -52,7 +54,10 @@ class GraphWeaver(Frame):
             # Nobody was looking for me, so I'm the tip of a new branch
             myHomeChain = ChainHandle(row, BATCHROW_UNDEF)
         else:
-            myMainOpenArc = min(myOpenArcs, key=lambda a: a.lane)
+            if len(myOpenArcs) == 1:
+                myMainOpenArc = myOpenArcs[0]
+            else:
+                myMainOpenArc = min(myOpenArcs, key=lambda a: a.lane)
             myHomeLane = myMainOpenArc.lane
             myHomeChain = myMainOpenArc.chain
             assert myHomeChain.isValid()
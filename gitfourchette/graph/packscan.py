@@ -0,0 +1,364 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+Multi-process reader for the parents and commit times of all commits in a
+repository's packfiles.
+
+Without a commit-graph file, sorting the history means inflating every
+single commit object, which Walker does on a single core. For very large
+repositories, we can instead split the packfile indexes into shards and read
+the commits of each shard in a separate process. The workers send their
+results back as flat buffers, and the topological sort runs in the calling
+process via CommitGraphFile.
+
+Loose commits and commits stored in alternate object directories aren't
+scanned; CommitGraphFile looks them up on demand like any commit that is
+absent from a commit-graph file. Every pack keeps its own index even if the
+repository has a multi-pack-index, so we read the pack indexes directly;
+objects that are stored in several packs (e.g. in .keep packs) are only
+registered once. Partial clones aren't scanned at all, because looking up
+their missing commits would fetch them from the promisor remote one by one.
+
+This is opt-in (see the parallelPrime pref): the workers are pure Python, so
+the scan only beats Walker when the history is large enough to keep several
+cores busy.
+
+Pack format reference: https://git-scm.com/docs/gitformat-pack
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import glob
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections.abc import Callable
+
+from gitfourchette.graph.commitgraphfile import CommitGraphError, CommitGraphFile, _commonDir
+
+logger = logging.getLogger(__name__)
+
+MinCommitsPerWorker = 20_000
+"Don't bother spawning a worker process for fewer commits than this."
+
+ShardsPerWorker = 4
+"Split the work more finely than the number of workers to balance the load."
+
+_IDX_HEADER = struct.Struct(">4sI")
+_IDX_MAGIC = b"\377tOc"
+_FANOUT_SIZE = 256 * 4
+
+_OBJ_COMMIT = 1
+_OBJ_OFS_DELTA = 6
+_OBJ_REF_DELTA = 7
+_OBJ_UNKNOWN = -1
+
+_INFLATE_FIRST_CHUNK = 512
+_INFLATE_MAX_CHUNK = 64 * 1024
+
+_POLL_INTERVAL = 0.1
+
+
+def scanPacks(
+        gitDir: str,
+        oidLength: int = 20,
+        numCommits: int = 0,
+        numWorkers: int = 0,
+        isCancelled: Callable[[], bool] | None = None,
+) -> CommitGraphFile | None:
+    """
+    Read the parents and commit times of all packed commits in the repository
+    at `gitDir` (the .git directory) with a pool of worker processes.
+    `oidLength` is the length of a raw object ID in this repository.
+
+    If `numWorkers` is 0, use one process per CPU core, within reason, given
+    the number of commits we expect to load (`numCommits`). Return None if
+    there aren't enough commits for this to pay off, if the repository is a
+    partial clone, or if `isCancelled` returns True before we're done.
+
+    Raise CommitGraphError if a packfile can't be read.
+    """
+
+    packDir = os.path.join(_commonDir(gitDir), "objects", "pack")
+    if glob.glob(os.path.join(glob.escape(packDir), "pack-*.promisor")):
+        return None
+
+    if numWorkers <= 0:
+        numWorkers = min(os.cpu_count() or 1, numCommits // MinCommitsPerWorker)
+        if numWorkers < 2:
+            return None
+
+    packs = []
+    for idxPath in sorted(glob.glob(os.path.join(glob.escape(packDir), "pack-*.idx"))):
+        packPath = idxPath.removesuffix(".idx") + ".pack"
+        if os.path.isfile(packPath):
+            packs.append((packPath, idxPath, _countObjects(idxPath)))
+
+    numObjects = sum(count for _, _, count in packs)
+
+    shardSize = max(1, -(-numObjects // (numWorkers * ShardsPerWorker)))
+    shards = [(packPath, idxPath, oidLength, start, min(start + shardSize, count))
+              for packPath, idxPath, count in packs
+              for start in range(0, count, shardSize)]
+
+    logger.debug(f"Scanning {numObjects} packed objects in {len(shards)} shards with {numWorkers} processes")
+
+    # Don't fork: other threads may be holding locks in this process.
+    context = multiprocessing.get_context("spawn")
+    commitGraph = CommitGraphFile([])
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(numWorkers, mp_context=context) as pool:
+            futures = [pool.submit(_scanShard, *shard) for shard in shards]
+            # Consume the results in submission order so that positions are deterministic
+            for future in futures:
+                while isCancelled is not None and not future.done():
+                    if isCancelled():
+                        logger.debug("Pack scan cancelled")
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        return None
+                    concurrent.futures.wait([future], timeout=_POLL_INTERVAL)
+                oids, parentCounts, parentOids, times = future.result()
+                commitGraph.addCommits(oids, _unpack("I", parentCounts), parentOids, _unpack("q", times), oidLength)
+    except concurrent.futures.process.BrokenProcessPool as exc:
+        raise CommitGraphError(f"worker process died: {exc}") from exc
+    except ValueError as exc:  # from addCommits if a shard's columns don't line up
+        raise CommitGraphError(f"bad pack scan results: {exc}") from exc
+
+    return commitGraph
+
+
+def _countObjects(idxPath: str) -> int:
+    with open(idxPath, "rb") as file:
+        header = file.read(_IDX_HEADER.size + _FANOUT_SIZE)
+    try:
+        magic, version = _IDX_HEADER.unpack_from(header, 0)
+        count, = struct.unpack_from(">I", header, _IDX_HEADER.size + _FANOUT_SIZE - 4)
+    except struct.error as exc:
+        raise CommitGraphError(f"{os.path.basename(idxPath)}: {exc}") from exc
+    if magic != _IDX_MAGIC or version != 2:
+        raise CommitGraphError(f"{os.path.basename(idxPath)}: unsupported pack index version")
+    return count
+
+
+def _unpack(typecode: str, data: bytes) -> array:
+    arr = array(typecode)
+    arr.frombytes(data)
+    return arr
+
+
+def _scanShard(packPath: str, idxPath: str, oidLength: int, start: int, stop: int
+               ) -> tuple[bytes, bytes, bytes, bytes]:
+    """
+    Worker process entry point. Read the commits among objects [start:stop)
+    of a pack index (in index order). Return flat buffers suitable for
+    CommitGraphFile.addCommits.
+    """
+    try:
+        with (open(idxPath, "rb") as idxFile, open(packPath, "rb") as packFile,
+              mmap.mmap(idxFile.fileno(), 0, access=mmap.ACCESS_READ) as idx,
+              mmap.mmap(packFile.fileno(), 0, access=mmap.ACCESS_READ) as pack):
+            return _PackReader(idx, pack, oidLength).scan(start, stop)
+    except (zlib.error, struct.error, ValueError, IndexError, KeyError) as exc:
+        raise CommitGraphError(f"{os.path.basename(packPath)}: {exc!r}") from exc
+
+
+class _PackReader:
+    def __init__(self, idx: mmap.mmap, pack: mmap.mmap, oidLength: int):
+        self.idx = idx
+        self.pack = pack
+        self.oidLength = oidLength
+
+        count, = struct.unpack_from(">I", idx, _IDX_HEADER.size + _FANOUT_SIZE - 4)
+        self.count = count
+        self.oidStart = _IDX_HEADER.size + _FANOUT_SIZE
+        offsetStart = self.oidStart + count * (oidLength + 4)  # skip oids and CRCs
+        self.largeOffsetStart = offsetStart + count * 4
+
+        offsets = _unpack("I", idx[offsetStart: offsetStart + count * 4])
+        if sys.byteorder == "little":
+            offsets.byteswap()
+        self.offsets = offsets
+
+        # Resolved type of each delta we've come across, keyed by pack offset
+        self.deltaTypes: dict[int, int] = {}
+
+    def scan(self, start: int, stop: int) -> tuple[bytes, bytes, bytes, bytes]:
+        oids = bytearray()
+        parentCounts = array("I")
+        parentOids = bytearray()
+        times = array("q")
+
+        idx = self.idx
+        oidStart = self.oidStart
+        h = self.oidLength
+
+        for i in range(start, stop):
+            offset = self.offsetAt(i)
+            if self.objectType(offset) != _OBJ_COMMIT:
+                continue
+
+            parents, commitTime = _parseCommit(self.inflateObject(offset))
+
+            oids += idx[oidStart + i * h: oidStart + (i + 1) * h]
+            parentCounts.append(len(parents))
+            for parent in parents:
+                parentOids += parent
+            times.append(commitTime)
+
+        return bytes(oids), parentCounts.tobytes(), bytes(parentOids), times.tobytes()
+
+    def offsetAt(self, i: int) -> int:
+        offset = self.offsets[i]
+        if offset & 0x80000000:
+            offset, = struct.unpack_from(">Q", self.idx, self.largeOffsetStart + (offset & 0x7FFFFFFF) * 8)
+        return offset
+
+    def findOffset(self, raw: bytes) -> int:
+        """ Return the pack offset of an object in this pack, or -1. """
+        idx = self.idx
+        oidStart = self.oidStart
+        h = self.oidLength
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = idx[oidStart + mid * h: oidStart + (mid + 1) * h]
+            if candidate < raw:
+                lo = mid + 1
+            elif candidate > raw:
+                hi = mid
+            else:
+                return self.offsetAt(mid)
+        return -1
+
+    def entryHeader(self, offset: int) -> tuple[int, int, int]:
+        """ Return the type of a pack entry, the offset of its base (for deltas) and the offset of its data. """
+        pack = self.pack
+        c = pack[offset]
+        objType = (c >> 4) & 7
+        p = offset + 1
+        while c & 0x80:
+            c = pack[p]
+            p += 1
+
+        base = -1
+        if objType == _OBJ_OFS_DELTA:
+            c = pack[p]
+            p += 1
+            distance = c & 0x7F
+            while c & 0x80:
+                c = pack[p]
+                p += 1
+                distance = ((distance + 1) << 7) | (c & 0x7F)
+            base = offset - distance
+        elif objType == _OBJ_REF_DELTA:
+            base = self.findOffset(pack[p: p + self.oidLength])
+            p += self.oidLength
+            if base < 0:  # Base isn't in this pack
+                objType = _OBJ_UNKNOWN
+
+        return objType, base, p
+
+    def objectType(self, offset: int) -> int:
+        """ Return the type of the object at the given pack offset, following delta chains. """
+        deltaTypes = self.deltaTypes
+        chain = []
+
+        while True:
+            try:
+                objType = deltaTypes[offset]
+                break
+            except KeyError:
+                pass
+            objType, base, _ = self.entryHeader(offset)
+            if objType not in (_OBJ_OFS_DELTA, _OBJ_REF_DELTA):
+                break
+            chain.append(offset)
+            offset = base
+
+        for delta in chain:
+            deltaTypes[delta] = objType
+        return objType
+
+    def inflateObject(self, offset: int) -> bytes:
+        """ Return the contents of the object at the given pack offset, applying deltas. """
+        deltas = []
+        while True:
+            objType, base, dataStart = self.entryHeader(offset)
+            if objType not in (_OBJ_OFS_DELTA, _OBJ_REF_DELTA):
+                break
+            deltas.append(self.inflate(dataStart))
+            offset = base
+
+        data = self.inflate(dataStart)
+        for delta in reversed(deltas):
+            data = _applyDelta(data, delta)
+        return data
+
+    def inflate(self, start: int) -> bytes:
+        pack = self.pack
+        inflater = zlib.decompressobj()
+        chunks = []
+        chunkSize = _INFLATE_FIRST_CHUNK  # most commits fit in here, don't copy more of the pack than needed
+        while not inflater.eof:
+            chunk = pack[start: start + chunkSize]
+            if not chunk:
+                raise ValueError("truncated pack entry")
+            chunks.append(inflater.decompress(chunk))
+            start += chunkSize
+            chunkSize = min(chunkSize * 2, _INFLATE_MAX_CHUNK)
+        return b"".join(chunks)
+
+
+def _applyDelta(base: bytes, delta: bytes) -> bytes:
+    p = 0
+    for _ in range(2):  # Skip base size and result size
+        while delta[p] & 0x80:
+            p += 1
+        p += 1
+
+    result = bytearray()
+    end = len(delta)
+    while p < end:
+        op = delta[p]
+        p += 1
+        if op & 0x80:  # Copy from base
+            copyOffset = 0
+            copySize = 0
+            for shift in range(4):
+                if op & (1 << shift):
+                    copyOffset |= delta[p] << (8 * shift)
+                    p += 1
+            for shift in range(3):
+                if op & (0x10 << shift):
+                    copySize |= delta[p] << (8 * shift)
+                    p += 1
+            result += base[copyOffset: copyOffset + (copySize or 0x10000)]
+        elif op:  # Insert literal data
+            result += delta[p: p + op]
+            p += op
+        else:
+            raise ValueError("bad delta opcode")
+    return bytes(result)
+
+
+def _parseCommit(data: bytes) -> tuple[list[bytes], int]:
+    """ Return the raw parent ids and the commit time of a raw commit object. """
+    parents = []
+    headerEnd = data.find(b"\n\n")
+    for line in data[:headerEnd if headerEnd >= 0 else len(data)].split(b"\n"):
+        if line.startswith(b"parent "):
+            parents.append(bytes.fromhex(line[7:].decode("ascii")))
+        elif line.startswith(b"committer "):
+            return parents, int(line.rsplit(b" ", 2)[1])
+    raise ValueError("commit has no committer")
@@ -157,6 +157,7 @@ class CommitLogDelegate(QStyledItemDelegate):
         rightBound = rect.right()
 
         # Get the info we need about the commit
+        contentSearchHit = False
         commit: Commit | None = index.data(CommitLogModel.Role.Commit)
         if commit and commit.id != UC_FAKEID:
             oid = commit.id
@@ -179,12 +180,19 @@ class CommitLogDelegate(QStyledItemDelegate):
             if self.repoModel.headCommitId == commit.id:
                 painter.setFont(self.activeCommitFont)
 
-            searchBar: SearchBar = self.parent().searchBar
+            graphView = self.parent()
+            searchBar: SearchBar = graphView.searchBar
             searchTerm: str = searchBar.searchTerm
             searchTermLooksLikeHash: bool = searchBar.searchTermLooksLikeHash
 
             if not searchBar.isVisible():
                 searchTerm = ""
+            elif graphView.contentSearchAction.isChecked():
+                # The term is in the files, not in the message: mark the entire hash of matching commits
+                contentSearchHit = bool(graphView.isSearchHit(graphView.clFilter.mapToSource(index).row()))
+                searchTerm = ""
+            elif graphView.isSearchHit(graphView.clFilter.mapToSource(index).row()) is False:
+                searchTerm = ""  # The search has already ruled out this commit, don't bother highlighting
         else:
             commit = None
             oid = None
@@ -245,15 +253,18 @@ class CommitLogDelegate(QStyledItemDelegate):
         painter.restore()
 
         # ------ Highlight searched hash
-        if searchTerm and searchTermLooksLikeHash and commit and str(commit).startswith(searchTerm):
+        if searchTerm and searchTermLooksLikeHash and commit and str(oid).startswith(searchTerm):
             x1 = 0
             x2 = min(len(hashText), len(searchTerm)) * hcw
             SearchBar.highlightNeedle(painter, rect, hashText, 0, len(searchTerm), x1, x2)
+        elif contentSearchHit:
+            SearchBar.highlightNeedle(painter, rect, hashText, 0, len(hashText), 0, len(hashText) * hcw)
 
         # ------ Graph
         rect.setLeft(leftBoundSummary)
         if oid is not None:
-            paintGraphFrame(self.repoModel, oid, painter, rect, outlineColor)
+            with self.repoModel.graphLock:
+                paintGraphFrame(self.repoModel, oid, painter, rect, outlineColor)
             rect.setLeft(rect.right())
 
         # ------ Set refbox/message area rect
@@ -34,8 +34,7 @@ class CommitLogFilter(QSortFilterProxyModel):
 
     def filterAcceptsRow(self, sourceRow: int, sourceParent: QModelIndex) -> bool:
         try:
-            commit = self.clModel._commitSequence[sourceRow]
-            return (not commit) or (commit.id not in self.hiddenIds)
+            return self.clModel._commitSequence.oidAt(sourceRow) not in self.hiddenIds
         except IndexError:
             # Probably an extra special row
             return True
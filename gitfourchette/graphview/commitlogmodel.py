@@ -7,6 +7,7 @@
 from dataclasses import dataclass
 from typing import Literal
 
+from gitfourchette.commitsequence import CommitSequence
 from gitfourchette.localization import *
 from gitfourchette.porcelain import *
 from gitfourchette.qt import *
@@ -42,15 +43,22 @@ class CommitLogModel(QAbstractListModel):
         SpecialRow      = Qt.ItemDataRole.UserRole + 4
 
     # Reference to RepoState.commitSequence
-    _commitSequence: list[Commit]
+    _commitSequence: CommitSequence
     _extraRow: SpecialRow
 
+    _numCommitRows: int
+    """
+    Number of rows of the commit sequence that are exposed to views.
+    May lag behind the length of the sequence while it's still being built.
+    """
+
     _authorColumnX: int
     _toolTipZones: dict[int, list[CommitToolTipZone]]
 
     def __init__(self, parent):
         super().__init__(parent)
-        self._commitSequence = []
+        self._commitSequence = CommitSequence()
+        self._numCommitRows = 0
         self._extraRow = SpecialRow.Invalid
         self._authorColumnX = -1
         self._toolTipZones = {}
@@ -60,19 +68,56 @@ class CommitLogModel(QAbstractListModel):
         return self._commitSequence is not None
 
     def clear(self):
-        self.setCommitSequence([])
+        self.setCommitSequence(CommitSequence())
         self._toolTipZones.clear()
         self._extraRow = SpecialRow.Invalid
 
-    def setCommitSequence(self, newCommitSequence: list[Commit]):
+    def setCommitSequence(self, newCommitSequence: CommitSequence, numRows: int = -1):
         self.beginResetModel()
         self._commitSequence = newCommitSequence
+        self._numCommitRows = len(newCommitSequence) if numRows < 0 else numRows
         self.endResetModel()
 
-    def mendCommitSequence(self, nRemovedRows: int, nAddedRows: int, newCommitSequence: list[Commit]):
+    @property
+    def numCommitRows(self) -> int:
+        return self._numCommitRows
+
+    def publishCommitRows(self, numRows: int):
+        """
+        Expose more rows of the current commit sequence, as it's being built.
+        """
+        oldNumRows = self._numCommitRows
+        if numRows <= oldNumRows:
+            return
+        assert numRows <= len(self._commitSequence)
+        assert self._extraRow == SpecialRow.Invalid, "publish all commit rows before adding an extra row"
+
+        self.beginInsertRows(QModelIndex(), oldNumRows, numRows - 1)
+        self._numCommitRows = numRows
+        self.endInsertRows()
+
+    def setExtraRow(self, extraRow: SpecialRow):
+        if extraRow == self._extraRow:
+            return
+
+        parent = QModelIndex()
+        row = self._numCommitRows
+
+        if self._extraRow != SpecialRow.Invalid:
+            self.beginRemoveRows(parent, row, row)
+            self._extraRow = SpecialRow.Invalid
+            self.endRemoveRows()
+
+        if extraRow != SpecialRow.Invalid:
+            self.beginInsertRows(parent, row, row)
+            self._extraRow = extraRow
+            self.endInsertRows()
+
+    def mendCommitSequence(self, nRemovedRows: int, nAddedRows: int, newCommitSequence: CommitSequence):
         parent = QModelIndex()  # it's not a tree model so there's no parent
 
         self._commitSequence = newCommitSequence
+        self._numCommitRows = len(newCommitSequence)
 
         # DON'T interleave beginRemoveRows/beginInsertRows!
         # It'll crash with QSortFilterProxyModel!
@@ -88,7 +133,7 @@ class CommitLogModel(QAbstractListModel):
         if not self.isValid:
             return 0
         else:
-            n = len(self._commitSequence)
+            n = self._numCommitRows
             if self._extraRow != SpecialRow.Invalid:
                 n += 1
             return n
@@ -110,16 +155,14 @@ class CommitLogModel(QAbstractListModel):
 
         elif role == CommitLogModel.Role.Oid:
             try:
-                commit = self._commitSequence[row]
-                if commit is not None:
-                    return commit.id
+                return self._commitSequence.oidAt(row)
             except IndexError:
                 pass
 
         elif role == CommitLogModel.Role.SpecialRow:
             if row == 0:
                 return SpecialRow.UncommittedChanges
-            elif row < len(self._commitSequence):
+            elif row < self._numCommitRows:
                 return SpecialRow.Commit
             else:
                 return self._extraRow
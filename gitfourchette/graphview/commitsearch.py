@@ -0,0 +1,129 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+import logging
+from collections.abc import Sequence
+
+from gitfourchette import settings
+from gitfourchette.commitsequence import CommitSequence
+from gitfourchette.pickaxe import Pickaxe, numWorkersFor, searchInPool
+from gitfourchette.porcelain import *
+from gitfourchette.qt import *
+from gitfourchette.toolbox import *
+
+logger = logging.getLogger(__name__)
+
+
+def commitMatchesSearchTerm(commit: Commit, term: str, likelyHash: bool) -> bool:
+    if likelyHash and str(commit.id).startswith(term):
+        return True
+    if term in commit.message.lower():
+        return True
+    if term in abbreviatePerson(commit.author, settings.prefs.authorDisplayStyle).lower():
+        return True
+    return False
+
+
+class CommitSearch(QThread):
+    """
+    Finds all the commits in a CommitSequence that match a search term.
+
+    Matching rows are reported in ascending order, a chunk at a time, via the
+    `progress` signal along with the "frontier": all rows above the frontier
+    have been looked at. The search can either run in the background (start)
+    or synchronously (run). When it runs in the background, it must be given
+    a Repo that no other thread uses.
+
+    In content mode, look for commits that add or remove occurrences of the
+    term in any file (like `git log -S`), instead of looking at the commit
+    messages. Large histories are searched with a pool of worker processes.
+    """
+
+    ChunkSize = 2000
+    "Number of rows to look at between two progress reports."
+
+    SyncThreshold = 10_000
+    "Search smaller commit logs synchronously (except in content mode)."
+
+    progress = Signal(list, int, bool)
+    "New matching rows, frontier, and whether the search is complete."
+
+    def __init__(self, parent: QObject, repo: Repo, sequence: CommitSequence, hiddenIds: set[Oid],
+                 term: str, likelyHash: bool, candidateRows: list[int] | None = None, content: bool = False):
+        super().__init__(parent)
+        self.setObjectName("CommitSearch")
+        self.repo = repo
+        self.sequence = sequence
+        self.hiddenIds = hiddenIds
+        self.term = term
+        self.likelyHash = likelyHash
+        self.candidateRows = candidateRows
+        self.content = content
+        self.pickaxe = Pickaxe(repo, term.encode("utf-8")) if content else None
+        self.cancelled = False
+
+    @calledFromQThread
+    def run(self):
+        sequence = self.sequence
+        numRows = len(sequence)
+
+        try:
+            if self.content:
+                # Weed out the rows that can't match upfront, so we can hand off the rest to worker processes
+                rows = [row for row in range(numRows) if self.isSearchable(row)]
+                numWorkers = numWorkersFor(len(rows))
+                if numWorkers >= 2:
+                    self.runInPool(rows, numWorkers)
+                    return
+            elif self.candidateRows is not None:
+                rows = self.candidateRows
+            else:
+                rows = range(numRows)
+
+            for start in range(0, len(rows), self.ChunkSize):
+                if self.cancelled:
+                    return
+                chunk = rows[start: start + self.ChunkSize]
+                hits = [row for row in chunk if self.matches(row)]
+                self.reportProgress(rows, start + self.ChunkSize, hits)
+
+            if not rows:
+                self.progress.emit([], numRows, True)
+
+        except Exception as exc:  # pragma: no cover
+            logger.warning(f"Commit search interrupted: {exc}", exc_info=True)
+
+    def runInPool(self, rows: list[int], numWorkers: int):
+        oids = [self.sequence.oidAt(row) for row in rows]
+        logger.debug(f"Searching {len(oids)} commits with {numWorkers} processes")
+        for end, hits in searchInPool(self.repo.path, self.pickaxe.needle, oids, numWorkers, lambda: self.cancelled):
+            self.reportProgress(rows, end, [rows[i] for i in hits])
+
+    def reportProgress(self, rows: Sequence[int], end: int, hits: list[int]):
+        """ Report the hits among rows[:end]. """
+        numRows = len(self.sequence)
+        frontier = rows[end] if end < len(rows) else numRows
+        self.progress.emit(hits, frontier, frontier == numRows)
+
+    def isSearchable(self, row: int) -> bool:
+        sequence = self.sequence
+        return not sequence.isMock(row) and sequence.oidAt(row) not in self.hiddenIds
+
+    def matches(self, row: int) -> bool:
+        if not self.isSearchable(row):
+            return False
+        oid = self.sequence.oidAt(row)
+        if self.content:
+            return self.pickaxe.commitMatches(oid)
+        if self.likelyHash and str(oid).startswith(self.term):
+            return True
+        # Don't go through the sequence's Commit cache, it belongs to the UI thread
+        return commitMatchesSearchTerm(self.repo[oid], self.term, False)
+
+    def cancel(self):
+        """ Stop searching. Blocks until the thread is done. """
+        self.cancelled = True
+        self.wait()
@@ -79,7 +79,7 @@ def paintGraphFrame(
         rect: QRect,
         outlineColor: QColor
 ):
-    graph = repoModel.graph
+    graph = repoModel.shownGraph
     hiddenCommits = repoModel.hiddenCommits
     assert graph is not None
 
@@ -4,21 +4,23 @@
 # For full terms, see the included LICENSE file.
 # -----------------------------------------------------------------------------
 
+import bisect
 from contextlib import suppress
 
 from gitfourchette import settings
 from gitfourchette.forms.searchbar import SearchBar
 from gitfourchette.globalshortcuts import GlobalShortcuts
-from gitfourchette.graph import MockCommit
 from gitfourchette.graphview.commitlogdelegate import CommitLogDelegate
 from gitfourchette.graphview.commitlogfilter import CommitLogFilter
 from gitfourchette.graphview.commitlogmodel import CommitLogModel, SpecialRow
+from gitfourchette.graphview.commitsearch import CommitSearch
 from gitfourchette.localization import *
 from gitfourchette.nav import NavLocator, NavContext
 from gitfourchette.porcelain import *
 from gitfourchette.qt import *
 from gitfourchette.repomodel import UC_FAKEID
 from gitfourchette.tasks import *
+from gitfourchette.tasks.loadtasks import openRepo
 from gitfourchette.toolbox import *
 
 
@@ -29,16 +31,33 @@ class GraphView(QListView):
     clModel: CommitLogModel
     clFilter: CommitLogFilter
 
+    commitSearch: CommitSearch | None
+    "Search for all the commits that match the term in the search bar."
+
+    searchHits: list[int]
+    "Rows (in clModel) of the commits that match the search term so far, in ascending order."
+
+    searchFrontier: int
+    "All rows above this one have been searched."
+
+    searchComplete: bool
+
+    pendingSearch: tuple[SearchBar.Op, int, bool] | None
+    "Search operation waiting for more hits: direction, origin row, and whether to keep quiet if nothing's found."
+
     class SelectCommitError(KeyError):
-        def __init__(self, oid: Oid, foundButHidden: bool, likelyTruncated: bool = False):
+        def __init__(self, oid: Oid, foundButHidden: bool, likelyTruncated: bool = False, outsidePathHistory: bool = False):
             super().__init__()
             self.oid = oid
             self.foundButHidden = foundButHidden
             self.likelyTruncated = likelyTruncated
+            self.outsidePathHistory = outsidePathHistory
 
         def __str__(self):
             if self.foundButHidden:
                 m = _("This commit isn’t shown in the graph because it’s part of a hidden branch.")
+            elif self.outsidePathHistory:
+                m = _("This commit isn’t shown in the graph because it doesn’t modify the files whose history is shown.")
             elif self.likelyTruncated:
                 m = _("This commit isn’t shown in the graph because it isn’t part of the truncated commit history.")
             else:
@@ -67,9 +86,25 @@ class GraphView(QListView):
 
         self.searchBar = SearchBar(self, toLengthVariants(_("Find a commit by hash, message or author|Find commit")))
         self.searchBar.detectHashes = True
-        self.searchBar.setUpItemViewBuddy()
+        self.searchBar.textChanged.connect(self.onSearchTextChanged)
+        self.searchBar.searchNext.connect(lambda: self.search(SearchBar.Op.NEXT))
+        self.searchBar.searchPrevious.connect(lambda: self.search(SearchBar.Op.PREVIOUS))
+        self.searchBar.searchPulse.connect(self.onSearchPulse)
         self.searchBar.hide()
 
+        self.contentSearchAction = self.searchBar.lineEdit.addAction(
+            stockIcon("SP_FileIcon"), QLineEdit.ActionPosition.TrailingPosition)
+        self.contentSearchAction.setCheckable(True)
+        self.contentSearchAction.setToolTip(_("Find commits that add or remove this text in any file"))
+        self.contentSearchAction.toggled.connect(self.onContentSearchToggled)
+
+        self.commitSearch = None
+        self.searchHits = []
+        self.searchFrontier = 0
+        self.searchComplete = False
+        self.pendingSearch = None
+        self._searchCandidateCache = {}
+
         self.refreshPrefs(invalidateMetrics=False)
 
     @property
@@ -219,6 +254,18 @@ class GraphView(QListView):
         oid = currentIndex.data(CommitLogModel.Role.Oid)
         return oid
 
+    def adjacentCommitIds(self) -> list[Oid]:
+        """ Commits in the rows just below and above the current row. """
+        row = self.currentIndex().row()
+        if row < 0:
+            return []
+        oids = []
+        for adjacentRow in row + 1, row - 1:
+            index = self.clFilter.index(adjacentRow, 0)
+            if index.isValid() and SpecialRow.Commit == index.data(CommitLogModel.Role.SpecialRow):
+                oids.append(index.data(CommitLogModel.Role.Oid))
+        return oids
+
     def getInfoOnCurrentCommit(self):
         oid = self.currentCommitId
         if not oid:
@@ -284,10 +331,17 @@ class GraphView(QListView):
         return index
 
     def getFilterIndexForCommit(self, oid: Oid) -> QModelIndex | None:
+        repoModel = self.repoModel
         try:
-            rawIndex = self.repoModel.graph.getCommitRow(oid)
+            rawIndex = repoModel.shownGraph.getCommitRow(oid)
         except KeyError as exc:
-            raise GraphView.SelectCommitError(oid, foundButHidden=False, likelyTruncated=self.repoModel.truncatedHistory) from exc
+            if repoModel.pathHistory is not None and oid in repoModel.graph.commitRows:
+                raise GraphView.SelectCommitError(oid, foundButHidden=False, outsidePathHistory=True) from exc
+            raise GraphView.SelectCommitError(oid, foundButHidden=False, likelyTruncated=repoModel.truncatedHistory) from exc
+
+        if rawIndex >= self.clModel.numCommitRows:
+            # The graph is still being built in the background and this row isn't visible yet
+            raise GraphView.SelectCommitError(oid, foundButHidden=False, likelyTruncated=True)
 
         newSourceIndex = self.clModel.index(rawIndex, 0)
         newFilterIndex = self.clFilter.mapFromSource(newSourceIndex)
@@ -319,24 +373,198 @@ class GraphView(QListView):
     # -------------------------------------------------------------------------
     # Find text in commit message or hash
 
-    def searchRange(self, searchRange: range) -> QModelIndex | None:
-        model = self.model()  # to filter out hidden rows, don't use self.clModel directly
-
-        term = self.searchBar.searchTerm
-        likelyHash = self.searchBar.searchTermLooksLikeHash
-        assert term
-        assert term == term.lower(), "search term should have been sanitized"
-
-        for i in searchRange:
-            index = model.index(i, 0)
-            commit = model.data(index, CommitLogModel.Role.Commit)
-            if commit is None or type(commit) is MockCommit:
-                continue
-            if likelyHash and str(commit.id).startswith(term):
-                return index
-            if term in commit.message.lower():
-                return index
-            if term in abbreviatePerson(commit.author, settings.prefs.authorDisplayStyle).lower():
-                return index
-
-        return None
+    def search(self, op: SearchBar.Op):
+        self.searchBar.popUp(forceSelectAll=op == SearchBar.Op.START)
+
+        if op == SearchBar.Op.START:
+            return
+
+        if not self.searchBar.searchTerm:  # user probably hit F3 without having searched before
+            return
+
+        self.ensureCommitSearch()
+
+        # Search from the selected row, or from the top/bottom of the graph
+        currentIndex = self.currentIndex()
+        if currentIndex.isValid():
+            origin = self.clFilter.mapToSource(currentIndex).row()
+        elif op == SearchBar.Op.NEXT:
+            origin = -1
+        else:
+            origin = len(self.clModel._commitSequence)
+
+        self.pendingSearch = (op, origin, False)
+        self.resolvePendingSearch()
+
+    def onSearchPulse(self):
+        """ The user has stopped typing: find the first match from the top of the visible rows. """
+        self.ensureCommitSearch()
+
+        if self.pendingSearch is not None:  # Don't override an explicit request
+            return
+
+        visibleRange = itemViewVisibleRowRange(self)
+        if visibleRange:
+            origin = self.clFilter.mapToSource(self.clFilter.index(visibleRange.start, 0)).row() - 1
+        else:
+            origin = -1
+
+        self.pendingSearch = (SearchBar.Op.NEXT, origin, True)
+        self.resolvePendingSearch()
+
+    def onSearchTextChanged(self):
+        self.cancelCommitSearch()
+        self.viewport().update()  # Redraw search term highlights
+
+    def onContentSearchToggled(self, content: bool):
+        self.searchBar.turnRed(False)
+        self.searchBar.setMatchCount(-1)
+        self.onSearchTextChanged()
+        if self.searchBar.searchTerm:
+            self.searchBar.searchPulseTimer.start()
+
+    def searchParams(self) -> tuple[str, bool, bool]:
+        """ Return the search term, whether it looks like a hash, and whether to search file contents. """
+        if self.contentSearchAction.isChecked():
+            # Search file contents verbatim, like git log -S
+            return self.searchBar.rawSearchTerm.strip(), False, True
+        return self.searchBar.searchTerm, self.searchBar.searchTermLooksLikeHash, False
+
+    def ensureCommitSearch(self):
+        """ Start looking for all the commits that match the search term, unless we're already on it. """
+        term, likelyHash, content = self.searchParams()
+        sequence = self.clModel._commitSequence
+        job = self.commitSearch
+
+        if (job is not None and (job.term, job.likelyHash, job.content) == (term, likelyHash, content)
+                and job.sequence is sequence and job.hiddenIds is self.clFilter.hiddenIds):
+            return
+
+        self.cancelCommitSearch()
+
+        candidateRows = self.searchCandidateRows(term, likelyHash) if not content else None
+        numRows = len(candidateRows) if candidateRows is not None else len(sequence)
+        synchronous = numRows < CommitSearch.SyncThreshold and not content
+
+        # The UI thread keeps using RepoModel.repo, so a background search must read commits through its own handle
+        repo = self.repoModel.repo
+        if not synchronous:
+            repo = openRepo(repo.workdir)
+
+        job = CommitSearch(self, repo, sequence, self.clFilter.hiddenIds,
+                           term, likelyHash, candidateRows, content)
+        job.progress.connect(self.onCommitSearchProgress)
+        self.commitSearch = job
+
+        if synchronous:
+            job.run()
+        else:
+            self.searchBar.setMatchCount(0, final=False)
+            job.start()
+
+    def cancelCommitSearch(self):
+        job = self.commitSearch
+        if job is None:
+            return
+        job.progress.disconnect(self.onCommitSearchProgress)
+        job.cancel()
+        job.deleteLater()
+        self.commitSearch = None
+        self.searchHits = []
+        self.searchFrontier = 0
+        self.searchComplete = False
+        self.pendingSearch = None
+
+    def onCommitSearchProgress(self, hits: list[int], frontier: int, complete: bool):
+        if self.sender() is not self.commitSearch:  # Stale report from a cancelled search
+            return
+
+        self.searchHits.extend(hits)
+        self.searchFrontier = frontier
+        self.searchComplete = complete
+        self.searchBar.setMatchCount(len(self.searchHits), final=complete)
+
+        if hits:
+            self.viewport().update()
+
+        self.resolvePendingSearch()
+
+    def resolvePendingSearch(self):
+        """ Select the match that the user is waiting for, if we've found it yet. """
+        if self.pendingSearch is None:
+            return
+
+        op, origin, quiet = self.pendingSearch
+        hits = self.searchHits
+
+        if op == SearchBar.Op.NEXT:
+            i = bisect.bisect_right(hits, origin)
+            if i < len(hits):
+                row = hits[i]
+            elif not self.searchComplete:
+                return  # Wait for more hits
+            else:
+                row = hits[0] if hits else -1  # Wrap around
+        else:
+            i = bisect.bisect_left(hits, origin)
+            if i > 0 and origin <= self.searchFrontier:
+                row = hits[i - 1]
+            elif not self.searchComplete:
+                return  # Wait for more hits
+            else:
+                row = hits[-1] if hits else -1  # Wrap around
+
+        self.pendingSearch = None
+
+        index = self.clFilter.mapFromSource(self.clModel.index(row, 0)) if row >= 0 else QModelIndex_default
+        if index.isValid():
+            self.setCurrentIndex(index)
+            return
+
+        self.searchBar.turnRed()
+        if not quiet:
+            title = self.searchBar.lineEdit.placeholderText().split("\x9C")[0]
+            message = self.searchBar.notFoundMessage(self.searchBar.rawSearchTerm)
+            qmb = asyncMessageBox(self.searchBar, 'information', title, message)
+            qmb.show()
+
+    def isSearchHit(self, sourceRow: int) -> bool | None:
+        """ Return whether a row matches the search term, or None if we don't know yet. """
+        job = self.commitSearch
+        if (job is None or sourceRow >= self.searchFrontier
+                or job.sequence is not self.clModel._commitSequence
+                or (job.term, job.likelyHash, job.content) != self.searchParams()):
+            return None
+        hits = self.searchHits
+        i = bisect.bisect_left(hits, sourceRow)
+        return i < len(hits) and hits[i] == sourceRow
+
+    def searchCandidateRows(self, term: str, likelyHash: bool) -> list[int] | None:
+        """
+        Return the sorted rows of the commits that may match the search term,
+        according to the repo's search index. Return None if the index can't
+        narrow down the search.
+        """
+        repoModel = self.repoModel
+        searchIndex = repoModel.searchIndex if repoModel is not None else None
+        if searchIndex is None:
+            return None
+
+        # Cache the rows for "find next/previous"
+        key = (term, likelyHash, searchIndex, searchIndex.generation, self.clModel._commitSequence)
+        with suppress(KeyError):
+            return self._searchCandidateCache[key]
+
+        oids = searchIndex.lookUp(term, likelyHash)
+        if oids is None:
+            return None
+
+        rows = set()
+        graph = repoModel.shownGraph
+        for oid in oids:
+            with suppress(KeyError):  # The commit may have gone away since it was indexed
+                rows.add(graph.getCommitRow(oid))
+        rows = sorted(rows)
+
+        self._searchCandidateCache = {key: rows}
+        return rows
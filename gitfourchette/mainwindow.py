@@ -616,6 +616,8 @@ class MainWindow(QMainWindow):
             rw.specialDiffView.setFocus()
         elif rw.conflictView.isVisibleTo(rw):
             rw.conflictView.setFocus()
+        elif rw.virtualDiffView.isVisibleTo(rw):
+            rw.virtualDiffView.setFocus()
         else:
             rw.diffView.setFocus()
 
@@ -36,6 +36,9 @@ class NavFlags(enum.IntFlag):
     AllowLargeFiles = enum.auto()
     "Bypass large file limit to display the diff at this location."
 
+    FullResolution = enum.auto()
+    "Decode images at full resolution to display the diff at this location."
+
     AllowLargeCommits = enum.auto()
     "Bypass rename detection limit to display the commit at this location."
 
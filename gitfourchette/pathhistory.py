@@ -0,0 +1,254 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+Path-limited history: the commits that touch some paths, like `git log -- <paths>`.
+
+A commit touches a path if the path (or anything under it, for a directory)
+differs between the commit and its first parent. Diffing the trees of every
+commit in the history is slow in large repositories, so we first ask the
+changed-path Bloom filters in git's commit-graph, which rule out most commits
+without reading a single object. The trees of the remaining commits are
+diffed, and the paths that each commit changes are cached for later queries.
+
+Like git's default history simplification, a merge that leaves the paths
+as they are in one of its parents is skipped, and only that parent's side of
+the history is followed. The surviving commits are then stitched back
+together into a smaller graph, with each commit's parents rewritten to their
+nearest ancestors that touch the paths.
+"""
+
+from __future__ import annotations
+
+import logging
+import sys
+from collections.abc import Iterable
+
+from gitfourchette.commitsequence import CommitSequence
+from gitfourchette.graph import CommitGraphError, CommitGraphFile, Graph, GraphBuildLoop, MockCommit, commitGraphEnabled
+from gitfourchette.porcelain import *
+
+logger = logging.getLogger(__name__)
+
+
+class ChangedPathCache:
+    """
+    Remembers the paths that each commit changes compared to its first
+    parent, along with their leading directories.
+    """
+
+    CacheSize = 100_000
+    "Number of commits to remember."
+
+    def __init__(self):
+        self.paths: dict[Oid, frozenset[str]] = {}
+
+    def changedPaths(self, repo: Repo, oid: Oid) -> frozenset[str]:
+        cache = self.paths
+        try:
+            return cache[oid]
+        except KeyError:
+            pass
+
+        commit = repo[oid]
+        tree = commit.tree
+        if commit.parent_ids:
+            diff = tree.diff_to_tree(repo[commit.parent_ids[0]].tree, swap=True)
+        else:
+            diff = tree.diff_to_tree(swap=True)
+
+        # No rename detection: a renamed file shows up as a deletion and an addition
+        paths = set()
+        for delta in diff.deltas:
+            path = delta.new_file.path
+            while path and path not in paths:
+                paths.add(sys.intern(path))
+                path = path.rpartition("/")[0]
+        paths = frozenset(paths)
+
+        if len(cache) >= self.CacheSize:
+            del cache[next(iter(cache))]
+        cache[oid] = paths
+        return paths
+
+
+class PathHistory:
+    """
+    Commit log limited to the commits that touch some paths.
+
+    Build it on a worker thread, then show `commitSequence` and `graph` in
+    GraphView instead of the full commit log.
+    """
+
+    paths: list[str]
+    "Paths relative to the root of the repository (files or directories)."
+
+    commitSequence: CommitSequence
+    "Commits that touch the paths (plus the Uncommitted Changes row), with rewritten parents."
+
+    graph: Graph
+
+    verdicts: dict[Oid, bool]
+    "Whether each commit touches the paths compared to its first parent."
+
+    sameParents: dict[Oid, Oid | None]
+    "Parent (beyond the first) in which the paths are the same as in each merge commit that touches them."
+
+    numBloomRejects: int
+    "Number of commits that the commit-graph's Bloom filters ruled out."
+
+    numTreeDiffs: int
+    "Number of commits whose changed paths had to be looked up."
+
+    truncated: bool
+    "Whether the commit log was truncated, i.e. older commits that touch the paths may be missing."
+
+    def __init__(self, paths: Iterable[str]):
+        self.paths = sorted({path.strip("/") for path in paths})
+        assert all(self.paths)
+        self.commitSequence = CommitSequence()
+        self.graph = Graph()
+        self.verdicts = {}
+        self.sameParents = {}
+        self.numBloomRejects = 0
+        self.numTreeDiffs = 0
+        self.truncated = False
+
+    def reuseFindings(self, previous: PathHistory | None):
+        """ Carry over what a previous PathHistory found out about the same paths (commits never change). """
+        if previous is not None and previous.paths == self.paths:
+            self.verdicts = previous.verdicts
+            self.sameParents = previous.sameParents
+
+    @staticmethod
+    def openCommitGraph(repo: Repo) -> CommitGraphFile | None:
+        """ Return the repository's commit-graph if it has changed-path Bloom filters. """
+        if not commitGraphEnabled(repo):
+            return None
+
+        try:
+            commitGraph = CommitGraphFile.open(repo.path)
+        except (CommitGraphError, OSError) as exc:
+            logger.info(f"Not using commit-graph for path history: {exc}")
+            return None
+
+        if commitGraph is None or not commitGraph.hasChangedPaths:
+            return None
+        return commitGraph
+
+    def touches(self, oid: Oid, repo: Repo, commitGraph: CommitGraphFile | None, cache: ChangedPathCache) -> bool:
+        """ Return True if the commit touches any of the paths. """
+        verdicts = self.verdicts
+        try:
+            return verdicts[oid]
+        except KeyError:
+            pass
+
+        paths = self.paths
+
+        if commitGraph is not None:
+            pos = commitGraph.find(oid)
+            if pos >= 0 and commitGraph.mayChangePaths(pos, paths) is False:
+                self.numBloomRejects += 1
+                verdicts[oid] = False
+                return False
+
+        self.numTreeDiffs += 1
+        changedPaths = cache.changedPaths(repo, oid)
+        verdict = any(path in changedPaths for path in paths)
+        verdicts[oid] = verdict
+        return verdict
+
+    def sameParent(self, oid: Oid, repo: Repo) -> Oid | None:
+        """
+        Return the first of a merge commit's other parents (beyond the first
+        parent) in which the paths are the same as in the merge, or None.
+        """
+        sameParents = self.sameParents
+        try:
+            return sameParents[oid]
+        except KeyError:
+            pass
+
+        commit = repo[oid]
+        entries = [_treeEntryId(commit.tree, path) for path in self.paths]
+
+        sameParent = None
+        for parent in commit.parents[1:]:
+            if entries == [_treeEntryId(parent.tree, path) for path in self.paths]:
+                sameParent = parent.id
+                break
+
+        sameParents[oid] = sameParent
+        return sameParent
+
+    def build(self, repo: Repo, sequence: CommitSequence, cache: ChangedPathCache):
+        """ Pick the commits that touch the paths out of the full commit log and build their graph. """
+        commitGraph = self.openCommitGraph(repo)
+
+        # Tips are the commits that nobody in the sequence descends from
+        hasChild = set()
+        for commit in sequence:
+            hasChild.update(commit.parent_ids)
+
+        # Walk down from the tips. If the paths are the same in a commit as in
+        # one of its parents, skip the commit and only follow that parent, so
+        # that side branches without an effect on the paths are pruned.
+        live = set()
+        entries: list[tuple[Oid | str, list[Oid], bool]] = []
+        for commit in sequence:
+            oid = commit.id
+            if oid in hasChild and oid not in live:
+                continue
+
+            parents = list(commit.parent_ids)
+            if type(oid) is not Oid:  # Uncommitted Changes
+                keep = True
+            elif not self.touches(oid, repo, commitGraph, cache):
+                keep = False
+                parents = parents[:1]
+            elif len(parents) > 1 and (sameParent := self.sameParent(oid, repo)) is not None:
+                keep = False
+                parents = [sameParent]
+            else:
+                keep = True
+
+            live.update(parents)
+            entries.append((oid, parents, keep))
+
+        # Map each commit to its nearest ancestor that we're keeping
+        substitutes: dict[Oid | str, Oid | None] = {}
+        for oid, parents, keep in reversed(entries):
+            if keep:
+                substitutes[oid] = oid
+            elif parents:
+                substitutes[oid] = substitutes.get(parents[0])
+            else:
+                substitutes[oid] = None
+
+        commits = []
+        for oid, parents, keep in entries:
+            if not keep:
+                continue
+            newParents = []
+            for parent in parents:
+                substitute = substitutes.get(parent)
+                if substitute is not None and substitute not in newParents:
+                    newParents.append(substitute)
+            commits.append(MockCommit(oid, newParents))
+
+        self.commitSequence = CommitSequence.fromCommits(repo, commits)
+        self.graph = GraphBuildLoop().sendAll(commits).graph
+
+        logger.info(f"History of {self.paths}: {len(commits)} rows "
+                    f"({self.numBloomRejects} commits ruled out by Bloom filters, {self.numTreeDiffs} tree diffs)")
+
+
+def _treeEntryId(tree: Tree, path: str) -> Oid | None:
+    try:
+        return tree[path].id
+    except KeyError:
+        return None
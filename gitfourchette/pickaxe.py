@@ -0,0 +1,129 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+History content search, like `git log -S`: find the commits that change the
+number of occurrences of a string in any file, compared to their first parent.
+
+The same blob usually shows up twice in a row of commits (once as the new
+side of a change, once as the old side of the next change to that file), so
+occurrence counts are cached by blob id. For large histories, the commits can
+be split into shards that are searched by a pool of worker processes.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+from collections.abc import Callable, Iterator, Sequence
+
+from gitfourchette.porcelain import *
+
+logger = logging.getLogger(__name__)
+
+MinCommitsPerWorker = 2000
+"Don't bother spawning a worker process for fewer commits than this."
+
+ShardSize = 500
+"Number of commits handed to a worker process at a time."
+
+_BINARY_SNIFF_SIZE = 8000  # same heuristic as git
+
+
+class Pickaxe:
+    CacheSize = 50_000
+    "Number of blob occurrence counts to remember."
+
+    def __init__(self, repo: Repo, needle: bytes):
+        assert needle
+        self.repo = repo
+        self.needle = needle
+        self.counts: dict[Oid, int] = {}
+
+    def blobCount(self, oid: Oid) -> int:
+        """ Count the occurrences of the needle in a blob. Binary blobs are skipped (count 0). """
+        if oid == NULL_OID:
+            return 0
+
+        counts = self.counts
+        try:
+            return counts[oid]
+        except KeyError:
+            pass
+
+        data = self.repo[oid].data
+        count = 0 if b"\0" in data[:_BINARY_SNIFF_SIZE] else data.count(self.needle)
+
+        if len(counts) >= self.CacheSize:
+            del counts[next(iter(counts))]
+        counts[oid] = count
+        return count
+
+    def commitMatches(self, oid: Oid) -> bool:
+        """ Return True if the commit changes the number of occurrences of the needle in any file. """
+        # No rename detection: it doesn't change the counts, and it's expensive
+        diffs, _dummy = self.repo.commit_diffs(oid, find_similar_threshold=0, context_lines=0)
+        for diff in diffs:
+            for delta in diff.deltas:
+                oldFile = delta.old_file
+                newFile = delta.new_file
+                if FileMode.COMMIT in (oldFile.mode, newFile.mode):  # Submodule
+                    continue
+                if self.blobCount(oldFile.id) != self.blobCount(newFile.id):
+                    return True
+        return False
+
+
+def numWorkersFor(numCommits: int) -> int:
+    """ Number of worker processes worth spawning to search the given number of commits. """
+    return min(os.cpu_count() or 1, numCommits // MinCommitsPerWorker)
+
+
+def searchInPool(repoPath: str, needle: bytes, oids: Sequence[Oid], numWorkers: int,
+                 isCancelled: Callable[[], bool] = lambda: False) -> Iterator[tuple[int, list[int]]]:
+    """
+    Search the given commits with a pool of worker processes. Yield the end
+    of each shard (an index into `oids`) and the indices of the matching
+    commits within, in order.
+    """
+    # Don't fork: other threads may be holding locks in this process.
+    context = multiprocessing.get_context("spawn")
+    pool = concurrent.futures.ProcessPoolExecutor(numWorkers, mp_context=context)
+
+    try:
+        futures = []
+        for start in range(0, len(oids), ShardSize):
+            shard = b"".join(oid.raw for oid in oids[start: start + ShardSize])
+            futures.append((start, pool.submit(_searchShard, repoPath, needle, shard)))
+
+        for start, future in futures:
+            if isCancelled():
+                return
+            yield min(start + ShardSize, len(oids)), [start + i for i in future.result()]
+    finally:
+        # Don't wait for shards that are still running if we're bailing out
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+_workerPickaxe: Pickaxe | None = None
+_workerRepoPath = ""
+
+
+def _searchShard(repoPath: str, needle: bytes, shard: bytes) -> list[int]:
+    """ Worker process entry point. Return the indices of the matching commits in the shard. """
+    global _workerPickaxe, _workerRepoPath
+
+    # Keep the repo and the blob counts around for the next shard
+    if _workerPickaxe is None or _workerRepoPath != repoPath or _workerPickaxe.needle != needle:
+        _workerPickaxe = Pickaxe(Repo(repoPath), needle)
+        _workerRepoPath = repoPath
+
+    pickaxe = _workerPickaxe
+    oidLength = pickaxe.repo.oid_length
+    return [i for i in range(len(shard) // oidLength)
+            if pickaxe.commitMatches(Oid(shard[i * oidLength: (i + 1) * oidLength]))]
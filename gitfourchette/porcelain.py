@@ -14,6 +14,7 @@ import logging as _logging
 import os as _os
 import re as _re
 import shutil as _shutil
+import time as _time
 import typing as _typing
 import warnings
 from contextlib import suppress as _suppress
@@ -86,7 +87,10 @@ from pygit2.enums import (
     SortMode,
 )
 
+from pygit2.errors import check_error as _check_error
+from pygit2.ffi import C as _C, ffi as _ffi
 from pygit2.remotes import TransferProgress
+from pygit2.utils import StrArray as _StrArray
 
 
 _logger = _logging.getLogger(__name__)
@@ -221,6 +225,19 @@ class StashApplyBreakdown(StashApplyCallbacks, CheckoutBreakdown):
         _logger.info(f"stash apply progress: {pr}")
 
 
+def _version_to_tuple(s: str) -> tuple[int, ...]:
+    v = []
+    for n in s.split("."):
+        try:
+            v.append(int(n))
+        except ValueError:
+            v.append(0)
+    # Trim trailing zeros to ease comparison
+    while v and v[-1] == 0:
+        v.pop()
+    return tuple(v)
+
+
 def _version_at_least(
         package_name: str,
         required_version_string: str,
@@ -228,20 +245,8 @@ def _version_at_least(
         raise_error=True,
         feature_name="This feature"
 ):
-    def version_to_tuple(s: str):
-        v = []
-        for n in s.split("."):
-            try:
-                v.append(int(n))
-            except ValueError:
-                v.append(0)
-        # Trim trailing zeros to ease comparison
-        while v and v[-1] == 0:
-            v.pop()
-        return tuple(v)
-
-    required_version = version_to_tuple(required_version_string)
-    current_version = version_to_tuple(current_version_string)
+    required_version = _version_to_tuple(required_version_string)
+    current_version = _version_to_tuple(current_version_string)
 
     if tuple(current_version) >= tuple(required_version):
         return True
@@ -273,6 +278,25 @@ def libgit2_version_at_least(required_version: str, raise_error=True, feature_na
         feature_name=feature_name)
 
 
+def _can_diff_index_paths() -> bool:
+    """
+    Repo._diff_index_paths reaches into pygit2's internals (the cffi handles
+    of Repository, Index and Tree, and Diff.from_c), which aren't part of its
+    public API. Only do this with the pygit2 versions that we know it works with.
+    """
+    if not (1, 15, 1) <= _version_to_tuple(PYGIT2_VERSION) < (1, 21):
+        return False
+    return hasattr(Diff, "from_c") and hasattr(Tree, "_pointer")
+
+
+PATH_LIMITED_DIFFS = _can_diff_index_paths()
+"""
+Whether the workdir and staged diffs can be limited to some paths. If not,
+Repo.get_unstaged_changes and Repo.get_staged_changes ignore their `paths`
+argument and return complete diffs.
+"""
+
+
 def split_remote_branch_shorthand(remote_branch_name: str) -> tuple[str, str]:
     """
     Extract the remote name and branch name from a remote branch shorthand
@@ -615,6 +639,163 @@ class GitConfigHelper:
         return s.encode('raw_unicode_escape').decode('unicode_escape')
 
 
+class UntrackedCache:
+    """
+    Remembers the contents of the untracked directories of a workdir between
+    calls to Repo.get_unstaged_changes, so that they needn't be walked again
+    unless they have changed.
+
+    An untracked directory contains no tracked files at all (e.g. build
+    outputs). libgit2 can spot these without descending into them. The diff
+    of all such directories is then reused as long as the modification times
+    of the directories and of their subdirectories haven't changed, nor the
+    .gitignore and exclude files that apply to them.
+
+    Setting up the cache costs a bit more than a plain diff, so the first
+    call doesn't use the cache; this keeps the initial load of a repo fast.
+
+    libgit2 doesn't support git's own untracked cache, but we honor
+    core.untrackedCache=false to turn this off.
+    """
+
+    RACY_NS = 2_000_000_000
+    "Don't trust modification times this recent (in nanoseconds), the directory may still change within the same tick."
+
+    primed: bool
+    "Whether get_unstaged_changes has been called once already."
+
+    untracked_dirs: list[str]
+    "Untracked directories covered by untracked_diff (with a trailing slash)."
+
+    untracked_diff: Diff | None
+    "Diff of the untracked directories, or None if nothing is cached."
+
+    def __init__(self):
+        self.primed = False
+        self.untracked_dirs = []
+        self.untracked_diff = None
+        self._stamped_paths: list[str] = []
+        self._stamp: list = []
+
+    @staticmethod
+    def is_enabled(repo: Repo) -> bool:
+        if not PATH_LIMITED_DIFFS:
+            return False
+        try:
+            return repo.config.get_bool("core.untrackedCache")
+        except (KeyError, ValueError, GitError):  # unset, or "keep"
+            return True
+
+    def clear(self):
+        self.untracked_dirs = []
+        self.untracked_diff = None
+        self._stamped_paths = []
+        self._stamp = []
+
+    def diff(self, repo: Repo, flags: DiffOption, context_lines: int) -> Diff:
+        """
+        Equivalent to diffing the index to the workdir with the given flags
+        (which must recurse untracked dirs). The diff may be shared with the
+        cache, so don't modify it.
+        """
+        assert flags & DiffOption.RECURSE_UNTRACKED_DIRS
+
+        if not self.primed:
+            self.primed = True
+            return repo.diff(None, None, flags=flags, context_lines=context_lines)
+
+        # Outline the workdir, stopping at untracked directories.
+        # (SHOW_UNTRACKED_CONTENT doesn't make libgit2 descend into them.)
+        outline_flags = flags & ~DiffOption.RECURSE_UNTRACKED_DIRS
+        outline_flags |= DiffOption.ENABLE_FAST_UNTRACKED_DIRS
+        outline = repo.diff(None, None, flags=outline_flags, context_lines=context_lines)
+
+        untracked_dirs = []
+        other_paths = []
+        for delta in outline.deltas:
+            path = delta.new_file.path
+            if delta.status == DeltaStatus.UNTRACKED and path.endswith("/"):
+                untracked_dirs.append(path)
+            else:
+                other_paths.append(path)
+
+        if not untracked_dirs:
+            # Nothing to descend into, so the outline is as good as a full diff
+            self.clear()
+            return outline
+
+        flags &= ~DiffOption.UPDATE_INDEX
+        untracked_diff = self._untracked_diff(repo, untracked_dirs, flags, context_lines)
+        if not other_paths:
+            return untracked_diff
+
+        # Merge into a fresh diff, never into the cached one.
+        # (Merge all untracked directories in one go: merging is linear in the size of both diffs.)
+        diff = repo._diff_index_paths(None, other_paths, flags, context_lines)
+        diff.merge(untracked_diff)
+        return diff
+
+    def _untracked_diff(self, repo: Repo, untracked_dirs: list[str], flags: DiffOption, context_lines: int) -> Diff:
+        workdir = repo.workdir
+
+        # .gitignore files in the parent directories also apply
+        parents = set()
+        for path in untracked_dirs:
+            parent = path.rstrip("/")
+            while parent:
+                parent = _dirname(parent)
+                parents.add(parent)
+        ignore_paths = [_joinpath(workdir, parent, ".gitignore") for parent in sorted(parents)]
+        ignore_paths += self._excludes_paths(repo)
+        stamp = [flags, context_lines, untracked_dirs] + [_stat_stamp(p) for p in ignore_paths]
+
+        if (self.untracked_diff is not None
+                and stamp + [_stat_stamp(p) for p in self._stamped_paths] == self._stamp):
+            return self.untracked_diff
+
+        # Stamp the subdirectories BEFORE diffing, so that any changes made in the meantime show up next time
+        stamped_paths = []
+        for path in untracked_dirs:
+            for root, dirnames, _dummy in _os.walk(_joinpath(workdir, path)):
+                stamped_paths.append(root)
+                stamped_paths.append(_joinpath(root, ".gitignore"))
+                with _suppress(ValueError):
+                    dirnames.remove(".git")  # untracked nested repository
+        file_stamps = [_stat_stamp(p) for p in ignore_paths + stamped_paths]
+        stamp = stamp[:3] + file_stamps
+
+        diff = repo._diff_index_paths(None, [path.removesuffix("/") for path in untracked_dirs], flags, context_lines)
+
+        racy_mtime = _time.time_ns() - self.RACY_NS
+        if all(s is None or s[0] < racy_mtime for s in file_stamps):
+            self.untracked_dirs = untracked_dirs
+            self.untracked_diff = diff
+            self._stamped_paths = stamped_paths
+            self._stamp = stamp
+        else:
+            self.clear()
+        return diff
+
+    @staticmethod
+    def _excludes_paths(repo: Repo) -> list[str]:
+        paths = [_joinpath(repo.path, "info", "exclude")]
+        excludes_file = repo.get_config_value("core.excludesFile")
+        if excludes_file:
+            paths.append(_os.path.expanduser(excludes_file))
+        else:
+            xdg_config_home = _os.environ.get("XDG_CONFIG_HOME") or _os.path.expanduser("~/.config")
+            paths.append(_joinpath(xdg_config_home, "git", "ignore"))
+        return paths
+
+
+def _stat_stamp(path: str) -> tuple[int, int, int] | None:
+    try:
+        st = _os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
 class Repo(_VanillaRepository):
     """
     Drop-in replacement for pygit2.Repository with convenient front-ends to common git operations.
@@ -648,6 +829,12 @@ class Repo(_VanillaRepository):
     def head_branch_fullname(self) -> str:
         return self.head.name
 
+    @property
+    def oid_length(self) -> int:
+        """Length of a raw object ID in this repo: 20 bytes for SHA-1, 32 bytes for SHA-256."""
+        object_format = self.get_config_value("extensions.objectFormat")
+        return 32 if object_format.lower() == "sha256" else 20
+
     def peel_commit(self, commit_id: Oid) -> Commit:
         return self[commit_id].peel(Commit)
 
@@ -699,11 +886,47 @@ class Repo(_VanillaRepository):
         dirty_diff.find_similar()
         return dirty_diff
 
-    def get_unstaged_changes(self, update_index: bool = False, show_binary: bool = False, context_lines: int = 3) -> Diff:
+    def _diff_index_paths(self, tree: Tree | None, paths: list[str], flags: DiffOption, context_lines: int) -> Diff:
+        """
+        Compare a tree to the index (or the index to the workdir if tree is
+        None), looking only at the given paths (files or directories).
+
+        pygit2 doesn't let us pass a pathspec to these diffs, so call libgit2
+        directly. Don't call this unless PATH_LIMITED_DIFFS is True.
+        """
+        assert PATH_LIMITED_DIFFS
+        copts = _ffi.new("git_diff_options *")
+        _check_error(_C.git_diff_options_init(copts, 1))
+        copts.flags = int(flags | DiffOption.DISABLE_PATHSPEC_MATCH)
+        copts.context_lines = context_lines
+
+        cdiff = _ffi.new("git_diff **")
+        index = self.index
+
+        with _StrArray(paths) as pathspec:
+            pathspec.assign_to(copts.pathspec)
+            if tree is None:
+                err = _C.git_diff_index_to_workdir(cdiff, self._repo, index._index, copts)
+            else:
+                ctree = _ffi.new("git_tree **")
+                _ffi.buffer(ctree)[:] = tree._pointer[:]
+                err = _C.git_diff_tree_to_index(cdiff, self._repo, ctree[0], index._index, copts)
+            _check_error(err)
+
+        return Diff.from_c(bytes(_ffi.buffer(cdiff)[:]), self)
+
+    def get_unstaged_changes(self, update_index: bool = False, show_binary: bool = False, context_lines: int = 3,
+                             paths: list[str] | None = None, untracked_cache: UntrackedCache | None = None) -> Diff:
         """
         Get a Diff of unstaged changes in the working directory.
 
         In other words, this function compares the workdir to the index.
+
+        If `paths` is given, only look at these files or directories (if
+        PATH_LIMITED_DIFFS is True; otherwise, the diff is complete).
+
+        If `untracked_cache` is given, reuse what it knows about untracked
+        directories that haven't changed since the previous call.
         """
 
         flags = (DiffOption.INCLUDE_UNTRACKED
@@ -727,15 +950,26 @@ class Repo(_VanillaRepository):
         if show_binary:
             flags |= DiffOption.SHOW_BINARY
 
+        if paths is not None and PATH_LIMITED_DIFFS:
+            return self._diff_index_paths(None, paths, flags, context_lines)
+
+        if untracked_cache is not None and untracked_cache.is_enabled(self):
+            return untracked_cache.diff(self, flags, context_lines)
+
         dirty_diff = self.diff(None, None, flags=flags, context_lines=context_lines)
         # dirty_diff.find_similar()  #-- it seems that find_similar cannot find renames in unstaged changes, so don't bother
         return dirty_diff
 
-    def get_staged_changes(self, fast: bool = False, show_binary: bool = False, context_lines: int = 3) -> Diff:
+    def get_staged_changes(self, fast: bool = False, show_binary: bool = False, context_lines: int = 3,
+                           paths: list[str] | None = None) -> Diff:
         """
         Get a Diff of the staged changes.
 
         In other words, this function compares the index to HEAD.
+
+        If `paths` is given, only look at these files or directories (if
+        PATH_LIMITED_DIFFS is True; otherwise, the diff is complete). Note that
+        renames can't be detected if one side of the rename is left out.
         """
 
         flags = DiffOption.INCLUDE_TYPECHANGE
@@ -747,6 +981,11 @@ class Repo(_VanillaRepository):
             index_tree_id = self.index.write_tree()
             tree = self.peel_tree(index_tree_id)
             return tree.diff_to_tree(swap=True, flags=flags, context_lines=context_lines)
+        elif paths is not None and PATH_LIMITED_DIFFS:
+            stage_diff = self._diff_index_paths(self.head_tree, paths, flags, context_lines)
+            if not fast:
+                stage_diff.find_similar()
+            return stage_diff
         else:
             # compare HEAD to index
             stage_diff: Diff = self.diff('HEAD', None, cached=True, flags=flags, context_lines=context_lines)
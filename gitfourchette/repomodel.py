@@ -4,20 +4,42 @@
 # For full terms, see the included LICENSE file.
 # -----------------------------------------------------------------------------
 
+import itertools
 import logging
+import os
+import threading
 from collections import defaultdict
-from collections.abc import Generator, Iterable
+from collections.abc import Callable, Generator, Iterable, Iterator
 
 from gitfourchette import settings
-from gitfourchette.graph import Graph, GraphSpliceLoop, MockCommit
+from gitfourchette.appconsts import APP_SYSTEM_NAME
+from gitfourchette.commitdiffcache import CommitDiffCache
+from gitfourchette.commitsequence import CommitSequence
+from gitfourchette.diffview.diffdocument import DiffDocumentCache
+from gitfourchette.diffview.specialdiff import DiffImageCache
+from gitfourchette.graph import (
+    CommitGraphError,
+    CommitGraphFile,
+    Graph,
+    GraphCache,
+    GraphCacheError,
+    GraphSpliceLoop,
+    MockCommit,
+    commitGraphEnabled,
+)
+from gitfourchette.graph.packscan import scanPacks
+from gitfourchette.pathhistory import ChangedPathCache, PathHistory
 from gitfourchette.porcelain import *
 from gitfourchette.repoprefs import RepoPrefs
+from gitfourchette.searchindex import CommitSearchIndex
 from gitfourchette.toolbox import *
 
 logger = logging.getLogger(__name__)
 
 UC_FAKEID = "UC_FAKEID"
 
+GRAPH_CACHE_FILENAME = f"{APP_SYSTEM_NAME}.graphcache"
+
 
 def toggleSetElement(s: set, element):
     assert isinstance(s, set)
@@ -36,7 +58,7 @@ class RepoModel:
     """Walker used to generate the graph. Call initializeWalker before use.
     Keep it around to speed up ulterior refreshes."""
 
-    commitSequence: list[Commit]
+    commitSequence: CommitSequence
     "Ordered list of commits."
 
     truncatedHistory: bool
@@ -49,6 +71,9 @@ class RepoModel:
     refsAt: dict[Oid, list[str]]
     "Get all reference names pointing at a given commit ID."
 
+    unsplicedRefs: dict[str, Oid] | None
+    "Refs as of the last graph splice, if they've changed since but the graph was still being built."
+
     mergeheads: list[Oid]
 
     stashes: list[Oid]
@@ -78,9 +103,46 @@ class RepoModel:
     hiddenCommits: set[Oid]
     "All cached commit oids that are hidden."
 
+    graphLock: threading.Lock
+    """
+    Held by GraphBuildThread while it extends the graph, the commit sequence and
+    the hidden/foreign commit sets. Take it before reading those on the UI thread
+    while the graph is being built.
+    """
+
+    searchIndex: CommitSearchIndex | None
+    "Index of the commit log for the search bar. Built in the background once the graph is complete."
+
+    pathHistory: PathHistory | None
+    "Commits that touch some paths, shown in GraphView instead of the full commit log. None shows all commits."
+
+    changedPathCache: ChangedPathCache
+    "Paths changed by each commit, for building path histories."
+
+    diffDocumentCache: DiffDocumentCache
+    "Layouts of recently viewed diffs."
+
+    diffImageCache: DiffImageCache
+    "Recently viewed images, scaled down to fit the diff view."
+
+    commitDiffCache: CommitDiffCache
+    "Diffs of recently viewed (or prefetched) commits."
+
+    auxRepo: Repo | None
+    "Second handle on the repository, so that a worker thread can read from it in parallel with `repo`."
+
+    untrackedCache: UntrackedCache
+    "Contents of the untracked directories as of the last workdir scan."
+
     workdirStale: bool
     "Flag indicating that the workdir should be refreshed before use."
 
+    workdirDirtyPaths: set[str] | None
+    "Workdir paths that may have changed since the file lists were last loaded. None or empty means unknown."
+
+    keyframesStale: bool
+    "Flag indicating that the graph changed and keyframes should be placed around the branch tips again."
+
     numUncommittedChanges: int
     "Number of unstaged+staged files. Zero means unknown count, not zero files."
 
@@ -92,21 +154,31 @@ class RepoModel:
     def __init__(self, repo: Repo):
         assert isinstance(repo, Repo)
 
-        self.commitSequence = []
+        self.commitSequence = CommitSequence(repo)
         self.truncatedHistory = True
+        self.searchIndex = None
+        self.pathHistory = None
+        self.changedPathCache = ChangedPathCache()
+        self.diffDocumentCache = DiffDocumentCache()
+        self.diffImageCache = DiffImageCache()
+        self.commitDiffCache = CommitDiffCache()
 
         self.walker = None
         self.graph = Graph()
+        self.graphLock = threading.Lock()
+        self.keyframesStale = False
 
         self.headIsDetached = False
         self.homeBranch = ""
 
         self.superproject = ""
         self.workdirStale = True
+        self.workdirDirtyPaths = None
         self.numUncommittedChanges = 0
 
         self.refs = {}
         self.refsAt = {}
+        self.unsplicedRefs = None
         self.mergeheads = []
         self.stashes = []
         self.submodules = {}
@@ -119,6 +191,8 @@ class RepoModel:
         self.localSeeds = set()
 
         self.repo = repo
+        self.auxRepo = None
+        self.untrackedCache = UntrackedCache()
 
         self.prefs = RepoPrefs(repo)
         self.prefs._parentDir = repo.path
@@ -137,6 +211,23 @@ class RepoModel:
         # The first item in the commit sequence is the "fake commit" for Uncommitted Changes.
         return max(0, len(self.commitSequence) - 1)
 
+    @property
+    def shownGraph(self) -> Graph:
+        """ Graph of the commits shown in GraphView (the path history's, if any). """
+        if self.pathHistory is not None:
+            return self.pathHistory.graph
+        return self.graph
+
+    def markWorkdirDirty(self, paths: Iterable[str] | None = None):
+        """ Flag the workdir as stale. Pass the paths that have changed, if known, so it can be reloaded partially. """
+        self.workdirStale = True
+        if paths is None or self.workdirDirtyPaths is None:
+            self.workdirDirtyPaths = None
+        else:
+            self.workdirDirtyPaths.update(paths)
+            if "" in self.workdirDirtyPaths:  # The root directory: everything
+                self.workdirDirtyPaths = None
+
     @property
     def headCommitId(self) -> Oid:
         """ Oid of the currently checked-out commit. """
@@ -242,9 +333,8 @@ class RepoModel:
 
         return prefix + settings.history.getRepoNickname(self.repo.workdir)
 
-    @benchmark
-    def primeWalker(self) -> Walker:
-        tipIds = self.refs.values()
+    @staticmethod
+    def walkerSortMode() -> SortMode:
         sorting = SortMode.TOPOLOGICAL
 
         if settings.prefs.chronologicalOrder:
@@ -254,20 +344,79 @@ class RepoModel:
             # ordering, keep TOPOLOGICAL in addition to TIME.
             sorting |= SortMode.TIME
 
-        if self.walker is None:
-            self.walker = self.repo.walk(None, sorting)
+        return sorting
+
+    @benchmark
+    def walkCommitGraph(self, maxCommits: int = 0, isCancelled: Callable[[], bool] | None = None,
+                        repo: Repo | None = None) -> Iterator[MockCommit] | None:
+        """
+        Sort the history with the help of git's commit-graph file, which spares
+        us from reading every single commit object like Walker does. The order
+        is the same as primeWalker's.
+
+        If there's no commit-graph file, very large repositories may have
+        their packfiles scanned by several processes instead (see packscan),
+        if the parallelPrime pref is on. Whether that pays off depends on the
+        number of commits loaded last time, capped by `maxCommits` (0 for no
+        limit). `isCancelled` lets the caller interrupt the scan.
+
+        Missing commits are looked up through `repo` if given (e.g. a handle
+        owned by a background thread), or through RepoModel.repo otherwise.
+
+        Return None if the repository has no usable commit-graph.
+        """
+
+        if repo is None:
+            repo = self.repo
+
+        if not commitGraphEnabled(repo):
+            return None
+
+        def lookUpMissing(oid: Oid):
+            commit = repo[oid]
+            return commit.commit_time, commit.parent_ids
+
+        try:
+            commitGraph = CommitGraphFile.open(repo.path)
+            if commitGraph is None and settings.prefs.parallelPrime:
+                numCommits = settings.history.getRepoNumCommits(repo.workdir)
+                if maxCommits:
+                    numCommits = min(numCommits, maxCommits)
+                commitGraph = scanPacks(repo.path, repo.oid_length, numCommits, isCancelled=isCancelled)
+            if commitGraph is None:
+                return None
+            return commitGraph.topologicalSequence(
+                list(self.refs.values()), settings.prefs.chronologicalOrder, lookUpMissing)
+        except (CommitGraphError, OSError, KeyError) as exc:
+            logger.info(f"Not using commit-graph: {exc}")
+            return None
+
+    @benchmark
+    def primeWalker(self, repo: Repo | None = None) -> Walker:
+        """
+        Push the tips onto RepoModel's walker. If `repo` is given, push them
+        onto a fresh walker on that repo handle instead, which the caller owns.
+        """
+        tipIds = self.refs.values()
+        sorting = self.walkerSortMode()
+
+        if repo is not None:
+            walker = repo.walk(None, sorting)
+        elif self.walker is None:
+            walker = self.walker = self.repo.walk(None, sorting)
         else:
-            self.walker.reset()
-            self.walker.sort(sorting)  # this resets the walker IF ALREADY WALKING (i.e. next was called once)
+            walker = self.walker
+            walker.reset()
+            walker.sort(sorting)  # this resets the walker IF ALREADY WALKING (i.e. next was called once)
 
         # In topological mode, the order in which the tips are pushed is
         # significant (last in, first out). The tips should be pre-sorted in
         # ASCENDING chronological order so that the latest modified branches
         # come out at the top of the graph in topological mode.
         for tip in tipIds:
-            self.walker.push(tip)
+            walker.push(tip)
 
-        return self.walker
+        return walker
 
     def uncommittedChangesMockCommit(self):
         try:
@@ -337,14 +486,151 @@ class RepoModel:
                     break
         coSplice.close()  # flush it
 
-        self.commitSequence = gsl.commitSequence
+        self.commitSequence = self.asCommitSequence(gsl.commitSequence)
         self.hideSeeds = gsl.hideSeeds
         self.localSeeds = gsl.localSeeds
         self.hiddenCommits = gsl.hiddenCommits
         self.foreignCommits = gsl.foreignCommits
 
+        # Keep the search index up to date (even if it's still being built)
+        if self.searchIndex is not None:
+            if gsl.numRowsRemoved >= 0:
+                sequence = self.commitSequence
+                self.searchIndex.addCommits(sequence[row] for row in range(gsl.numRowsAdded) if not sequence.isMock(row))
+            else:
+                self.searchIndex = None  # The graph was replaced wholesale, it must be reindexed
+
+        # Don't hold up the refresh; RepoWidget places keyframes when it's idle
+        self.keyframesStale = True
+
         return gsl
 
+    @benchmark
+    def placeGraphKeyframes(self, maxTips: int = 64):
+        """
+        Place keyframes around HEAD and the most recent branch tips so that
+        jumping to them in the GraphView doesn't replay a long stretch of graph.
+        """
+        rows = []
+        # refsAt is sorted by ascending commit time; favor recent tips
+        for oid in itertools.chain([self.headCommitId], reversed(self.refsAt)):
+            if len(rows) >= maxTips:
+                break
+            try:
+                rows.append(self.graph.getCommitRow(oid))
+            except KeyError:
+                continue
+        self.graph.placeKeyframes(rows)
+        self.keyframesStale = False
+
+    def asCommitSequence(self, commits) -> CommitSequence:
+        # GraphSpliceLoop hands back a plain list if it couldn't splice
+        if isinstance(commits, CommitSequence):
+            return commits
+        return CommitSequence.fromCommits(self.repo, commits)
+
+    @property
+    def graphCachePath(self) -> str:
+        return os.path.join(self.repo.path, GRAPH_CACHE_FILENAME)
+
+    @benchmark
+    def loadGraphCache(self, maxCommits: int) -> GraphSpliceLoop | None:
+        """
+        Restore the graph and commit sequence from the on-disk graph cache,
+        splicing in any commits that appeared since the cache was written.
+
+        Return None if the cache is missing or unusable; the caller should
+        then walk the entire history. Otherwise, return the GraphSpliceLoop
+        that brought the cached graph up to date.
+        """
+
+        path = self.graphCachePath
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            cache = GraphCache.read(path)
+        except (OSError, GraphCacheError) as exc:
+            logger.warning(f"Ignoring graph cache: {exc}")
+            return None
+
+        if cache.chronological != settings.prefs.chronologicalOrder:
+            logger.info("Ignoring graph cache: different sort order")
+            return None
+
+        if not cache.sequence or cache.sequence[0].id != UC_FAKEID:
+            return None
+
+        numCachedCommits = len(cache.sequence) - 1
+        if numCachedCommits == 0 or (cache.truncated and numCachedCommits < maxCommits):
+            return None
+
+        oldTips = set(cache.tips)
+        newTips = set(self.getKnownTips())
+        repo = self.repo
+
+        oldSequence = CommitSequence.fromCommits(repo, cache.sequence)
+
+        try:
+            # Walk the commits that appeared since the cache was written.
+            newCommits = []
+            if not newTips.issubset(oldTips):
+                walker = repo.walk(None, self.walkerSortMode())
+                for tip in self.refs.values():
+                    if tip not in oldTips:
+                        walker.push(tip)
+                for tip in oldTips:
+                    walker.hide(tip)
+                newCommits = list(walker)
+        except (KeyError, ValueError, GitError) as exc:
+            logger.info(f"Ignoring graph cache: {exc}")
+            return None
+
+        # Every vanished tip must still be reachable from the new commits,
+        # otherwise the cached sequence contains commits that are now gone.
+        reachable = set(newTips)
+        for commit in newCommits:
+            reachable.update(commit.parent_ids)
+        if not (oldTips - newTips).issubset(reachable):
+            logger.info("Ignoring graph cache: some cached commits became unreachable")
+            return None
+
+        hideSeeds = self.getHiddenTips()
+        localSeeds = self.getLocalTips()
+        gsl = GraphSpliceLoop(cache.graph, oldSequence, oldHeads=oldTips, newHeads=newTips,
+                              hideSeeds=hideSeeds, localSeeds=localSeeds)
+        gsl.sendAll(itertools.chain([self.uncommittedChangesMockCommit()], newCommits, oldSequence[1:]))
+
+        if not gsl.splicer.foundEquilibrium:
+            logger.info("Ignoring graph cache: splicing failed")
+            return None
+
+        self.graph = cache.graph
+        self.commitSequence = self.asCommitSequence(gsl.commitSequence)
+        self.truncatedHistory = cache.truncated
+        self.hiddenCommits = gsl.hiddenCommits
+        self.foreignCommits = gsl.foreignCommits
+        self.hideSeeds = hideSeeds
+        self.localSeeds = localSeeds
+
+        logger.debug(f"Graph cache: {len(newCommits)} new commits, "
+                     f"{gsl.numRowsAdded} rows added, {gsl.numRowsRemoved} rows removed")
+        return gsl
+
+    @benchmark
+    def saveGraphCache(self):
+        if self.numRealCommits == 0:
+            return
+
+        cache = GraphCache(self.graph, self.commitSequence, self.getKnownTips(),
+                           truncated=self.truncatedHistory,
+                           chronological=settings.prefs.chronologicalOrder)
+
+        try:
+            cache.write(self.graphCachePath)
+        except OSError as exc:
+            logger.warning(f"Couldn't write graph cache: {exc}")
+
     @benchmark
     def toggleHideRefPattern(self, refPattern: str):
         toggleSetElement(self.prefs.hiddenRefPatterns, refPattern)
@@ -0,0 +1,371 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+Watch a repository for changes made by other programs, so that the UI can
+refresh itself without waiting for the window to regain focus.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import errno
+import logging
+import os
+import struct
+import sys
+
+from gitfourchette.porcelain import *
+from gitfourchette.qt import *
+from gitfourchette.tasks.repotask import TaskEffects
+from gitfourchette.toolbox import *
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_EXCL_UNLINK = 0x4000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_WATCH_MASK = (_IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+                  | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR | _IN_EXCL_UNLINK)
+_IN_EVENT = struct.Struct("iIII")
+
+# Files in the git directory that are worth a refresh (besides refs/**)
+_GITDIR_EFFECTS = {
+    "index": TaskEffects.Index | TaskEffects.Workdir,
+    "HEAD": TaskEffects.Head | TaskEffects.Refs | TaskEffects.Workdir,
+    "packed-refs": TaskEffects.Refs,
+    "MERGE_HEAD": TaskEffects.Refs,
+    "CHERRY_PICK_HEAD": TaskEffects.Refs,
+    "REVERT_HEAD": TaskEffects.Refs,
+    "config": TaskEffects.Remotes,
+}
+
+
+def _loadLibc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+
+
+class RepoWatcher(QObject):
+    """
+    Watches the working directory and the git directory of a repository.
+
+    Bursts of events are coalesced into a single `changed` signal carrying
+    the effects that a refresh should cover, and the workdir paths that were
+    touched (files, or directories whose contents changed). Changes to
+    ignored files and to the object database are not reported.
+
+    On Linux, inotify tells us exactly which files changed. Elsewhere,
+    QFileSystemWatcher only tells us which directories changed.
+    """
+
+    Delay = 250
+    "Milliseconds of quiet to wait for before reporting a burst of changes."
+
+    MaxDelay = 2000
+    "Report an ongoing burst of changes after this many milliseconds anyway."
+
+    MaxDirectories = 10_000
+    "Stop watching new workdir directories past this number."
+
+    Disabled = False
+    "Set in test mode so that unit tests decide when to refresh."
+
+    changed = Signal(TaskEffects, set)
+
+    def __init__(self, parent: QObject, repo: Repo):
+        super().__init__(parent)
+        self.setObjectName("RepoWatcher")
+        self.repo = repo
+        self.workdir = os.path.normpath(repo.workdir)
+        self.gitDir = os.path.normpath(repo.path)
+        self.pendingEffects = TaskEffects.Nothing
+        self.pendingPaths = set()
+        self.numDirectories = 0
+
+        self.flushTimer = CallbackAccumulator(self, self.flush, self.Delay)
+        self.burstTimer = QElapsedTimer()
+
+        # QFileSystemWatcher fallback: modification times of the git directory's interesting files and directories
+        self.gitDirStamps: dict[str, int] = {}
+
+        # Watched directory -> (is it in the git directory?, path relative to the workdir or the git directory)
+        self.watches: dict[int | str, tuple[bool, str]] = {}
+
+        self.libc = _loadLibc()
+        self.inotifyFd = -1
+        self.notifier = None
+        self.fsWatcher = None
+
+        if self.libc is not None:
+            self.inotifyFd = self.libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.inotifyFd >= 0:
+            self.notifier = QSocketNotifier(self.inotifyFd, QSocketNotifier.Type.Read, self)
+            self.notifier.activated.connect(self.readEvents)
+        else:
+            self.fsWatcher = QFileSystemWatcher(self)
+            self.fsWatcher.directoryChanged.connect(self.onDirectoryChanged)
+
+    @staticmethod
+    def listDirectories(repo: Repo, top: str = "", limit: int = MaxDirectories) -> list[str]:
+        """
+        Return the workdir directories worth watching under `top` (inclusive),
+        relative to the workdir. Ignored directories are skipped.
+        """
+        workdir = repo.workdir
+        dirs = []
+        stack = [top]
+        while stack and len(dirs) < limit:
+            rel = stack.pop()
+            dirs.append(rel)
+            try:
+                with os.scandir(os.path.join(workdir, rel)) as it:
+                    for entry in it:
+                        if entry.name == ".git" or not entry.is_dir(follow_symlinks=False):
+                            continue
+                        sub = f"{rel}/{entry.name}" if rel else entry.name
+                        if not repo.path_is_ignored(sub + "/"):
+                            stack.append(sub)
+            except OSError:
+                pass
+        return dirs
+
+    def start(self, workdirDirectories: list[str]):
+        """ Start watching the git directory and the given workdir directories (see listDirectories). """
+        self.watchDirectory(True, "")
+        for rel in self.listGitDirectories("refs"):
+            self.watchDirectory(True, rel)
+        for rel in workdirDirectories:
+            self.watchDirectory(False, rel)
+        self.stampGitDir()
+        logger.debug(f"Watching {self.numDirectories} directories in {self.workdir}")
+
+    def stop(self):
+        self.flushTimer.stop()
+        if self.notifier is not None:
+            self.notifier.setEnabled(False)
+            self.notifier = None
+        if self.inotifyFd >= 0:
+            os.close(self.inotifyFd)
+            self.inotifyFd = -1
+        if self.fsWatcher is not None and self.fsWatcher.directories():
+            self.fsWatcher.removePaths(self.fsWatcher.directories())
+        self.watches.clear()
+
+    def listGitDirectories(self, top: str) -> list[str]:
+        dirs = []
+        for root, _subdirs, _dummy in os.walk(os.path.join(self.gitDir, top)):
+            dirs.append(os.path.relpath(root, self.gitDir).replace(os.sep, "/"))
+        return dirs
+
+    def watchDirectory(self, inGitDir: bool, rel: str):
+        if not inGitDir and self.numDirectories >= self.MaxDirectories:
+            return
+
+        base = self.gitDir if inGitDir else self.workdir
+        fullPath = os.path.join(base, rel) if rel else base
+
+        if self.fsWatcher is not None:
+            if self.fsWatcher.addPath(fullPath):
+                self.watches[fullPath] = (inGitDir, rel)
+                self.numDirectories += not inGitDir
+            return
+
+        wd = self.libc.inotify_add_watch(self.inotifyFd, os.fsencode(fullPath), _IN_WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = (inGitDir, rel)
+            self.numDirectories += not inGitDir
+        elif ctypes.get_errno() == errno.ENOSPC:  # pragma: no cover
+            logger.warning(f"Out of inotify watches (see fs.inotify.max_user_watches); not watching {fullPath}")
+            self.numDirectories = self.MaxDirectories
+
+    def readEvents(self):
+        """ Read all the inotify events that are available right now. """
+        if self.inotifyFd < 0:
+            return
+
+        while True:
+            try:
+                data = os.read(self.inotifyFd, 65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as exc:  # pragma: no cover
+                logger.warning(f"Can't read inotify events: {exc}")
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, nameLength = _IN_EVENT.unpack_from(data, offset)
+                offset += _IN_EVENT.size
+                name = os.fsdecode(data[offset: offset + nameLength].rstrip(b"\0"))
+                offset += nameLength
+                self.onEvent(wd, mask, name)
+
+    def onEvent(self, wd: int, mask: int, name: str):
+        if mask & _IN_Q_OVERFLOW:
+            # We've missed some events, so we don't know what changed
+            self.addPending(TaskEffects.DefaultRefresh, "")
+            return
+
+        if mask & _IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        try:
+            inGitDir, rel = self.watches[wd]
+        except KeyError:
+            return
+
+        if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+            if not rel:  # The whole workdir or git directory is gone
+                self.addPending(TaskEffects.DefaultRefresh, "")
+            return
+
+        path = f"{rel}/{name}" if rel else name
+        isDir = bool(mask & _IN_ISDIR)
+
+        # Start watching new directories (their contents are dirty anyway)
+        if isDir and mask & (_IN_CREATE | _IN_MOVED_TO):
+            if inGitDir:
+                for sub in self.listGitDirectories(path):
+                    self.watchDirectory(True, sub)
+            elif not self.repo.path_is_ignored(path + "/"):
+                for sub in self.listDirectories(self.repo, path, self.MaxDirectories - self.numDirectories):
+                    self.watchDirectory(False, sub)
+
+        self.onPathChanged(inGitDir, path, isDir)
+
+    def onDirectoryChanged(self, fullPath: str):
+        """ QFileSystemWatcher fallback: we only know which directory changed. """
+        try:
+            inGitDir, rel = self.watches[fullPath]
+        except KeyError:
+            return
+
+        if not os.path.isdir(fullPath):
+            self.watches.pop(fullPath, None)
+        elif inGitDir:
+            for sub in self.listGitDirectories(rel):
+                if os.path.join(self.gitDir, sub) not in self.watches:
+                    self.watchDirectory(True, sub)
+        else:
+            for sub in self.listDirectories(self.repo, rel, self.MaxDirectories - self.numDirectories):
+                if os.path.join(self.workdir, sub) not in self.watches:
+                    self.watchDirectory(False, sub)
+
+        if not inGitDir:
+            self.onPathChanged(False, rel, True)
+            return
+
+        # These signals lag behind, so discardPending can't drain them.
+        # Tell which files have changed since the last refresh by their modification times.
+        oldStamps = self.gitDirStamps
+        self.stampGitDir()
+        for path, stamp in self.gitDirStamps.items():
+            if oldStamps.get(path) != stamp:
+                self.onPathChanged(True, path, False)
+        for path in oldStamps.keys() - self.gitDirStamps.keys():
+            self.onPathChanged(True, path, False)
+
+    def stampGitDir(self):
+        if self.fsWatcher is None:
+            return
+
+        paths = list(_GITDIR_EFFECTS)
+        paths.extend(rel for inGitDir, rel in self.watches.values() if inGitDir and rel)
+
+        stamps = {}
+        for path in paths:
+            try:
+                stamps[path] = os.stat(os.path.join(self.gitDir, path)).st_mtime_ns
+            except OSError:
+                pass
+        self.gitDirStamps = stamps
+
+    def onPathChanged(self, inGitDir: bool, path: str, isDir: bool):
+        if inGitDir:
+            if path.endswith(".lock"):
+                effects = TaskEffects.Nothing
+            elif path.startswith("refs/") or path == "refs":
+                effects = TaskEffects.Refs
+            else:
+                effects = _GITDIR_EFFECTS.get(path, TaskEffects.Nothing)
+            self.addPending(effects)
+        elif not path or not self.repo.path_is_ignored(path + "/" if isDir else path):
+            self.addPending(TaskEffects.Workdir, path)
+
+    def addPending(self, effects: TaskEffects, path: str | None = None):
+        if effects == TaskEffects.Nothing:
+            return
+
+        if self.pendingEffects == TaskEffects.Nothing:
+            self.burstTimer.start()
+        self.pendingEffects |= effects
+        if path is not None:
+            self.pendingPaths.add(path)
+
+        # Wait for a moment of quiet, unless the burst has been going on for too long
+        if not self.flushTimer.isActive() or self.burstTimer.elapsed() < self.MaxDelay:
+            self.flushTimer.start()
+
+    def flush(self):
+        effects = self.pendingEffects
+        paths = self.pendingPaths
+        self.pendingEffects = TaskEffects.Nothing
+        self.pendingPaths = set()
+        if effects != TaskEffects.Nothing:
+            logger.debug(f"Changes detected: {repr(effects)} {sorted(paths)[:10]}")
+            self.changed.emit(effects, paths)
+
+    def seesAllChanges(self) -> bool:
+        """
+        Return True if every change to a file in the workdir gets reported
+        with its path, so that the workdir can be reloaded partially.
+        """
+        return self.inotifyFd >= 0 and self.numDirectories < self.MaxDirectories
+
+    def discardPending(self, effects: TaskEffects, paths: set[str] | None = None):
+        """
+        Forget about the changes that a refresh covering the given effects has
+        just picked up, including the ones caused by the refresh itself
+        (e.g. rewriting the index).
+
+        If the refresh only reloaded some workdir paths, pass them so that the
+        changes elsewhere in the workdir are still reported.
+        """
+        self.readEvents()
+        self.stampGitDir()
+        self.pendingEffects &= ~effects
+        if effects & TaskEffects.Workdir:
+            if paths is None:
+                self.pendingPaths.clear()
+            else:
+                self.pendingPaths = {path for path in self.pendingPaths if not isUnderPaths(path, paths)}
+        # Without any paths, the Workdir bit is only meaningful alongside Index or Head
+        if not self.pendingPaths and not self.pendingEffects & (TaskEffects.Index | TaskEffects.Head):
+            self.pendingEffects &= ~TaskEffects.Workdir
+        if self.pendingEffects == TaskEffects.Nothing:
+            self.flushTimer.stop()
@@ -13,7 +13,7 @@ from gitfourchette import tasks
 from gitfourchette.diffarea import DiffArea
 from gitfourchette.diffview.diffdocument import DiffDocument
 from gitfourchette.diffview.diffview import DiffView
-from gitfourchette.diffview.specialdiff import ShouldDisplayPatchAsImageDiff
+from gitfourchette.diffview.specialdiff import ShouldDisplayPatchAsImageDiff, ShouldDisplayPatchAsVirtualDiff
 from gitfourchette.exttools import PREFKEY_MERGETOOL, openInTextEditor
 from gitfourchette.forms.banner import Banner
 from gitfourchette.forms.openrepoprogress import OpenRepoProgress
@@ -22,12 +22,15 @@ from gitfourchette.forms.unloadedrepoplaceholder import UnloadedRepoPlaceholder
 from gitfourchette.globalshortcuts import GlobalShortcuts
 from gitfourchette.graphview.graphview import GraphView
 from gitfourchette.localization import *
-from gitfourchette.nav import NavHistory, NavLocator, NavContext
+from gitfourchette.nav import NavHistory, NavLocator, NavContext, NavFlags
+from gitfourchette.pathhistory import PathHistory
 from gitfourchette.porcelain import *
 from gitfourchette.qt import *
 from gitfourchette.repomodel import RepoModel
+from gitfourchette.repowatcher import RepoWatcher
+from gitfourchette.searchindex import CommitSearchIndex
 from gitfourchette.sidebar.sidebar import Sidebar
-from gitfourchette.tasks import RepoTask, TaskEffects, TaskBook, AbortMerge, RepoTaskRunner
+from gitfourchette.tasks import RepoTask, TaskEffects, TaskBook, AbortMerge, RepoTaskRunner, TaskLane
 from gitfourchette.toolbox import *
 from gitfourchette.trtables import TrTables
 
@@ -57,6 +60,21 @@ class RepoWidget(QStackedWidget):
 
     allowAutoLoad: bool
 
+    graphBuild: tasks.GraphBuildThread | None
+    "Background thread finishing the commit graph after the repo has been primed"
+
+    searchIndexBuild: tasks.SearchIndexThread | None
+    "Background thread indexing the commit log for the search bar"
+
+    renameDetection: tasks.RenameDetectionThread | None
+    "Background thread looking for renames in a large commit"
+
+    pendingRenameDetection: Oid
+    "Large commit to look for renames in once renameDetection is done"
+
+    repoWatcher: RepoWatcher | None
+    "Watches the repo for changes made by other programs"
+
     navLocator: NavLocator
     navHistory: NavHistory
 
@@ -118,12 +136,26 @@ class RepoWidget(QStackedWidget):
         self.pendingEffects = TaskEffects.Nothing
         self.pendingStatusMessage = ""
         self.allowAutoLoad = True
+        self.graphBuild = None
+        self.searchIndexBuild = None
+        self.renameDetection = None
+        self.pendingRenameDetection = NULL_OID
+        self.repoWatcher = None
 
         self.busyCursorDelayer = QTimer(self)
         self.busyCursorDelayer.setSingleShot(True)
         self.busyCursorDelayer.setInterval(100)
         self.busyCursorDelayer.timeout.connect(lambda: self.setCursor(Qt.CursorShape.BusyCursor))
 
+        # Prefetch the diffs around the current location once the task runner has been idle for a moment
+        self.prefetchTimer = QTimer(self)
+        self.prefetchTimer.setSingleShot(True)
+        self.prefetchTimer.setInterval(150)
+        self.prefetchTimer.timeout.connect(self.placeStaleKeyframes)
+        self.prefetchTimer.timeout.connect(self.prefetchNeighbors)
+        self.repoTaskRunner.ready.connect(self.prefetchTimer.start)
+        self.prefetchedLocator = NavLocator()
+
         self.navLocator = NavLocator()
         self.navHistory = NavHistory()
 
@@ -179,6 +211,7 @@ class RepoWidget(QStackedWidget):
         self.stagedFiles = self.diffArea.stagedFiles
         self.committedFiles = self.diffArea.committedFiles
         self.diffView = self.diffArea.diffView
+        self.virtualDiffView = self.diffArea.virtualDiffView
         self.specialDiffView = self.diffArea.specialDiffView
         self.conflictView = self.diffArea.conflictView
         self.diffBanner = self.diffArea.diffBanner
@@ -221,10 +254,12 @@ class RepoWidget(QStackedWidget):
 
         self.graphView.linkActivated.connect(self.processInternalLink)
         self.graphView.statusMessage.connect(self.statusMessage)
+        self.graphView.verticalScrollBar().actionTriggered.connect(self.onGraphScrolled)
 
         self.diffArea.committedFiles.openDiffInNewWindow.connect(self.loadPatchInNewWindow)
         self.diffArea.conflictView.openPrefs.connect(self.openPrefs)
         self.diffArea.diffView.contextualHelp.connect(self.statusMessage)
+        self.diffArea.virtualDiffView.contextualHelp.connect(self.statusMessage)
         self.diffArea.specialDiffView.linkActivated.connect(self.processInternalLink)
 
         self.sidebar.statusMessage.connect(self.statusMessage)
@@ -261,6 +296,7 @@ class RepoWidget(QStackedWidget):
             self.diffArea.dirtyFiles,
             self.diffArea.stagedFiles,
             self.diffArea.diffView,
+            self.diffArea.virtualDiffView,
             self.diffArea.specialDiffView,
             self.diffArea.conflictView,
         )
@@ -289,14 +325,20 @@ class RepoWidget(QStackedWidget):
         graphView = GraphView(self)
         graphView.searchBar.notFoundMessage = self.commitNotFoundMessage
 
+        pathHistoryBanner = Banner(self, orientation=Qt.Orientation.Horizontal)
+        pathHistoryBanner.setProperty("class", "history")
+        pathHistoryBanner.setVisible(False)
+
         container = QWidget()
         layout = QVBoxLayout(container)
         layout.setSpacing(0)
         layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(pathHistoryBanner)
         layout.addWidget(graphView.searchBar)
         layout.addWidget(graphView)
 
         self.graphView = graphView
+        self.pathHistoryBanner = pathHistoryBanner
         return container
 
     def _makeSidebarContainer(self):
@@ -332,6 +374,40 @@ class RepoWidget(QStackedWidget):
 
         return task
 
+    def placeStaleKeyframes(self):
+        """ Place graph keyframes around the branch tips after the top of the graph has changed. """
+        if (not self.isLoaded
+                or not self.repoModel.keyframesStale
+                or self.repoTaskRunner.isBusy()
+                or (self.graphBuild is not None and self.graphBuild.isRunning())):  # It'll place them when it's done
+            return
+        self.repoModel.placeGraphKeyframes()
+
+    def prefetchNeighbors(self):
+        """ Prefetch the diffs of the files and commits next to the current location. """
+        locator = self.navLocator
+        if (RepoTaskRunner.ForceSerial  # No point prefetching on the UI thread
+                or not self.isLoaded
+                or not self.uiReady
+                or not self.isVisible()
+                or self.repoTaskRunner.isBusy()
+                or locator.isSimilarEnoughTo(self.prefetchedLocator)):
+            return
+
+        if locator.context in [NavContext.UNSTAGED, NavContext.STAGED, NavContext.COMMITTED]:
+            fileList = self.diffArea.fileListByContext(locator.context)
+            patches = [(entry.diff, entry.patchNo,
+                        NavLocator(context=locator.context, commit=locator.commit, path=entry.canonicalPath))
+                       for entry in fileList.adjacentEntries()]
+        else:
+            patches = []
+
+        commitIds = self.graphView.adjacentCommitIds()
+
+        self.prefetchedLocator = locator
+        if patches or commitIds:
+            self.runTask(tasks.PrefetchNeighbors, patches, commitIds)
+
     # -------------------------------------------------------------------------
     # Initial repo priming
 
@@ -451,6 +527,8 @@ class RepoWidget(QStackedWidget):
             newLocator = self.diffView.getPreciseLocator()
             if not newLocator.isSimilarEnoughTo(self.navLocator):
                 warnings.warn(f"RepoWidget/DiffView locator mismatch: {self.navLocator} vs. {newLocator}")
+        elif self.virtualDiffView.isVisibleTo(self):
+            newLocator = self.virtualDiffView.getPreciseLocator()
         else:
             newLocator = self.navLocator.coarse()
 
@@ -528,9 +606,25 @@ class RepoWidget(QStackedWidget):
             self.repoTaskRunner.killCurrentTask()
             self.repoTaskRunner.joinZombieTask()
 
+            # Stop watching the repo
+            self.stopRepoWatcher()
+
+            # Stop building the graph
+            if self.graphBuild is not None:
+                self.graphBuild.cancel()
+            if self.searchIndexBuild is not None:
+                self.searchIndexBuild.cancel()
+            if self.renameDetection is not None:
+                self.renameDetection.cancel()
+            self.pendingRenameDetection = NULL_OID
+            self.graphView.cancelCommitSearch()
+
             # Free the repository
             self.repoModel.repo.free()
             self.repoModel.repo = None
+            if self.repoModel.auxRepo is not None:
+                self.repoModel.auxRepo.free()
+                self.repoModel.auxRepo = None
             logger.info(f"Repository freed: {self.pendingPath}")
 
         # Forget RepoModel
@@ -564,7 +658,8 @@ class RepoWidget(QStackedWidget):
         except Exception as exc:
             excMessageBox(exc, _("Open diff in new window"),
                           _("Only text diffs may be opened in a separate window."),
-                          showExcSummary=not isinstance(exc, ShouldDisplayPatchAsImageDiff),
+                          showExcSummary=not isinstance(exc, ShouldDisplayPatchAsImageDiff
+                                                                  | ShouldDisplayPatchAsVirtualDiff),
                           icon='information')
             return
 
@@ -644,6 +739,7 @@ class RepoWidget(QStackedWidget):
             self.diffArea.stagedFiles: self.diffArea.stagedFiles.searchBar,
             self.diffArea.committedFiles: self.diffArea.committedFiles.searchBar,
             self.diffArea.diffView: self.diffArea.diffView.searchBar,
+            self.diffArea.virtualDiffView: self.diffArea.virtualDiffView.searchBar,
         }
 
         # Find a sink to redirect search to
@@ -658,7 +754,7 @@ class RepoWidget(QStackedWidget):
             searchBar = self.graphView.searchBar
 
         # Forward search
-        if isinstance(sink, QAbstractItemView):
+        if isinstance(sink, QAbstractItemView) and sink is not self.graphView:
             searchBar.searchItemView(op)
         else:
             sink.search(op)
@@ -687,6 +783,17 @@ class RepoWidget(QStackedWidget):
 
     def toggleHideRefPattern(self, refPattern: str):
         assert refPattern.startswith("refs/")
+
+        # The entire graph must be ready before we can re-trickle hidden commits; try again once it is
+        graphBuild = self.graphBuild
+        if graphBuild is not None and not graphBuild.wrappedUp:
+            def retry():
+                graphBuild.settled.disconnect(retry)
+                if not graphBuild.cancelled:
+                    self.toggleHideRefPattern(refPattern)
+            graphBuild.settled.connect(retry)
+            return
+
         self.repoModel.toggleHideRefPattern(refPattern)
         self.graphView.clFilter.setHiddenCommits(self.repoModel.hiddenCommits)
 
@@ -695,6 +802,146 @@ class RepoWidget(QStackedWidget):
 
     # -------------------------------------------------------------------------
 
+    def setPathHistory(self, pathHistory: PathHistory | None):
+        """ Show only the commits that touch some paths in GraphView, or all commits if None. """
+        repoModel = self.repoModel
+        repoModel.pathHistory = pathHistory
+        sequence = pathHistory.commitSequence if pathHistory is not None else repoModel.commitSequence
+
+        with QSignalBlockerContext(self.graphView):
+            self.graphView.clModel.setCommitSequence(sequence)
+
+        self.refreshPathHistoryBanner()
+
+    def exitPathHistory(self):
+        self.setPathHistory(None)
+        self.jump(self.navLocator)
+
+    def refreshPathHistoryBanner(self):
+        pathHistory = self.repoModel.pathHistory if self.repoModel is not None else None
+        if pathHistory is None:
+            self.pathHistoryBanner.setVisible(False)
+            return
+
+        paths = pathHistory.paths
+        text = _n("Showing the commits that modify {0}.", "Showing the commits that modify {n} files.",
+                  len(paths), bquo(paths[0]))
+        if pathHistory.truncated:
+            text += " " + _n("Only the most recent commit was searched.",
+                             "Only the {n} most recent commits were searched.", self.repoModel.numRealCommits)
+        self.pathHistoryBanner.popUp("", text)
+        if pathHistory.truncated and self.graphBuild is not None and self.graphBuild.canResume():
+            self.pathHistoryBanner.addButton(englishTitleCase(_("Search entire history")), self.searchEntirePathHistory)
+        self.pathHistoryBanner.addButton(englishTitleCase(_("Show all commits")), self.exitPathHistory)
+
+    def searchEntirePathHistory(self):
+        """ Load the rest of the truncated history, then pick the path history out of all of it. """
+        graphBuild = self.graphBuild
+        pathHistory = self.repoModel.pathHistory
+        if graphBuild is None or pathHistory is None or not graphBuild.canResume():
+            return
+
+        # GraphView must show the full commit log while GraphBuildThread publishes new rows to it
+        self.setPathHistory(None)
+        graphBuild.resume(0)
+        tasks.ShowPathHistory.invoke(self, pathHistory.paths)
+
+    # -------------------------------------------------------------------------
+
+    def onGraphScrolled(self, action: int):
+        """ Load the next page of truncated history when the user scrolls near the bottom of the graph. """
+        graphBuild = self.graphBuild
+        if graphBuild is None or self.repoModel.pathHistory is not None:
+            return
+
+        # actionTriggered fires before the value changes; sliderPosition is where we're headed
+        scrollBar = self.graphView.verticalScrollBar()
+        if scrollBar.sliderPosition() < scrollBar.maximum() - scrollBar.pageStep():
+            return
+
+        pageSize = settings.prefs.maxCommits
+        if pageSize > 0 and graphBuild.canResume():
+            graphBuild.resume(self.repoModel.numRealCommits + pageSize)
+
+    # -------------------------------------------------------------------------
+
+    def buildSearchIndex(self):
+        """ Index the commit log in the background so that GraphView can search it quickly. """
+        if self.searchIndexBuild is not None:
+            self.searchIndexBuild.cancel()
+
+        repoModel = self.repoModel
+        repoModel.searchIndex = None
+
+        if repoModel.numRealCommits < CommitSearchIndex.MinCommits:
+            return
+
+        repoModel.searchIndex = CommitSearchIndex(repoModel.repo)
+        self.searchIndexBuild = tasks.SearchIndexThread(self, repoModel.searchIndex)
+        self.searchIndexBuild.start()
+
+    def detectRenamesInBackground(self, oid: Oid):
+        """ Look for renames in a large commit that was loaded without rename detection. """
+        if self.renameDetection is not None:
+            if self.renameDetection.oid != oid:
+                self.pendingRenameDetection = oid  # One at a time
+            return
+
+        self.renameDetection = tasks.RenameDetectionThread(self, oid, settings.prefs.contextLines)
+        self.renameDetection.start()
+
+    def onRenamesDetected(self, oid: Oid):
+        flv = self.committedFiles
+
+        # Move on to the commit that's being shown now, if it's still waiting
+        pending = self.pendingRenameDetection
+        self.pendingRenameDetection = NULL_OID
+        if pending != NULL_OID and pending == flv.commitId and flv.skippedRenameDetection:
+            self.detectRenamesInBackground(pending)
+
+        # Upgrade the file list if it's still showing this commit. Don't interrupt anything to do it:
+        # the complete diffs are in the cache for next time.
+        runner = self.repoTaskRunner
+        if (flv.commitId == oid
+                and flv.skippedRenameDetection
+                and self.navLocator.commit == oid
+                and not runner.isBusy(TaskLane.Main)
+                and not runner.isBusy(TaskLane.View)):
+            self.jump(self.navLocator.withExtraFlags(NavFlags.AllowLargeCommits))
+
+    @staticmethod
+    def listWatchableDirectories(repo: Repo) -> list[str] | None:
+        """ Look for the workdir directories that RepoWatcher should watch (may be slow). """
+        if RepoWatcher.Disabled or not settings.prefs.watchRepo:
+            return None
+        return RepoWatcher.listDirectories(repo)
+
+    def startRepoWatcher(self, workdirDirectories: list[str] | None = None):
+        """ Watch the repo for changes made by other programs, if enabled in the prefs. """
+        self.stopRepoWatcher()
+
+        if RepoWatcher.Disabled or not settings.prefs.watchRepo or not self.isLoaded:
+            return
+
+        if workdirDirectories is None:
+            workdirDirectories = RepoWatcher.listDirectories(self.repo)
+
+        self.repoWatcher = RepoWatcher(self, self.repo)
+        self.repoWatcher.changed.connect(self.onRepoWatcherChanged)
+        self.repoWatcher.start(workdirDirectories)
+
+    def stopRepoWatcher(self):
+        if self.repoWatcher is not None:
+            self.repoWatcher.stop()
+            self.repoWatcher.deleteLater()
+            self.repoWatcher = None
+
+    def onRepoWatcherChanged(self, effects: TaskEffects, paths: set[str]):
+        # If we're busy, refreshRepo stashes the effects until the current task is done
+        self.refreshRepo(effects, dirtyPaths=paths)
+
+    # -------------------------------------------------------------------------
+
     def setInitialFocus(self):
         """
         Focus on some useful widget within RepoWidget.
@@ -703,22 +950,37 @@ class RepoWidget(QStackedWidget):
         if not self.focusWidget():  # only if nothing has the focus yet
             self.graphView.setFocus()
 
-    def refreshRepo(self, effects: TaskEffects = TaskEffects.DefaultRefresh, jumpTo: NavLocator = NavLocator.Empty):
-        """Refresh the repo as soon as possible."""
+    def refreshRepo(self, effects: TaskEffects = TaskEffects.DefaultRefresh, jumpTo: NavLocator = NavLocator.Empty,
+                    dirtyPaths: set[str] | None = None):
+        """
+        Refresh the repo as soon as possible.
+
+        If the effects include TaskEffects.Workdir, pass the workdir paths that
+        have changed (if known) so that the file lists can be reloaded partially.
+        """
 
         if (not self.isLoaded) or self.isPriming:
             return
         assert self.repoModel is not None
 
-        if not self.isVisible() or self.repoTaskRunner.isBusy():
+        if not effects & TaskEffects.Workdir:
+            dirtyPaths = set()
+        elif effects & (TaskEffects.Index | TaskEffects.Head):
+            dirtyPaths = None  # If the index or HEAD may have moved, any path may have changed
+
+        # Remote operations may keep running in the background while we refresh
+        runner = self.repoTaskRunner
+        if not self.isVisible() or runner.isBusy(TaskLane.Main) or runner.isBusy(TaskLane.View):
             # Can't refresh right now. Stash the effect bits for later.
             logger.debug(f"Stashing refresh bits {repr(effects)}")
             self.pendingEffects |= effects
+            if effects & TaskEffects.Workdir:
+                self.repoModel.markWorkdirDirty(dirtyPaths)
             if jumpTo:
                 warnings.warn(f"Ignoring post-refresh jump {jumpTo} because can't refresh yet")
             return
 
-        # Consume pending effect bits, if any
+        # Consume pending effect bits, if any (their dirty paths have already been marked)
         if self.pendingEffects != TaskEffects.Nothing:
             logger.debug(f"Consuming pending refresh bits {self.pendingEffects}")
             effects |= self.pendingEffects
@@ -734,7 +996,7 @@ class RepoWidget(QStackedWidget):
 
         # Invoke refresh task
         if effects != TaskEffects.Nothing:
-            tasks.RefreshRepo.invoke(self, effects, jumpTo)
+            tasks.RefreshRepo.invoke(self, effects, jumpTo, dirtyPaths)
         elif jumpTo:
             tasks.Jump.invoke(self, jumpTo)
         else:
@@ -868,7 +1130,7 @@ class RepoWidget(QStackedWidget):
     def refreshPostTask(self, task: tasks.RepoTask):
         if task.postStatus:
             self.pendingStatusMessage = task.postStatus
-        self.refreshRepo(task.effects, task.jumpTo)
+        self.refreshRepo(task.effects, task.jumpTo, task.dirtyPaths)
 
     def onRepoTaskProgress(self, progressText: str, withSpinner: bool = False):
         if withSpinner:
@@ -897,7 +1159,11 @@ class RepoWidget(QStackedWidget):
         if not self.uiReady:
             return
 
+        if self.repoModel is not None:
+            self.repoModel.diffDocumentCache.clear()
+
         self.diffView.refreshPrefs()
+        self.virtualDiffView.refreshPrefs()
         self.graphView.refreshPrefs()
         if PREFKEY_MERGETOOL in prefDiff:
             self.conflictView.refreshPrefs()
@@ -906,6 +1172,9 @@ class RepoWidget(QStackedWidget):
         self.stagedFiles.refreshPrefs()
         self.committedFiles.refreshPrefs()
 
+        if "watchRepo" in prefDiff:
+            self.startRepoWatcher()
+
         # Reflect any change in titlebar prefs
         if self.isVisible():
             self.refreshWindowChrome()
@@ -940,10 +1209,18 @@ class RepoWidget(QStackedWidget):
             self.jump(locator)
         elif url.authority() == "expandlog":
             # After loading, jump back to what is currently the last commit
-            self.pendingLocator = NavLocator.inCommit(self.repoModel.commitSequence[-1].id)
-            # Reload the repo
+            lastLocator = NavLocator.inCommit(self.repoModel.commitSequence[-1].id)
             maxCommits = int(kwargs.get("n", self.repoModel.nextTruncationThreshold))
-            self.primeRepo(force=True, maxCommits=maxCommits)
+            if self.repoModel.pathHistory is not None:
+                self.setPathHistory(None)
+            if self.graphBuild is not None and self.graphBuild.canResume():
+                # Keep walking from where we stopped
+                self.graphBuild.resume(maxCommits)
+                self.jump(lastLocator)
+            else:
+                # Reload the repo
+                self.pendingLocator = lastLocator
+                self.primeRepo(force=True, maxCommits=maxCommits)
         elif url.authority() == "opensubfolder":
             p = self.repo.in_workdir(simplePath)
             self.openRepo.emit(p, NavLocator())
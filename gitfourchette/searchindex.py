@@ -0,0 +1,215 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+"""
+Inverted index for finding commits by message, author or hash.
+
+GraphView's search bar looks for a substring in the message and author of
+each commit. Scanning the entire log for every keystroke means reading every
+single commit from the object database, which takes seconds in very large
+repositories. CommitSearchIndex maps each word (lowercase run of \\w
+characters) to the commits that contain it. Any commit containing the search
+term must contain a word that contains each of the term's words, so looking
+up the vocabulary narrows down the search to a handful of candidates, which
+the caller must then check against the actual commits.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import threading
+from array import array
+from bisect import bisect_right
+from collections.abc import Callable, Iterable
+
+from gitfourchette.porcelain import *
+from gitfourchette.toolbox import *
+
+logger = logging.getLogger(__name__)
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+class CommitSearchIndex:
+    MinCommits = 10_000
+    "Don't bother indexing repositories smaller than this, a linear scan is fast enough."
+
+    MinWordLength = 3
+    "Shorter words in a search term match too much of the vocabulary to narrow down the search."
+
+    BatchSize = 1000
+    "Number of commits to index between two acquisitions of the lock."
+
+    oidLength: int
+    "Length of a raw id in the indexed repository: 20 bytes for SHA-1, 32 bytes for SHA-256."
+
+    oids: bytearray
+    "Raw id of each indexed commit (document), back to back."
+
+    postings: dict[str, array]
+    "Ids of the documents that contain each word."
+
+    complete: bool
+    "True once the entire commit log has been indexed. Don't look anything up until then."
+
+    generation: int
+    "Incremented every time the index changes."
+
+    def __init__(self, repo: Repo):
+        # Commits may be added (see RepoModel.syncTopOfGraph) before build() starts, so get the id length upfront
+        self.oidLength = repo.oid_length
+        self.lock = threading.Lock()
+        self.oids = bytearray()
+        self.postings = {}
+        self.complete = False
+        self.generation = 0
+
+        # Words in the order they were first seen, and a searchable blob thereof (rebuilt lazily)
+        self._words: list[str] = []
+        self._wordBlob = ""
+        self._wordStarts = array("q")
+
+        # Hex ids of all documents, back to back (rebuilt lazily)
+        self._hexBlob = ""
+
+    def __len__(self):
+        return len(self.oids) // self.oidLength
+
+    @staticmethod
+    def commitText(commit: Commit) -> str:
+        """ Lowercase text that the search bar may match in a commit. """
+        author = commit.author
+        # The initials may not be a substring of the name, unlike any other AuthorDisplayStyle
+        initials = abbreviatePerson(author, AuthorDisplayStyle.INITIALS)
+        return "\n".join((commit.message, author.name, author.email, initials)).lower()
+
+    def build(self, repo: Repo, oids: Iterable[Oid], isCancelled: Callable[[], bool] = lambda: False) -> bool:
+        """
+        Index the given commits, reading them from the repository in batches.
+        Mark the index as complete unless isCancelled() returns True midway.
+        """
+        assert repo.oid_length == self.oidLength, "index was created for another repository"
+        batch = []
+        for oid in oids:
+            batch.append(repo[oid])
+            if len(batch) >= self.BatchSize:
+                self.addCommits(batch)
+                batch.clear()
+                if isCancelled():
+                    return False
+
+        self.addCommits(batch)
+
+        with self.lock:
+            self.complete = True
+            self.generation += 1
+        return True
+
+    def addCommits(self, commits: Iterable[Commit]):
+        entries = [(commit.id.raw, set(_WORD_PATTERN.findall(self.commitText(commit)))) for commit in commits]
+        if not entries:
+            return
+
+        with self.lock:
+            oids = self.oids
+            postings = self.postings
+            newWords = self._words
+
+            h = self.oidLength
+            doc = len(oids) // h
+            for raw, words in entries:
+                assert len(raw) == h, f"expected {h}-byte oids, got {len(raw)}"
+                oids += raw
+                for word in words:
+                    try:
+                        postings[word].append(doc)
+                    except KeyError:
+                        postings[word] = array("i", [doc])
+                        newWords.append(word)
+                doc += 1
+
+            self.generation += 1
+
+    def lookUp(self, term: str, likelyHash: bool = False) -> list[Oid] | None:
+        """
+        Return the ids of the commits that may contain the search term, in no
+        particular order. These are candidates only: the caller must make sure
+        that they actually match the term.
+
+        Return None if the index can't narrow down the search (i.e. the index is
+        incomplete, or the term is too short); the caller must then scan the
+        entire commit log.
+        """
+        assert term == term.lower(), "search term should have been sanitized"
+
+        words = [word for word in _WORD_PATTERN.findall(term) if len(word) >= self.MinWordLength]
+        if not words:
+            return None
+
+        with self.lock:
+            if not self.complete:
+                return None
+
+            # Longest words first: they match the fewest entries in the vocabulary
+            docs = None
+            for word in sorted(set(words), key=len, reverse=True):
+                wordDocs = self._docsContaining(word)
+                docs = wordDocs if docs is None else (docs & wordDocs)
+                if not docs:
+                    break
+
+            if likelyHash:
+                docs |= self._docsWithHashPrefix(term)
+
+            oids = self.oids
+            h = self.oidLength
+            return [Oid(bytes(oids[doc * h: (doc + 1) * h])) for doc in docs]
+
+    def _docsContaining(self, word: str) -> set[int]:
+        """ Return the documents that contain a word that contains the given word. """
+        words = self._words
+        starts = self._wordStarts
+
+        # Append new words to the blob
+        if len(starts) < len(words):
+            newWords = words[len(starts):]
+            position = len(self._wordBlob)
+            for newWord in newWords:
+                starts.append(position)
+                position += len(newWord) + 1
+            self._wordBlob += "\n".join(newWords) + "\n"
+
+        blob = self._wordBlob
+        postings = self.postings
+        docs = set()
+
+        position = blob.find(word)
+        while position >= 0:
+            i = bisect_right(starts, position) - 1
+            docs.update(postings[words[i]])
+            # Skip to the next word in the vocabulary
+            position = blob.find(word, starts[i] + len(words[i]) + 1)
+
+        return docs
+
+    def _docsWithHashPrefix(self, prefix: str) -> set[int]:
+        hexBlob = self._hexBlob
+        if len(hexBlob) < len(self.oids) * 2:
+            hexBlob += self.oids[len(hexBlob) // 2:].hex()
+            self._hexBlob = hexBlob
+
+        hexSize = 2 * self.oidLength
+        docs = set()
+        position = hexBlob.find(prefix)
+        while position >= 0:
+            doc, misalignment = divmod(position, hexSize)
+            if misalignment == 0:
+                docs.add(doc)
+                position = hexBlob.find(prefix, position + hexSize)
+            else:
+                position = hexBlob.find(prefix, (doc + 1) * hexSize)
+        return docs
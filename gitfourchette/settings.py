@@ -123,6 +123,8 @@ class Prefs(PrefsFile):
     flattenLanes                : bool                  = True
     animations                  : bool                  = True
     autoRefresh                 : bool                  = True
+    watchRepo                   : bool                  = True
+    parallelPrime               : bool                  = False
     verbosity                   : LoggingLevel          = LoggingLevel.WARNING
     forceQtApi                  : QtApiNames            = QtApiNames.QTAPI_AUTOMATIC
 
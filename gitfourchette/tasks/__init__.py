@@ -4,7 +4,7 @@
 # For full terms, see the included LICENSE file.
 # -----------------------------------------------------------------------------
 
-from gitfourchette.tasks.repotask import RepoTask, RepoTaskRunner, TaskPrereqs, TaskEffects
+from gitfourchette.tasks.repotask import RepoTask, RepoTaskRunner, TaskPrereqs, TaskEffects, TaskLane
 from gitfourchette.tasks.repotask import RepoGoneError
 from gitfourchette.tasks.repotask import TaskInvoker
 
@@ -52,8 +52,9 @@ from gitfourchette.tasks.jumptasks import (
     JumpToUncommittedChanges,
     RefreshRepo,
 )
-from gitfourchette.tasks.loadtasks import PrimeRepo
-from gitfourchette.tasks.loadtasks import LoadWorkdir, LoadCommit, LoadPatch
+from gitfourchette.tasks.loadtasks import PrimeRepo, GraphBuildThread, SearchIndexThread, ShowPathHistory
+from gitfourchette.tasks.loadtasks import RenameDetectionThread
+from gitfourchette.tasks.loadtasks import LoadWorkdir, LoadCommit, LoadPatch, PrefetchNeighbors
 from gitfourchette.tasks.nettasks import (
     DeleteRemoteBranch,
     RenameRemoteBranch,
@@ -7,6 +7,7 @@
 import logging
 import os
 import shutil
+from collections.abc import Iterable
 from contextlib import suppress
 
 from gitfourchette import reverseunidiff
@@ -23,13 +24,22 @@ from gitfourchette.trtables import TrTables
 logger = logging.getLogger(__name__)
 
 
+def _deltaPaths(deltas: Iterable[DiffDelta]) -> set[str]:
+    """ Old and new paths of the given deltas. """
+    paths = set()
+    for delta in deltas:
+        paths.add(delta.old_file.path.removesuffix("/"))
+        paths.add(delta.new_file.path.removesuffix("/"))
+    return paths
+
+
 class _BaseStagingTask(RepoTask):
     def canKill(self, task: RepoTask):
         # Jump/Refresh tasks shouldn't prevent a staging task from starting
         # when the user holds down RETURN/DELETE in a FileListView
         # to stage/unstage a series of files.
         from gitfourchette import tasks
-        return isinstance(task, tasks.Jump | tasks.RefreshRepo)
+        return super().canKill(task) or isinstance(task, tasks.Jump | tasks.RefreshRepo)
 
     def denyConflicts(self, patches: list[Patch], purpose: PatchPurpose):
         conflicts = [p for p in patches if p.delta.status == DeltaStatus.CONFLICTED]
@@ -72,6 +82,7 @@ class StageFiles(_BaseStagingTask):
 
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths(p.delta for p in patches)
 
         self.repo.stage_files(patches)
 
@@ -168,6 +179,7 @@ class DiscardFiles(_BaseStagingTask):
 
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths(p.delta for p in patches)
 
         paths = [patch.delta.new_file.path for patch in patches
                  if patch not in submos]
@@ -219,6 +231,7 @@ class UnstageFiles(_BaseStagingTask):
 
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths(p.delta for p in patches)
 
         self.repo.unstage_files(patches)
 
@@ -243,6 +256,7 @@ class DiscardModeChanges(_BaseStagingTask):
 
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths(p.delta for p in patches)
 
         paths = [patch.delta.new_file.path for patch in patches]
         self.repo.discard_mode_changes(paths)
@@ -256,6 +270,7 @@ class UnstageModeChanges(_BaseStagingTask):
 
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths(p.delta for p in patches)
 
         self.repo.unstage_mode_changes(patches)
 
@@ -289,6 +304,7 @@ class ApplyPatch(RepoTask):
 
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths([fullPatch.delta])
 
         self.repo.apply(subPatch, applyLocation)
 
@@ -307,6 +323,7 @@ class RevertPatch(RepoTask):
 
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths(diff.deltas)
 
         diff = self.repo.apply(diff, location=ApplyLocation.WORKDIR)
 
@@ -321,6 +338,7 @@ class HardSolveConflicts(RepoTask):
     def flow(self, conflictedFiles: dict[str, Oid]):
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = set(conflictedFiles)
 
         repo = self.repo
         repo.refresh_index()
@@ -368,6 +386,7 @@ class MarkConflictSolved(RepoTask):
     def flow(self, path: str):
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = {path}
 
         repo = self.repo
 
@@ -382,13 +401,14 @@ class MarkConflictSolved(RepoTask):
 class AcceptMergeConflictResolution(RepoTask):
     def canKill(self, task: RepoTask) -> bool:
         from gitfourchette.tasks import RefreshRepo, Jump
-        return isinstance(task, RefreshRepo | Jump)
+        return super().canKill(task) or isinstance(task, RefreshRepo | Jump)
 
     def flow(self, mergeDriver: MergeDriver):
         path = mergeDriver.relativeTargetPath
 
         yield from self.flowEnterWorkerThread()
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = {path}
 
         mergeDriver.copyScratchToTarget()
         mergeDriver.deleteNow()
@@ -456,6 +476,7 @@ class ApplyPatchFile(RepoTask):
         yield from self.flowConfirm(title, text, verb=verb, detailList=details)
 
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths(deltas)
 
         self.repo.apply(loadedDiff, ApplyLocation.WORKDIR)
         self.jumpTo = NavLocator.inUnstaged(deltas[0].new_file.path)
@@ -495,6 +516,7 @@ class ApplyPatchData(RepoTask):
         yield from self.flowConfirm(title, text, verb=verb, detailList=details)
 
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = _deltaPaths(deltas)
         self.repo.apply(loadedDiff, ApplyLocation.WORKDIR)
         self.jumpTo = NavLocator.inUnstaged(deltas[0].new_file.path)
 
@@ -532,6 +554,7 @@ class RestoreRevisionToWorkdir(RepoTask):
         yield from self.flowConfirm(text=prompt, verb=_("Restore"))
 
         self.effects |= TaskEffects.Workdir
+        self.dirtyPaths = {diffFile.path}
 
         if delete:
             os.unlink(path)
@@ -14,8 +14,9 @@ import logging
 import os
 from collections.abc import Generator
 
-from gitfourchette.diffview.diffdocument import DiffDocument
+from gitfourchette.diffview.diffdocument import DiffDocument, DiffDocumentCache
 from gitfourchette.diffview.specialdiff import SpecialDiffError, DiffConflict, DiffImagePair
+from gitfourchette.diffview.virtualdiffdocument import VirtualDiffDocument
 from gitfourchette.graphview.commitlogmodel import SpecialRow
 from gitfourchette.localization import *
 from gitfourchette.nav import NavLocator, NavContext, NavFlags
@@ -24,8 +25,8 @@ from gitfourchette.qt import *
 from gitfourchette.repomodel import UC_FAKEID
 from gitfourchette.sidebar.sidebarmodel import UC_FAKEREF
 from gitfourchette.tasks import TaskPrereqs
-from gitfourchette.tasks.loadtasks import LoadCommit, LoadPatch, LoadWorkdir
-from gitfourchette.tasks.repotask import AbortTask, RepoTask, TaskEffects, RepoGoneError, FlowControlToken
+from gitfourchette.tasks.loadtasks import LoadCommit, LoadPatch, LoadWorkdir, ShowPathHistory
+from gitfourchette.tasks.repotask import AbortTask, RepoTask, TaskEffects, RepoGoneError, FlowControlToken, TaskLane
 from gitfourchette.toolbox import *
 
 logger = logging.getLogger(__name__)
@@ -38,6 +39,9 @@ class Jump(RepoTask):
     Only the Jump task may "cement" the RepoWidget's navLocator.
     """
 
+    MaxIncrementalPaths = 1000
+    "Reload the entire workdir if more paths than this have changed."
+
     @dataclasses.dataclass
     class Result(Exception):
         locator: NavLocator
@@ -46,7 +50,13 @@ class Jump(RepoTask):
         patch: Patch | None = None
 
     def canKill(self, task: RepoTask):
-        return isinstance(task, Jump | RefreshRepo)
+        return super().canKill(task) or isinstance(task, Jump | RefreshRepo)
+
+    def lane(self) -> TaskLane:
+        return TaskLane.View
+
+    def canRunAlongside(self, task: RepoTask) -> bool:
+        return task.lane() == TaskLane.Network
 
     def flow(self, locator: NavLocator):
         if not locator:
@@ -92,9 +102,10 @@ class Jump(RepoTask):
 
             # Prepare Result object.
             if locator.path:
-                # Load patch in DiffView
+                # Load patch in DiffView (stat the file before the patch reads it)
+                fileStat = DiffDocumentCache.fileStat(locator, self.repo.workdir)
                 patch = fileList.getPatchForFile(locator.path)
-                patchTask = yield from self.flowSubtask(LoadPatch, patch, locator)
+                patchTask = yield from self.flowSubtask(LoadPatch, patch, locator, fileStat)
                 result = Jump.Result(locator, patchTask.header, patchTask.result, patch)
             else:
                 # Blank path
@@ -131,14 +142,37 @@ class Jump(RepoTask):
             # so that it stays stale if this task gets interrupted.
             repoModel.workdirStale = True
 
+            # If we know which paths have changed since the file lists were
+            # last filled, only reload those paths. This requires the
+            # RepoWatcher to tell us about every change made by other programs.
+            paths = None
+            dirtyPaths = repoModel.workdirDirtyPaths
+            if (dirtyPaths
+                    and rw.repoWatcher is not None
+                    and rw.repoWatcher.seesAllChanges()
+                    and len(dirtyPaths) <= Jump.MaxIncrementalPaths
+                    and previousLocator.context != NavContext.EMPTY
+                    and not rw.stagedFiles.flModel.hasRenamesUnder(dirtyPaths)):
+                paths = sorted(dirtyPaths)
+
             # Load workdir (async)
             workdirTask = yield from self.flowSubtask(
-                LoadWorkdir, allowWriteIndex=locator.hasFlags(NavFlags.AllowWriteIndex))
+                LoadWorkdir, allowWriteIndex=locator.hasFlags(NavFlags.AllowWriteIndex), paths=paths)
 
             # Fill FileListViews
             with QSignalBlockerContext(rw.dirtyFiles, rw.stagedFiles):  # Don't emit jump signals
-                rw.dirtyFiles.setContents([workdirTask.dirtyDiff], False)
-                rw.stagedFiles.setContents([workdirTask.stageDiff], False)
+                if workdirTask.dirtyDiffPaths is None:
+                    rw.dirtyFiles.setContents([workdirTask.dirtyDiff], False)
+                else:
+                    rw.dirtyFiles.updateContents([workdirTask.dirtyDiff], workdirTask.dirtyDiffPaths)
+                if workdirTask.stageDiffPaths is None:
+                    rw.stagedFiles.setContents([workdirTask.stageDiff], False)
+                else:
+                    rw.stagedFiles.updateContents([workdirTask.stageDiff], workdirTask.stageDiffPaths)
+
+            # The workdir is fresh; don't refresh it again for changes we've just picked up
+            if rw.repoWatcher is not None:
+                rw.repoWatcher.discardPending(TaskEffects.Workdir | TaskEffects.Index, workdirTask.dirtyDiffPaths)
 
             nDirty = rw.dirtyFiles.model().rowCount()
             nStaged = rw.stagedFiles.model().rowCount()
@@ -157,6 +191,7 @@ class Jump(RepoTask):
             repoModel.numUncommittedChanges = newNumChanges
 
             repoModel.workdirStale = False
+            repoModel.workdirDirtyPaths = set()
 
             # Show number of staged changes in sidebar and graph
             if numChangesDifferent:
@@ -293,7 +328,9 @@ class Jump(RepoTask):
         area.diffBanner.setVisible(False)
         area.contextHeader.setContext(locator, commit.message, isStash)
 
-        if locator.commit == flv.commitId and not locator.hasFlags(NavFlags.ForceDiff):
+        if (locator.commit == flv.commitId
+                and not locator.hasFlags(NavFlags.ForceDiff)
+                and not (flv.skippedRenameDetection and locator.hasFlags(NavFlags.AllowLargeCommits))):
             # No need to reload the same commit
             # (if this flv was dormant and is sent back to the foreground).
             pass
@@ -316,6 +353,10 @@ class Jump(RepoTask):
                 flv.setContents(diffs, subtask.skippedRenameDetection)
                 numChanges = flv.model().rowCount()
 
+            # The file list will be upgraded once renames have been found
+            if subtask.skippedRenameDetection:
+                rw.detectRenamesInBackground(locator.commit)
+
             # Set header text
             headerText = toLengthVariants(_n("{n} change:|{n} ch.:", "{n} changes:|{n} ch.:", numChanges))
             area.committedHeader.setText(headerText)
@@ -334,7 +375,7 @@ class Jump(RepoTask):
         if not area.diffBanner.lastWarningWasDismissed:
             if flv.skippedRenameDetection:
                 warnings.append(_("Rename detection was skipped to load this large commit faster."))
-            elif locator.hasFlags(NavFlags.AllowLargeCommits | NavFlags.ForceDiff):
+            elif locator.hasFlags(NavFlags.AllowLargeCommits):
                 n = sum(sum(1 if delta.status == DeltaStatus.RENAMED else 0 for delta in diff.deltas) for diff in diffs)
                 warnings.append(_n("{n} rename detected.", "{n} renames detected.", n))
 
@@ -368,6 +409,10 @@ class Jump(RepoTask):
 
         document = result.document
 
+        if not isinstance(document, VirtualDiffDocument):
+            # Free up the memory taken by the previous large diff
+            area.virtualDiffView.clear()
+
         if document is None:
             area.clearDocument()
 
@@ -376,6 +421,11 @@ class Jump(RepoTask):
             area.setDiffStackPage("text")
             area.diffView.replaceDocument(self.repo, result.patch, result.locator, document)
 
+        elif isinstance(document, VirtualDiffDocument):
+            assert result.patch is not None
+            area.setDiffStackPage("virtual")
+            area.virtualDiffView.replaceDocument(self.repo, result.patch, result.locator, document)
+
         elif isinstance(document, DiffConflict):
             conflict = document
             area.setDiffStackPage("conflict")
@@ -388,7 +438,7 @@ class Jump(RepoTask):
         elif isinstance(document, DiffImagePair):
             assert result.patch is not None
             area.setDiffStackPage("special")
-            area.specialDiffView.displayImageDiff(result.patch.delta, document.oldImage, document.newImage)
+            area.specialDiffView.displayImageDiff(result.patch.delta, document, result.locator)
 
         else:
             raise NotImplementedError(f"Can't display {type(document)}")
@@ -399,6 +449,12 @@ class JumpBackOrForward(RepoTask):
     Navigate back or forward in the RepoWidget's NavHistory.
     """
 
+    def lane(self) -> TaskLane:
+        return TaskLane.View
+
+    def canRunAlongside(self, task: RepoTask) -> bool:
+        return task.lane() == TaskLane.Network
+
     def flow(self, delta: int):
         rw = self.rw
 
@@ -460,9 +516,13 @@ class RefreshRepo(RepoTask):
         return task is None or isinstance(task, Jump | RefreshRepo)
 
     def canKill(self, task: RepoTask):
-        return RefreshRepo.canKill_static(task)
+        return super().canKill(task) or RefreshRepo.canKill_static(task)
+
+    def canRunAlongside(self, task: RepoTask) -> bool:
+        return task.lane() == TaskLane.Network
 
-    def flow(self, effectFlags: TaskEffects = TaskEffects.DefaultRefresh, jumpTo: NavLocator = NavLocator.Empty):
+    def flow(self, effectFlags: TaskEffects = TaskEffects.DefaultRefresh, jumpTo: NavLocator = NavLocator.Empty,
+             dirtyPaths: set[str] | None = None):
         rw = self.rw
         repoModel = self.repoModel
         assert onAppThread()
@@ -474,7 +534,8 @@ class RefreshRepo(RepoTask):
         if not os.path.isdir(self.repo.path):
             raise RepoGoneError(self.repo.path)
 
-        repoModel.workdirStale |= bool(effectFlags & TaskEffects.Workdir)
+        if effectFlags & TaskEffects.Workdir:
+            repoModel.markWorkdirDirty(dirtyPaths)
 
         initialLocator = rw.navLocator
         initialGraphScroll = rw.graphView.verticalScrollBar().value()
@@ -513,9 +574,26 @@ class RefreshRepo(RepoTask):
             stashesChanged = repoModel.syncStashes()
             homeBranchChanged = oldHeadBranch != repoModel.homeBranch
 
+            # Refs that changed while the graph was being built haven't been spliced in yet
+            if repoModel.unsplicedRefs is not None:
+                oldRefs = repoModel.unsplicedRefs
+                refsChanged = True
+
             # Load commits from changed refs only
-            if refsChanged:
+            if not refsChanged:
+                pass
+            elif rw.graphBuild is not None and not rw.graphBuild.wrappedUp:
+                # Can't splice a graph that's still being built. GraphBuildThread refreshes us again when it's done.
+                repoModel.unsplicedRefs = oldRefs
+            else:
+                repoModel.unsplicedRefs = None
                 self.syncTopOfGraph(oldRefs)
+                # Truncated history can't be resumed past a splice; let go of the old walk
+                if rw.graphBuild is not None and not rw.graphBuild.canResume():
+                    rw.graphBuild.cancel()
+                # Pick the new commits that touch the paths whose history we're showing
+                if repoModel.pathHistory is not None:
+                    yield from self.flowSubtask(ShowPathHistory, repoModel.pathHistory.paths, jump=False)
 
         # Schedule a repaint of the entire GraphView if the refs changed
         if effectFlags & (TaskEffects.Head | TaskEffects.Refs):
@@ -581,6 +659,11 @@ class RefreshRepo(RepoTask):
         # Do this last because it requires the index to be fresh (updated by the Jump subtask)
         rw.refreshWindowChrome()
 
+        # Changes made by other programs until now have been picked up
+        # (except in the workdir, where Jump knows what it has reloaded)
+        if rw.repoWatcher is not None:
+            rw.repoWatcher.discardPending(effectFlags & ~TaskEffects.Workdir)
+
         logger.debug(f"Changes detected on refresh: "
                      f"Ref={refsChanged} Stash={stashesChanged} Submo={submodulesChanged} Remote={remotesChanged}")
 
@@ -602,9 +685,15 @@ class RefreshRepo(RepoTask):
             # If new commits are part of a hidden branch, we've got to invalidate the CommitFilter.
             clFilter.setHiddenCommits(repoModel.hiddenCommits)
 
-            if gsl.numRowsRemoved >= 0:
+            if repoModel.pathHistory is not None:
+                # GraphView shows the path history instead, which the caller rebuilds
+                pass
+            elif gsl.numRowsRemoved >= 0:
                 # Sync top of graphview
                 clModel.mendCommitSequence(gsl.numRowsRemoved, gsl.numRowsAdded, repoModel.commitSequence)
             else:
                 # Replace graph wholesale
                 clModel.setCommitSequence(repoModel.commitSequence)
+
+            if gsl.numRowsRemoved < 0:
+                self.rw.buildSearchIndex()
@@ -4,20 +4,28 @@
 # For full terms, see the included LICENSE file.
 # -----------------------------------------------------------------------------
 
+import concurrent.futures
+import itertools
 import logging
+import os
 
 from gitfourchette import colors
 from gitfourchette import settings
 from gitfourchette.application import GFApplication
-from gitfourchette.diffview.diffdocument import DiffDocument
-from gitfourchette.diffview.specialdiff import (ShouldDisplayPatchAsImageDiff, SpecialDiffError, DiffImagePair)
-from gitfourchette.graph import GraphBuildLoop
+from gitfourchette.commitsequence import CommitSequence
+from gitfourchette.diffview.diffdocument import DiffDocument, DiffDocumentCache
+from gitfourchette.diffview.specialdiff import (ShouldDisplayPatchAsImageDiff, ShouldDisplayPatchAsVirtualDiff,
+                                                SpecialDiffError, DiffImagePair)
+from gitfourchette.diffview.virtualdiffdocument import VirtualDiffDocument
+from gitfourchette.graph import GraphBuildLoop, GraphCache
 from gitfourchette.graphview.commitlogmodel import SpecialRow
 from gitfourchette.localization import *
 from gitfourchette.nav import NavLocator, NavFlags, NavContext
+from gitfourchette.pathhistory import PathHistory
 from gitfourchette.porcelain import *
 from gitfourchette.qt import *
-from gitfourchette.tasks.repotask import RepoTask
+from gitfourchette.searchindex import CommitSearchIndex
+from gitfourchette.tasks.repotask import RepoTask, TaskEffects, TaskLane
 from gitfourchette.toolbox import *
 from gitfourchette.trtables import TrTables
 
@@ -32,6 +40,9 @@ def contextLines():
 
 
 class PrimeRepo(RepoTask):
+    FirstBatchSize = 10000
+    "Number of commits to load before showing the repo. The rest of the history is loaded in the background."
+
     progressRange = Signal(int, int)
     progressValue = Signal(int)
     progressMessage = Signal(str)
@@ -62,20 +73,16 @@ class PrimeRepo(RepoTask):
         progressWidget.ui.abortButton.clicked.connect(self.onAbortButtonClicked)
 
         # Create the repo
-        repo = Repo(path, RepositoryOpenFlag.NO_SEARCH)
+        repo = openRepo(path)
 
         if repo.is_bare:
             raise NotImplementedError(_("Sorry, {app} doesn’t support bare repositories.").format(app=qAppName()))
 
-        # Bind to sessionwide git config file
-        sessionwideConfigPath = GFApplication.instance().sessionwideGitConfigPath
-        # Level -1 was chosen because it's the only level for which changing branch settings
-        # in a repo won't leak into this file (e.g. change branch upstream).
-        # TODO: `level=4, force=True` would make sense here but this leaks branch settings. Is this a bug in pygit2?
-        #       git_config_add_file_ondisk has an optional 'repo' argument "to allow parsing of conditional includes",
-        #       but pygit2 doesn't make it possible to pass anything but NULL.
-        #       See also https://github.com/libgit2/libgit2/blob/main/include/git2/config.h#L42
-        repo.config.add_file(sessionwideConfigPath, level=-1)
+        # Stop building the graph of the repo we're replacing, if any
+        if rw.graphBuild is not None:
+            rw.graphBuild.cancel()
+        if rw.searchIndexBuild is not None:
+            rw.searchIndexBuild.cancel()
 
         # Create RepoModel
         repoModel = RepoModel(repo)
@@ -86,82 +93,35 @@ class PrimeRepo(RepoTask):
         # ---------------------------------------------------------------------
         yield from self.flowEnterWorkerThread()
 
-        locale = QLocale()
-
-        # Prime the walker (this might take a while)
-        walker = repoModel.primeWalker()
-
-        commitSequence = [repoModel.uncommittedChangesMockCommit()]
-
-        # Retrieve the number of commits that we loaded last time we opened this repo
-        # so we can estimate how long it'll take to load it again
-        numCommitsBallpark = settings.history.getRepoNumCommits(repo.workdir)
-        if numCommitsBallpark != 0:
-            # Reserve second half of progress bar for graph progress
-            self.progressRange.emit(0, 2*numCommitsBallpark)
-
-        # ---------------------------------------------------------------------
-        # Build commit sequence
-
-        self.progressAbortable.emit(True)
-
-        truncatedHistory = False
         if maxCommits < 0:  # -1 means take maxCommits from prefs. Warning, pref value can be 0, meaning infinity!
             maxCommits = settings.prefs.maxCommits
         if maxCommits == 0:  # 0 means infinity
             maxCommits = 2**63  # ought to be enough
-        progressInterval = 1000 if maxCommits >= 10000 else 1000
-
-        for i, commit in enumerate(walker):
-            commitSequence.append(commit)
 
-            if i+1 >= maxCommits or (self.abortFlag and i+1 >= progressInterval):
-                truncatedHistory = True
-                break
+        # Try to pick up where we left off last time, so we don't have to walk the entire history
+        cachedSplice = repoModel.loadGraphCache(maxCommits)
+        buildJob = None
 
-            # Report progress, not too often
-            if i % progressInterval == 0:
-                message = _("{0} commits…").format(locale.toString(i))
-                self.progressMessage.emit(message)
-                if numCommitsBallpark > 0 and i <= numCommitsBallpark:
-                    self.progressValue.emit(i)
+        if cachedSplice is None:
+            buildJob = self.buildGraphFromScratch(repoModel, maxCommits)
+            if buildJob.done:
+                repoModel.saveGraphCache()
+        elif cachedSplice.numRowsAdded != 0 or cachedSplice.numRowsRemoved != 0:
+            repoModel.saveGraphCache()
 
-        # Can't abort anymore
-        self.progressAbortable.emit(False)
+        # If we're still building the graph, GraphBuildThread will take care of this when it's done
+        if buildJob is None or buildJob.done:
+            repoModel.placeGraphKeyframes()
 
-        numCommits = len(commitSequence) - 1
-        logger.info(f"{repoModel.shortName}: loaded {numCommits} commits")
-        if truncatedHistory:
-            message = _("{0} commits (truncated log).").format(locale.toString(numCommits))
-        else:
-            message = _("{0} commits total.").format(locale.toString(numCommits))
-        self.progressMessage.emit(message)
+        # Hang on to the build job if there's more history to load, either now or later
+        if buildJob is not None and buildJob.done and not buildJob.truncated:
+            buildJob = None
 
-        if numCommitsBallpark != 0:
-            # First half of progress bar was for commit log
-            self.progressRange.emit(-numCommits, numCommits)
-        else:
-            self.progressRange.emit(0, numCommits)
-        self.progressValue.emit(0)
+        # Find the directories to watch for external changes while we're off the UI thread
+        watchedDirectories = rw.listWatchableDirectories(repo)
 
-        # ---------------------------------------------------------------------
-        # Build graph
-
-        hideSeeds = self.repoModel.getHiddenTips()
-        localSeeds = self.repoModel.getLocalTips()
-        buildLoop = GraphBuildLoop(heads=self.repoModel.getKnownTips(), hideSeeds=hideSeeds, localSeeds=localSeeds)
-        buildLoop.onKeyframe = self.progressValue.emit
-        buildLoop.sendAll(commitSequence)
-        self.progressValue.emit(numCommits)
-
-        graph = buildLoop.graph
-        repoModel.hiddenCommits = buildLoop.hiddenCommits
-        repoModel.foreignCommits = buildLoop.foreignCommits
-        repoModel.commitSequence = commitSequence
-        repoModel.truncatedHistory = truncatedHistory
-        repoModel.graph = graph
-        repoModel.hideSeeds = hideSeeds
-        repoModel.localSeeds = localSeeds
+        numCommits = repoModel.numRealCommits
+        truncatedHistory = repoModel.truncatedHistory
 
         # ---------------------------------------------------------------------
         # RETURN TO UI THREAD
@@ -186,7 +146,9 @@ class PrimeRepo(RepoTask):
 
         # Prime GraphView
         with QSignalBlockerContext(rw.graphView):
-            if repoModel.truncatedHistory:
+            if buildJob is not None and not buildJob.done:
+                extraRow = SpecialRow.Invalid  # GraphBuildThread will add it when it's done
+            elif repoModel.truncatedHistory:
                 extraRow = SpecialRow.TruncatedHistory
             elif repo.is_shallow:
                 extraRow = SpecialRow.EndOfShallowHistory
@@ -197,6 +159,7 @@ class PrimeRepo(RepoTask):
             rw.graphView.clModel._extraRow = extraRow
             rw.graphView.clModel.setCommitSequence(repoModel.commitSequence)
             rw.graphView.selectRowForLocator(NavLocator.inWorkdir(), force=True)
+        rw.refreshPathHistoryBanner()
 
         # Prime Sidebar
         with QSignalBlockerContext(rw.sidebar):
@@ -209,6 +172,21 @@ class PrimeRepo(RepoTask):
         # Restore main UI
         rw.removePlaceholderWidget()
 
+        # Keep building the rest of the graph in the background while the user gets to work.
+        # (Start this before jumping to the workdir so LoadWorkdir doesn't wait on the full walk.)
+        # If the history is truncated, keep the job around so we can resume loading it later.
+        if buildJob is not None:
+            rw.graphBuild = GraphBuildThread(rw, buildJob)
+            if not buildJob.done:
+                rw.graphBuild.start()
+
+        # Index the commit log for the search bar (GraphBuildThread does this when it's done)
+        if buildJob is None or buildJob.done:
+            rw.buildSearchIndex()
+
+        # Pick up changes made by other programs from now on
+        rw.startRepoWatcher(watchedDirectories)
+
         # Refresh tab text
         rw.nameChange.emit()
 
@@ -233,35 +211,658 @@ class PrimeRepo(RepoTask):
         yield from self.flowSubtask(Jump, initialLocator)
         rw.graphView.scrollToRowForLocator(initialLocator, QAbstractItemView.ScrollHint.PositionAtCenter)
 
+    def buildGraphFromScratch(self, repoModel, maxCommits: int) -> "GraphBuildJob":
+        """
+        Walk the first `FirstBatchSize` commits of the history. If there are
+        more commits to go, the returned job isn't done yet and should be
+        passed on to a GraphBuildThread.
+        """
+        locale = QLocale()
+        job = GraphBuildJob(repoModel, maxCommits)
+        job.isAborted = lambda: self.abortFlag
+
+        # Retrieve the number of commits that we loaded last time we opened this repo
+        # so we can estimate how long it'll take to load it again
+        numCommitsBallpark = min(settings.history.getRepoNumCommits(repoModel.repo.workdir), self.FirstBatchSize)
+        if numCommitsBallpark != 0:
+            self.progressRange.emit(0, numCommitsBallpark)
+
+        self.progressAbortable.emit(True)
+
+        progressInterval = 1000
+
+        while not job.done and job.numCommits < self.FirstBatchSize:
+            job.step(min(progressInterval, self.FirstBatchSize - job.numCommits))
+
+            if self.abortFlag:
+                job.truncate()
+                break
+
+            # Report progress
+            i = job.numCommits
+            message = _("{0} commits…").format(locale.toString(i))
+            self.progressMessage.emit(message)
+            if numCommitsBallpark > 0 and i <= numCommitsBallpark:
+                self.progressValue.emit(i)
+
+        # Can't abort anymore
+        self.progressAbortable.emit(False)
+
+        numCommits = locale.toString(job.numCommits)
+        if not job.done:
+            message = _("{0} commits…").format(numCommits)
+        elif job.truncated:
+            message = _("{0} commits (truncated log).").format(numCommits)
+        else:
+            message = _("{0} commits total.").format(numCommits)
+        self.progressMessage.emit(message)
+
+        if job.done:
+            job.finish()
+        else:
+            # Another thread will keep building the graph while the UI thread is reading it
+            job.deferKeyframes()
+
+        job.applyTo(repoModel)
+        return job
+
     def onError(self, exc: Exception):
         self.rw.cleanup(str(exc), allowAutoReload=False)
         super().onError(exc)
 
 
+class GraphBuildJob:
+    """
+    Builds the commit sequence and the graph in a single pass, one batch of
+    commits at a time.
+
+    Commits coming out of the walker are packed into the CommitSequence and
+    fed to the graph builder right away, so we never hold on to the full
+    Commit objects for the entire history.
+    """
+
+    LockedChunkSize = 256
+    "Number of commits added to the graph per acquisition of RepoModel.graphLock."
+
+    def __init__(self, repoModel, maxCommits: int):
+        # The UI thread keeps using RepoModel.repo while we're walking, so walk through our own handle
+        self.repo = openRepo(repoModel.repo.path)
+        self.repoModel = repoModel
+        self.shortName = repoModel.shortName
+        self.maxCommits = maxCommits
+        self.done = False
+        self.truncated = False
+
+        # Sorting the history may take a while, so the walker is opened by the first call to step()
+        self.walker = None
+        self.lock = repoModel.graphLock
+
+        # Lets the owner interrupt openWalker
+        self.isAborted = lambda: False
+
+        self.tips = list(repoModel.getKnownTips())
+        self.hideSeeds = repoModel.getHiddenTips()
+        self.localSeeds = repoModel.getLocalTips()
+        self.graphCachePath = repoModel.graphCachePath
+
+        self.buildLoop = GraphBuildLoop(heads=self.tips, hideSeeds=self.hideSeeds, localSeeds=self.localSeeds)
+        self.coBuild = self.buildLoop.coBuild()
+        self.coBuild.send(None)  # prime the generator
+
+        # Keyframes that were in the graph before deferKeyframes was called
+        self.keyframes = []
+        self.numMergedKeyframes = 0
+
+        # Commits in the sequence are looked up lazily by the UI thread, so bind it to RepoModel.repo
+        self.commitSequence = CommitSequence(repoModel.repo)
+        ucCommit = repoModel.uncommittedChangesMockCommit()
+        self.commitSequence.append(ucCommit)
+        self.coBuild.send(ucCommit)
+        self.numRowsReady = 1
+
+    @property
+    def numCommits(self) -> int:
+        return len(self.commitSequence) - 1
+
+    def openWalker(self):
+        repoModel = self.repoModel
+
+        # Use the commit-graph file if the repo has one; otherwise, prime the walker (this might take a while)
+        walker = repoModel.walkCommitGraph(self.maxCommits, self.isAborted, self.repo)
+        if walker is None and self.isAborted():
+            walker = []
+        elif walker is None:
+            walker = repoModel.primeWalker(self.repo)
+        self.walker = iter(walker)
+
+    def step(self, batchSize: int):
+        """ Walk up to `batchSize` more commits. """
+        if self.walker is None:
+            self.openWalker()
+
+        commitSequence = self.commitSequence
+        coBuild = self.coBuild
+
+        budget = min(batchSize, self.maxCommits - self.numCommits)
+        walker = itertools.islice(self.walker, budget)
+        count = 0
+        while True:
+            # Pull the commits out of the walker before taking the lock so the UI thread isn't kept waiting
+            chunk = list(itertools.islice(walker, self.LockedChunkSize))
+            if not chunk:
+                break
+            with self.lock:
+                for commit in chunk:
+                    commitSequence.append(commit)
+                    coBuild.send(commit)
+            count += len(chunk)
+
+        # All rows up to here are fully built; let the UI thread see them
+        self.numRowsReady = len(commitSequence)
+
+        if self.numCommits >= self.maxCommits:
+            self.truncate()
+        elif count < budget:
+            self.done = True  # walker depleted
+
+    def truncate(self):
+        self.truncated = True
+        self.done = True
+
+    def finish(self):
+        # If truncated, leave the builder open so we can pick up where we left off
+        if not self.truncated:
+            with self.lock:
+                self.coBuild.close()
+            self.close()
+        logger.info(f"{self.shortName}: loaded {self.numCommits} commits")
+
+    def close(self):
+        """ Release our repo handle. The job can't be resumed afterwards. """
+        if self.repo is not None:
+            self.walker = None
+            self.repo.free()
+            self.repo = None
+
+    def isResumable(self, repoModel) -> bool:
+        """
+        Return True if the history was truncated and the graph hasn't been
+        touched since (e.g. by splicing in new commits or hiding branches),
+        so we can keep walking from the bottom of the graph.
+        """
+        return (self.truncated
+                and self.repo is not None
+                and repoModel.graph is self.buildLoop.graph
+                and repoModel.commitSequence is self.commitSequence
+                and repoModel.hiddenCommits is self.buildLoop.hiddenCommits
+                and repoModel.foreignCommits is self.buildLoop.foreignCommits)
+
+    def resume(self, maxCommits: int):
+        """ Lift the truncation threshold so that `step` can walk more commits. """
+        assert self.truncated
+        self.maxCommits = maxCommits
+        self.truncated = False
+        self.done = False
+
+    def deferKeyframes(self):
+        """
+        Stop writing keyframes into the graph so the UI thread can play it back
+        while we keep building it. Call mergeKeyframes on the UI thread later.
+        """
+        self.keyframes = list(self.buildLoop.graph.keyframes)
+        self.buildLoop.deferredKeyframes = []
+        self.numMergedKeyframes = 0
+
+    def mergeKeyframes(self):
+        """ Call this with the lock held. """
+        deferred = self.buildLoop.deferredKeyframes
+        if deferred is None:
+            return
+        graph = self.buildLoop.graph
+        end = len(deferred)
+        for kf in deferred[self.numMergedKeyframes: end]:
+            graph.saveKeyframe(kf)
+        self.numMergedKeyframes = end
+
+    def applyTo(self, repoModel):
+        repoModel.hiddenCommits = self.buildLoop.hiddenCommits
+        repoModel.foreignCommits = self.buildLoop.foreignCommits
+        repoModel.commitSequence = self.commitSequence
+        repoModel.truncatedHistory = self.truncated or not self.done
+        repoModel.graph = self.buildLoop.graph
+        repoModel.hideSeeds = self.hideSeeds
+        repoModel.localSeeds = self.localSeeds
+
+    def saveGraphCache(self):
+        """ Like RepoModel.saveGraphCache, but safe to call while the UI thread is using the graph. """
+        if self.numCommits == 0:
+            return
+
+        keyframes = self.keyframes
+        if self.buildLoop.deferredKeyframes is not None:
+            keyframes = keyframes + self.buildLoop.deferredKeyframes
+
+        cache = GraphCache(self.buildLoop.graph, self.commitSequence, self.tips,
+                           truncated=self.truncated,
+                           chronological=settings.prefs.chronologicalOrder,
+                           keyframes=keyframes)
+        try:
+            # The UI thread may save volatile keyframes into the graph while we're writing it out
+            with self.lock:
+                cache.write(self.graphCachePath)
+        except OSError as exc:
+            logger.warning(f"Couldn't write graph cache: {exc}")
+
+
+class GraphBuildThread(QThread):
+    """
+    Builds the rest of the graph after PrimeRepo has shown the first rows.
+
+    New rows are published to the CommitLogModel as each batch is ready,
+    so the user can keep working while the history loads.
+
+    If the history is truncated, the thread sticks around (idle) so that
+    the walk can be resumed from the bottom of the graph later on.
+    """
+
+    BatchSize = 10000
+
+    batchReady = Signal()
+    keyframeReached = Signal(int)
+
+    settled = Signal()
+    "Emitted on the UI thread once the graph built so far has been handed over to RepoModel, or the build was cancelled."
+
+    def __init__(self, rw, job: GraphBuildJob):
+        super().__init__(rw)
+        self.setObjectName("GraphBuildThread")
+        self.rw = rw
+        self.job = job
+        self.repoModel = rw.repoModel
+        self.cancelled = False
+        self.wrappedUp = job.done
+        self.batchReady.connect(self.publishRows)
+        self.keyframeReached.connect(self.reportProgress)
+        self.finished.connect(self.wrapUp)
+        job.buildLoop.onKeyframe = self.keyframeReached.emit
+
+    @calledFromQThread
+    def run(self):
+        job = self.job
+        try:
+            while not job.done and not self.cancelled:
+                job.step(self.BatchSize)
+                self.batchReady.emit()
+        except Exception as exc:  # pragma: no cover
+            logger.warning(f"Graph build interrupted: {exc}", exc_info=True)
+            job.truncate()
+
+        if not self.cancelled:
+            job.finish()
+            job.saveGraphCache()
+
+    def cancel(self):
+        """ Stop building the graph and forget about it. Blocks until the thread is done. """
+        self.cancelled = True
+        self.wait()
+        self.wrapUp()
+        self.job.close()
+        if self.rw.graphBuild is self:
+            self.rw.graphBuild = None
+
+    def join(self):
+        """ Block until the entire graph is built, then publish it. """
+        self.wait()
+        self.wrapUp()
+
+    def canResume(self) -> bool:
+        return not self.isRunning() and self.job.isResumable(self.repoModel)
+
+    def resume(self, maxCommits: int):
+        """
+        Load more history, picking up the walk where it was truncated.
+        `maxCommits` is the new total number of commits (0 for no limit).
+        """
+        assert onAppThread()
+        assert self.canResume()
+
+        job = self.job
+        job.resume(maxCommits or 2**63)
+        job.deferKeyframes()
+        self.repoModel.truncatedHistory = True  # until we're done
+
+        self.wrappedUp = False
+        self.rw.graphView.clModel.setExtraRow(SpecialRow.Invalid)
+        self.start()
+
+    def reportProgress(self, row: int):
+        if self.cancelled or self.wrappedUp:
+            return
+        self.rw.statusMessage.emit(_("Loading history: {0} commits…").format(QLocale().toString(row)))
+
+    def publishRows(self):
+        if self.cancelled or self.wrappedUp:
+            return
+
+        job = self.job
+        with job.lock:
+            numRows = job.numRowsReady
+            job.mergeKeyframes()
+
+        # Membership tests on the live set are atomic, and the build thread only ever adds to it.
+        # (The status of a commit doesn't change once it's been walked.)
+        self.rw.graphView.clFilter.hiddenIds = job.buildLoop.hiddenCommits
+        self.rw.graphView.clModel.publishCommitRows(numRows)
+
+    def wrapUp(self):
+        if self.wrappedUp:
+            return
+
+        rw = self.rw
+        if rw.graphBuild is self and (self.cancelled or not self.job.truncated):
+            rw.graphBuild = None
+
+        rw.clearStatus.emit()  # Progress messages
+
+        if self.cancelled:
+            self.wrappedUp = True
+            self.settled.emit()
+            return
+
+        self.publishRows()
+        self.wrappedUp = True
+
+        job = self.job
+        repoModel = self.repoModel
+        job.applyTo(repoModel)
+        repoModel.placeGraphKeyframes()
+
+        if repoModel.truncatedHistory:
+            extraRow = SpecialRow.TruncatedHistory
+        elif repoModel.repo.is_shallow:
+            extraRow = SpecialRow.EndOfShallowHistory
+        else:
+            extraRow = SpecialRow.Invalid
+
+        rw.graphView.clFilter.setHiddenCommits(repoModel.hiddenCommits)
+        rw.graphView.clModel.setExtraRow(extraRow)
+
+        if not repoModel.truncatedHistory:
+            settings.history.setRepoNumCommits(repoModel.repo.workdir, repoModel.numRealCommits)
+            settings.history.setDirty()
+
+        logger.info(f"{repoModel.shortName}: graph complete")
+
+        rw.buildSearchIndex()
+        self.settled.emit()
+
+        # Splice in the commits that appeared while we were building the graph
+        if repoModel.unsplicedRefs is not None:
+            rw.refreshRepo(TaskEffects.Refs)
+
+
+class SearchIndexThread(QThread):
+    """
+    Indexes the commit log for the search bar once the graph is complete.
+
+    Commits that RepoModel.syncTopOfGraph splices into the graph in the
+    meantime are added to the index as they come.
+    """
+
+    def __init__(self, rw, index: CommitSearchIndex):
+        super().__init__(rw)
+        self.setObjectName("SearchIndexThread")
+        self.rw = rw
+        self.index = index
+        # The UI thread keeps using RepoModel.repo while we're indexing, so read the commits through our own handle
+        self.repo = openRepo(rw.repoModel.repo.workdir)
+        self.commitSequence = rw.repoModel.commitSequence
+        self.cancelled = False
+        self.finished.connect(self.wrapUp)
+
+    @calledFromQThread
+    def run(self):
+        sequence = self.commitSequence
+        oids = (sequence.oidAt(row) for row in range(len(sequence)) if not sequence.isMock(row))
+        try:
+            self.index.build(self.repo, oids, lambda: self.cancelled)
+        except Exception as exc:  # pragma: no cover
+            logger.warning(f"Search index interrupted: {exc}", exc_info=True)
+        finally:
+            # The index only keeps raw oids, so no objects from this repo escape the thread
+            self.repo.free()
+
+    def cancel(self):
+        """ Stop indexing and forget about it. Blocks until the thread is done. """
+        self.cancelled = True
+        self.wait()
+        self.wrapUp()
+
+    def wrapUp(self):
+        if self.rw.searchIndexBuild is self:
+            self.rw.searchIndexBuild = None
+
+
+class RenameDetectionThread(QThread):
+    """
+    Looks for renames in a commit that was too large for LoadCommit to do it
+    right away. The complete diffs replace the ones in the commit diff cache,
+    then RepoWidget reloads the commit if it's still showing it.
+    """
+
+    def __init__(self, rw, oid: Oid, contextLines: int):
+        super().__init__(rw)
+        self.setObjectName("RenameDetectionThread")
+        self.rw = rw
+        self.repo = openRepo(rw.repoModel.repo.workdir)
+        self.cache = rw.repoModel.commitDiffCache
+        self.oid = oid
+        self.contextLines = contextLines
+        self.done = False
+        self.cancelled = False
+        self.finished.connect(self.wrapUp)
+
+    @calledFromQThread
+    def run(self):
+        try:
+            # Diff the commit without renames first, so we can bail before find_similar if cancelled
+            diffs, skippedRenameDetection = self.repo.commit_diffs(
+                self.oid, find_similar_threshold=0, context_lines=self.contextLines)
+            if self.cancelled:
+                return
+            if skippedRenameDetection:
+                diffs[0].find_similar()
+        except Exception as exc:  # pragma: no cover
+            logger.warning(f"Rename detection failed: {exc}", exc_info=True)
+            return
+        if self.cancelled:
+            return
+        self.cache.put(self.oid, self.contextLines, diffs, False)
+        self.done = True
+
+    def cancel(self):
+        """
+        Forget about the results. This doesn't wait for the thread to finish
+        (find_similar can't be interrupted); the thread outlives the RepoWidget
+        if need be, then deletes itself.
+        """
+        self.cancelled = True
+        self.finished.disconnect(self.wrapUp)
+        self.wrapUp()
+
+        if self.isRunning():
+            app = GFApplication.instance()
+            self.setParent(app)
+            self.finished.connect(self.deleteLater)
+            app.aboutToQuit.connect(self.wait)
+
+    def wrapUp(self):
+        if self.rw.renameDetection is not self:
+            return
+        self.rw.renameDetection = None
+        if self.done and not self.cancelled:
+            self.rw.onRenamesDetected(self.oid)
+
+
+class ShowPathHistory(RepoTask):
+    """
+    Limit GraphView to the commits that touch some paths.
+
+    Pass jump=False to rebuild the path history without moving the selection
+    (e.g. when RefreshRepo has spliced new commits into the graph).
+    """
+
+    def flow(self, paths: list[str], jump: bool = True):
+        from gitfourchette.tasks.jumptasks import Jump
+
+        rw = self.rw
+        repoModel = self.repoModel
+
+        # The path history is picked out of the full commit log, so we need all of it.
+        # Try again once the graph is ready, without holding up the task runner in the meantime.
+        graphBuild = rw.graphBuild
+        if graphBuild is not None and not graphBuild.wrappedUp:
+            def retry():
+                graphBuild.settled.disconnect(retry)
+                if not graphBuild.cancelled:
+                    ShowPathHistory.invoke(rw, paths, jump)
+            graphBuild.settled.connect(retry)
+            return
+
+        pathHistory = PathHistory(paths)
+        pathHistory.reuseFindings(repoModel.pathHistory)
+        pathHistory.truncated = repoModel.truncatedHistory
+        sequence = repoModel.commitSequence
+
+        yield from self.flowEnterWorkerThread()
+        pathHistory.build(self.repo, sequence, repoModel.changedPathCache)
+
+        yield from self.flowEnterUiThread()
+        rw.setPathHistory(pathHistory)
+
+        if not jump:
+            return
+
+        # Stay on the current commit if it touches the paths, otherwise go to the latest commit that does
+        locator = rw.navLocator
+        if locator.context == NavContext.COMMITTED and locator.commit not in pathHistory.graph.commitRows:
+            if len(pathHistory.commitSequence) > 1:
+                locator = NavLocator.inCommit(pathHistory.commitSequence.oidAt(1))
+            else:
+                locator = NavLocator.inWorkdir()
+        yield from self.flowSubtask(Jump, locator)
+
+
 class LoadWorkdir(RepoTask):
+    Parallel = (os.cpu_count() or 1) >= 2
+    """
+    Diff the staged changes on a separate thread while the worker thread diffs
+    the unstaged changes. Both are independent reads, and libgit2 does most of
+    the work without holding the GIL.
+    """
+
+    _stagingPool: concurrent.futures.ThreadPoolExecutor | None = None
+
+    def lane(self) -> TaskLane:
+        return TaskLane.View
+
     def canKill(self, task: RepoTask):
         if isinstance(task, LoadWorkdir):
             warnings.warn("LoadWorkdir is killing another LoadWorkdir. This is inefficient!")
             return True
-        return isinstance(task, LoadCommit | LoadPatch)
-
-    def flow(self, allowWriteIndex: bool):
-        yield from self.flowEnterWorkerThread()
+        return super().canKill(task) or isinstance(task, LoadCommit | LoadPatch)
 
-        with Benchmark("LoadWorkdir/Index"):
-            self.repo.refresh_index()
+    def flow(self, allowWriteIndex: bool, paths: list[str] | None = None):
+        """
+        If `paths` is given, only diff these files or directories.
+        `dirtyDiffPaths` and `stageDiffPaths` tell which paths each diff was
+        limited to (None means the diff is complete).
+        """
 
-        with Benchmark("LoadWorkdir/Staged"):
-            self.stageDiff = self.repo.get_staged_changes(context_lines=contextLines())
+        yield from self.flowEnterWorkerThread()
 
-        # yield from self.flowEnterWorkerThread()  # let task thread be interrupted here
-        with Benchmark("LoadWorkdir/Unstaged"):
-            self.dirtyDiff = self.repo.get_unstaged_changes(allowWriteIndex, context_lines=contextLines())
+        if not PATH_LIMITED_DIFFS:
+            paths = None  # Can't diff some paths only, so reload everything
+        self.dirtyDiffPaths = set(paths) if paths else None
+
+        with Benchmark("LoadWorkdir"):
+            with Benchmark("Index"):
+                self.repo.refresh_index()
+
+            if not LoadWorkdir.Parallel:
+                with Benchmark("Staged"):
+                    self.stageDiff, self.stageDiffPaths = self.loadStagedChanges(self.repo, paths)
+                with Benchmark("Unstaged"):
+                    self.dirtyDiff = self.repo.get_unstaged_changes(
+                        allowWriteIndex, context_lines=contextLines(), paths=paths,
+                        untracked_cache=self.repoModel.untrackedCache)
+                return
+
+            # libgit2 objects mustn't be used by several threads at once,
+            # so the staged diff gets a repo handle of its own
+            if self.repoModel.auxRepo is None:
+                with Benchmark("OpenAuxRepo"):
+                    self.repoModel.auxRepo = openRepo(self.repo.workdir)
+            auxRepo = self.repoModel.auxRepo
+
+            def loadStagedInParallel():
+                with Benchmark("LoadWorkdir/Staged"):
+                    return self.loadStagedChanges(auxRepo, paths)
+
+            if LoadWorkdir._stagingPool is None:
+                LoadWorkdir._stagingPool = concurrent.futures.ThreadPoolExecutor(1, "LoadWorkdir")
+            stagedFuture = LoadWorkdir._stagingPool.submit(loadStagedInParallel)
+
+            try:
+                with Benchmark("Unstaged"):
+                    self.dirtyDiff = self.repo.get_unstaged_changes(
+                        allowWriteIndex, context_lines=contextLines(), paths=paths,
+                        untracked_cache=self.repoModel.untrackedCache)
+            finally:
+                # Don't leave the staged diff running if the unstaged diff failed
+                with Benchmark("WaitForStaged"):
+                    self.stageDiff, self.stageDiffPaths = stagedFuture.result()
+
+    @staticmethod
+    def loadStagedChanges(repo: Repo, paths: list[str] | None) -> tuple[Diff, set[str] | None]:
+        """
+        Diff the index against HEAD. Return the diff and the paths it is
+        limited to (None if the diff is complete).
+        """
+        repo.refresh_index()
+
+        if paths and not repo.head_is_unborn:
+            stageDiff = repo.get_staged_changes(context_lines=contextLines(), paths=paths)
+            # Rename detection needs to see both sides of a rename, which may lie outside the paths
+            if not any(delta.status in (DeltaStatus.ADDED, DeltaStatus.DELETED) for delta in stageDiff.deltas):
+                return stageDiff, set(paths)
+
+        return repo.get_staged_changes(context_lines=contextLines()), None
+
+
+def openRepo(path: str) -> Repo:
+    """ Open the repository at the given path, bound to the sessionwide git config file. """
+    repo = Repo(path, RepositoryOpenFlag.NO_SEARCH)
+
+    # Bind to sessionwide git config file
+    sessionwideConfigPath = GFApplication.instance().sessionwideGitConfigPath
+    # Level -1 was chosen because it's the only level for which changing branch settings
+    # in a repo won't leak into this file (e.g. change branch upstream).
+    # TODO: `level=4, force=True` would make sense here but this leaks branch settings. Is this a bug in pygit2?
+    #       git_config_add_file_ondisk has an optional 'repo' argument "to allow parsing of conditional includes",
+    #       but pygit2 doesn't make it possible to pass anything but NULL.
+    #       See also https://github.com/libgit2/libgit2/blob/main/include/git2/config.h#L42
+    repo.config.add_file(sessionwideConfigPath, level=-1)
+
+    return repo
 
 
 class LoadCommit(RepoTask):
+    def lane(self) -> TaskLane:
+        return TaskLane.View
+
     def canKill(self, task: RepoTask):
-        return isinstance(task, LoadWorkdir | LoadCommit | LoadPatch)
+        return super().canKill(task) or isinstance(task, LoadWorkdir | LoadCommit | LoadPatch)
 
     def flow(self, locator: NavLocator):
         yield from self.flowEnterWorkerThread()
@@ -269,17 +870,98 @@ class LoadCommit(RepoTask):
         oid = locator.commit
         largeCommitThreshold = -1 if locator.hasFlags(NavFlags.AllowLargeCommits) else RENAME_COUNT_THRESHOLD
 
-        self.diffs, self.skippedRenameDetection = self.repo.commit_diffs(
-            oid, find_similar_threshold=largeCommitThreshold, context_lines=contextLines())
+        # Commits never change, so there's no need to bypass the cache even with ForceDiff
+        cache = self.repoModel.commitDiffCache
+        cached = cache.get(oid, contextLines(), needRenames=locator.hasFlags(NavFlags.AllowLargeCommits))
+
+        if cached is not None:
+            self.diffs, self.skippedRenameDetection = cached
+        else:
+            self.diffs, self.skippedRenameDetection = self.repo.commit_diffs(
+                oid, find_similar_threshold=largeCommitThreshold, context_lines=contextLines())
+            cache.put(oid, contextLines(), self.diffs, self.skippedRenameDetection)
         self.message = self.repo.get_commit_message(oid)
 
 
+class PrefetchNeighbors(RepoTask):
+    """
+    Prepare the diffs that the user is likely to look at next while the repo
+    is idle: the files above and below the current file, and the commits
+    above and below the current commit (along with their first file).
+
+    Each item is prefetched in a step of its own, so that any other task
+    can interrupt the prefetcher without waiting for long.
+    """
+
+    def lane(self) -> TaskLane:
+        return TaskLane.Prefetch
+
+    def canKill(self, task: RepoTask):
+        return isinstance(task, PrefetchNeighbors)
+
+    def flow(self, patches: list[tuple[Diff, int, NavLocator]], commitIds: list[Oid]):
+        for diff, patchNo, locator in patches:
+            yield from self.flowEnterWorkerThread()
+            self._prefetchDocument(diff, patchNo, locator)
+
+        for oid in commitIds:
+            yield from self.flowEnterWorkerThread()
+            diffs = self._prefetchCommit(oid)
+
+            firstDiff = next((diff for diff in diffs if len(diff) != 0), None)
+            if firstDiff is not None:
+                yield from self.flowEnterWorkerThread()
+                path = next(iter(firstDiff.deltas)).new_file.path.removesuffix("/")
+                self._prefetchDocument(firstDiff, 0, NavLocator.inCommit(oid, path))
+
+    def _prefetchCommit(self, oid: Oid) -> list[Diff]:
+        cache = self.repoModel.commitDiffCache
+        cached = cache.get(oid, contextLines())
+        if cached is not None:
+            return cached[0]
+
+        diffs, skippedRenameDetection = self.repo.commit_diffs(
+            oid, find_similar_threshold=RENAME_COUNT_THRESHOLD, context_lines=contextLines())
+        cache.put(oid, contextLines(), diffs, skippedRenameDetection)
+        return diffs
+
+    def _prefetchDocument(self, diff: Diff, patchNo: int, locator: NavLocator):
+        fileStat = DiffDocumentCache.fileStat(locator, self.repo.workdir)
+        try:
+            patch: Patch = diff[patchNo]
+        except (GitError, OSError):
+            return
+
+        delta = patch.delta
+        if (delta.status == DeltaStatus.CONFLICTED
+                or FileMode.COMMIT in (delta.new_file.mode, delta.old_file.mode)):
+            return
+
+        cache = self.repoModel.diffDocumentCache
+        key = DiffDocumentCache.key(patch, locator, fileStat)
+        if key is None or key in cache:
+            return
+
+        try:
+            document = DiffDocument.fromPatch(patch, locator)
+        except (SpecialDiffError, ShouldDisplayPatchAsImageDiff, ShouldDisplayPatchAsVirtualDiff):
+            return  # Only text diffs are cached
+        except Exception:  # Don't bother the user with errors in speculative work
+            logger.warning(f"Failed to prefetch {locator}", exc_info=True)
+            return
+
+        cache.put(key, document)
+
+
 class LoadPatch(RepoTask):
+    def lane(self) -> TaskLane:
+        return TaskLane.View
+
     def canKill(self, task: RepoTask):
-        return isinstance(task, LoadPatch)
+        return super().canKill(task) or isinstance(task, LoadPatch)
 
-    def _processPatch(self, patch: Patch, locator: NavLocator
-                      ) -> DiffDocument | SpecialDiffError | DiffConflict | DiffImagePair:
+    def _processPatch(self, patch: Patch, locator: NavLocator, fileStat: tuple | None
+                      ) -> DiffDocument | VirtualDiffDocument | SpecialDiffError | DiffConflict | DiffImagePair:
         if not patch:
             locator = locator.withExtraFlags(NavFlags.ForceDiff)
             longformItems = [linkify(_("Try to reload the file."), locator.url())]
@@ -308,21 +990,41 @@ class LoadPatch(RepoTask):
             return SpecialDiffError.submoduleDiff(self.repo, patch, locator)
 
         try:
-            diffModel = DiffDocument.fromPatch(patch, locator)
-            diffModel.document.moveToThread(QApplication.instance().thread())
-            return diffModel
+            return self._layOutDocument(patch, locator, fileStat)
         except SpecialDiffError as dme:
             return dme
         except ShouldDisplayPatchAsImageDiff:
-            return DiffImagePair(self.repo, patch.delta, locator)
+            return DiffImagePair(self.repo, patch.delta, locator, self.imageMaxSize, self.repoModel.diffImageCache)
+        except ShouldDisplayPatchAsVirtualDiff:
+            return VirtualDiffDocument.fromPatch(patch, locator)
         except BaseException as exc:
             summary, details = excStrings(exc)
             return SpecialDiffError(summary, icon="SP_MessageBoxCritical", preformatted=details)
 
+    def _layOutDocument(self, patch: Patch, locator: NavLocator, fileStat: tuple | None) -> DiffDocument:
+        cache = self.repoModel.diffDocumentCache
+        key = DiffDocumentCache.key(patch, locator, fileStat)
+
+        with Benchmark("Lay out diff") as bench:
+            document = None
+            if key is not None and not locator.hasFlags(NavFlags.ForceRecreateDocument):
+                document = cache.get(key)
+
+            if document is None:
+                document = DiffDocument.fromPatch(patch, locator)
+                if key is not None:
+                    cache.put(key, document)
+                bench.phase = "cache miss"
+            else:
+                bench.phase = "cache hit"
+            bench.phase += f", hit rate {cache.hitRate():.0%} ({cache.hits}/{cache.hits + cache.misses})"
+
+        return document
+
     def _makeHeader(self, result, locator):
         header = "<html>" + escape(locator.path)
 
-        if isinstance(result, DiffDocument):
+        if isinstance(result, DiffDocument | VirtualDiffDocument):
             if settings.prefs.colorblind:
                 addColor = colors.teal
                 delColor = colors.orange
@@ -344,9 +1046,18 @@ class LoadPatch(RepoTask):
 
         return header
 
-    def flow(self, patch: Patch, locator: NavLocator):
-        # yield from self.flowEnterWorkerThread()
+    def flow(self, patch: Patch, locator: NavLocator, fileStat: tuple | None):
+        # fileStat must be taken before computing the patch (see DiffDocumentCache.fileStat).
+        # Lay out the diff off the UI thread. The QTextDocument itself is assembled
+        # by DiffView.replaceDocument, so a LoadPatch that gets killed on the way
+        # (e.g. the user has moved on to another file) never touches the UI.
+        # Images are decoded no larger than the view, in device pixels.
+        specialDiffView = self.rw.specialDiffView
+        self.imageMaxSize = specialDiffView.viewport().size() * specialDiffView.devicePixelRatio()
+
+        yield from self.flowEnterWorkerThread()
+        result = self._processPatch(patch, locator, fileStat)
+
         yield from self.flowEnterUiThread()
-        # QThread.msleep(500)
-        self.result = self._processPatch(patch, locator)
-        self.header = self._makeHeader(self.result, locator)
+        self.result = result
+        self.header = self._makeHeader(result, locator)
@@ -13,7 +13,7 @@ from gitfourchette.localization import *
 from gitfourchette.nav import NavLocator
 from gitfourchette.porcelain import Oid, Signature
 from gitfourchette.qt import *
-from gitfourchette.tasks.repotask import RepoTask
+from gitfourchette.tasks.repotask import RepoTask, TaskLane
 from gitfourchette.toolbox import *
 
 logger = logging.getLogger(__name__)
@@ -45,6 +45,12 @@ class EditRepoSettings(RepoTask):
 
 
 class GetCommitInfo(RepoTask):
+    def lane(self) -> TaskLane:
+        return TaskLane.View
+
+    def canRunAlongside(self, task: RepoTask) -> bool:
+        return task.lane() == TaskLane.Network
+
     @staticmethod
     def formatSignature(sig: Signature):
         dateText = signatureDateFormat(sig)
@@ -97,7 +103,7 @@ class GetCommitInfo(RepoTask):
 
         # Graph debug info
         if withDebugInfo:
-            graph = repoModel.graph
+            graph = repoModel.shownGraph
             seqIndex = graph.getCommitRow(oid)
             frame = graph.getFrame(seqIndex)
             homeChain = frame.homeChain()
@@ -22,7 +22,9 @@ from gitfourchette.qt import *
 from gitfourchette.remotelink import RemoteLink
 from gitfourchette.tasks import TaskPrereqs
 from gitfourchette.tasks.branchtasks import MergeBranch
-from gitfourchette.tasks.repotask import AbortTask, RepoTask, TaskEffects
+from gitfourchette.tasks.jumptasks import RefreshRepo
+from gitfourchette.tasks.loadtasks import openRepo
+from gitfourchette.tasks.repotask import AbortTask, RepoTask, TaskEffects, TaskLane
 from gitfourchette.toolbox import *
 from gitfourchette.trtables import TrTables
 
@@ -36,6 +38,21 @@ class _BaseNetTask(RepoTask):
         super().__init__(parent)
         self.remoteLinkDialog = None
 
+    def lane(self) -> TaskLane:
+        return TaskLane.Network
+
+    def canRunAlongside(self, task: RepoTask) -> bool:
+        # Let the user browse the repo (and see the effects of other remote
+        # operations) while waiting on the network.
+        return self.lane() == TaskLane.Network and (task.lane() == TaskLane.View or isinstance(task, RefreshRepo))
+
+    def setRepoModel(self, repoModel):
+        super().setRepoModel(repoModel)
+        # Tasks in other lanes keep using RepoModel.repo while we're running, so get our own handle on the repo.
+        # (Not freed explicitly: objects that we hand out, e.g. to PushDialog, may outlive the task.)
+        if repoModel is not None and self.lane() == TaskLane.Network:
+            self.repo = openRepo(repoModel.repo.workdir)
+
     def _showRemoteLinkDialog(self, title: str = ""):
         assert not self.remoteLinkDialog
         assert onAppThread()
@@ -233,6 +250,9 @@ class FetchRemoteBranch(_BaseNetTask):
 
 
 class PullBranch(_BaseNetTask):
+    def lane(self) -> TaskLane:
+        return TaskLane.Main  # merges into the working directory
+
     def prereqs(self) -> TaskPrereqs:
         return TaskPrereqs.NoUnborn | TaskPrereqs.NoDetached
 
@@ -245,6 +265,9 @@ class PullBranch(_BaseNetTask):
 
 
 class UpdateSubmodule(_BaseNetTask):
+    def lane(self) -> TaskLane:
+        return TaskLane.Main  # checks out the submodule's working directory
+
     def flow(self, submoduleName: str, init=True):
         self._showRemoteLinkDialog()
         yield from self.flowEnterWorkerThread()
@@ -269,6 +292,9 @@ class UpdateSubmodule(_BaseNetTask):
 
 
 class UpdateSubmodulesRecursive(_BaseNetTask):
+    def lane(self) -> TaskLane:
+        return TaskLane.Main
+
     def flow(self):
         count = 0
 
@@ -300,7 +326,7 @@ class PushRefspecs(_BaseNetTask):
                 remote.push(refspecs, callbacks=self.remoteLink)
 
 
-class PushBranch(RepoTask):
+class PushBranch(_BaseNetTask):
     def flow(self, branchName: str = ""):
         if len(self.repo.remotes) == 0:
             text = paragraphs(
@@ -9,7 +9,7 @@ from __future__ import annotations
 import enum
 import logging
 import warnings
-from collections.abc import Generator
+from collections.abc import Generator, Iterable
 from typing import Any, TYPE_CHECKING, Literal, TypeVar
 
 from gitfourchette.localization import *
@@ -89,6 +89,25 @@ class TaskEffects(enum.IntFlag):
     # regardless of what part of the repo is being viewed.
 
 
+class TaskLane(enum.IntEnum):
+    """
+    RepoTaskRunner runs one task at a time per lane. Tasks in different lanes
+    may run concurrently if they agree to it (see RepoTask.canRunAlongside).
+    """
+
+    Main = enum.auto()
+    "Tasks that modify the repository or the working directory."
+
+    Network = enum.auto()
+    "Tasks that spend most of their time talking to a remote."
+
+    View = enum.auto()
+    "Read-only tasks that populate the UI (navigation, loading commits and patches)."
+
+    Prefetch = enum.auto()
+    "Speculative work done while the repo is idle. Any task in another lane interrupts it."
+
+
 class FlowControlToken:
     """
     Object that can be yielded from `RepoTask.flow()` to control the flow of the coroutine.
@@ -156,6 +175,9 @@ class RepoTask(QObject):
     effects: TaskEffects
     """ Which parts of the UI should be refreshed when this task completes. """
 
+    dirtyPaths: set[str] | None
+    """ Workdir paths modified by this task, if it has TaskEffects.Workdir. None means unknown. """
+
     _postStatus: str
     """ Display this message in the status bar after completion (user code should use the getter/setter). """
 
@@ -188,6 +210,7 @@ class RepoTask(QObject):
         self.setObjectName(self.__class__.__name__)
         self.jumpTo = NavLocator()
         self.effects = TaskEffects.Nothing
+        self.dirtyPaths = None
         self._postStatus = ""
         self._postStatusLocked = False
         self._taskStack = [self]
@@ -226,6 +249,23 @@ class RepoTask(QObject):
     def canKill(self, task: RepoTask) -> bool:
         """
         Return true if this task is allowed to take precedence over the given running task.
+
+        Any task may interrupt speculative work in the Prefetch lane.
+        Overrides should keep this rule by deferring to super().canKill().
+        """
+        return task.lane() == TaskLane.Prefetch and self.lane() != TaskLane.Prefetch
+
+    def lane(self) -> TaskLane:
+        """
+        Lane in which this task runs. Must not change over the task's lifetime.
+        """
+        return TaskLane.Main
+
+    def canRunAlongside(self, task: RepoTask) -> bool:
+        """
+        Return true if this task may run at the same time as the given task,
+        which runs in another lane. Both tasks must agree, otherwise canKill
+        decides whether this task may start.
         """
         return False
 
@@ -381,6 +421,8 @@ class RepoTask(QObject):
 
         # Percolate effect bits to caller task
         self.effects |= subtask.effects
+        if subtask is not self and subtask.effects & TaskEffects.Workdir:
+            self.dirtyPaths = None  # Don't bother merging the paths
 
         # Percolate postStatus to caller task if it's not manually overridden
         if not self._postStatusLocked and subtask.postStatus:
@@ -567,6 +609,51 @@ class RepoTask(QObject):
                 _("Before performing this action, commit your changes or stash them.")))
 
 
+class _LaneState(QObject):
+    """ Bookkeeping for one lane of a RepoTaskRunner. """
+
+    continueFlow = Signal(FlowControlToken)
+    "Connected to RepoTaskRunner._iterateFlow"
+
+    workerThread: FlowWorkerThread
+
+    currentTask: RepoTask | None
+    "Task that is currently running (or waiting to start)"
+
+    zombieTask: RepoTask | None
+    "Task that is being interrupted"
+
+    started: bool
+    "Whether currentTask has started running"
+
+    waitingOn: list[RepoTask]
+    "Zombies in other lanes that must die before currentTask may start"
+
+    workerPriority: QThread.Priority
+
+    busyMessage: str
+
+    benchmark: Benchmark
+    "Context manager"
+
+    def __init__(self, runner: RepoTaskRunner, lane: TaskLane):
+        super().__init__(runner)
+        self.setObjectName(f"{lane.name}Lane")
+        self.workerThread = FlowWorkerThread(self)
+        self.workerThread.flow = None
+        if lane == TaskLane.Prefetch:
+            self.workerPriority = QThread.Priority.LowestPriority
+        else:
+            self.workerPriority = QThread.Priority.InheritPriority
+        self.workerThread.tokenReady.connect(self.continueFlow)
+        self.currentTask = None
+        self.zombieTask = None
+        self.started = False
+        self.waitingOn = []
+        self.busyMessage = ""
+        self.benchmark = Benchmark("???")
+
+
 class RepoTaskRunner(QObject):
     ForceSerial = False
     """
@@ -581,68 +668,69 @@ class RepoTaskRunner(QObject):
     ready = Signal()
     requestAttention = Signal()
 
-    _continueFlow = Signal(FlowControlToken)
-    "Connected to _iterateFlow"
-
-    _workerThread: FlowWorkerThread
-
-    _currentTask: RepoTask | None
-    "Task that is currently running"
-
-    _zombieTask: RepoTask | None
-    "Task that is being interrupted"
-
-    _currentTaskBenchmark: Benchmark
-    "Context manager"
+    _lanes: dict[TaskLane, _LaneState]
 
     def __init__(self, parent: QObject):
         super().__init__(parent)
         self.setObjectName("RepoTaskRunner")
-        self._currentTask = None
-        self._zombieTask = None
-        self._currentTaskBenchmark = Benchmark("???")
-
-        self._workerThread = FlowWorkerThread(self)
-        self._workerThread.flow = None
-        self._workerThread.tokenReady.connect(self._continueFlow)
+        self._lanes = {lane: _LaneState(self, lane) for lane in TaskLane}
 
     @property
     def currentTask(self):
-        return self._currentTask
+        """ Task that is currently running in the main lane. """
+        return self._lanes[TaskLane.Main].currentTask
+
+    def runningTasks(self) -> list[RepoTask]:
+        return [state.currentTask for state in self._lanes.values() if state.currentTask is not None]
 
-    def isBusy(self):
-        return self._currentTask is not None or self._zombieTask is not None or self._workerThread.isRunning()
+    def _selectLanes(self, lane: TaskLane | None) -> Iterable[_LaneState]:
+        if lane is None:
+            return self._lanes.values()
+        return [self._lanes[lane]]
 
-    def killCurrentTask(self):
+    def isBusy(self, lane: TaskLane | None = None):
+        """ Return true if any task is running in the given lane (or in any lane if None). """
+        return any(state.currentTask is not None or state.zombieTask is not None or state.workerThread.isRunning()
+                   for state in self._selectLanes(lane))
+
+    def killCurrentTask(self, lane: TaskLane | None = None):
         """
-        Interrupt current task next time it yields a FlowControlToken.
+        Interrupt the task running in the given lane (or in all lanes if None)
+        next time it yields a FlowControlToken.
 
         The task will not die immediately; use joinZombieTask() after killing
         the task to block the current thread until the task runner is empty.
         """
-        if not self._currentTask:
+        for state in self._selectLanes(lane):
+            self._killLaneTask(state)
+
+    def _killLaneTask(self, state: _LaneState):
+        task = state.currentTask
+        if not task:
             # Nothing to kill.
             return
 
-        if not self._zombieTask:
+        if not state.started:
+            # The task hasn't started yet - it's waiting on a zombie to die.
+            # Just drop it, but let the zombie die cleanly.
+            assert task._currentIteration == 0, "currentTask isn't supposed to have started yet!"
+            task.deleteLater()
+        else:
             # Move the currently-running task to zombie mode.
             # It'll get deleted next time it yields a FlowControlToken.
-            self._zombieTask = self._currentTask
-        else:
-            # There's already a zombie. This means that the current task hasn't
-            # started yet - it's waiting on the zombie to die.
-            # Just overwrite the current task, but let the zombie die cleanly.
-            assert self._currentTask._currentIteration == 0, "_currentTask isn't supposed to have started yet!"
-            self._currentTask.deleteLater()
+            assert not state.zombieTask
+            state.zombieTask = task
 
-        self._currentTask = None
+        state.currentTask = None
+        state.started = False
+        state.waitingOn = []
 
     def joinZombieTask(self):
-        """Block UI thread until the current zombie task is dead.
+        """Block UI thread until all zombie tasks are dead.
         Returns immediately if there's no zombie task."""
 
         assert onAppThread()
-        while self._zombieTask:
+        while any(state.zombieTask for state in self._lanes.values()):
             QThread.yieldCurrentThread()
             QThread.msleep(30)
             flags = QEventLoop.ProcessEventsFlag.ExcludeUserInputEvents
@@ -651,12 +739,14 @@ class RepoTaskRunner(QObject):
         self.joinWorkerThread()
         assert not self.isBusy()
 
-    def joinWorkerThread(self):
+    def joinWorkerThread(self, lane: TaskLane | None = None):
         assert onAppThread()
-        if self._workerThread.isRunning():
-            self._workerThread.wait()
-        assert not self._workerThread.isRunning()
-        assert not self._workerThread.flow
+        for state in self._selectLanes(lane):
+            workerThread = state.workerThread
+            if workerThread.isRunning():
+                workerThread.wait()
+            assert not workerThread.isRunning()
+            assert not workerThread.flow
 
     def put(self, task: RepoTask, *args, **kwargs):
         assert onAppThread()
@@ -665,33 +755,77 @@ class RepoTaskRunner(QObject):
         task._currentFlow = task.flow(*args, **kwargs)
         assert isinstance(task._currentFlow, Generator), "flow() must contain at least one yield statement"
 
-        if not self._currentTask:
-            self._currentTask = task
-            self._startTask(task)
+        state = self._lanes[task.lane()]
+        toKill = []
+        waitingOn = []
 
-        elif task.canKill(self._currentTask):
-            logger.info(f"Task {task} killed task {self._currentTask}")
-            self.killCurrentTask()
-            self._currentTask = task
+        # Resolve conflicts with tasks in the other lanes
+        for otherState in self._lanes.values():
+            if otherState is state:
+                continue
 
-        else:
-            logger.info(f"Task {task} cannot kill task {self._currentTask}")
-            message = _("Please wait for the current operation to complete ({0})."
-                              ).format(hquo(self._currentTask.name()))
-            showInformation(task.parentWidget(), _("Operation in progress"), "<html>" + message)
+            zombie = otherState.zombieTask
+            if zombie and not (task.canRunAlongside(zombie) and zombie.canRunAlongside(task)):
+                waitingOn.append(zombie)
+
+            other = otherState.currentTask
+            if not other or (task.canRunAlongside(other) and other.canRunAlongside(task)):
+                pass
+            elif task.canKill(other):
+                toKill.append(otherState)
+            else:
+                self._refuseTask(task, other)
+                return
+
+        # Resolve conflicts with the task running in the same lane
+        if state.currentTask and not task.canKill(state.currentTask):
+            self._refuseTask(task, state.currentTask)
+            return
+
+        for victimState in toKill + [state]:
+            if victimState.currentTask:
+                logger.info(f"Task {task} killed task {victimState.currentTask}")
+                self._killLaneTask(victimState)
+            if victimState is not state and victimState.zombieTask:
+                waitingOn.append(victimState.zombieTask)
+
+        state.currentTask = task
+        state.started = False
+        state.waitingOn = waitingOn
+        self._startPendingTasks()
+
+    def _refuseTask(self, task: RepoTask, runningTask: RepoTask):
+        logger.info(f"Task {task} cannot kill task {runningTask}")
+        message = _("Please wait for the current operation to complete ({0})."
+                    ).format(hquo(runningTask.name()))
+        showInformation(task.parentWidget(), _("Operation in progress"), "<html>" + message)
+
+    def _startPendingTasks(self):
+        zombies = [state.zombieTask for state in self._lanes.values() if state.zombieTask]
+
+        for state in self._lanes.values():
+            task = state.currentTask
+            if not task or state.started or state.zombieTask:
+                continue
+            state.waitingOn = [z for z in state.waitingOn if z in zombies]
+            if state.waitingOn:
+                continue
+            state.started = True
+            self._startTask(task)
 
     def _startTask(self, task: RepoTask):
-        assert self._currentTask == task
+        state = self._lanes[task.lane()]
+        assert state.currentTask == task
         assert task._currentFlow
         assert task.isRootTask
 
         logger.debug(f">>> {task}")
 
-        self._currentTaskBenchmark.name = str(task)
-        self._currentTaskBenchmark.__enter__()
+        state.benchmark.name = str(task)
+        state.benchmark.__enter__()
 
         # Prepare internal signal for coroutine continuation
-        self._continueFlow.connect(lambda result: self._iterateFlow(task, result))
+        state.continueFlow.connect(lambda result: self._iterateFlow(task, result))
         task.uiReady.connect(lambda: self._iterateFlow(task, FlowControlToken()))
 
         # Check task prerequisites
@@ -706,12 +840,14 @@ class RepoTaskRunner(QObject):
         self._iterateFlow(task, FlowControlToken())
 
     def _iterateFlow(self, task: RepoTask, token: FlowControlToken):
+        state = self._lanes[task.lane()]
+
         while True:
             assert onAppThread()
             task._currentIteration += 1
 
             # Let worker thread wrap up
-            self.joinWorkerThread()
+            self.joinWorkerThread(task.lane())
 
             assert not isinstance(token, Generator), \
                 "You're trying to yield a nested generator. Did you mean 'yield from'?"
@@ -719,14 +855,13 @@ class RepoTaskRunner(QObject):
                 f"In a RepoTask coroutine, you can only yield FlowControlToken. You yielded: {type(token).__name__}")
 
             # Wrap up zombie task (task that was interrupted earlier)
-            if task is self._zombieTask:
-                assert task is not self._currentTask
+            if task is state.zombieTask:
+                assert task is not state.currentTask
                 self._releaseTask(task)
                 task.deleteLater()
 
-                # Another task is queued up, start it now
-                if self._currentTask:
-                    self._startTask(self._currentTask)
+                # Other tasks may be queued up, start them now
+                self._startPendingTasks()
                 return
 
             nextToken = self._processToken(task, token)
@@ -738,9 +873,10 @@ class RepoTaskRunner(QObject):
             self.ready.emit()
 
     def _processToken(self, task: RepoTask, token: FlowControlToken) -> FlowControlToken | None:
+        state = self._lanes[task.lane()]
         flow = task._currentFlow
         assert flow is not None
-        assert task is self._currentTask
+        assert task is state.currentTask
 
         if (token.flowControl == FlowControlToken.Kind.ContinueOnUiThread or
               (token.flowControl == FlowControlToken.Kind.ContinueOnWorkThread and RepoTaskRunner.ForceSerial)):
@@ -750,20 +886,22 @@ class RepoTaskRunner(QObject):
             return token
 
         elif token.flowControl == FlowControlToken.Kind.WaitReady:
-            self.progress.emit("", False)
+            self._setBusyMessage(state, "")
             self.requestAttention.emit()
             # When user is ready, task.uiReady will fire, and we'll re-enter _iterateFlow
 
         elif token.flowControl == FlowControlToken.Kind.ContinueOnWorkThread:
             assert not RepoTaskRunner.ForceSerial
-            busyMessage = _("Busy: {0}…").format(task.name())
-            self.progress.emit(busyMessage, True)
+            if task.lane() != TaskLane.Prefetch:  # Don't look busy while doing speculative work
+                busyMessage = _("Busy: {0}…").format(task.name())
+                self._setBusyMessage(state, busyMessage)
 
             # Wrapper around `next(flow)`.
-            # It will, in turn, emit _continueFlow, which will re-enter _iterateFlow.
-            assert not self._workerThread.isRunning()
-            self._workerThread.flow = flow
-            self._workerThread.start()
+            # It will, in turn, emit continueFlow, which will re-enter _iterateFlow.
+            workerThread = state.workerThread
+            assert not workerThread.isRunning()
+            workerThread.flow = flow
+            workerThread.start(state.workerPriority)
 
         elif token.flowControl == FlowControlToken.Kind.InterruptedByException:
             exception = token.exception
@@ -771,7 +909,7 @@ class RepoTaskRunner(QObject):
 
             # Wait for worker thread to wrap up cleanly,
             # otherwise we'll still appear to be busy for postTask callbacks.
-            self.joinWorkerThread()
+            self.joinWorkerThread(task.lane())
 
             # Stop tracking this task
             self._releaseTask(task)
@@ -799,6 +937,13 @@ class RepoTaskRunner(QObject):
 
         return None
 
+    def _setBusyMessage(self, state: _LaneState, message: str):
+        state.busyMessage = message
+        if not message:
+            # Fall back to another lane's busy message, if any
+            message = next((s.busyMessage for s in self._lanes.values() if s.busyMessage), "")
+        self.progress.emit(message, bool(message))
+
     @staticmethod
     def _getNextToken(flow: RepoTask.FlowGeneratorType) -> FlowControlToken:
         try:
@@ -809,11 +954,12 @@ class RepoTaskRunner(QObject):
 
     def _releaseTask(self, task: RepoTask):
         logger.debug(f"<<< {task}")
-        self.progress.emit("", False)
-        self._currentTaskBenchmark.__exit__(None, None, None)
+        state = self._lanes[task.lane()]
+        self._setBusyMessage(state, "")
+        state.benchmark.__exit__(None, None, None)
 
         assert onAppThread()
-        assert task is self._currentTask or task is self._zombieTask
+        assert task is state.currentTask or task is state.zombieTask
         assert task.isRootTask
 
         # Clean up all tasks in the stack (remember, we're the root stack)
@@ -821,15 +967,16 @@ class RepoTaskRunner(QObject):
         while task._taskStack:
             task._popSubtask()
 
-        self._continueFlow.disconnect()
+        state.continueFlow.disconnect()
         task.uiReady.disconnect()
 
         task._currentFlow = None
 
-        if task is self._currentTask:
-            self._currentTask = None
-        elif task is self._zombieTask:
-            self._zombieTask = None
+        if task is state.currentTask:
+            state.currentTask = None
+            state.started = False
+        elif task is state.zombieTask:
+            state.zombieTask = None
         else:
             raise AssertionError("_releaseTask: task is neither current nor zombie")
 
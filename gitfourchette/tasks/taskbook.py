@@ -77,6 +77,7 @@ class TaskBook:
             tasks.NewRemote: _("Add remote"),
             tasks.NewStash: _("Stash changes"),
             tasks.NewTag: _("New tag"),
+            tasks.PrefetchNeighbors: _("Prefetch nearby diffs"),
             tasks.PrimeRepo: _("Open repo"),
             tasks.PullBranch: _("Pull remote branch"),
             tasks.PushBranch: _("Push branch"),
@@ -93,6 +94,7 @@ class TaskBook:
             tasks.RevertCommit: _("Revert commit"),
             tasks.RevertPatch: _("Revert selected text"),
             tasks.SetUpGitIdentity: _("Git identity"),
+            tasks.ShowPathHistory: _("Show file history"),
             tasks.EditRepoSettings: _("Repository settings"),
             tasks.StageFiles: _("Stage files"),
             tasks.SwitchBranch: _("Switch to branch"),
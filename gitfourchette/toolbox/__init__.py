@@ -36,7 +36,7 @@ from .messageboxes import (
     addULToMessageBox,
     NonCriticalOperation)
 from .iconbank import stockIcon, clearStockIconCache
-from .pathutils import PathDisplayStyle, abbreviatePath, compactPath
+from .pathutils import PathDisplayStyle, abbreviatePath, compactPath, isUnderPaths
 from .persistentfiledialog import PersistentFileDialog
 from .qbusyspinner import QBusySpinner
 from .qcomboboxwithpreview import QComboBoxWithPreview
@@ -46,6 +46,7 @@ from .qhintbutton import QHintButton
 from .qsignalblockercontext import QSignalBlockerContext
 from .qstatusbar2 import QStatusBar2
 from .qtabwidget2 import QTabWidget2, QTabBar2
+from .sizeboundedlru import SizeBoundedLRU
 from .qtutils import (
     addComboBoxItem,
     isImageFormatSupported,
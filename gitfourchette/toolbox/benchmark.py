@@ -6,6 +6,7 @@
 
 import logging
 import os
+import threading
 import time
 
 logger = logging.getLogger(__name__)
@@ -27,7 +28,16 @@ def getRSS():
 class Benchmark:
     """ Context manager that reports how long a piece of code takes to run. """
 
-    nesting: list[str] = []
+    _threadLocal = threading.local()
+
+    @classmethod
+    def nesting(cls) -> list[str]:
+        """ Names of the benchmarks running on the current thread, outermost first. """
+        try:
+            return cls._threadLocal.nesting
+        except AttributeError:
+            cls._threadLocal.nesting = []
+            return cls._threadLocal.nesting
 
     def __init__(self, name: str):
         self.name = name
@@ -39,7 +49,7 @@ class Benchmark:
         if self.startTime:
             self.exit()
 
-        Benchmark.nesting.append(self.name)
+        Benchmark.nesting().append(self.name)
         self.startBytes = getRSS()
         self.startTime = time.perf_counter()
         self.phase = phase
@@ -48,12 +58,12 @@ class Benchmark:
         ms = 1000 * (time.perf_counter() - self.startTime)
         kb = (getRSS() - self.startBytes) // 1024
 
-        description = "/".join(Benchmark.nesting)
+        description = "/".join(Benchmark.nesting())
         if self.phase:
             description += f" ({self.phase})"
         logger.log(BENCHMARK_LOGGING_LEVEL, f"{ms:8.2f} ms {kb:6,d}K {description}")
 
-        Benchmark.nesting.pop()
+        Benchmark.nesting().pop()
         self.startTime = 0.0
         self.phase = ""
 
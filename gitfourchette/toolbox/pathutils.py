@@ -37,3 +37,13 @@ def abbreviatePath(path: str, style: PathDisplayStyle = PathDisplayStyle.FULL_PA
         return path.rsplit('/', 1)[-1]
     else:
         return path
+
+
+def isUnderPaths(path: str, paths: set[str]) -> bool:
+    """ Return True if a repo-relative path is one of the given paths, or if it's inside one of them. """
+    path = path.removesuffix("/")
+    while path:
+        if path in paths:
+            return True
+        path = path.rpartition("/")[0]
+    return False
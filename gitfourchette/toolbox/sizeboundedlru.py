@@ -0,0 +1,92 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Generic, TypeVar
+
+_K = TypeVar("_K", bound=Hashable)
+_V = TypeVar("_V")
+
+
+class SizeBoundedLRU(Generic[_K, _V]):
+    """
+    Thread-safe cache that evicts its least recently used entries once their
+    total size exceeds MaxSize. Subclasses define how to measure a value
+    (sizeOf), in whatever unit MaxSize is expressed.
+    """
+
+    MaxSize = 0
+    "Budget for the total size of the entries. Values larger than this aren't cached at all."
+
+    entries: OrderedDict[_K, tuple[_V, int]]
+    "Cached values and their sizes, from least to most recently used."
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.totalSize = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def sizeOf(self, value: _V) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, key: _K) -> bool:
+        return key in self.entries
+
+    def get(self, key: _K, accept: Callable[[_V], bool] | None = None) -> _V | None:
+        """
+        Return the value cached under a key, or None. A value that `accept`
+        rejects is left in the cache, but it counts as a miss.
+        """
+        with self.lock:
+            try:
+                value, _size = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if accept is not None and not accept(value):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: _K, value: _V, replace: Callable[[_V], bool] | None = None):
+        """
+        Cache a value under a key, then evict the least recently used entries
+        until the rest fit in MaxSize. If `replace` rejects the value that's
+        already cached under the key, keep that one instead.
+        """
+        size = self.sizeOf(value)
+        if size > self.MaxSize:
+            return
+
+        with self.lock:
+            previous = self.entries.get(key)
+            if previous is not None:
+                if replace is not None and not replace(previous[0]):
+                    return
+                del self.entries[key]
+                self.totalSize -= previous[1]
+
+            self.entries[key] = (value, size)
+            self.totalSize += size
+
+            while self.totalSize > self.MaxSize:
+                _oldKey, (_oldValue, oldSize) = self.entries.popitem(last=False)
+                self.totalSize -= oldSize
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.totalSize = 0
+
+    def hitRate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -283,7 +283,9 @@ class TrTables:
             "tabSpaces": _("One tab is # spaces"),
             "contextLines": _("Show up to # context lines"),
             "contextLines_help": _("Amount of unmodified lines to show around red or green lines in a diff."),
-            "largeFileThresholdKB": _("Load diffs up to # KB"),
+            "largeFileThresholdKB": _("Fully format diffs up to # KB"),
+            "largeFileThresholdKB_help": _("Larger diffs are shown in a lightweight viewer without "
+                                           "word wrap or intra-line highlighting."),
             "imageFileThresholdKB": _("Load images up to # KB"),
             "wordWrap": _("Word wrap"),
             "showStrayCRs": _("Display alien line endings (CRLF)"),
@@ -335,6 +337,11 @@ class TrTables:
 
             "verbosity": _("Logging verbosity"),
             "autoRefresh": _("Auto-refresh when app regains focus"),
+            "watchRepo": _("Auto-refresh when files change on disk"),
+            "parallelPrime": _("Use all CPU cores to load huge repositories"),
+            "parallelPrime_help": _(
+                "When opening a very large repository that has no commit-graph file, "
+                "read its history with several processes."),
             "animations": _("Animation effects"),
             "smoothScroll": _("Smooth scrolling (where applicable)"),
             "forceQtApi": _("Preferred Qt binding"),
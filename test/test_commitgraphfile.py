@@ -0,0 +1,332 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+import shutil
+import subprocess
+import threading
+
+import pytest
+
+from gitfourchette import settings
+from gitfourchette.graph import CommitGraphFile, commitGraphEnabled
+from gitfourchette.graph import packscan
+from gitfourchette.graphview.commitlogmodel import CommitLogModel
+from gitfourchette.graphview.graphview import GraphView
+from gitfourchette.nav import NavLocator
+from gitfourchette.pathhistory import ChangedPathCache, PathHistory
+from gitfourchette.repomodel import RepoModel
+from .util import *
+
+requiresGit = pytest.mark.skipif(not shutil.which("git"), reason="git executable required to write commit-graph")
+
+
+def writeCommitGraph(wd: str, *args: str):
+    subprocess.run(["git", "commit-graph", "write", "--reachable", *args], cwd=wd, check=True, capture_output=True)
+
+
+def repack(wd: str):
+    # Aggressive delta compression so that some commits are stored as deltas
+    subprocess.run(["git", "repack", "-a", "-d", "-f", "--window=250"], cwd=wd, check=True, capture_output=True)
+
+
+def walkerSequence(repo: Repo, tips: list[Oid], sorting: SortMode):
+    walker = repo.walk(None, sorting)
+    for tip in tips:
+        walker.push(tip)
+    return [(c.id, list(c.parent_ids)) for c in walker]
+
+
+def makeOctopus(repo: Repo):
+    head = repo.head_commit
+    parents = [head.id]
+    for i in range(2):
+        parents.append(repo.create_commit(None, TEST_SIGNATURE, TEST_SIGNATURE, f"side {i}", head.tree_id, [head.parents[0].id]))
+    repo.create_commit("HEAD", TEST_SIGNATURE, TEST_SIGNATURE, "octopus", head.tree_id, parents)
+
+
+@requiresGit
+@pytest.mark.parametrize("split", [False, True])
+@pytest.mark.parametrize("sorting", [SortMode.TOPOLOGICAL, SortMode.TOPOLOGICAL | SortMode.TIME])
+def testCommitGraphOrderMatchesWalker(tempDir, split, sorting):
+    wd = unpackRepo(tempDir)
+    with RepoContext(wd) as repo:
+        makeOctopus(repo)
+
+    writeCommitGraph(wd)
+
+    if split:
+        # Add a layer to the chain, then a commit that isn't in the commit-graph at all
+        with RepoContext(wd) as repo:
+            repo.create_commit_on_head("layer 2", TEST_SIGNATURE, TEST_SIGNATURE)
+        writeCommitGraph(wd, "--split")
+        with RepoContext(wd) as repo:
+            repo.create_commit_on_head("not in commit-graph", TEST_SIGNATURE, TEST_SIGNATURE)
+
+    with RepoContext(wd) as repo:
+        tips = list(repo.map_refs_to_ids().values())
+        commitGraph = CommitGraphFile.open(repo.path)
+        assert commitGraph is not None
+        assert len(commitGraph.layers) == (2 if split else 1)
+
+        def lookUpMissing(oid):
+            commit = repo[oid]
+            return commit.commit_time, commit.parent_ids
+
+        sequence = commitGraph.topologicalSequence(tips, bool(sorting & SortMode.TIME), lookUpMissing)
+        assert [(c.id, c.parent_ids) for c in sequence] == walkerSequence(repo, tips, sorting)
+        assert len(commitGraph.missingOids) == (1 if split else 0)
+
+
+@requiresGit
+def testOpenRepoWithCommitGraph(tempDir, mainWindow):
+    wd = unpackRepo(tempDir)
+    writeCommitGraph(wd)
+
+    rw = mainWindow.openRepo(wd)
+    repoModel = rw.repoModel
+    tips = list(repoModel.refs.values())
+    assert [(c.id, list(c.parent_ids)) for c in repoModel.commitSequence[1:]] == \
+           walkerSequence(rw.repo, tips, repoModel.walkerSortMode())
+
+    # Commit objects are read on demand
+    assert rw.graphView.clModel.data(rw.graphView.clModel.index(1, 0), CommitLogModel.Role.Commit).message
+
+
+@requiresGit
+def testCommitGraphDisabledInConfig(tempDir, mainWindow):
+    wd = unpackRepo(tempDir)
+    writeCommitGraph(wd, "--changed-paths")
+    with RepoContext(wd) as repo:
+        repo.config["core.commitGraph"] = False
+
+    rw = mainWindow.openRepo(wd)
+    assert not commitGraphEnabled(rw.repo)
+    assert rw.repoModel.walkCommitGraph() is None
+    assert PathHistory.openCommitGraph(rw.repo) is None
+
+
+@requiresGit
+@pytest.mark.parametrize("sorting", [SortMode.TOPOLOGICAL, SortMode.TOPOLOGICAL | SortMode.TIME])
+def testPackScanOrderMatchesWalker(tempDir, sorting):
+    wd = unpackRepo(tempDir)
+    with RepoContext(wd) as repo:
+        makeOctopus(repo)
+    repack(wd)
+
+    with RepoContext(wd) as repo:
+        repo.create_commit_on_head("loose commit", TEST_SIGNATURE, TEST_SIGNATURE)
+        tips = list(repo.map_refs_to_ids().values())
+
+        commitGraph = packscan.scanPacks(repo.path, numWorkers=2)
+        assert commitGraph is not None
+
+        def lookUpMissing(oid):
+            commit = repo[oid]
+            return commit.commit_time, commit.parent_ids
+
+        sequence = commitGraph.topologicalSequence(tips, bool(sorting & SortMode.TIME), lookUpMissing)
+        assert [(c.id, c.parent_ids) for c in sequence] == walkerSequence(repo, tips, sorting)
+        assert commitGraph.numLookups == 1  # the loose commit
+
+
+@requiresGit
+def testPackScanBailsOut(tempDir):
+    wd = unpackRepo(tempDir)
+    repack(wd)
+
+    with RepoContext(wd) as repo:
+        gitDir = repo.path
+    assert packscan.scanPacks(gitDir, numCommits=10) is None  # Not enough commits to pay off
+    assert packscan.scanPacks(gitDir, numWorkers=2, isCancelled=lambda: True) is None
+
+    packs = [f for f in os.listdir(f"{gitDir}/objects/pack") if f.endswith(".pack")]
+    writeFile(f"{gitDir}/objects/pack/{packs[0].removesuffix('.pack')}.promisor", "")
+    assert packscan.scanPacks(gitDir, numWorkers=2) is None  # Partial clone
+
+
+@requiresGit
+def testOpenRepoWithPackScan(tempDir, mainWindow, monkeypatch):
+    wd = unpackRepo(tempDir)
+    repack(wd)
+
+    scans = []
+
+    def spyScanPacks(*args, **kwargs):
+        commitGraph = packscan.scanPacks(*args, **kwargs)
+        if commitGraph is not None:
+            scans.append(args)
+        return commitGraph
+
+    monkeypatch.setattr(packscan, "MinCommitsPerWorker", 1)
+    monkeypatch.setattr("os.cpu_count", lambda: 2)
+    monkeypatch.setattr("gitfourchette.repomodel.scanPacks", spyScanPacks)
+    monkeypatch.setattr(RepoModel, "loadGraphCache", lambda *a: None)  # walk the history every time
+
+    # We don't know how many commits there are the first time around
+    monkeypatch.setattr(settings.prefs, "parallelPrime", True)
+    mainWindow.openRepo(wd)
+    mainWindow.closeCurrentTab()
+    assert not scans
+
+    # Off by default
+    monkeypatch.setattr(settings.prefs, "parallelPrime", False)
+    mainWindow.openRepo(wd)
+    mainWindow.closeCurrentTab()
+    assert not scans
+    monkeypatch.setattr(settings.prefs, "parallelPrime", True)
+
+    # Not worth it if we're only going to show a couple commits
+    monkeypatch.setattr(settings.prefs, "maxCommits", 1)
+    mainWindow.openRepo(wd)
+    mainWindow.closeCurrentTab()
+    assert not scans
+
+    monkeypatch.setattr(settings.prefs, "maxCommits", 0)
+    rw = mainWindow.openRepo(wd)
+    repoModel = rw.repoModel
+    assert len(scans) == 1
+    assert scans[0][1] == 20  # OID length
+    tips = list(repoModel.refs.values())
+    assert [(c.id, list(c.parent_ids)) for c in repoModel.commitSequence[1:]] == \
+           walkerSequence(rw.repo, tips, repoModel.walkerSortMode())
+
+
+@requiresGit
+@pytest.mark.parametrize("split", [False, True])
+def testChangedPathBloomFilters(tempDir, split):
+    wd = unpackRepo(tempDir)
+    writeCommitGraph(wd, "--changed-paths")
+
+    if split:
+        writeFile(f"{wd}/c/c2-2.txt", "layer 2\n")
+        with RepoContext(wd) as repo:
+            repo.index.add_all()
+            repo.create_commit_on_head("layer 2", TEST_SIGNATURE, TEST_SIGNATURE)
+        writeCommitGraph(wd, "--changed-paths", "--split=no-merge")
+
+    with RepoContext(wd) as repo:
+        commitGraph = CommitGraphFile.open(repo.path)
+        assert commitGraph.hasChangedPaths
+        assert len(commitGraph.layers) == (2 if split else 1)
+        cache = ChangedPathCache()
+        somePaths = ["a/a1.txt", "b/b1.txt", "c/c2-2.txt", "master.txt", "nope/nope.txt"]
+
+        numRejects = 0
+        for commit in repo.walk(repo.head_commit_id):
+            pos = commitGraph.find(commit.id)
+            assert pos >= 0
+            changedPaths = cache.changedPaths(repo, commit.id)
+            # No false negatives, including leading directories
+            for path in changedPaths:
+                assert commitGraph.mayChangePaths(pos, [path]) is not False
+            numRejects += sum(commitGraph.mayChangePaths(pos, [path]) is False for path in somePaths)
+
+        assert numRejects > 0
+
+
+@pytest.mark.parametrize("bloom", [False, pytest.param(True, marks=requiresGit)])
+def testPathHistory(tempDir, mainWindow, bloom):
+    wd = unpackRepo(tempDir)
+    if bloom:
+        writeCommitGraph(wd, "--changed-paths")
+
+    rw = mainWindow.openRepo(wd)
+    numRows = rw.graphView.clModel.rowCount()
+    assert rw.pathHistoryBanner.isHidden()
+
+    oid = Oid(hex="c9ed7bf12c73de26422b7c5a44d74cfce5a8993b")
+    rw.jump(NavLocator.inCommit(oid, "c/c2-2.txt"), check=True)
+    triggerMenuAction(rw.committedFiles.makeContextMenu(), "history")
+
+    pathHistory = rw.repoModel.pathHistory
+    assert pathHistory.paths == ["c/c2-2.txt"]
+    assert (pathHistory.numBloomRejects > 0) == bloom
+    assert rw.navLocator.commit == oid
+    assert rw.pathHistoryBanner.isVisible()
+    assert "c2-2.txt" in rw.pathHistoryBanner.label.text()
+    assert qlvGetRowData(rw.graphView, CommitLogModel.Role.Oid)[1:] == [
+        oid, Oid(hex="ce112d052bcf42442aa8563f1e2b7a8aabbf4d17")]
+
+    # Commits outside the path history can't be selected
+    with pytest.raises(GraphView.SelectCommitError, match="files whose history"):
+        rw.graphView.getFilterIndexForCommit(Oid(hex="49322bb17d3acc9146f98c97d078513228bbf3c0"))
+
+    # New commits that touch the path show up after a refresh
+    writeFile(f"{wd}/c/c2-2.txt", "revived\n")
+    writeFile(f"{wd}/master.txt", "unrelated\n")
+    with RepoContext(wd) as repo:
+        repo.index.add("c/c2-2.txt")
+        newOid = repo.create_commit_on_head("Revive c2-2", TEST_SIGNATURE, TEST_SIGNATURE)
+    rw.refreshRepo()
+    assert rw.repoModel.pathHistory is not None
+    assert qlvGetRowData(rw.graphView, CommitLogModel.Role.Oid)[1:] == [
+        newOid, oid, Oid(hex="ce112d052bcf42442aa8563f1e2b7a8aabbf4d17")]
+
+    # Back to the full commit log
+    rw.pathHistoryBanner.buttons[-1].click()
+    assert rw.repoModel.pathHistory is None
+    assert rw.pathHistoryBanner.isHidden()
+    assert rw.graphView.clModel.rowCount() == numRows + 1
+
+
+def testPathHistoryWhileGraphIsBuilding(tempDir, mainWindow, monkeypatch, qtbot):
+    from gitfourchette.tasks import PrimeRepo, GraphBuildThread, ShowPathHistory
+    from gitfourchette.tasks.loadtasks import GraphBuildJob
+    monkeypatch.setattr(PrimeRepo, "FirstBatchSize", 3)
+    monkeypatch.setattr(GraphBuildThread, "BatchSize", 2)
+
+    # Hold the build thread back until we've asked for the path history
+    gate = threading.Event()
+    originalStep = GraphBuildJob.step
+
+    def gatedStep(job, batchSize):
+        if threading.current_thread() is not threading.main_thread():
+            assert gate.wait(timeout=10)
+        originalStep(job, batchSize)
+
+    monkeypatch.setattr(GraphBuildJob, "step", gatedStep)
+
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    graphBuild = rw.graphBuild
+    assert not graphBuild.wrappedUp
+
+    # The task mustn't wait for the graph on the UI thread
+    ShowPathHistory.invoke(rw, ["c/c2-2.txt"])
+    assert rw.repoModel.pathHistory is None
+    assert not rw.repoTaskRunner.isBusy()
+
+    # The path history shows up once the graph is complete
+    gate.set()
+    qtbot.waitUntil(lambda: rw.repoModel.pathHistory is not None)
+    assert graphBuild.wrappedUp
+    assert not rw.repoModel.pathHistory.truncated
+    assert qlvGetRowData(rw.graphView, CommitLogModel.Role.Oid)[1:] == [
+        Oid(hex="c9ed7bf12c73de26422b7c5a44d74cfce5a8993b"), Oid(hex="ce112d052bcf42442aa8563f1e2b7a8aabbf4d17")]
+
+
+def testPathHistoryInTruncatedHistory(tempDir, mainWindow, monkeypatch, qtbot):
+    from gitfourchette.tasks import ShowPathHistory
+    monkeypatch.setattr(settings.prefs, "maxCommits", 2)
+
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    rw.graphBuild.join()
+    assert rw.repoModel.truncatedHistory
+
+    # Tell the user that older commits weren't searched
+    ShowPathHistory.invoke(rw, ["c/c2-2.txt"])
+    assert rw.repoModel.pathHistory.truncated
+    assert "2 most recent commits" in rw.pathHistoryBanner.label.text()
+    assert rw.pathHistoryBanner.buttons[-2].text() == "Search Entire History"
+
+    # Load the rest of the history and search all of it
+    rw.pathHistoryBanner.buttons[-2].click()
+    qtbot.waitUntil(lambda: rw.repoModel.pathHistory is not None and not rw.repoModel.pathHistory.truncated)
+    assert not rw.repoModel.truncatedHistory
+    assert "most recent" not in rw.pathHistoryBanner.label.text()
+    assert qlvGetRowData(rw.graphView, CommitLogModel.Role.Oid)[1:] == [
+        Oid(hex="c9ed7bf12c73de26422b7c5a44d74cfce5a8993b"), Oid(hex="ce112d052bcf42442aa8563f1e2b7a8aabbf4d17")]
@@ -0,0 +1,107 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+import threading
+
+import pytest
+
+from gitfourchette.commitsequence import CommitSequence
+from gitfourchette.graph import MockCommit
+from .util import *
+
+
+def rowData(sequence):
+    return [(c.id, list(c.parent_ids)) for c in sequence]
+
+
+def testCommitSequenceMatchesWalker(tempDir):
+    wd = unpackRepo(tempDir)
+    with RepoContext(wd) as repo:
+        commits = list(repo.walk(repo.head_commit_id, SortMode.TOPOLOGICAL))
+        uc = MockCommit("UC_FAKEID", [repo.head_commit_id])
+
+        sequence = CommitSequence.fromCommits(repo, [uc] + commits)
+        assert len(sequence) == len(commits) + 1
+        assert sequence[0] is uc
+        assert sequence.isMock(0)
+        assert sequence.oidAt(0) == "UC_FAKEID"
+        assert rowData(sequence[1:]) == rowData(commits)
+        assert sequence[-1].id == commits[-1].id
+
+        # Log columns were filled in from the walker's commits
+        assert sequence.authorTimeAt(1) == commits[0].author.time
+        assert sequence.authorNameAt(1) == commits[0].author.name
+
+        # Slicing and concatenating (as GraphSpliceLoop does)
+        spliced = commits[:3] + sequence[5:]
+        assert type(spliced) is CommitSequence
+        assert rowData(spliced) == rowData(commits[:3] + commits[4:])
+        assert spliced.names is sequence.names
+        assert spliced.authorNameAt(2) == commits[2].author.name
+
+
+def testCommitSequenceMaterializesLazily(tempDir):
+    wd = unpackRepo(tempDir)
+    with RepoContext(wd) as repo:
+        commits = [MockCommit(c.id, c.parent_ids) for c in repo.walk(repo.head_commit_id, SortMode.TOPOLOGICAL)]
+        sequence = CommitSequence.fromCommits(repo, commits)
+
+        # Nothing is known beyond the graph yet
+        assert all(t == -1 for t in sequence.authorTimes)
+
+        row = sequence[2]
+        assert row.message == repo[commits[2].id].message
+        assert sequence.authorTimes[2] == repo[commits[2].id].author.time
+
+        # Materialized commits are kept in a bounded cache
+        sequence.CommitCacheSize = 3
+        for i in range(len(sequence)):
+            sequence.commitAt(i)
+        assert len(sequence._commitCache) <= 3
+
+
+def testCommitSequenceFillsColumnsWhileAppending(tempDir):
+    wd = unpackRepo(tempDir)
+    with RepoContext(wd) as repo:
+        commits = list(repo.walk(repo.head_commit_id, SortMode.TOPOLOGICAL))
+        mocks = [MockCommit(c.id, c.parent_ids) for c in commits]
+        sequence = CommitSequence.fromCommits(repo, mocks)
+
+        # A background thread appends full commits (interning their author names)
+        # while this thread fills in the log columns of the first rows
+        def appendRows():
+            for _i in range(50):
+                sequence.extend(commits)
+
+        thread = threading.Thread(target=appendRows)
+        thread.start()
+        for _i in range(50):
+            for row in range(len(mocks)):
+                sequence.commitAt(row)
+        thread.join()
+
+        assert len(sequence.names) == len(set(sequence.names))
+        for row in range(len(sequence)):
+            assert sequence.authorNameAt(row) == commits[row % len(commits)].author.name
+
+
+def testCommitSequenceOidLengthComesFromRepo(tempDir):
+    wd = unpackRepo(tempDir)
+    with RepoContext(wd) as repo:
+        commits = list(repo.walk(repo.head_commit_id, SortMode.TOPOLOGICAL))
+        sequence = CommitSequence.fromCommits(repo, commits)
+        assert sequence.oidLength == repo.oid_length == 20
+        assert sequence[1:].oidLength == 20
+
+    # A SHA-256 repo's column would be 32 bytes wide; SHA-1 oids mustn't be packed into it
+    class Sha256Repo:
+        oid_length = 32
+
+    sequence = CommitSequence(Sha256Repo())
+    sequence.append(MockCommit("UC_FAKEID", []))
+    assert len(sequence.oids) == 32
+    with pytest.raises(AssertionError):
+        sequence.append(commits[0])
@@ -4,10 +4,16 @@
 # For full terms, see the included LICENSE file.
 # -----------------------------------------------------------------------------
 
+from dataclasses import fields
+
 import pytest
 
+from gitfourchette.diffview import diffdocument, intraline
+from gitfourchette.diffview.diffdocument import DiffDocument
 from gitfourchette.diffview.diffview import DiffView
-from gitfourchette.nav import NavLocator
+from gitfourchette.diffview.virtualdiffdocument import VirtualDiffDocument
+from gitfourchette.nav import NavLocator, NavFlags
+from gitfourchette.subpatch import DiffLinePos
 from .util import *
 
 
@@ -391,6 +397,125 @@ def testDiffStrayLineEndings(tempDir, mainWindow):
     )
 
 
+def testDiffDocumentCache(tempDir, mainWindow):
+    wd = unpackRepo(tempDir)
+    writeFile(f"{wd}/a/a1.txt", "a1\nchanged\n")
+    writeFile(f"{wd}/b/b1.txt", "b1\nchanged\n")
+    rw = mainWindow.openRepo(wd)
+    cache = rw.repoModel.diffDocumentCache
+
+    def stats():
+        return cache.hits, cache.misses, len(cache.entries)
+
+    rw.jump(NavLocator.inUnstaged("a/a1.txt"))
+    rw.jump(NavLocator.inUnstaged("b/b1.txt"))
+    hits, misses, entries = stats()
+    assert entries == 2
+
+    # Going back reuses the layout
+    rw.navigateBack()
+    assert rw.navLocator.path == "a/a1.txt"
+    assert stats() == (hits + 1, misses, 2)
+    assert "changed" in rw.diffView.toPlainText()
+
+    # Cached layouts don't keep any pygit2 objects (or the patches behind them) alive
+    lineData = [ld for document, _size in cache.entries.values() for ld in document.lineData]
+    assert [(ld.origin, ld.oldLineNo, ld.newLineNo) for ld in lineData[:4]] == [("@", -1, -1), (" ", 1, 1), ("-", 2, -1), ("+", -1, 2)]
+    assert all(type(value) in (str, int, DiffLinePos) for ld in lineData for value in (getattr(ld, f.name) for f in fields(ld)))
+
+    # Modified file on disk
+    writeFile(f"{wd}/a/a1.txt", "a1\nchanged again\n")
+    rw.jump(NavLocator.inUnstaged("a/a1.txt").withExtraFlags(NavFlags.ForceDiff))
+    assert stats() == (hits + 1, misses + 1, 3)
+    assert "changed again" in rw.diffView.toPlainText()
+
+    # Changing prefs empties the cache
+    dlg = mainWindow.openPrefsDialog("showStrayCRs")
+    dlg.findChild(QCheckBox, "prefctl_showStrayCRs").setChecked(False)
+    dlg.accept()
+    assert len(cache.entries) == 1  # just the diff that was reloaded
+
+
+def testDiffDocumentLayoutMatchesQTextDocument(tempDir, mainWindow):
+    wd = unpackRepo(tempDir)
+    with RepoContext(wd) as repo:
+        writeFile(f"{wd}/cats.txt", "🐈 cat\nsame\n")
+        repo.index.add("cats.txt")
+        repo.create_commit_on_head("cats", TEST_SIGNATURE, TEST_SIGNATURE)
+    writeFile(f"{wd}/cats.txt", "🐈 dog\nsame\n🦆 quack\r\nbye")
+
+    rw = mainWindow.openRepo(wd)
+    rw.jump(NavLocator.inUnstaged(path="cats.txt"))
+    assert rw.diffView.isVisibleTo(rw)
+    assert rw.diffView.toPlainText().lower() == (
+        "@@ -1,2 +1,4 @@\n"
+        "🐈 cat\n"
+        "🐈 dog\n"
+        "same\n"
+        "🦆 quack<crlf>\n"
+        "bye<no newline at end of file>"
+    )
+
+    # Positions computed off the UI thread must match the actual document (in UTF-16 code units)
+    document = rw.diffView.document()
+    lineData = rw.diffView.lineData
+    assert len(lineData) == document.blockCount()
+    for i, ld in enumerate(lineData):
+        block = document.findBlockByNumber(i)
+        assert ld.cursorStart == block.position()
+        assert ld.cursorEnd == block.position() + block.length() - 1
+
+    # Intra-line differences must be emphasized past the non-BMP character
+    def emphasizedText(blockNumber):
+        block = document.findBlockByNumber(blockNumber)
+        it = block.begin()
+        fragments = []
+        while not it.atEnd():
+            fragment = it.fragment()
+            if fragment.charFormat().hasProperty(QTextFormat.Property.BackgroundBrush):
+                fragments.append(fragment.text())
+            it += 1
+        return fragments
+
+    assert emphasizedText(1) == ["cat"]
+    assert emphasizedText(2) == ["dog"]
+    assert emphasizedText(3) == []
+
+
+def testIntraLineDifferences(tempDir, mainWindow, monkeypatch):
+    wd = unpackRepo(tempDir)
+    with RepoContext(wd) as repo:
+        writeFile(f"{wd}/words.txt", "a1\na1\nsame\n")
+        repo.index.add("words.txt")
+        repo.create_commit_on_head("words", TEST_SIGNATURE, TEST_SIGNATURE)
+    writeFile(f"{wd}/words.txt", "a1 = foo\nb1\nsame\n")
+
+    rw = mainWindow.openRepo(wd)
+    locator = NavLocator.inUnstaged("words.txt")
+    patch = rw.dirtyFiles.getPatchForFile(locator.path)
+
+    def emphasizedText():
+        document = DiffDocument.fromPatch(patch, locator)
+        return [document.text[start:end] for start, end, _origin in document.emphasisSpans]
+
+    # Differences are word by word
+    assert emphasizedText() == ["a1", " = foo", "b1"]
+
+    # Give up on lines that are too long
+    intraline.clearCache()
+    monkeypatch.setattr(intraline, "MAX_TOKENS", 2)
+    assert emphasizedText() == ["a1", "b1"]
+
+    # Give up when out of time, regardless of cached results
+    intraline.clearCache()
+    monkeypatch.setattr(intraline, "MAX_TOKENS", 500)
+    assert emphasizedText() == ["a1", " = foo", "b1"]
+    monkeypatch.setattr(diffdocument, "INTRALINE_WORK_BUDGET", 1)
+    assert emphasizedText() == [" = foo"]
+    monkeypatch.setattr(diffdocument, "INTRALINE_WORK_BUDGET", 0)
+    assert emphasizedText() == []
+
+
 def testDiffBinaryWarning(tempDir, mainWindow):
     wd = unpackRepo(tempDir)
 
@@ -412,15 +537,16 @@ def testDiffVeryLongLines(tempDir, mainWindow):
     rw = mainWindow.openRepo(wd)
     rw.jump(NavLocator.inUnstaged(path="longlines.txt"))
     assert not rw.diffView.isVisibleTo(rw)
-    assert rw.specialDiffView.isVisibleTo(rw)
-    assert "long lines" in rw.specialDiffView.toPlainText().lower()
+    assert rw.virtualDiffView.isVisibleTo(rw)
+    document = rw.virtualDiffView.document
+    assert [document.rowText(row) for row in range(len(document))] == ["@@ -0,0 +1 @@", contents.rstrip()]
 
-    qteClickLink(rw.specialDiffView, "load.+anyway")
+    rw.virtualDiffView.loadFormattedDiff()
     assert rw.diffView.isVisibleTo(rw)
     assert rw.diffView.toPlainText().rstrip() == "@@ -0,0 +1 @@\n" + contents.rstrip()
 
 
-def testDiffLargeFile(tempDir, mainWindow):
+def testDiffLargeFile(tempDir, mainWindow, qtbot):
     wd = unpackRepo(tempDir)
 
     # About one megabyte
@@ -430,14 +556,150 @@ def testDiffLargeFile(tempDir, mainWindow):
     rw = mainWindow.openRepo(wd)
     rw.jump(NavLocator.inUnstaged(path="bigfile.txt"))
     assert not rw.diffView.isVisible()
-    assert rw.specialDiffView.isVisible()
-    assert "too large to be previewed" in rw.specialDiffView.toPlainText().lower()
+    assert rw.virtualDiffView.isVisible()
+    assert "+100000" in rw.diffArea.diffHeader.text()
 
-    qteClickLink(rw.specialDiffView, "load.+anyway")
+    document = rw.virtualDiffView.document
+    qtbot.waitUntil(document.isComplete)
+    assert len(document) == 100_001
+    assert document.rowText(0) == "@@ -0,0 +1,100000 @@"
+    assert document.rowText(100_000) == f"{99_999:08x}."
+    assert list(document.lineNumbers(99_998, 100_001)) == [(-1, 99_998), (-1, 99_999), (-1, 100_000)]
+
+    rw.virtualDiffView.loadFormattedDiff()
     assert rw.diffView.isVisible()
     assert rw.diffView.toPlainText().rstrip() == "@@ -0,0 +1,100000 @@\n" + contents.rstrip()
 
 
+def testVirtualDiffViewIndexesInChunks(tempDir, mainWindow, qtbot, monkeypatch):
+    wd = unpackRepo(tempDir)
+    mainWindow.onAcceptPrefsDialog({"largeFileThresholdKB": 1})
+    monkeypatch.setattr(VirtualDiffDocument, "ChunkSize", 4096)
+
+    writeFile(f"{wd}/bigfile.txt", "".join(f"{i:08x}\n" for i in range(10_000)))
+    rw = mainWindow.openRepo(wd)
+    rw.jump(NavLocator.inUnstaged(path="bigfile.txt"))
+
+    # The top of the diff is shown before the rest of it is indexed
+    vdv = rw.virtualDiffView
+    document = vdv.document
+    assert vdv.isVisible()
+    assert not document.isComplete()
+    assert vdv.visibleRowCount() < len(document) < 10_001
+    assert document.rowText(1) == "00000000"
+    assert vdv.progressBar.isVisible()
+
+    # Selecting the hunk doesn't wait for the rest of it; the selection grows as rows are indexed
+    assert document.hunkRange(0) == (0, len(document) - 1)
+    vdv.selectClumpOfLinesAt(0)
+    assert not document.isComplete()
+    assert vdv.getSelectedLineExtents() == (0, len(document) - 1)
+
+    qtbot.waitUntil(document.isComplete)
+    assert not vdv.progressBar.isVisible()
+    assert len(document) == 10_001
+    assert document.hunkRange(0) == (0, 10_000)
+    assert vdv.getSelectedLineExtents() == (0, 10_000)
+    assert list(document.lineNumbers(9_999, 10_001)) == [(-1, 9_999), (-1, 10_000)]
+
+    # Going to the end indexes the rest of the diff right away
+    vdv.selectRows(0, 0)
+    rw.jump(NavLocator.inUnstaged(path="bigfile.txt").withExtraFlags(NavFlags.ForceRecreateDocument))
+    document = vdv.document
+    assert not document.isComplete()
+    vdv.setFocus()
+    QTest.keyClick(vdv, Qt.Key.Key_End)
+    assert document.isComplete()
+    assert vdv.cursorRow == 10_000
+    assert document.rowText(vdv.cursorRow) == f"{9_999:08x}"
+
+
+@pytest.mark.parametrize("method", ["key", "menu"])
+def testVirtualDiffViewStageLines(tempDir, mainWindow, method):
+    wd = unpackRepo(tempDir)
+    mainWindow.onAcceptPrefsDialog({"largeFileThresholdKB": 1})
+
+    lines = [f"line {i}\n" for i in range(200)]
+    writeFile(f"{wd}/a/a1.txt", "".join(lines))
+    rw = mainWindow.openRepo(wd)
+    rw.jump(NavLocator.inUnstaged("a/a1.txt"))
+
+    vdv = rw.virtualDiffView
+    assert vdv.isVisibleTo(rw)
+    assert vdv.document.origin(0) == "@"
+
+    # Click row 0 (hunk header): nothing to stage there
+    vdv.setFocus()
+    QTest.mouseClick(vdv.viewport(), Qt.MouseButton.LeftButton, pos=QPoint(50, vdv.rowHeight() // 2))
+    assert vdv.getSelectedLineExtents() == (0, 0)
+    assert not vdv.isSelectionActionable()
+
+    # Select the first 2 new lines, below the 2 deleted "a1" lines
+    vdv.selectRows(3, 3)
+    QTest.keyClick(vdv, Qt.Key.Key_Down, Qt.KeyboardModifier.ShiftModifier)
+    assert vdv.getSelectedLineExtents() == (3, 4)
+    assert [vdv.document.rowText(row) for row in (3, 4)] == ["line 0", "line 1"]
+
+    if method == "key":
+        QTest.keyPress(vdv, Qt.Key.Key_Return)
+    else:
+        menu = vdv.contextMenu(vdv.viewport().mapToGlobal(QPoint(50, vdv.rowHeight() * 3)))
+        triggerMenuAction(menu, "stage lines")
+
+    stagedBlob = rw.repo.peel_blob(rw.repo.index["a/a1.txt"].id)
+    assert stagedBlob.data == b"a1\na1\nline 0\nline 1\n"
+
+
+def testVirtualDiffViewSearch(tempDir, mainWindow):
+    wd = unpackRepo(tempDir)
+    mainWindow.onAcceptPrefsDialog({"largeFileThresholdKB": 1})
+
+    writeFile(f"{wd}/a/a1.txt", "".join(f"line {i}\n" for i in range(200)) + "Needle\n")
+    rw = mainWindow.openRepo(wd)
+    rw.jump(NavLocator.inUnstaged("a/a1.txt"))
+
+    vdv = rw.virtualDiffView
+    vdv.setFocus()
+    QTest.qWait(1)
+    QTest.keySequence(vdv, "Ctrl+F")
+    assert vdv.searchBar.isVisibleTo(rw)
+
+    QTest.keyClicks(vdv.searchBar.lineEdit, "needle")
+    vdv.searchBar.ui.forwardButton.click()
+    assert vdv.document.rowText(vdv.cursorRow) == "Needle"
+    assert vdv.verticalScrollBar().value() > 0
+
+    vdv.searchBar.ui.forwardButton.click()
+    acceptQMessageBox(rw, "no more occurrences")
+    assert vdv.document.rowText(vdv.cursorRow) == "Needle"
+
+
+def testVirtualDiffDocumentColumnsAndSearch():
+    longLine = "x" * 100_000 + "\tÉTÉ"
+    data = ("@@ -1,2 +1,2 @@\n-abc\n+\tdef\r\n+" + longLine + "\n").encode("utf-8")
+    document = VirtualDiffDocument(data, 0, 2, 1)
+    document.indexAll()
+
+    assert document.rowColumns(1, 0, 10, 4) == ("abc", 3)
+    assert document.rowColumns(2, 0, 10, 4) == ("    def", 7)
+    assert document.rowColumns(2, 5, 10, 4) == ("ef", 7)
+
+    # Only the visible columns of a long row are decoded, but its width is still known
+    text, width = document.rowColumns(3, 0, 10, 4)
+    assert text == "x" * 10
+    assert width >= 100_000
+    assert document.rowColumns(3, 99_998, 10, 4)[0] == "xx    ÉTÉ"
+
+    # Non-ASCII letters are found regardless of case
+    assert document.find("été", 0) == 3
+    assert document.find("ÉTÉ", 0) == 3
+    assert document.find("été", 4, backward=True) == 3
+    assert document.find("DEF", 0) == 2
+    assert document.find("ete", 0) == -1
+    assert document.find("ete", 4, backward=True) == -1
+    assert document.find("été", 3, backward=True) == -1
+
+
 def testDiffImage(tempDir, mainWindow):
     wd = unpackRepo(tempDir)
     shutil.copyfile(getTestDataPath("image1.png"), f"{wd}/image.png")
@@ -465,6 +727,45 @@ def testDiffImage(tempDir, mainWindow):
     assert re.search("6.6 pixels", rw.specialDiffView.toPlainText())
 
 
+def testDiffImageScaledDown(tempDir, mainWindow):
+    wd = unpackRepo(tempDir)
+    bigImage = QImage(4000, 3000, QImage.Format.Format_RGB32)
+    bigImage.fill(Qt.GlobalColor.darkCyan)
+    assert bigImage.save(f"{wd}/image.png")
+
+    rw = mainWindow.openRepo(wd)
+    rw.jump(NavLocator.inUnstaged("image.png"))
+    assert rw.specialDiffView.isVisibleTo(rw)
+    assert re.search("4000.3000 pixels", rw.specialDiffView.toPlainText())
+    assert "scaled down" in rw.specialDiffView.toPlainText().lower()
+    image = rw.specialDiffView.document().resource(QTextDocument.ResourceType.ImageResource, QUrl("image"))
+    assert image.width() < 4000
+    assert image.width() * 3 == image.height() * 4
+
+    qteClickLink(rw.specialDiffView, "full resolution")
+    assert re.search("4000.3000 pixels", rw.specialDiffView.toPlainText())
+    assert "scaled down" not in rw.specialDiffView.toPlainText().lower()
+    image = rw.specialDiffView.document().resource(QTextDocument.ResourceType.ImageResource, QUrl("image"))
+    assert image.width() == 4000
+
+    # Staged images are decoded from blobs, so they're cached
+    cache = rw.repoModel.diffImageCache
+    assert not cache.entries
+    rw.diffArea.dirtyFiles.stage()
+    rw.jump(NavLocator.inStaged("image.png"))
+    assert "scaled down" in rw.specialDiffView.toPlainText().lower()
+    assert len(cache.entries) == 1
+
+    # Same blob once committed
+    hits = cache.hits
+    rw.diffArea.commitButton.click()
+    findQDialog(rw, "commit").ui.summaryEditor.setText("commit a large image")
+    findQDialog(rw, "commit").accept()
+    rw.jump(NavLocator.inCommit(rw.repo.head_commit_id, "image.png"))
+    assert "scaled down" in rw.specialDiffView.toPlainText().lower()
+    assert cache.hits == hits + 1
+
+
 def testDiffLargeImage(tempDir, mainWindow):
     wd = unpackRepo(tempDir)
     shutil.copyfile(getTestDataPath("image1.png"), f"{wd}/image.png")
@@ -4,8 +4,13 @@
 # For full terms, see the included LICENSE file.
 # -----------------------------------------------------------------------------
 
+import os
+import sys
+
 import pytest
 
+from gitfourchette.repowatcher import RepoWatcher
+from gitfourchette.tasks import TaskEffects
 from .util import *
 
 
@@ -124,3 +129,56 @@ def testExternalChangeWhileTaskIsBusyThenAborts(tempDir, mainWindow):
 
     # Even though the task aborts, the repo should auto-refresh
     assert qlvGetRowData(rw.dirtyFiles) == ["sneaky.txt"]
+
+
+@pytest.mark.parametrize("inotify", [
+    pytest.param(True, marks=pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux only")),
+    False,
+])
+def testRepoWatcher(tempDir, mainWindow, qtbot, monkeypatch, inotify):
+    monkeypatch.setattr(RepoWatcher, "Disabled", False)
+    monkeypatch.setattr(RepoWatcher, "Delay", 10)
+    if not inotify:
+        monkeypatch.setattr("gitfourchette.repowatcher._loadLibc", lambda: None)
+
+    wd = unpackRepo(tempDir)
+    writeFile(f"{wd}/.gitignore", "*.o\n")
+    rw = mainWindow.openRepo(wd)
+    assert (rw.repoWatcher.inotifyFd >= 0) == inotify
+    assert qlvGetRowData(rw.dirtyFiles) == [".gitignore"]
+
+    reports = []
+    rw.repoWatcher.changed.connect(lambda effects, paths: reports.append((effects, paths)))
+
+    # Changes to ignored files are not reported
+    writeFile(f"{wd}/a/junk.o", "junk")
+    writeFile(f"{wd}/a/new.txt", "new file\n")
+    qtbot.waitUntil(lambda: qlvGetRowData(rw.dirtyFiles) == [".gitignore", "a/new.txt"])
+    assert reports[0] == (TaskEffects.Workdir, {"a/new.txt"} if inotify else {"a"})
+
+    # New directories are watched too
+    os.mkdir(f"{wd}/newdir")
+    qtbot.waitUntil(lambda: "newdir" in {rel for _inGitDir, rel in rw.repoWatcher.watches.values()})
+    writeFile(f"{wd}/newdir/hello.txt", "hello\n")
+    qtbot.waitUntil(lambda: "newdir/hello.txt" in qlvGetRowData(rw.dirtyFiles))
+
+    if inotify:
+        # Modifications to existing files (QFileSystemWatcher can't see those)
+        writeFile(f"{wd}/master.txt", "modified\n")
+        qtbot.waitUntil(lambda: "master.txt" in qlvGetRowData(rw.dirtyFiles))
+
+    # Refs created by another program
+    with RepoContext(wd) as repo2:
+        repo2.create_branch_on_head("made-elsewhere")
+    qtbot.waitUntil(lambda: "refs/heads/made-elsewhere" in rw.repoModel.refs)
+
+    # Our own index writes don't cause another refresh
+    reports.clear()
+    qlvClickNthRow(rw.dirtyFiles, 0)
+    QTest.keyPress(rw.dirtyFiles, Qt.Key.Key_Return)
+    assert ".gitignore" in qlvGetRowData(rw.stagedFiles)
+    QTest.qWait(100)
+    assert not reports
+
+    rw.cleanup()
+    assert rw.repoWatcher is None
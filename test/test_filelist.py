@@ -5,12 +5,17 @@
 # -----------------------------------------------------------------------------
 
 import os.path
+import sys
+import threading
 
 import pytest
 
 from .util import *
 from . import reposcenario
 from gitfourchette.nav import NavLocator, NavContext
+from gitfourchette.repowatcher import RepoWatcher
+from gitfourchette.tasks import LoadWorkdir
+from gitfourchette.porcelain import UntrackedCache
 
 
 def testParentlessCommitFileList(tempDir, mainWindow):
@@ -390,3 +395,249 @@ def testGrayOutStageButtonsAfterDiscardingOnlyFile(tempDir, mainWindow):
     assert not rw.diffArea.stageButton.isEnabled()
     assert not rw.diffArea.discardButton.isEnabled()
     assert not rw.diffArea.unstageButton.isEnabled()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs inotify")
+def testIncrementalWorkdirReload(tempDir, mainWindow, qtbot, monkeypatch):
+    # Partial reloads rely on the RepoWatcher to report changes made by other programs
+    monkeypatch.setattr(RepoWatcher, "Disabled", False)
+    monkeypatch.setattr(RepoWatcher, "Delay", 10)
+
+    wd = unpackRepo(tempDir)
+    writeFile(f"{wd}/master.txt", "modified\n")
+    writeFile(f"{wd}/a/new.txt", "new\n")
+    writeFile(f"{wd}/b/b1.txt", "modified\n")
+    os.rename(f"{wd}/c/c1.txt", f"{wd}/c/renamed.txt")
+    rw = mainWindow.openRepo(wd)
+
+    numUpdates = 0
+    numResets = 0
+
+    def countUpdates(*args):
+        nonlocal numUpdates
+        numUpdates += 1
+        return updateDiffs(*args)
+
+    def countResets(*args):
+        nonlocal numResets
+        numResets += 1
+        return setDiffs(*args)
+
+    updateDiffs = rw.stagedFiles.flModel.updateDiffs
+    setDiffs = rw.stagedFiles.flModel.setDiffs
+    rw.stagedFiles.flModel.updateDiffs = countUpdates
+    rw.stagedFiles.flModel.setDiffs = countResets
+
+    def listEntries(view):
+        return [(entry.canonicalPath, entry.delta.status) for entry in view.flModel.entries]
+
+    def assertSameAsFullReload():
+        assert rw.repoModel.workdirDirtyPaths == set()
+        incremental = listEntries(rw.dirtyFiles), listEntries(rw.stagedFiles)
+        rw.refreshRepo()  # The index may have changed, so this reloads everything
+        assert incremental == (listEntries(rw.dirtyFiles), listEntries(rw.stagedFiles))
+
+    def stage(path):
+        qlvClickNthRow(rw.dirtyFiles, qlvGetRowData(rw.dirtyFiles).index(path))
+        QTest.keyPress(rw.dirtyFiles, Qt.Key.Key_Return)
+
+    def unstage(path):
+        qlvClickNthRow(rw.stagedFiles, qlvGetRowData(rw.stagedFiles).index(path))
+        QTest.keyPress(rw.stagedFiles, Qt.Key.Key_Delete)
+
+    # Modified files are reloaded incrementally
+    stage("master.txt")
+    stage("b/b1.txt")
+    assert qlvGetRowData(rw.stagedFiles) == ["b/b1.txt", "master.txt"]
+    assert (numUpdates, numResets) == (2, 0)
+    assertSameAsFullReload()
+
+    unstage("master.txt")
+    assert qlvGetRowData(rw.stagedFiles) == ["b/b1.txt"]
+    assert "master.txt" in qlvGetRowData(rw.dirtyFiles)
+    assertSameAsFullReload()
+
+    # Changes made by other programs are picked up incrementally too
+    numUpdates = numResets = 0
+    writeFile(f"{wd}/a/new2.txt", "new\n")
+    writeFile(f"{wd}/b/b1.txt", "modified again\n")
+    qtbot.waitUntil(lambda: "a/new2.txt" in qlvGetRowData(rw.dirtyFiles))
+    qtbot.waitUntil(lambda: "b/b1.txt" in qlvGetRowData(rw.dirtyFiles))
+    assert numResets == 0
+    assertSameAsFullReload()
+
+    # Rename detection needs the full staged diff
+    numUpdates = numResets = 0
+    stage("c/c1.txt")
+    stage("c/renamed.txt")
+    assert numResets == 2
+    assert listEntries(rw.stagedFiles)[-1] == ("c/renamed.txt", DeltaStatus.RENAMED)
+    assertSameAsFullReload()
+
+    numUpdates = numResets = 0
+    unstage("c/renamed.txt")
+    assert numResets == 1
+    assert listEntries(rw.stagedFiles)[-1] == ("c/c1.txt", DeltaStatus.DELETED)
+    assertSameAsFullReload()
+
+
+def testWorkdirReloadWithoutPathLimitedDiffs(tempDir, mainWindow, monkeypatch):
+    # Pretend that this version of pygit2 can't be trusted with path-limited diffs
+    from gitfourchette import porcelain
+    from gitfourchette.tasks import loadtasks
+    monkeypatch.setattr(porcelain, "PATH_LIMITED_DIFFS", False)
+    monkeypatch.setattr(loadtasks, "PATH_LIMITED_DIFFS", False)
+
+    wd = unpackRepo(tempDir)
+    writeFile(f"{wd}/master.txt", "modified\n")
+    writeFile(f"{wd}/a/new.txt", "new\n")
+    rw = mainWindow.openRepo(wd)
+
+    # The paths are ignored, the diffs are complete
+    assert not UntrackedCache.is_enabled(rw.repo)
+    assert [d.new_file.path for d in rw.repo.get_unstaged_changes(paths=["master.txt"]).deltas] == [
+        "a/new.txt", "master.txt"]
+
+    qlvClickNthRow(rw.dirtyFiles, 1)
+    QTest.keyPress(rw.dirtyFiles, Qt.Key.Key_Return)
+    assert qlvGetRowData(rw.dirtyFiles) == ["a/new.txt"]
+    assert qlvGetRowData(rw.stagedFiles) == ["master.txt"]
+
+
+@pytest.mark.parametrize("parallel", [True, False])
+def testLoadWorkdirStagedAndUnstagedInParallel(tempDir, mainWindow, monkeypatch, parallel):
+    monkeypatch.setattr(LoadWorkdir, "Parallel", parallel)
+
+    wd = unpackRepo(tempDir)
+    writeFile(f"{wd}/master.txt", "modified\n")
+    writeFile(f"{wd}/a/new.txt", "new\n")
+    with RepoContext(wd, write_index=True) as repo2:
+        repo2.index.add("a/new.txt")
+    writeFile(f"{wd}/b/b1.txt", "modified\n")
+
+    rw = mainWindow.openRepo(wd)
+    assert qlvGetRowData(rw.dirtyFiles) == ["b/b1.txt", "master.txt"]
+    assert qlvGetRowData(rw.stagedFiles) == ["a/new.txt"]
+    assert (rw.repoModel.auxRepo is not None) == parallel
+
+    qlvClickNthRow(rw.dirtyFiles, 1)
+    QTest.keyPress(rw.dirtyFiles, Qt.Key.Key_Return)
+    assert qlvGetRowData(rw.dirtyFiles) == ["b/b1.txt"]
+    assert qlvGetRowData(rw.stagedFiles) == ["a/new.txt", "master.txt"]
+
+
+def testUntrackedCache(tempDir, mainWindow, monkeypatch):
+    monkeypatch.setattr(UntrackedCache, "RACY_NS", 0)
+
+    wd = unpackRepo(tempDir)
+    writeFile(f"{wd}/.gitignore", "*.o\n")
+    writeFile(f"{wd}/build/x/1.txt", "1\n")
+    writeFile(f"{wd}/build/x/2.o", "junk\n")
+    writeFile(f"{wd}/build2.txt", "not in build\n")
+    writeFile(f"{wd}/a/gen/g.txt", "generated\n")
+    writeFile(f"{wd}/a/a1.txt", "modified\n")
+
+    rw = mainWindow.openRepo(wd)
+    cache = rw.repoModel.untrackedCache
+
+    def assertSameAsWithoutCache():
+        fullDiff = rw.repo.get_unstaged_changes()
+        assert qlvGetRowData(rw.dirtyFiles) == [delta.new_file.path for delta in fullDiff.deltas]
+
+    # The initial load doesn't bother with the cache
+    assert cache.primed
+    assert cache.untracked_diff is None
+    assertSameAsWithoutCache()
+
+    rw.refreshRepo()
+    assert cache.untracked_dirs == ["a/gen/", "build/"]
+    assertSameAsWithoutCache()
+    assert qlvGetRowData(rw.dirtyFiles) == [".gitignore", "a/a1.txt", "a/gen/g.txt", "build/x/1.txt", "build2.txt"]
+
+    # The cached diff is reused if nothing has changed
+    cachedDiff = cache.untracked_diff
+    rw.refreshRepo()
+    assert cache.untracked_diff is cachedDiff
+    assertSameAsWithoutCache()
+
+    # New files in an untracked directory
+    writeFile(f"{wd}/build/x/y/3.txt", "3\n")
+    rw.refreshRepo()
+    assert "build/x/y/3.txt" in qlvGetRowData(rw.dirtyFiles)
+    assertSameAsWithoutCache()
+
+    # New ignore rules
+    writeFile(f"{wd}/build/.gitignore", "*.txt\n")
+    rw.refreshRepo()
+    assert qlvGetRowData(rw.dirtyFiles) == [".gitignore", "a/a1.txt", "a/gen/g.txt", "build/.gitignore", "build2.txt"]
+    assertSameAsWithoutCache()
+
+    # A directory that gains a tracked file isn't untracked anymore
+    with RepoContext(wd, write_index=True) as repo2:
+        repo2.index.add("a/gen/g.txt")
+    rw.refreshRepo()
+    assert cache.untracked_dirs == ["build/"]
+    assert "a/gen/g.txt" in qlvGetRowData(rw.stagedFiles)
+    assertSameAsWithoutCache()
+
+    # Honor core.untrackedCache=false
+    with RepoContext(wd) as repo2:
+        repo2.config["core.untrackedCache"] = False
+    assert not UntrackedCache.is_enabled(rw.repo)
+
+
+def testDetectRenamesInBackground(tempDir, mainWindow, qtbot, monkeypatch):
+    from gitfourchette.tasks import loadtasks
+    monkeypatch.setattr(loadtasks, "RENAME_COUNT_THRESHOLD", 1)
+
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    oid = Oid(hex="ce112d052bcf42442aa8563f1e2b7a8aabbf4d17")
+
+    # The commit is loaded without rename detection at first
+    rw.jump(NavLocator.inCommit(oid, "c/c2-2.txt"))
+    assert rw.committedFiles.skippedRenameDetection
+    assert qlvGetRowData(rw.committedFiles) == ["c/c2-2.txt", "c/c2.txt"]
+
+    # Then the commit is reloaded with the complete diffs, on the same file
+    qtbot.waitUntil(lambda: not rw.committedFiles.skippedRenameDetection)
+    assert rw.renameDetection is None
+    assert qlvGetRowData(rw.committedFiles) == ["c/c2-2.txt"]
+    assert rw.navLocator.isSimilarEnoughTo(NavLocator.inCommit(oid, "c/c2-2.txt"))
+    assert "1 rename detected" in rw.diffBanner.label.text()
+
+    # Coming back to the commit later uses the complete diffs from the cache
+    rw.jump(NavLocator.inCommit(rw.repo.head_commit_id))
+    rw.jump(NavLocator.inCommit(oid))
+    assert not rw.committedFiles.skippedRenameDetection
+    assert qlvGetRowData(rw.committedFiles) == ["c/c2-2.txt"]
+
+
+def testCancelRenameDetectionWithoutBlocking(tempDir, mainWindow, qtbot, monkeypatch):
+    from gitfourchette.tasks import loadtasks
+    monkeypatch.setattr(loadtasks, "RENAME_COUNT_THRESHOLD", 1)
+
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    oid = Oid(hex="ce112d052bcf42442aa8563f1e2b7a8aabbf4d17")
+    rw.jump(NavLocator.inCommit(oid, "c/c2-2.txt"))
+    qtbot.waitUntil(lambda: rw.renameDetection is None)
+
+    # Stall the thread while it's diffing the commit
+    gate = threading.Event()
+    thread = loadtasks.RenameDetectionThread(rw, oid, 3)
+    assert thread.repo is not rw.repo
+    commitDiffs = thread.repo.commit_diffs
+    thread.repo.commit_diffs = lambda *args, **kwargs: gate.wait(10) and commitDiffs(*args, **kwargs)
+    cachedEntry = rw.repoModel.commitDiffCache.entries[(oid, 3)]
+    rw.renameDetection = thread
+    thread.start()
+
+    # Cancelling returns right away, and the thread drops its results once it's done
+    thread.cancel()
+    assert rw.renameDetection is None
+    assert thread.isRunning()
+    with qtbot.waitSignal(thread.finished):
+        gate.set()
+    assert not thread.done
+    assert rw.repoModel.commitDiffCache.entries[(oid, 3)] is cachedEntry
@@ -5,19 +5,23 @@
 # -----------------------------------------------------------------------------
 
 import os.path
+import threading
 from contextlib import suppress
 
 import pytest
 
+from gitfourchette import tasks
 from gitfourchette.application import GFApplication
 from gitfourchette.forms.commitdialog import CommitDialog
 from gitfourchette.forms.donateprompt import DonatePrompt
 from gitfourchette.forms.reposettingsdialog import RepoSettingsDialog
 from gitfourchette.forms.unloadedrepoplaceholder import UnloadedRepoPlaceholder
-from gitfourchette.graphview.commitlogmodel import SpecialRow
+from gitfourchette.graph import GraphBuildLoop, GraphDiagram
+from gitfourchette.graphview.commitlogmodel import CommitLogModel, SpecialRow
 from gitfourchette.mainwindow import MainWindow
 from gitfourchette.nav import NavLocator, NavContext
 from gitfourchette.sidebar.sidebarmodel import SidebarItem
+from gitfourchette.toolbox import makeInternalLink, SizeBoundedLRU
 from .util import *
 
 
@@ -235,6 +239,9 @@ def testTruncatedHistory(tempDir, mainWindow, method):
         qteClickLink(rw.specialDiffView, "load full")
     elif method == "graphcm":
         triggerMenuAction(rw.graphView.makeContextMenu(), "load full")
+    # The rest of the history is loaded in the background
+    if rw.graphBuild is not None:
+        rw.graphBuild.join()
     assert 7 < rw.graphView.clFilter.rowCount()
 
     # Truncated history row must be gone
@@ -249,6 +256,144 @@ def testTruncatedHistory(tempDir, mainWindow, method):
     assert not rw.diffBanner.isVisibleTo(rw)
 
 
+@pytest.mark.parametrize("maxCommits", [0, 5])
+def testProgressiveGraphBuild(tempDir, mainWindow, monkeypatch, maxCommits):
+    from gitfourchette.tasks import PrimeRepo, GraphBuildThread
+    monkeypatch.setattr(PrimeRepo, "FirstBatchSize", 3)
+    monkeypatch.setattr(GraphBuildThread, "BatchSize", 2)
+
+    mainWindow.onAcceptPrefsDialog({"maxCommits": maxCommits})
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    clModel = rw.graphView.clModel
+
+    # The first batch is shown right away; the rest of the graph may still be building
+    assert clModel.numCommitRows >= 4
+    if rw.graphBuild is not None:
+        rw.graphBuild.join()
+    # A truncated build sticks around so it can be resumed later
+    assert (rw.graphBuild is not None) == bool(maxCommits)
+
+    repoModel = rw.repoModel
+    repoModel.graph.testConsistency()
+    assert clModel.numCommitRows == len(repoModel.commitSequence)
+    assert repoModel.graph.keyframeRows == sorted(repoModel.graph.keyframeRows)
+
+    walker = rw.repo.walk(None, repoModel.walkerSortMode())
+    for tip in repoModel.refs.values():
+        walker.push(tip)
+    walkerIds = [c.id for c in walker]
+    sequenceIds = [c.id for c in repoModel.commitSequence[1:]]
+
+    lastRow = clModel.index(clModel.rowCount() - 1, 0)
+    if maxCommits:
+        assert repoModel.truncatedHistory
+        assert sequenceIds == walkerIds[:maxCommits]
+        assert lastRow.data(CommitLogModel.Role.SpecialRow) == SpecialRow.TruncatedHistory
+    else:
+        assert not repoModel.truncatedHistory
+        assert sequenceIds == walkerIds
+        assert lastRow.data(CommitLogModel.Role.SpecialRow) == SpecialRow.Commit
+
+    # The complete graph can be spliced
+    with RepoContext(wd) as repo:
+        newOid = repo.create_commit_on_head("new commit on top", TEST_SIGNATURE, TEST_SIGNATURE)
+    rw.refreshRepo()
+    assert repoModel.commitSequence[1].id == newOid
+    assert clModel.numCommitRows == len(repoModel.commitSequence)
+    repoModel.graph.testConsistency()
+
+
+def testRefreshWhileGraphIsBuilding(tempDir, mainWindow, monkeypatch):
+    from gitfourchette.tasks import PrimeRepo, GraphBuildThread
+    from gitfourchette.tasks.loadtasks import GraphBuildJob
+    monkeypatch.setattr(PrimeRepo, "FirstBatchSize", 3)
+    monkeypatch.setattr(GraphBuildThread, "BatchSize", 2)
+
+    # Hold the build thread back until we're done poking at the UI
+    gate = threading.Event()
+    originalStep = GraphBuildJob.step
+
+    def gatedStep(job, batchSize):
+        if threading.current_thread() is not threading.main_thread():
+            assert gate.wait(timeout=10)
+        originalStep(job, batchSize)
+
+    monkeypatch.setattr(GraphBuildJob, "step", gatedStep)
+
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    repoModel = rw.repoModel
+    assert not rw.graphBuild.wrappedUp
+
+    # The build thread walks through a repo handle of its own
+    job = rw.graphBuild.job
+    assert job.repo is not None
+    assert job.repo is not repoModel.repo
+
+    # The refresh mustn't wait for the graph; the new commit is spliced in once the graph is complete
+    with RepoContext(wd) as repo:
+        newOid = repo.create_commit_on_head("new commit on top", TEST_SIGNATURE, TEST_SIGNATURE)
+    rw.refreshRepo()
+    assert repoModel.refs["HEAD"] == newOid
+    assert repoModel.unsplicedRefs is not None
+    assert newOid not in repoModel.graph.commitRows
+
+    # Hiding a branch is deferred until the graph is complete, too
+    rw.toggleHideRefPattern("refs/heads/no-parent")
+    assert not repoModel.hiddenRefs
+
+    gate.set()
+    rw.graphBuild.join()
+    assert rw.graphBuild is None
+    assert job.repo is None  # released once the graph is complete
+    assert repoModel.unsplicedRefs is None
+    assert repoModel.commitSequence[1].id == newOid
+    assert rw.graphView.clModel.numCommitRows == len(repoModel.commitSequence)
+    assert repoModel.hiddenRefs == {"refs/heads/no-parent"}
+    repoModel.graph.testConsistency()
+
+
+def testResumeTruncatedHistory(tempDir, mainWindow):
+    mainWindow.onAcceptPrefsDialog({"maxCommits": 5})
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    repoModel = rw.repoModel
+    graph = repoModel.graph
+    assert repoModel.numRealCommits == 5
+    assert rw.graphBuild.canResume()
+
+    walker = rw.repo.walk(None, repoModel.walkerSortMode())
+    for tip in repoModel.refs.values():
+        walker.push(tip)
+    walkerIds = [c.id for c in walker]
+
+    # Load more history: the walk must resume without rebuilding the graph from scratch
+    rw.processInternalLink(makeInternalLink("expandlog", n="12"))
+    rw.graphBuild.join()
+    assert rw.repoModel is repoModel
+    assert repoModel.graph is graph
+    assert [c.id for c in repoModel.commitSequence[1:]] == walkerIds[:12]
+    assert rw.graphView.clModel.numCommitRows == 13
+    graph.testConsistency()
+
+    # The resumed graph must be identical to one built in one go
+    verification = GraphBuildLoop(heads=repoModel.getKnownTips()).sendAll(repoModel.commitSequence).graph
+    assert GraphDiagram.diagram(graph) == GraphDiagram.diagram(verification)
+
+    # Splicing new commits in makes the walk non-resumable; fall back to reloading the repo
+    with RepoContext(wd) as repo:
+        repo.create_commit_on_head("new commit on top", TEST_SIGNATURE, TEST_SIGNATURE)
+    rw.refreshRepo()
+    assert rw.graphBuild is None
+    rw.processInternalLink(makeInternalLink("expandlog", n="0"))
+    if rw.graphBuild is not None:
+        rw.graphBuild.join()
+    assert rw.repoModel is not repoModel
+    assert not rw.repoModel.truncatedHistory
+    assert rw.repoModel.numRealCommits == len(walkerIds) + 1
+
+
 def testRepoNickname(tempDir, mainWindow):
     wd = unpackRepo(tempDir)
     rw = mainWindow.openRepo(wd)
@@ -617,3 +762,120 @@ def testConfigFileScrubbing(tempDir, mainWindow):
 
     assert b'[branch "master"]' not in readFile(configPath)
     assert b'[branch "scrubme"]' not in readFile(configPath)
+
+
+def testViewTasksRunAlongsideNetworkTask(tempDir, mainWindow, taskThread, qtbot):
+    gate = threading.Event()
+
+    class SlowNetworkTask(tasks.RepoTask):
+        def lane(self):
+            return tasks.TaskLane.Network
+
+        def canRunAlongside(self, task):
+            return task.lane() == tasks.TaskLane.View
+
+        def flow(self):
+            yield from self.flowEnterWorkerThread()
+            gate.wait(10)
+
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    runner = rw.repoTaskRunner
+    qtbot.waitUntil(lambda: not runner.isBusy())
+
+    rw.runTask(SlowNetworkTask)
+    assert runner.isBusy(tasks.TaskLane.Network)
+
+    # Browsing isn't blocked by the network task
+    oid = rw.repo.head_commit.parent_ids[0]
+    rw.jump(NavLocator.inCommit(oid))
+    qtbot.waitUntil(lambda: rw.navLocator.commit == oid and not runner.isBusy(tasks.TaskLane.View))
+    assert runner.isBusy(tasks.TaskLane.Network)
+
+    # Tasks that don't agree to run alongside it must still wait
+    rw.runTask(SlowNetworkTask)
+    rejectQMessageBox(rw, "please wait for the current operation")
+
+    gate.set()
+    qtbot.waitUntil(lambda: not runner.isBusy())
+
+
+def testPrefetchNeighbors(tempDir, mainWindow, taskThread, qtbot):
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    runner = rw.repoTaskRunner
+    qtbot.waitUntil(lambda: not runner.isBusy())
+    repoModel = rw.repoModel
+
+    oid = rw.repo.head_commit.parent_ids[0]
+    nextOid = rw.repo[oid].parent_ids[0]
+    rw.jump(NavLocator.inCommit(oid))
+    qtbot.waitUntil(lambda: rw.prefetchedLocator.commit == oid and not runner.isBusy())
+
+    # The commits around the current commit have been loaded ahead of time
+    assert (rw.repo.head_commit_id, 3) in repoModel.commitDiffCache.entries
+    assert (nextOid, 3) in repoModel.commitDiffCache.entries
+    (prefetchedDiffs, _skippedRenameDetection), _numDeltas = repoModel.commitDiffCache.entries[(nextOid, 3)]
+
+    # Stepping to the next commit uses the prefetched diffs and layout
+    hits = repoModel.diffDocumentCache.hits
+    rw.jump(NavLocator.inCommit(nextOid))
+    qtbot.waitUntil(lambda: rw.navLocator.commit == nextOid and not runner.isBusy(tasks.TaskLane.View))
+    assert rw.committedFiles.flModel.entries[0].diff is prefetchedDiffs[0]
+    assert repoModel.diffDocumentCache.hits == hits + 1
+    qtbot.waitUntil(lambda: not runner.isBusy())
+
+    # Any other task interrupts the prefetcher
+    gate = threading.Event()
+    steps = []
+
+    class SlowPrefetch(tasks.RepoTask):
+        def lane(self):
+            return tasks.TaskLane.Prefetch
+
+        def flow(self):
+            for step in range(2):
+                yield from self.flowEnterWorkerThread()
+                steps.append(step)
+                gate.wait(10)
+
+    busyMessages = []
+    runner.progress.connect(lambda message, _busy: busyMessages.append(message))
+    rw.runTask(SlowPrefetch)
+    qtbot.waitUntil(lambda: steps == [0])
+    assert not any(busyMessages)  # Speculative work doesn't show as busy
+    rw.jump(NavLocator.inCommit(oid))
+    gate.set()
+    qtbot.waitUntil(lambda: rw.navLocator.commit == oid and not runner.isBusy(tasks.TaskLane.View))
+    assert steps == [0]
+
+
+def testSizeBoundedLRU():
+    class LengthLRU(SizeBoundedLRU[str, str]):
+        MaxSize = 10
+
+        def sizeOf(self, value: str) -> int:
+            return len(value)
+
+    cache = LengthLRU()
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb")
+    assert cache.get("a") == "aaaa"  # "b" is now the least recently used entry
+
+    # Evict least recently used entries to make room
+    cache.put("c", "cccc")
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.totalSize == 8
+
+    # Don't cache values that are too large, nor values that callers reject
+    cache.put("d", "d" * 11)
+    assert "d" not in cache
+    cache.put("a", "AA", replace=lambda previous: previous != "aaaa")
+    assert cache.get("a") == "aaaa"
+    assert cache.get("a", accept=lambda value: value.isupper()) is None
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    cache.clear()
+    assert not cache.entries
+    assert cache.totalSize == 0
@@ -0,0 +1,94 @@
+# -----------------------------------------------------------------------------
+# Copyright (C) 2024 Iliyas Jorio.
+# This file is part of GitFourchette, distributed under the GNU GPL v3.
+# For full terms, see the included LICENSE file.
+# -----------------------------------------------------------------------------
+
+import io
+import os
+
+import pytest
+
+from gitfourchette.graph import *
+from gitfourchette.repomodel import GRAPH_CACHE_FILENAME
+from .test_graphsplicer import KF_INTERVAL_TEST, SCENARIOS
+from .util import *
+
+
+def roundTrip(graph, sequence, heads) -> GraphCache:
+    buffer = io.BytesIO()
+    GraphCache(graph, sequence, heads, truncated=True).dump(buffer)
+    buffer.seek(0)
+    return GraphCache.load(buffer)
+
+
+@pytest.mark.parametrize('scenarioKey', SCENARIOS.keys())
+def testGraphCacheRoundTrip(scenarioKey):
+    textGraph1, textGraph2, _ = SCENARIOS[scenarioKey]
+    sequence1, heads1 = GraphDiagram.parseDefinition(textGraph1)
+    sequence2, heads2 = GraphDiagram.parseDefinition(textGraph2)
+
+    original = GraphBuildLoop(keyframeInterval=KF_INTERVAL_TEST).sendAll(sequence1).graph
+    cache = roundTrip(original, sequence1, heads1)
+    g = cache.graph
+
+    assert cache.truncated
+    assert set(cache.tips) == set(heads1)
+    assert [(c.id, list(c.parent_ids)) for c in cache.sequence] == [(c.id, list(c.parent_ids)) for c in sequence1]
+    assert g.keyframeRows == original.keyframeRows
+    assert GraphDiagram.diagram(g, verbose=True) == GraphDiagram.diagram(original, verbose=True)
+    g.testConsistency()
+
+    # The restored graph must be spliceable just like the original one
+    spliceLoop = GraphSpliceLoop(g, cache.sequence, heads1, heads2, keyframeInterval=KF_INTERVAL_TEST)
+    spliceLoop.sendAll(sequence2)
+    g.testConsistency()
+    assert [c.id for c in sequence2] == [c.id for c in spliceLoop.commitSequence]
+
+    verification = GraphBuildLoop().sendAll(sequence2).graph
+    g.keyframes = []
+    g.keyframeRows = []
+    assert GraphDiagram.diagram(g, verbose=True) == GraphDiagram.diagram(verification, verbose=True)
+
+
+@pytest.mark.parametrize("damage", ["magic", "truncate"])
+def testGraphCacheRejectsDamagedFile(damage):
+    sequence, heads = GraphDiagram.parseDefinition("a-b:c,d c:e d-e-f")
+    graph = GraphBuildLoop(keyframeInterval=KF_INTERVAL_TEST).sendAll(sequence).graph
+
+    buffer = io.BytesIO()
+    GraphCache(graph, sequence, heads).dump(buffer)
+    data = buffer.getvalue()
+
+    if damage == "magic":
+        data = b"X" + data[1:]
+    else:
+        data = data[:-5]
+
+    with pytest.raises((GraphCacheError, EOFError)):
+        GraphCache.load(io.BytesIO(data))
+
+
+def testReopenRepoWithGraphCache(tempDir, mainWindow):
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    cachePath = os.path.join(rw.repo.path, GRAPH_CACHE_FILENAME)
+    assert os.path.isfile(cachePath)
+    oldSequence = [c.id for c in rw.repoModel.commitSequence]
+    mainWindow.closeCurrentTab()
+
+    # Advance master outside the app
+    with RepoContext(wd) as repo:
+        newOid = repo.create_commit_on_head("new commit on top", TEST_SIGNATURE, TEST_SIGNATURE)
+
+    rw = mainWindow.openRepo(wd)
+    repoModel = rw.repoModel
+    newSequence = [c.id for c in repoModel.commitSequence]
+    assert newSequence == oldSequence[:1] + [newOid] + oldSequence[1:]
+    assert repoModel.graph.getCommitRow(newOid) == 1
+    repoModel.graph.testConsistency()
+
+    # Cache must have been refreshed to include the new commit
+    cache = GraphCache.read(cachePath)
+    assert newOid in cache.tips
+    assert [c.id for c in cache.sequence] == newSequence
@@ -217,3 +217,59 @@ def testVisibleJunctionOnHiddenArc():
     assert laneRemap['d'] == [(0, 0), (1, 1), (2, 2)]
     assert laneRemap['e'] == [(0, 0), (1, 1), (2, 2)]
     assert laneRemap['z'] == [(0, X), (1, X), (2, X)]
+
+
+def testAdaptiveKeyframes():
+    # Long graph with a side branch every few commits
+    definition = " ".join(f"m{i}:m{i+1},f{i} f{i}:m{i+1}" for i in range(1000)) + " m1000"
+    sequence, heads = GraphDiagram.parseDefinition(definition)
+    graph = GraphBuildLoop(heads, keyframeInterval=1000).sendAll(sequence).graph
+    permanentRows = list(graph.keyframeRows)
+
+    replays = []
+    graph.onReplay = lambda goalRow, numRows: replays.append(numRows)
+
+    # Jumping deep into the graph replays a long stretch once...
+    frame = graph.getFrame(900)
+    assert replays[-1] == 900
+
+    # ...then the neighborhood is cheap to revisit
+    for row in range(901, 940):
+        assert graph.getFrame(row).commit == sequence[row].id
+    assert max(replays[1:]) <= 32
+    assert graph.getFrame(900) == frame
+
+    # Volatile keyframes are evicted past the memory budget; permanent ones stay
+    graph.maxVolatileKeyframes = 10
+    for row in range(0, len(sequence), 37):
+        assert graph.getFrame(row).commit == sequence[row].id
+    assert len(graph.volatileKeyframeUse) <= 10
+    assert all(row in graph.keyframeRows for row in permanentRows)
+    graph.testConsistency()
+
+    # Keyframes placed ahead of time around interesting rows (e.g. branch tips)
+    graph.placeKeyframes([1500])
+    replays.clear()
+    graph.getFrame(1490)
+    assert replays[-1] < 32
+
+
+def testShallowCopyOwnsKeyframes():
+    definition = " ".join(f"m{i}:m{i+1},f{i} f{i}:m{i+1}" for i in range(500)) + " m500"
+    sequence, heads = GraphDiagram.parseDefinition(definition)
+    source = GraphBuildLoop(heads, keyframeInterval=1000).sendAll(sequence).graph
+    source.getFrame(800)  # leave volatile keyframes behind
+
+    graph = Graph()
+    graph.shallowCopyFrom(source)
+    rows = list(source.keyframeRows)
+    use = dict(source.volatileKeyframeUse)
+
+    # Mutating the copy's keyframes mustn't touch the source's
+    graph.maxVolatileKeyframes = 2
+    graph.placeKeyframes([300, 600, 900])
+    graph.evictColdKeyframes()
+    assert source.keyframeRows == rows
+    assert source.volatileKeyframeUse == use
+    assert len(source.keyframes) == len(rows)
+    graph.testConsistency()
@@ -7,12 +7,26 @@
 import pygit2.enums
 import pytest
 
+from gitfourchette import pickaxe
 from gitfourchette.graphview.commitlogmodel import SpecialRow
+from gitfourchette.graphview.commitsearch import CommitSearch
 from gitfourchette.nav import NavLocator
+from gitfourchette.searchindex import CommitSearchIndex
 from .util import *
 
 
-def testCommitSearch(tempDir, mainWindow):
+def openRepoWithSearchIndex(wd, mainWindow, monkeypatch):
+    monkeypatch.setattr(CommitSearchIndex, "MinCommits", 0)
+    rw = mainWindow.openRepo(wd)
+    if rw.searchIndexBuild is not None:
+        assert rw.searchIndexBuild.repo is not rw.repo
+        rw.searchIndexBuild.wait()
+    assert rw.repoModel.searchIndex.complete
+    return rw
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def testCommitSearch(tempDir, mainWindow, monkeypatch, indexed):
     # Commits that contain "first" in their summary
     matchingCommits = [
         Oid(hex="6462e7d8024396b14d7651e2ec11e2bbf07a05c4"),
@@ -24,7 +38,11 @@ def testCommitSearch(tempDir, mainWindow):
     ]
 
     wd = unpackRepo(tempDir)
-    rw = mainWindow.openRepo(wd)
+    if indexed:
+        rw = openRepoWithSearchIndex(wd, mainWindow, monkeypatch)
+    else:
+        rw = mainWindow.openRepo(wd)
+        assert rw.repoModel.searchIndex is None
 
     searchBar = rw.graphView.searchBar
     searchEdit = searchBar.lineEdit
@@ -153,6 +171,152 @@ def testCommitSearchByAuthor(tempDir, mainWindow):
         assert oid == rw.graphView.currentCommitId
 
 
+@pytest.mark.parametrize("indexed", [False, True])
+def testCommitSearchInBackground(tempDir, mainWindow, monkeypatch, qtbot, indexed):
+    # Commits that contain "first" in their summary, in graph order
+    matchingCommits = [
+        Oid(hex="6462e7d8024396b14d7651e2ec11e2bbf07a05c4"),
+        Oid(hex="42e4e7c5e507e113ebbb7801b16b52cf867b7ce1"),
+        Oid(hex="d31f5a60d406e831d056b8ac2538d515100c2df2"),
+        Oid(hex="83d2f0431bcdc9c2fd2c17b828143be6ee4fbe80"),
+        Oid(hex="2c349335b7f797072cf729c4f3bb0914ecb6dec9"),
+        Oid(hex="ac7e7e44c1885efb472ad54a78327d66bfc4ecef"),
+    ]
+
+    monkeypatch.setattr(CommitSearch, "SyncThreshold", 0)
+    monkeypatch.setattr(CommitSearch, "ChunkSize", 2)
+
+    wd = unpackRepo(tempDir)
+    if indexed:
+        rw = openRepoWithSearchIndex(wd, mainWindow, monkeypatch)
+    else:
+        rw = mainWindow.openRepo(wd)
+    graphView = rw.graphView
+    searchBar = graphView.searchBar
+    searchEdit = searchBar.lineEdit
+    matchCountLabel = searchBar.ui.matchCountLabel
+
+    QTest.keySequence(mainWindow, "Ctrl+F")
+
+    # A new keystroke cancels the search in flight
+    QTest.keyClicks(searchEdit, "fir")
+    graphView.ensureCommitSearch()
+    firstJob = graphView.commitSearch
+    assert firstJob.repo is not rw.repo
+    QTest.keyClicks(searchEdit, "st")
+    assert firstJob.cancelled
+    assert graphView.commitSearch is None
+    assert not matchCountLabel.isVisible()
+
+    # Hit Return right away: the selection should follow once the hits come in
+    QTest.keySequence(searchEdit, "Return")
+    qtbot.waitUntil(lambda: graphView.searchComplete)
+    assert graphView.currentCommitId == matchingCommits[0]
+    assert matchCountLabel.isVisible()
+    assert "6 matches" in matchCountLabel.text()
+
+    sourceRows = [graphView.clModel._commitSequence.oidAt(row) for row in graphView.searchHits]
+    assert sourceRows == matchingCommits
+
+    # Step through the precomputed hits, with wraparound
+    for oid in matchingCommits[1:] + matchingCommits[:1]:
+        QTest.keySequence(searchEdit, "Return")
+        assert graphView.currentCommitId == oid
+    for oid in reversed(matchingCommits):
+        QTest.keySequence(searchEdit, "Shift+Return")
+        assert graphView.currentCommitId == oid
+
+    # Nothing found
+    searchEdit.selectAll()
+    QTest.keyClicks(searchEdit, "bogus search term")
+    QTest.keySequence(searchEdit, "Return")
+    qtbot.waitUntil(lambda: graphView.searchComplete)
+    assert "0 matches" in matchCountLabel.text()
+    rejectQMessageBox(searchBar, "not found")
+
+
+@pytest.mark.parametrize("pool", [False, True])
+def testCommitContentSearch(tempDir, mainWindow, monkeypatch, qtbot, pool):
+    # Commits that change the number of occurrences of "c2" in any file (git log -S c2)
+    matchingCommits = {
+        Oid(hex="c9ed7bf12c73de26422b7c5a44d74cfce5a8993b"),
+        Oid(hex="ce112d052bcf42442aa8563f1e2b7a8aabbf4d17"),
+        Oid(hex="1203b03dc816ccbb67773f28b3c19318654b0bc8"),
+        Oid(hex="6462e7d8024396b14d7651e2ec11e2bbf07a05c4"),
+    }
+
+    if pool:
+        monkeypatch.setattr(pickaxe, "MinCommitsPerWorker", 1)
+        monkeypatch.setattr(pickaxe, "ShardSize", 3)
+        monkeypatch.setattr("os.cpu_count", lambda: 2)
+
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+    graphView = rw.graphView
+    searchBar = graphView.searchBar
+    searchEdit = searchBar.lineEdit
+
+    QTest.keySequence(mainWindow, "Ctrl+F")
+    graphView.contentSearchAction.setChecked(True)
+    QTest.keyClicks(searchEdit, "c2")
+    QTest.keySequence(searchEdit, "Return")
+    qtbot.waitUntil(lambda: graphView.searchComplete, timeout=30_000)
+    assert "4 matches" in searchBar.ui.matchCountLabel.text()
+
+    hits = [graphView.clModel._commitSequence.oidAt(row) for row in graphView.searchHits]
+    assert set(hits) == matchingCommits
+    assert graphView.currentCommitId == hits[0]
+
+    # Back to regular search
+    graphView.contentSearchAction.setChecked(False)
+    searchEdit.selectAll()
+    QTest.keyClicks(searchEdit, "First")
+    QTest.keySequence(searchEdit, "Return")
+    assert graphView.currentCommitId == Oid(hex="6462e7d8024396b14d7651e2ec11e2bbf07a05c4")
+
+    # Commit messages are out of scope in content mode
+    graphView.contentSearchAction.setChecked(True)
+    QTest.keySequence(searchEdit, "Return")
+    qtbot.waitUntil(lambda: graphView.searchComplete, timeout=30_000)
+    assert "0 matches" in searchBar.ui.matchCountLabel.text()
+    rejectQMessageBox(searchBar, "not found")
+
+
+def testCommitSearchIndexCandidates(tempDir, mainWindow, monkeypatch):
+    wd = unpackRepo(tempDir)
+    rw = openRepoWithSearchIndex(wd, mainWindow, monkeypatch)
+    repoModel = rw.repoModel
+    searchIndex = repoModel.searchIndex
+    commits = [c for c in repoModel.commitSequence if type(c.id) is Oid]
+    assert searchIndex.oidLength == rw.repo.oid_length
+    assert len(searchIndex) == len(commits)
+
+    for term in ["first", "irs", "a u thor", "thor@example.com", "c/c2-2.txt", "merge branch 'a'", "c9ed7bf", "42e4e7c"]:
+        candidates = searchIndex.lookUp(term, likelyHash=bool(re.fullmatch(r"[0-9a-f]+", term)))
+        expected = {c.id for c in commits
+                    if term in c.message.lower() or term in c.author.name.lower() or term in c.author.email.lower()
+                    or str(c.id).startswith(term)}
+        assert expected
+        assert expected.issubset(candidates), term
+
+    assert len(searchIndex.lookUp("first")) < len(commits)
+
+    # Terms without any long enough words can't be narrowed down
+    assert searchIndex.lookUp("a u") is None
+
+    # New commits must be indexed as they're spliced into the graph
+    with RepoContext(wd) as repo:
+        newOid = repo.create_commit_on_head("Xylophone quintessence", TEST_SIGNATURE, TEST_SIGNATURE)
+    rw.refreshRepo()
+    assert rw.repoModel.searchIndex is searchIndex
+    assert searchIndex.lookUp("phone quint") == [newOid]
+
+    QTest.keySequence(mainWindow, "Ctrl+F")
+    QTest.keyClicks(rw.graphView.searchBar.lineEdit, "phone quint")
+    QTest.keySequence(rw.graphView.searchBar.lineEdit, "Return")
+    assert rw.graphView.currentCommitId == newOid
+
+
 @pytest.mark.parametrize("method", ["hotkey", "contextmenu"])
 def testCommitInfo(tempDir, mainWindow, method):
     oid1 = Oid(hex="83834a7afdaa1a1260568567f6ad90020389f664")
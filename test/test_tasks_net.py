@@ -546,3 +546,22 @@ def testPushDeleteTag(tempDir, mainWindow):
 
     with RepoContext(barePath) as bareRepo:
         assert "etiquette" not in bareRepo.listall_tags()
+
+
+def testNetworkTasksHaveTheirOwnRepo(tempDir, mainWindow):
+    from gitfourchette import tasks
+    wd = unpackRepo(tempDir)
+    rw = mainWindow.openRepo(wd)
+
+    # Network tasks may run while View tasks read from RepoModel.repo
+    for taskClass in [tasks.FetchRemotes, tasks.PushBranch]:
+        task = taskClass(rw)
+        task.setRepoModel(rw.repoModel)
+        assert task.repo is not rw.repo
+        assert task.repo.workdir == rw.repo.workdir
+        assert task.canRunAlongside(tasks.Jump(rw))
+
+    # Tasks that touch the working directory run in the Main lane with the shared repo
+    task = tasks.PullBranch(rw)
+    task.setRepoModel(rw.repoModel)
+    assert task.repo is rw.repo